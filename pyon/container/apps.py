@@ -87,6 +87,9 @@ class AppManager(object):
                     dict_merge(rel_cfg, config, inplace=True)
                 self.start_app_from_url(app_file_path, config=rel_cfg)
 
+        # Write deferred registrations of all processes started for the rel
+        self.container.proc_manager.flush_registrations()
+
     def start_app_from_url(self, app_url="", config=None):
         """
         @brief Read the app file and call start_app
@@ -149,6 +152,8 @@ class AppManager(object):
             except Exception:
                 log.exception("Appl %s start from appdef failed" % appdef.name)
 
+        self.container.proc_manager.flush_registrations()
+
     def stop_app(self, appdef):
         log.debug("App '%s' stopping" % appdef.name)
         try:
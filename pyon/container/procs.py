@@ -10,6 +10,7 @@ import re
 
 from couchdb.http import ResourceNotFound
 from gevent.coros import RLock
+import gevent
 
 from pyon.agent.agent import ResourceAgent
 from pyon.agent.simple_agent import SimpleResourceAgent
@@ -18,6 +19,7 @@ from pyon.core.bootstrap import CFG, IonObject, get_sys_name
 from pyon.core.exception import ContainerConfigError, BadRequest, NotFound
 from pyon.ion.endpoint import ProcessRPCServer
 from pyon.ion.conversation import ConversationRPCServer
+from pyon.ion.identifier import create_unique_resource_id
 from pyon.ion.stream import StreamPublisher, StreamSubscriber
 from pyon.ion.process import IonProcessThreadManager, IonProcessError
 from pyon.net.messaging import IDPool
@@ -38,6 +40,10 @@ STANDALONE_PROCESS_TYPE = 'standalone'
 IMMEDIATE_PROCESS_TYPE = 'immediate'
 SIMPLE_PROCESS_TYPE = 'simple'
 
+DEFAULT_REGISTRATION_CONFIG = {"deferred": False,       # Queue process registrations and write them in batches
+                               "flush_interval": 0.5,   # Seconds after first queued registration until flush
+                               }
+
 
 class ProcManager(object):
     def __init__(self, container):
@@ -65,6 +71,13 @@ class ProcManager(object):
         # list of callbacks for process state changes
         self._proc_state_change_callbacks = []
 
+        # Deferred process registration: processes are registered in batches by flush_registrations
+        self.registration_cfg = DEFAULT_REGISTRATION_CONFIG.copy()
+        self.registration_cfg.update(CFG.get_safe("container.processes.registration", None) or {})
+        self._pending_regs = []
+        self._reg_lock = RLock()
+        self._reg_timer = None
+
     def start(self):
         log.debug("ProcManager starting ...")
         self.proc_sup.start()
@@ -97,6 +110,10 @@ class ProcManager(object):
             except Exception as ex:
                 log.warn("Failed to terminate process (%s): %s", proc.id, ex)
 
+        if self._reg_timer:
+            self._reg_timer.kill()
+            self._reg_timer = None
+
         # TODO: Have a choice of shutdown behaviors for waiting on children, timeouts, etc
         self.proc_sup.shutdown(CFG.cc.timeout.shutdown)
 
@@ -787,6 +804,11 @@ class ProcManager(object):
             process_instance._process.notify_stop()
             process_instance._process.stop()
 
+        # Close the shared RPC reply queue if the process' clients used multiplexed mode
+        if getattr(process_instance, '_rpc_multiplexer', None) is not None:
+            process_instance._rpc_multiplexer.close()
+            process_instance._rpc_multiplexer = None
+
     def _set_publisher_endpoints(self, process_instance, publisher_streams=None):
 
         publisher_streams = publisher_streams or {}
@@ -817,6 +839,11 @@ class ProcManager(object):
         # processes. How to deal with this?
         process_instance.errcause = "registering"
 
+        if self.registration_cfg["deferred"] and process_instance._proc_type != IMMEDIATE_PROCESS_TYPE:
+            self._defer_registration(process_instance)
+            self._call_proc_state_changed(process_instance, ProcessStateEnum.RUNNING)
+            return
+
         if process_instance._proc_type != IMMEDIATE_PROCESS_TYPE:
             if self.container.has_capability(self.container.CCAP.RESOURCE_REGISTRY):
                 proc_obj = Process(name=process_instance.id, label=name, proctype=process_instance._proc_type)
@@ -871,6 +898,126 @@ class ProcManager(object):
 
         self._call_proc_state_changed(process_instance, ProcessStateEnum.RUNNING)
 
+    def _defer_registration(self, process_instance):
+        """
+        Queues the registration of a process for the next flush_registrations. The Process resource id
+        is assigned here, so that the process is fully usable before its registration is written.
+        """
+        if self.container.has_capability(self.container.CCAP.RESOURCE_REGISTRY):
+            process_instance._proc_res_id = create_unique_resource_id()
+        self._pending_regs.append(process_instance)
+        if not self._reg_timer:
+            self._reg_timer = gevent.spawn_later(self.registration_cfg["flush_interval"], self._flush_registrations_timed)
+
+    def _flush_registrations_timed(self):
+        self._reg_timer = None
+        try:
+            self.flush_registrations()
+        except Exception:
+            log.exception("Error flushing deferred process registrations")
+
+    def flush_registrations(self):
+        """
+        Writes all queued process registrations: Process and new Service resources with one create_mult,
+        all associations with one create_association_mult and agents with one directory register_mult.
+        """
+        with self._reg_lock:
+            proc_list, self._pending_regs = self._pending_regs, []
+            if not proc_list:
+                return
+            log.debug("Flushing %s deferred process registrations", len(proc_list))
+
+            if self.container.has_capability(self.container.CCAP.RESOURCE_REGISTRY):
+                rr = self.container.resource_registry
+                res_list, assoc_list = [], []
+                for process_instance in proc_list:
+                    proc_obj = Process(name=process_instance.id, label=process_instance._proc_name,
+                                       proctype=process_instance._proc_type)
+                    proc_obj._id = process_instance._proc_res_id
+                    res_list.append(proc_obj)
+                    assoc_list.append((self.cc_id, "hasProcess", process_instance._proc_res_id))
+
+                svc_procs = [proc for proc in proc_list if proc._proc_type == SERVICE_PROCESS_TYPE]
+                if svc_procs:
+                    # Registration of SERVICE processes: find existing Service resources for all processes at once
+                    svc_names = set(proc.name for proc in svc_procs)
+                    svc_ids = self._find_resource_ids_by_name("Service", svc_names)
+                    new_svc_names = []
+                    for process_instance in svc_procs:
+                        svc_name = process_instance.name
+                        if svc_name not in svc_ids:
+                            # We are starting the first process of a service instance
+                            # TODO: This should be created by the HA Service agent in the future
+                            svc_obj = Service(name=svc_name, exchange_name=process_instance._proc_listen_name, state=ServiceStateEnum.READY)
+                            svc_obj._id = create_unique_resource_id()
+                            res_list.append(svc_obj)
+                            svc_ids[svc_name] = [svc_obj._id]
+                            new_svc_names.append(svc_name)
+                        elif len(svc_ids[svc_name]) > 1:
+                            log.warn("More than 1 Service resource found with name %s: %s", svc_name, svc_ids[svc_name])
+                        process_instance._proc_svc_id = svc_ids[svc_name][0]
+                        assoc_list.append((process_instance._proc_svc_id, "hasProcess", process_instance._proc_res_id))
+
+                    if new_svc_names:
+                        # Create associations to service definition resources
+                        svcdef_ids = self._find_resource_ids_by_name("ServiceDefinition", new_svc_names)
+                        for svc_name in new_svc_names:
+                            svcdef_list = svcdef_ids.get(svc_name, None)
+                            if svcdef_list:
+                                if len(svcdef_list) > 1:
+                                    log.warn("More than 1 ServiceDefinition resource found with name %s: %s", svc_name, svcdef_list)
+                                assoc_list.append((svc_ids[svc_name][0], "hasServiceDefinition", svcdef_list[0]))
+                            else:
+                                log.error("Cannot find ServiceDefinition resource for %s", svc_name)
+
+                try:
+                    rr.create_mult(res_list)
+                except Exception:
+                    # Nothing was written - keep the registrations queued for the next flush
+                    log.exception("Could not register %s processes, retrying with the next flush", len(proc_list))
+                    self._pending_regs[:0] = proc_list
+                    if not self._reg_timer:
+                        self._reg_timer = gevent.spawn_later(self.registration_cfg["flush_interval"], self._flush_registrations_timed)
+                    return
+                try:
+                    rr.create_association_mult(assoc_list)
+                except Exception:
+                    # The resources exist - create the associations one by one, so that one failure does not lose all
+                    log.warn("Could not create %s process associations in one batch, creating one by one", len(assoc_list))
+                    for subject_id, predicate, object_id in assoc_list:
+                        try:
+                            rr.create_association(subject_id, predicate, object_id)
+                        except Exception:
+                            log.exception("Could not create association %s %s %s", subject_id, predicate, object_id)
+
+            agent_procs = [proc for proc in proc_list if proc._proc_type == AGENT_PROCESS_TYPE]
+            if agent_procs and self.container.has_capability(self.container.CCAP.DIRECTORY):
+                # Registration of AGENT processes: in Directory
+                entries = [("/Agents", process_instance.id,
+                            dict(name=process_instance._proc_name,
+                                 container=process_instance.container.id,
+                                 resource_id=process_instance.resource_id,
+                                 agent_id=process_instance.agent_id,
+                                 def_id=process_instance.agent_def_id,
+                                 capabilities=process_instance.get_capabilities()))
+                           for process_instance in agent_procs]
+                try:
+                    self.container.directory.register_mult(entries)
+                except Exception:
+                    # register_mult only creates entries - fall back to register for existing ones
+                    log.warn("Could not register %s agents in one batch, registering one by one", len(entries))
+                    for parent, key, attrs in entries:
+                        self.container.directory.register(parent, key, **attrs)
+
+    def _find_resource_ids_by_name(self, restype, names):
+        """Returns a dict of resource name to list of ids for resources of given type with any of the given names"""
+        res_ids = {}
+        for name in set(names):
+            name_ids, _ = self.container.resource_registry.find_resources(restype=restype, name=name, id_only=True)
+            if name_ids:
+                res_ids[name] = name_ids
+        return res_ids
+
     def terminate_process(self, process_id, do_notifications=True):
         """
         Terminates a process and all its resources. Termination is graceful with timeout.
@@ -898,6 +1045,15 @@ class ProcManager(object):
             self._call_proc_state_changed(process_instance, ProcessStateEnum.TERMINATED)
 
     def _unregister_process(self, process_id, process_instance):
+        if process_instance in self._pending_regs:
+            # Registration was deferred and never written - nothing to remove in the system
+            self._pending_regs.remove(process_instance)
+            self._remove_local_registration(process_id, process_instance)
+            return
+        with self._reg_lock:
+            # Wait for a flush in progress to complete
+            pass
+
         # Remove process registration in resource registry
         if process_instance._proc_res_id:
             if self.container.has_capability(self.container.CCAP.RESOURCE_REGISTRY):
@@ -937,6 +1093,9 @@ class ProcManager(object):
             if self.container.has_capability(self.container.CCAP.DIRECTORY):
                 self.container.directory.unregister_safe("/Agents", process_instance.id)
 
+        self._remove_local_registration(process_id, process_instance)
+
+    def _remove_local_registration(self, process_id, process_instance):
         # Remove internal registration in container
         del self.procs[process_id]
         if process_instance._proc_name in self.procs_by_name:
@@ -12,7 +12,7 @@ from ooi.timer import get_accumulators
 from pyon.public import log, IonObject, BadRequest, CFG
 from pyon.util.containers import get_ion_ts
 
-DEFAULT_SNAPSHOTS = ["basic", "config", "processes", "policy", "accumulators", "gevent", "gevent_block"]
+DEFAULT_SNAPSHOTS = ["basic", "config", "processes", "policy", "accumulators", "datastore", "gevent", "gevent_block"]
 
 
 class ContainerSnapshot(object):
@@ -199,3 +199,20 @@ class ContainerSnapshot(object):
                     )
 
         return all_acc_dict
+
+    def _snap_datastore(self, **kwargs):
+        snap_result = {}
+        # Only report if the Postgres datastore is in use - do not import it otherwise
+        pg_store = sys.modules.get("pyon.datastore.postgresql.base_store", None)
+        if pg_store:
+            snap_result["postgres_pools"] = pg_store.PostgresDataStore.get_pool_stats()
+            snap_result["postgres_statements"] = pg_store.PostgresDataStore.get_statement_stats(limit=100)
+        res_registry = getattr(self.container, "resource_registry", None)
+        res_cache = getattr(res_registry, "res_cache", None)
+        if res_cache:
+            snap_result["resource_cache"] = res_cache.get_stats()
+        assoc_index = getattr(res_registry, "assoc_index", None)
+        if assoc_index:
+            snap_result["assoc_index"] = assoc_index.get_stats()
+
+        return snap_result
@@ -8,6 +8,8 @@ from nose.plugins.attrib import attr
 from couchdb.http import ResourceNotFound
 from gevent.event import AsyncResult, Event
 import gevent
+import sys
+import time
 
 from pyon.agent.simple_agent import SimpleResourceAgent
 from pyon.container.procs import ProcManager
@@ -18,6 +20,7 @@ from pyon.ion.conversation import ConversationRPCServer
 from pyon.net.transport import NameTrio, TransportError
 from pyon.public import PRED, CCAP, IonObject
 from pyon.ion.service import BaseService
+from pyon.util.containers import DotDict
 from pyon.util.int_test import IonIntegrationTestCase
 from pyon.util.unit_test import PyonTestCase
 
@@ -289,6 +292,80 @@ class TestProcManager(PyonTestCase):
 
         self.container.directory.unregister_safe.assert_called_once_with("/Agents", sentinel.pid)
 
+    def test__register_process_deferred(self):
+        self.pm.cc_id = "ccid"
+        self.pm.registration_cfg["deferred"] = True
+        self.pm.registration_cfg["flush_interval"] = 60
+        def find_resources(restype="", name="", id_only=False, **kwargs):
+            return (["sdid"] if restype == "ServiceDefinition" and name == "sample" else []), []
+        self.container.resource_registry.find_resources.side_effect = find_resources
+
+        def create_proc(proc_id, name, proc_type):
+            pmock = Mock()
+            pmock.id = proc_id
+            pmock.name = "sample"
+            pmock._proc_name = name
+            pmock._proc_type = proc_type
+            pmock._proc_listen_name = "sample"
+            self.pm._register_process(pmock, name)
+            return pmock
+
+        svc_procs = [create_proc("p1", "sample1", "service"), create_proc("p2", "sample2", "service")]
+        agent_proc = create_proc("p3", "agent1", "agent")
+
+        # Registration is queued with local ids, nothing is written yet
+        self.assertTrue(self.pm._reg_timer)
+        self.assertEquals(len(self.pm._pending_regs), 3)
+        self.assertFalse(self.container.resource_registry.create.called)
+        self.assertFalse(self.container.directory.register.called)
+        self.assertEquals(self.pm.procs["p1"], svc_procs[0])
+        self.assertTrue(all(type(proc._proc_res_id) is str for proc in svc_procs + [agent_proc]))
+
+        self.pm.flush_registrations()
+
+        self.assertEquals(self.pm._pending_regs, [])
+        res_list = self.container.resource_registry.create_mult.call_args[0][0]
+        self.assertEquals(sorted(res_obj.type_ for res_obj in res_list), ["Process", "Process", "Process", "Service"])
+        svc_id = svc_procs[0]._proc_svc_id
+        self.assertEquals(svc_procs[1]._proc_svc_id, svc_id)
+        assoc_list = self.container.resource_registry.create_association_mult.call_args[0][0]
+        self.assertEquals(len(assoc_list), 6)
+        self.assertIn(("ccid", "hasProcess", agent_proc._proc_res_id), assoc_list)
+        self.assertIn((svc_id, "hasProcess", svc_procs[1]._proc_res_id), assoc_list)
+        self.assertIn((svc_id, "hasServiceDefinition", "sdid"), assoc_list)
+        entries = self.container.directory.register_mult.call_args[0][0]
+        self.assertEquals([(parent, key) for parent, key, _ in entries], [("/Agents", "p3")])
+        # Services and definitions are found by name
+        self.container.resource_registry.find_resources.assert_any_call(restype="Service", name="sample", id_only=True)
+        self.container.resource_registry.find_resources.assert_any_call(restype="ServiceDefinition", name="sample", id_only=True)
+
+        # Flush without pending registrations does nothing
+        self.pm.flush_registrations()
+        self.assertEquals(self.container.resource_registry.create_mult.call_count, 1)
+
+        # Unregistering a queued process does not touch the resource registry
+        pmock = create_proc("p4", "sample4", "standalone")
+        self.pm._unregister_process("p4", pmock)
+        self.assertEquals(self.pm._pending_regs, [])
+        self.assertNotIn("p4", self.pm.procs)
+        self.assertFalse(self.container.resource_registry.delete.called)
+
+        # Failed writes keep the registrations queued
+        self.container.resource_registry.create_mult.side_effect = Exception("db down")
+        proc5 = create_proc("p5", "sample5", "standalone")
+        self.pm.flush_registrations()
+        self.assertEquals(self.pm._pending_regs, [proc5])
+        self.container.resource_registry.create_mult.side_effect = None
+
+        # Associations are created one by one if the batch fails
+        self.container.resource_registry.create_association_mult.side_effect = Exception("duplicate")
+        self.pm.flush_registrations()
+        self.assertEquals(self.pm._pending_regs, [])
+        self.container.resource_registry.create_association.assert_called_once_with("ccid", "hasProcess", proc5._proc_res_id)
+        self.container.resource_registry.create_association_mult.side_effect = None
+
+        self.pm._reg_timer.kill()
+
     def test__create_listening_endpoint_with_cfg(self):
         self.patch_cfg('pyon.container.procs.CFG', container=dict(messaging=dict(endpoint=dict(proc_listening_type='pyon.container.test.test_procs.TestRPCServer'))))
 
@@ -464,6 +541,44 @@ class TestProcManagerInt(IonIntegrationTestCase):
         # now try to terminate it again, it shouldn't exist
         self.assertRaises(BadRequest, self.container.terminate_process, pid)
 
+    def test_deferred_registration(self):
+        self._start_container()
+
+        pm = self.container.proc_manager
+        rr = self.container.resource_registry
+        self.addCleanup(setattr, pm, "registration_cfg", pm.registration_cfg)
+        pm.registration_cfg = dict(deferred=True, flush_interval=0.1)
+
+        pid = self._spawnproc(pm, 'service')
+        proc = pm.procs[pid]
+        self.assertTrue(proc._proc_res_id)
+        self.assertRaises(NotFound, rr.read, proc._proc_res_id)
+
+        # Registration is written by the timer
+        gevent.sleep(0.3)
+        proc_obj = rr.read(proc._proc_res_id)
+        self.assertEquals(proc_obj.name, pid)
+        svc_ids, _ = rr.find_subjects("Service", "hasProcess", proc._proc_res_id, id_only=True)
+        self.assertEquals(svc_ids, [proc._proc_svc_id])
+
+        # Explicit flush, e.g. at the end of an app deployment
+        pid2 = self._spawnproc(pm, 'simple')
+        pm.flush_registrations()
+        proc2 = pm.procs[pid2]
+        cc_proc_ids, _ = rr.find_objects(pm.cc_id, "hasProcess", "Process", id_only=True)
+        self.assertIn(proc2._proc_res_id, cc_proc_ids)
+
+        pm.terminate_process(pid)
+        pm.terminate_process(pid2)
+        self.assertRaises(NotFound, rr.read, proc._proc_res_id)
+        self.assertRaises(NotFound, rr.read, proc2._proc_res_id)
+
+        # Terminating a process before its registration is written
+        pid3 = self._spawnproc(pm, 'simple')
+        pm.terminate_process(pid3)
+        self.assertEquals(pm._pending_regs, [])
+        self.assertEquals(len(pm.procs), 0)
+
     def test_proc_state_change_callback(self):
         self._start_container()
 
@@ -609,3 +724,31 @@ class TestProcManagerInt(IonIntegrationTestCase):
         self.assertTrue(proc.CFG.more, 'exists')
 
         pm.terminate_process(pid1)
+
+
+@attr('PFM')
+class TestProcManagerSpeed(IonIntegrationTestCase):
+
+    def test_register_process_speed(self):
+        self._start_container()
+
+        pm = self.container.proc_manager
+        self.addCleanup(setattr, pm, "registration_cfg", pm.registration_cfg)
+        num_procs = 500
+        print >>sys.stderr, ""
+        for deferred in (False, True):
+            pm.registration_cfg = dict(deferred=deferred, flush_interval=0.5)
+            rel = DotDict(apps=[DotDict(name="sample%s" % i, config={'process': {'type': 'simple'}},
+                                        processapp=["sample%s" % i, 'pyon.container.test.test_procs', 'SampleProcess'])
+                                for i in xrange(num_procs)])
+
+            t1 = time.time()
+            self.container.app_manager.start_rel(rel)
+            t2 = time.time()
+            self.assertEquals(len(pm.procs), num_procs)
+            self.assertEquals(pm._pending_regs, [])
+            print >>sys.stderr, "start_rel %s processes (deferred=%s): %.4fs" % (num_procs, deferred, t2-t1)
+
+            for pid in pm.procs.keys():
+                pm.terminate_process(pid)
+            self.container.app_manager.apps = []
@@ -27,12 +27,18 @@ class EncodeTypes(object):
     DTYPE = 'd'
     SLICE = 'i'
     NPVAL = 'n'
+    NPBUF = 'b'
 
 
 # Global lazy load reference to the Pyon object registry (we be set on first use, not on load).
 # Note: We need this here so that the decode_ion/encode_ion functions can be imported (i.e. be static).
 obj_registry = None
 
+# If True, numpy arrays are encoded as raw buffer plus dtype and shape (NPBUF) instead of a nested
+# list of Python values (NPARRAY). Both forms are always decoded. Enable (via the interceptor
+# config) only once no containers older than the NPBUF encoding receive messages from this one.
+numpy_buffer_encode = False
+
 
 def decode_ion(obj):
     """msgpack object hook to decode granule (numpy) types and IonObjects.
@@ -49,15 +55,8 @@ def decode_ion(obj):
         if obj_registry is None:
             obj_registry = get_obj_registry()
 
-        ion_obj = obj_registry.new(obj["type_"])
-        for k, v in obj.iteritems():
-            # unicode translate to utf8
-            # Note: This is not recursive within dicts/list or any other types
-            if isinstance(v, unicode):
-                v = v.encode('utf8')
-            if k != "type_":
-                setattr(ion_obj, k, v)
-        return ion_obj
+        # Note: unicode translate to utf8 is not recursive within dicts/list or any other types
+        return obj_registry.get_decoder(obj["type_"])(obj)
 
     if 't' not in obj:
         return obj
@@ -67,6 +66,13 @@ def decode_ion(obj):
     if objt == EncodeTypes.LIST:
         return list(obj['o'])
 
+    elif objt == EncodeTypes.NPBUF:
+        # Copy out of the message buffer, so that the array is writable
+        dt = np.dtype(obj['d'])
+        if not obj['o']:
+            return np.empty(obj['s'], dtype=dt)
+        return np.frombuffer(obj['o'], dtype=dt).reshape(obj['s']).copy()
+
     elif objt == EncodeTypes.NPARRAY:
         return np.array(obj['o'], dtype=np.dtype(obj['d']))
 
@@ -109,6 +115,10 @@ def encode_ion(obj):
         return {'t': EncodeTypes.SET, 'o': tuple(obj)}
 
     if isinstance(obj, np.ndarray):
+        # Object and structured dtypes have no portable raw representation
+        if numpy_buffer_encode and not obj.dtype.hasobject and obj.dtype.fields is None:
+            return {'t': EncodeTypes.NPBUF, 'o': np.ascontiguousarray(obj).tostring(), 'd': obj.dtype.str,
+                    's': obj.shape}
         return {'t': EncodeTypes.NPARRAY, 'o': obj.tolist(), 'd': obj.dtype.str}
 
     if isinstance(obj, complex):
@@ -139,6 +149,9 @@ class EncodeInterceptor(Interceptor):
 
     def configure(self, config):
         self.max_message_size = get_safe(config, 'max_message_size', 20000000)
+
+        global numpy_buffer_encode
+        numpy_buffer_encode = get_safe(config, 'numpy_buffer_encode', False)
         log.debug("EncodeInterceptor enabled")
 
     def outgoing(self, invocation):
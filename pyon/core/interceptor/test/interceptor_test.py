@@ -65,6 +65,55 @@ class InterceptorTest(PyonTestCase):
         for d in c:
             self.assertTrue((a==d).all())
 
+    @unittest.skipIf(not _have_numpy,'No numpy')
+    def test_numpy_buffer_encode(self):
+        import msgpack
+        from pyon.core.interceptor import encode as encode_mod
+        encode = EncodeInterceptor()
+
+        # List form is the default and always decoded
+        a = np.array([1.5, 2.5, 3.5], dtype='float32')
+        invoke = Invocation()
+        invoke.message = a
+        msg = msgpack.unpackb(encode.outgoing(invoke).message)
+        self.assertEquals(msg['t'], encode_mod.EncodeTypes.NPARRAY)
+        b = encode.incoming(invoke).message
+        self.assertEquals(b.dtype, a.dtype)
+        self.assertTrue((a==b).all())
+
+        encode.configure({'numpy_buffer_encode': True})
+        self.addCleanup(encode.configure, {})
+
+        # Non-contiguous, multi-dimensional, non-native byte order
+        a = np.arange(24, dtype='>f8').reshape(4, 6)[:, ::2]
+        invoke = Invocation()
+        invoke.message = a
+        msg = msgpack.unpackb(encode.outgoing(invoke).message)
+        self.assertEquals(msg['t'], encode_mod.EncodeTypes.NPBUF)
+        b = encode.incoming(invoke).message
+        self.assertEquals(b.dtype, a.dtype)
+        self.assertEquals(b.shape, a.shape)
+        self.assertTrue((a==b).all())
+
+        # Decoded arrays are writable copies
+        b[0, 0] = 42
+        self.assertEquals(b[0, 0], 42)
+
+        # Empty and 0-d arrays
+        for a in (np.array([], dtype='int32'), np.array(3.5)):
+            invoke = Invocation()
+            invoke.message = a
+            b = encode.incoming(encode.outgoing(invoke)).message
+            self.assertEquals(b.shape, a.shape)
+            self.assertTrue((a==b).all())
+
+        # Object arrays still use the list form
+        a = np.array([{'a': 1}, 'x'], dtype='object')
+        invoke = Invocation()
+        invoke.message = a
+        msg = msgpack.unpackb(encode.outgoing(invoke).message)
+        self.assertEquals(msg['t'], encode_mod.EncodeTypes.NPARRAY)
+
     def test_set(self):
         a = {1,2}
         invoke = Invocation()
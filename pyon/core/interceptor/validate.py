@@ -5,7 +5,7 @@
 from pyon.core.interceptor.interceptor import Interceptor
 from pyon.core.bootstrap import IonObject, CFG
 from pyon.core.exception import BadRequest
-from pyon.core.object import IonObjectBase, walk
+from pyon.core.object import IonObjectBase, walk_visit
 from pyon.core.registry import is_ion_object
 from pyon.util.log import log
 
@@ -50,10 +50,9 @@ class ValidateInterceptor(Interceptor):
             def validate_ionobj(obj):
                 if isinstance(obj, IonObjectBase):
                     obj._validate()
-                return obj
 
             try:
-                walk(payload, validate_ionobj)
+                walk_visit(payload, validate_ionobj)
             except AttributeError as e:
                 if invocation.headers.has_key("raise-exception") and invocation.headers['raise-exception']:
                     log.warn('message failed validation: %s\nheaders %s\npayload %s', e.message, invocation.headers, payload)
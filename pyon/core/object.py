@@ -65,143 +65,13 @@ class IonObjectBase(object):
         """
         Compare fields to the schema and raise AttributeError if mismatched.
         Named _validate instead of validate because the data may have a field named "validate".
+        The schema is compiled into a validation function once per class (see compile_validator).
         """
-        fields, schema = self.__dict__, self._schema
-
-        # Check for extra fields not defined in the schema
-        extra_fields = fields.viewkeys() - schema.viewkeys() - built_in_attrs
-        if len(extra_fields) > 0:
-            raise AttributeError('Fields found that are not in the schema: %r' % (list(extra_fields)))
-
-        required_decorator = 'Required'
-        content_type_decorator = 'ContentType'
-        content_count_decorator = 'ContentCount'
-        value_range_decorator = 'ValueRange'
-        value_pattern_decorator = 'ValuePattern'
-
-        # Check required field criteria met
-        for key in schema:
-            if 'decorators' in schema[key] and required_decorator in schema[key]['decorators']:
-                if not key in fields or fields[key] is None:
-                    raise AttributeError('Required value "%s" not set' % key)
-
-        # Check each attribute
-        for key in fields.iterkeys():
-            if key in built_in_attrs:
-                continue
-
-            schema_val = schema[key]
-
-            # Correct any float or long types that got downgraded to int
-            if isinstance(fields[key], int):
-                if schema_val['type'] == 'float':
-                    fields[key] = float(fields[key])
-                elif schema_val['type'] == 'long':
-                    fields[key] = long(fields[key])
-
-            # argh, annoying work around for OrderedDict vs dict issue
-            if type(fields[key]) == dict and schema_val['type'] == 'OrderedDict':
-                fields[key] = OrderedDict(fields[key])
-
-            # Basic type checking
-            field_val = fields[key]
-            #if 'decorators' in schema_val:
-                #log.debug("Validating %s: %s: %s: %s" % (key, schema_val["type"], schema_val["decorators"], str(field_val)))
-            #else:
-                #log.debug("Validating %s: %s: %s" % (key, schema_val["type"], str(field_val)))
-            if type(field_val).__name__ != schema_val['type']:
-
-                # if the schema doesn't define a type, we can't very well validate it
-                if schema_val['type'] == 'NoneType':
-                    continue
-
-                # Allow unicode instead of str. This may be too lenient.
-                if schema_val['type'] == 'str' and type(field_val).__name__ == 'unicode':
-                    continue
-
-                # Already checked for required above.  Assume optional and continue
-                if field_val is None:
-                    continue
-
-                # Allow unicode instead of str. This may be too lenient.
-                if schema_val['type'] == 'str' and type(field_val).__name__ == 'unicode':
-                    continue
-
-                # IonObjects are ok for dict fields too!
-                if isinstance(field_val, IonObjectBase) and schema_val['type'] == 'OrderedDict':
-                    continue
-
-                if not key in fields or fields[key] is None:
-                    raise AttributeError('Required value "%s" not set' % key)
-
-                # Check for inheritance
-                if self.check_inheritance_chain(type(field_val), schema_val['type']):
-                    continue
-
-                # Check enum types
-                from pyon.core.registry import enum_classes
-                if isinstance(field_val, int) and schema_val['type'] in enum_classes:
-                    if field_val not in enum_classes(schema_val['type'])._str_map:
-                        raise AttributeError('Invalid enum value "%d" for field "%s.%s", should be between 1 and %d' %
-                                     (fields[key], type(self).__name__, key, len(enum_classes(schema_val['type'])._str_map)))
-                    else:
-                        continue
-
-                # TODO work around for msgpack issue
-                if type(field_val) == tuple and schema_val['type'] == 'list':
-                    continue
-
-                # TODO remove this at some point
-                if isinstance(field_val, IonObjectBase) and schema_val['type'] == 'dict':
-                    log.warn('TODO: Please convert generic dict attribute type to abstract type for field "%s.%s"' % (type(self).__name__, key))
-                    continue
-
-                # Special case check for ION object being passed where default type is dict or str
-                if 'decorators' in schema_val:
-                    if content_type_decorator in schema_val['decorators']:
-                        if isinstance(field_val, IonObjectBase) and schema_val['type'] == 'dict' or schema_val['type'] == 'str':
-                            self.check_content(key, field_val, schema_val['decorators'][content_type_decorator])
-                            continue
-
-                raise AttributeError('Invalid type "%s" for field "%s.%s", should be "%s"' %
-                                     (type(fields[key]), type(self).__name__, key, schema_val['type']))
-
-            if type(field_val).__name__ == 'str':
-                if value_pattern_decorator in schema_val['decorators']:
-                    self.check_string_pattern_match(key, field_val, schema_val['decorators'][value_pattern_decorator])
-
-            if type(field_val).__name__ in ['int', 'float', 'long']:
-                if value_range_decorator in schema_val['decorators']:
-                    self.check_numeric_value_range(key, field_val, schema_val['decorators'][value_range_decorator])
-
-            if 'decorators' in schema_val:
-                if content_type_decorator in schema_val['decorators']:
-                    if schema_val['type'] == 'list':
-                        self.check_collection_content(key, field_val, schema_val['decorators'][content_type_decorator])
-                    elif schema_val['type'] == 'dict' or schema_val['type'] == 'OrderedDict':
-                        self.check_collection_content(key, field_val.values(), schema_val['decorators'][content_type_decorator])
-                    else:
-                        self.check_content(key, field_val, schema_val['decorators'][content_type_decorator])
-                if content_count_decorator in schema_val['decorators']:
-                    if schema_val['type'] == 'list':
-                        self.check_collection_length(key, field_val, schema_val['decorators'][content_count_decorator])
-                    if schema_val['type'] == 'dict' or schema_val['type'] == 'OrderedDict':
-                        self.check_collection_length(key, field_val.values(), schema_val['decorators'][content_count_decorator])
-
-            if isinstance(field_val, IonObjectBase):
-                field_val._validate()
-
-            # Next validate only IonObjects found in child collections.
-            # Note that this is non-recursive; only for first-level collections.
-            elif isinstance(field_val, Mapping):
-                for subkey in field_val:
-                    subval = field_val[subkey]
-                    if isinstance(subval, IonObjectBase):
-                        subval._validate()
-            elif isinstance(field_val, Iterable):
-                for subval in field_val:
-                    if isinstance(subval, IonObjectBase):
-                        subval._validate()
+        validator = _validators.get(self.__class__, None)
+        if validator is None:
+            validator = compile_validator(self.__class__)
+            _validators[self.__class__] = validator
+        validator(self)
 
     def _get_type(self):
         return self.__class__.__name__
@@ -356,6 +226,259 @@ class IonObjectBase(object):
 class IonMessageObjectBase(IonObjectBase):
     pass
 
+
+# Cache of IonObject class to compiled validation function
+_validators = {}
+
+# Cache of (type, type name) to result of the inheritance check
+_inheritance_cache = {}
+
+# Schema type names that can be checked by type identity instead of name
+_schema_builtin_types = {'str': str, 'unicode': unicode, 'bool': bool, 'int': int, 'long': long, 'float': float,
+                         'list': list, 'tuple': tuple, 'dict': dict, 'OrderedDict': OrderedDict}
+
+# Value types that never contain IonObjects
+_scalar_types = frozenset((str, unicode, bool, int, long, float, type(None)))
+
+
+def _inherits_from(typ, type_name):
+    """Same as IonObjectBase.check_inheritance_chain, cached per type"""
+    res = _inheritance_cache.get((typ, type_name), None)
+    if res is None:
+        res = False
+        bases = typ.__bases__
+        while bases:
+            if bases[0].__name__ == type_name:
+                res = True
+                break
+            if bases[0].__name__ == "object":
+                break
+            bases = bases[0].__bases__
+        _inheritance_cache[(typ, type_name)] = res
+    return res
+
+
+def _compile_field_validator(clzz, key, schema_val):
+    """
+    Returns a function validating the value of one field given its schema entry.
+    All decorator values are parsed, evaluated and compiled once here.
+    """
+    from pyon.core.registry import enum_classes, issubtype
+
+    obj_type = clzz.__name__
+    stype = schema_val['type']
+    exp_type = _schema_builtin_types.get(stype, None)
+    is_collection = stype in ('list', 'dict', 'OrderedDict')
+    enum_clzz = enum_classes.get(stype, None)
+    decorators = schema_val.get('decorators', None) or {}
+
+    content_types = None
+    if 'ContentType' in decorators:
+        content_types = [ct.strip() for ct in decorators['ContentType'].split(',')]
+        content_types_str = decorators['ContentType']
+
+    content_count = None
+    if 'ContentCount' in decorators:
+        count_vals = decorators['ContentCount'].split(',')
+        content_count = int(count_vals[0].strip()), int(count_vals[-1].strip())
+
+    value_range = None
+    if 'ValueRange' in decorators:
+        range_vals = decorators['ValueRange'].split(',')
+        value_range = eval(range_vals[0].strip()), eval(range_vals[1].strip() if len(range_vals) > 1 else range_vals[0].strip())
+
+    value_pattern = None
+    if 'ValuePattern' in decorators:
+        value_pattern_str = decorators['ValuePattern']
+        value_pattern = re.compile(value_pattern_str)
+
+    def check_content(value):
+        vtype = type(value)
+        for content_type in content_types:
+            if vtype.__name__ == content_type or _inherits_from(vtype, content_type):
+                return
+        raise AttributeError('Invalid value type %s in field "%s.%s", should be one of "%s"' %
+                (str(value), obj_type, key, content_types_str))
+
+    def check_collection_content(list_values):
+        for value in list_values:
+            vtype = type(value)
+            for content_type in content_types:
+                if isinstance(value, dict) and 'type_' in value:
+                    if value['type_'] == content_type or issubtype(value['type_'], content_type):
+                        break
+                if vtype.__name__ == content_type or _inherits_from(vtype, content_type):
+                    break
+            else:
+                raise AttributeError('Invalid value type %s in collection field "%s.%s", should be one of "%s"' %
+                    (str(list_values), obj_type, key, content_types_str))
+
+    def check_collection_length(list_values):
+        if len(list_values) < content_count[0] or len(list_values) > content_count[1]:
+            raise AttributeError('Invalid value length for collection field "%s.%s", should be between %d and %d' %
+                (obj_type, key, content_count[0], content_count[1]))
+
+    def validate_field(fields, field_val):
+        # Correct any float or long types that got downgraded to int
+        if isinstance(field_val, int):
+            if stype == 'float':
+                field_val = fields[key] = float(field_val)
+            elif stype == 'long':
+                field_val = fields[key] = long(field_val)
+
+        # argh, annoying work around for OrderedDict vs dict issue
+        elif stype == 'OrderedDict' and type(field_val) is dict:
+            field_val = fields[key] = OrderedDict(field_val)
+
+        vtype = type(field_val)
+        if (vtype is not exp_type) if exp_type is not None else (vtype.__name__ != stype):
+            # if the schema doesn't define a type, we can't very well validate it
+            if stype == 'NoneType':
+                return
+            # Allow unicode instead of str. This may be too lenient.
+            if stype == 'str' and vtype is unicode:
+                return
+            # Already checked for required. Assume optional and continue
+            if field_val is None:
+                return
+            # IonObjects are ok for dict fields too!
+            if stype == 'OrderedDict' and isinstance(field_val, IonObjectBase):
+                return
+            if _inherits_from(vtype, stype):
+                return
+            if enum_clzz is not None and isinstance(field_val, int):
+                if field_val not in enum_clzz._str_map:
+                    raise AttributeError('Invalid enum value "%d" for field "%s.%s", should be between 1 and %d' %
+                                         (field_val, obj_type, key, len(enum_clzz._str_map)))
+                return
+            # TODO work around for msgpack issue
+            if stype == 'list' and vtype is tuple:
+                return
+            # TODO remove this at some point
+            if stype == 'dict' and isinstance(field_val, IonObjectBase):
+                log.warn('TODO: Please convert generic dict attribute type to abstract type for field "%s.%s"' % (obj_type, key))
+                return
+            # Special case check for ION object being passed where default type is str
+            if content_types is not None and stype == 'str':
+                check_content(field_val)
+                return
+
+            raise AttributeError('Invalid type "%s" for field "%s.%s", should be "%s"' %
+                                 (vtype, obj_type, key, stype))
+
+        if value_pattern is not None and vtype is str:
+            if not value_pattern.match(field_val):
+                raise AttributeError('Invalid value pattern %s for field "%s.%s", should match regular expression %s' %
+                    (field_val, obj_type, key, value_pattern_str))
+
+        if value_range is not None and (vtype is int or vtype is float or vtype is long):
+            if field_val < value_range[0] or field_val > value_range[1]:
+                raise AttributeError('Invalid value %s for field "%s.%s", should be between %d and %d' %
+                    (str(field_val), obj_type, key, value_range[0], value_range[1]))
+
+        if content_types is not None:
+            if stype == 'list':
+                check_collection_content(field_val)
+            elif stype == 'dict' or stype == 'OrderedDict':
+                check_collection_content(field_val.values())
+            else:
+                check_content(field_val)
+
+        if content_count is not None and is_collection:
+            check_collection_length(field_val if stype == 'list' else field_val.values())
+
+        if vtype in _scalar_types:
+            return
+
+        if isinstance(field_val, IonObjectBase):
+            field_val._validate()
+
+        # Next validate only IonObjects found in child collections.
+        # Note that this is non-recursive; only for first-level collections.
+        elif isinstance(field_val, Mapping):
+            for subkey in field_val:
+                subval = field_val[subkey]
+                if isinstance(subval, IonObjectBase):
+                    subval._validate()
+        elif isinstance(field_val, Iterable):
+            for subval in field_val:
+                if isinstance(subval, IonObjectBase):
+                    subval._validate()
+
+    return validate_field
+
+
+def compile_validator(clzz):
+    """
+    Returns a function that validates instances of given IonObject class against the class _schema
+    and raises AttributeError if mismatched. Behaves like the former interpreting implementation of
+    IonObjectBase._validate, but type checks, decorator lookups and parsing of decorator values
+    (including regular expressions) happen once per class.
+    """
+    schema = clzz._schema
+    allowed_fields = frozenset(schema) | built_in_attrs
+    required_fields = [key for key, schema_val in schema.iteritems()
+                       if 'Required' in (schema_val.get('decorators', None) or {})]
+    field_validators = {key: _compile_field_validator(clzz, key, schema_val) for key, schema_val in schema.iteritems()}
+
+    def validate(obj):
+        fields = obj.__dict__
+
+        # Check for extra fields not defined in the schema
+        if not allowed_fields.issuperset(fields):
+            extra_fields = fields.viewkeys() - allowed_fields
+            raise AttributeError('Fields found that are not in the schema: %r' % (list(extra_fields)))
+
+        # Check required field criteria met
+        for key in required_fields:
+            if fields.get(key, None) is None:
+                raise AttributeError('Required value "%s" not set' % key)
+
+        # Check each attribute
+        for key, field_val in fields.items():
+            if key in built_in_attrs:
+                continue
+            field_validators[key](fields, field_val)
+
+    return validate
+
+
+def build_object_decoder(clzz):
+    """
+    Returns a function that creates an instance of the given IonObject class directly from a
+    decoded dict (e.g. from msgpack or the datastore), without first constructing the object with
+    all defaults and then calling setattr once per field. Top level unicode values are encoded to
+    UTF8 str. Objects are only default constructed if the dict lacks some schema fields.
+    Extra fields not in the schema are kept, or discarded if discard_extra is True.
+    """
+    schema_fields = frozenset(clzz._schema)
+    known_fields = schema_fields | built_in_attrs
+    type_name = clzz.__name__
+    # Message objects do not have a type_ attribute
+    set_type = "type_" in clzz().__dict__
+
+    def decode_object(obj_dict, discard_extra=False):
+        if schema_fields.issubset(obj_dict):
+            ion_obj = clzz.__new__(clzz)
+        else:
+            ion_obj = clzz()
+        fields = ion_obj.__dict__
+        for k, v in obj_dict.iteritems():
+            if k not in known_fields and discard_extra:
+                log.info('discard %s not in current schema' % k)
+                continue
+            if type(v) is unicode:
+                v = v.encode('utf8')
+            fields[k] = v
+        if set_type:
+            fields["type_"] = type_name
+        else:
+            fields.pop("type_", None)
+        return ion_obj
+
+    return decode_object
+
+
 def walk(o, cb, modify_key_value = 'value'):
     """
     Utility method to do recursive walking of a possible iterable (inc dicts) and do inline transformations.
@@ -395,6 +518,67 @@ def walk(o, cb, modify_key_value = 'value'):
         return newo
 
 
+def walk_update(o, cb):
+    """
+    Non-recursive variant of walk that does not rebuild collections. The callback is applied to the given
+    object and to all values nested in dicts, lists and IonObjects, which are modified in place only where the
+    callback returns a different object. Tuples and sets are turned into lists as with walk.
+    Dict keys are not passed to the callback.
+    """
+    newo = cb(o)
+    if isinstance(newo, (tuple, set)):
+        newo = list(newo)
+    elif not isinstance(newo, (dict, list, IonObjectBase)):
+        return newo
+
+    def iter_values(container):
+        if isinstance(container, dict):
+            return container.iteritems()
+        elif isinstance(container, list):
+            return enumerate(container)
+        return ((fieldname, getattr(container, fieldname)) for fieldname in container._schema)
+
+    # A frame is: (collection, (key, value) iterator)
+    stack = [(newo, iter_values(newo))]
+    while stack:
+        container, values = stack[-1]
+        for key, value in values:
+            newvalue = cb(value)
+            if isinstance(newvalue, (tuple, set)):
+                newvalue = list(newvalue)
+            if newvalue is not value:
+                if isinstance(container, IonObjectBase):
+                    setattr(container, key, newvalue)
+                else:
+                    container[key] = newvalue
+            if isinstance(newvalue, (dict, list, IonObjectBase)):
+                stack.append((newvalue, iter_values(newvalue)))
+                break
+        else:
+            stack.pop()
+
+    return newo
+
+
+def walk_visit(o, cb):
+    """
+    Non-recursive, read-only variant of walk. Calls the callback for the given object and all values nested
+    in dicts, lists, tuples, sets and IonObjects. Return values of the callback are ignored and nothing is copied.
+    The callback is called for a collection before its values are visited.
+    """
+    stack = [o]
+    while stack:
+        obj = stack.pop()
+        cb(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set)):
+            stack.extend(obj)
+        elif isinstance(obj, IonObjectBase):
+            for fieldname in obj._schema:
+                stack.append(getattr(obj, fieldname))
+
+
 class IonObjectSerializationBase(object):
     """
     Base serialization class for serializing/deserializing IonObjects.
@@ -449,8 +633,19 @@ class IonObjectSerializer(IonObjectSerializationBase):
     def serialize(self, obj, update_version=False):
 
         self._transform_method = self._transform(update_version)
+        transform = self._transform_method
+
+        def copy_transform(value):
+            # Copy all dicts and lists, so that the result never shares data with the given object
+            newvalue = transform(value)
+            if newvalue is value:
+                if isinstance(value, dict):
+                    return dict(value)
+                elif isinstance(value, list):
+                    return list(value)
+            return newvalue
 
-        return IonObjectSerializationBase.operate(self, obj)
+        return walk_update(obj, copy_transform)
 
 class IonObjectBlameSerializer(IonObjectSerializer):
 
@@ -485,32 +680,15 @@ class IonObjectDeserializer(IonObjectSerializationBase):
     def _transform(self, obj):
         # Note: This check to detect an IonObject is a bit risky (only type_)
         if isinstance(obj, dict) and "type_" in obj:
-            objc  = obj
-            otype = objc['type_'].encode('ascii')   # Correct?
+            otype = obj['type_'].encode('ascii')   # Correct?
 
-            # don't supply a dict - we want the object to initialize with all its defaults intact,
-            # which preserves things like IonEnumObject and invokes the setattr behavior we want there.
-            ion_obj = self._obj_registry.new(otype)
-
-            # get outdated attributes in data that are not defined in the current schema
-            extra_attributes = objc.viewkeys() - ion_obj._schema.viewkeys() - built_in_attrs
-            for extra in extra_attributes:
-                objc.pop(extra)
-                log.info('discard %s not in current schema' % extra)
-
-            for k, v in objc.iteritems():
-
-                # unicode translate to utf8
-                if isinstance(v, unicode):
-                    v = str(v.encode('utf8'))
+            if "_conflicts" in obj:
+                log.warn("CouchDB conflict detected for ID=%s (ignored): %s", obj.get('_id', None), obj["_conflicts"])
 
-                # CouchDB adds _attachments and puts metadata in it
-                # in pyon metadata is in the document
-                # so we discard _attachments while transforming between the two
-                if k not in ("type_", "_attachments", "_conflicts"):
-                    setattr(ion_obj, k, v)
-                if k == "_conflicts":
-                    log.warn("CouchDB conflict detected for ID=%S (ignored): %s", obj.get('_id', None), v)
+            # Outdated attributes in data that are not defined in the current schema are discarded.
+            # This includes CouchDB's _attachments (in pyon metadata is in the document)
+            decoder = self._obj_registry.get_decoder(otype)
+            ion_obj = decoder(obj, discard_extra=True)
 
             return ion_obj
 
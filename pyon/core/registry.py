@@ -6,7 +6,7 @@ import inspect
 from copy import deepcopy
 
 from pyon.core.exception import NotFound
-from pyon.core.object import walk
+from pyon.core.object import walk, build_object_decoder
 
 import interface.objects
 import interface.messages
@@ -139,13 +139,10 @@ class IonObjectRegistry(object):
         from pyon.core.bootstrap import CFG
         self.validate_setattr = CFG.get_safe('container.objects.validate.setattr', False)
 
-    def new(self, _def, _dict=None, **kwargs):
-        """Instantiates an IonObject based on given object type name and initial values.
-        Note: This is called for the IonObject() instantiation but not for the ObjType() instantiation.
-        @param _def    Name of object type
-        @param _dict   A dict/DotDict/derivative with initial values
-        @param kwargs  Additional initial values
-        """
+        # Cache of object type name to function building objects from decoded dicts
+        self._decoders = {}
+
+    def _get_class(self, _def):
         if _def in model_classes:
             clzz = model_classes[_def]
         elif _def in message_classes:
@@ -166,6 +163,17 @@ class IonObjectRegistry(object):
             setattrmethod = validating_setattr
             setattr(clzz, "__setattr__", setattrmethod)
 
+        return clzz
+
+    def new(self, _def, _dict=None, **kwargs):
+        """Instantiates an IonObject based on given object type name and initial values.
+        Note: This is called for the IonObject() instantiation but not for the ObjType() instantiation.
+        @param _def    Name of object type
+        @param _dict   A dict/DotDict/derivative with initial values
+        @param kwargs  Additional initial values
+        """
+        clzz = self._get_class(_def)
+
         if _dict:
             # Traverse input parameters looking for dict values being passed in as
             # the init values of complex types.  Instantiate new object and substitute
@@ -188,3 +196,23 @@ class IonObjectRegistry(object):
             obj = clzz(**kwargs)
 
         return obj
+
+    def get_decoder(self, _def):
+        """Returns a function that instantiates an IonObject of given type name from a decoded dict
+        (such as received in a message or read from a datastore). The function is built once per type.
+        See pyon.core.object.build_object_decoder.
+        """
+        decoder = self._decoders.get(_def, None)
+        if decoder is None:
+            clzz = self._get_class(_def)
+            if hasattr(clzz, "_schema"):
+                decoder = build_object_decoder(clzz)
+            else:
+                def decoder(obj_dict, discard_extra=False):
+                    ion_obj = self.new(_def)
+                    for k, v in obj_dict.iteritems():
+                        if k != "type_":
+                            setattr(ion_obj, k, v)
+                    return ion_obj
+            self._decoders[_def] = decoder
+        return decoder
@@ -6,7 +6,7 @@ __license__ = 'Apache 2.0'
 
 from pyon.core.registry import IonObjectRegistry
 from pyon.core.bootstrap import IonObject
-from pyon.core.object import IonObjectSerializer, IonObjectDeserializer
+from pyon.core.object import IonObjectSerializer, IonObjectDeserializer, walk, walk_update, walk_visit
 from pyon.core.bootstrap import get_obj_registry
 from pyon.util.int_test import IonIntegrationTestCase
 from nose.plugins.attrib import attr
@@ -53,6 +53,66 @@ class ObjectTest(IonIntegrationTestCase):
         obj.abstract_val = user_info
         obj._validate
 
+    def test_decoder(self):
+        decoder = self.registry.get_decoder('SampleObject')
+        self.assertIs(decoder, self.registry.get_decoder('SampleObject'))
+
+        # All fields present
+        obj_dict = IonObjectSerializer().serialize(self.registry.new('SampleObject', name='sample'))
+        obj_dict['name'] = u'unicode \u20ac'
+        obj = decoder(obj_dict)
+        self.assertEqual(type(obj).__name__, 'SampleObject')
+        self.assertEqual(obj.type_, 'SampleObject')
+        self.assertEqual(obj.name, 'unicode \xe2\x82\xac')
+        self.assertEqual(type(obj.name), str)
+        self.assertEqual(obj.time, "1341269890404")
+
+        # Missing fields get defaults, extra fields kept unless discarded
+        obj = decoder({'type_': 'SampleObject', 'name': 'sample', 'extra_field': 5})
+        self.assertEqual(obj.name, 'sample')
+        self.assertEqual(obj.time, "1341269890404")
+        self.assertEqual(obj.extra_field, 5)
+
+        obj = decoder({'type_': 'SampleObject', 'name': 'sample', 'extra_field': 5}, discard_extra=True)
+        self.assertFalse('extra_field' in obj)
+        obj._validate()
+
+    def test_walk_modes(self):
+        def times_ten(value):
+            if type(value) is int:
+                return value * 10
+            return value
+
+        unchanged = {'a': 'b', 'c': ['d']}
+        test_obj = {'one': 1, 'list': [2, (3, 4)], 'unchanged': unchanged}
+
+        # In place
+        self.assertEqual(walk(test_obj, times_ten), {'one': 10, 'list': [20, [30, 40]], 'unchanged': unchanged})
+        self.assertEqual(test_obj, {'one': 1, 'list': [2, (3, 4)], 'unchanged': unchanged})
+        test_list = test_obj['list']
+        res = walk_update(test_obj, times_ten)
+        self.assertIs(res, test_obj)
+        self.assertIs(res['list'], test_list)
+        self.assertEqual(res, {'one': 10, 'list': [20, [30, 40]], 'unchanged': unchanged})
+
+        # Serialized results never share collections with the given object
+        obj = self.registry.new('SampleObject', name='sample')
+        test_obj = {'obj': obj, 'unchanged': unchanged}
+        res = IonObjectSerializer().serialize(test_obj)
+        self.assertIsNot(res, test_obj)
+        self.assertIsNot(res['unchanged'], unchanged)
+        self.assertIsNot(res['unchanged']['c'], unchanged['c'])
+        res['unchanged']['c'].append('e')
+        self.assertEqual(unchanged, {'a': 'b', 'c': ['d']})
+        self.assertEqual(res['obj']['name'], 'sample')
+
+        # Visit
+        visited = []
+        walk_visit({'obj': obj, 'list': (1, 2)}, visited.append)
+        self.assertIn(obj, visited)
+        self.assertIn('sample', visited)
+        self.assertIn(2, visited)
+
     def test_persisted_version(self):
 
         # create an initial version of SampleResource
@@ -317,3 +317,120 @@ class MessagingPerfTest(IonUnitTestCase):
 
         count_objs(test_obj1)
         time_serialize(test_obj1, "dict of ion nested validated", has_ion=True)
+
+    def test_numpy_perf(self):
+        import numpy as np
+        from pyon.core.interceptor import encode as encode_mod
+        from pyon.core.interceptor.encode import encode_ion, decode_ion
+
+        test_array = np.random.uniform(-1000.0, 1000.0, 1000000).astype('float64')
+
+        old_setting = encode_mod.numpy_buffer_encode
+        try:
+            for name, buffer_encode in (("numpy list", False), ("numpy buffer", True)):
+                encode_mod.numpy_buffer_encode = buffer_encode
+                with time_it(name + ", 1M float64, msgpack.packb"):
+                    msg = msgpack.packb(test_array, default=encode_ion)
+
+                with time_it(name + ", 1M float64, msgpack.unpackb"):
+                    new_array = msgpack.unpackb(msg, object_hook=decode_ion, use_list=1)
+                log.info("  len(msgpack): %s", len(msg))
+
+                self.assertTrue((test_array == new_array).all())
+        finally:
+            encode_mod.numpy_buffer_encode = old_setting
+
+    def test_decode_perf(self):
+        obj_registry = get_obj_registry()
+        _io_serializer = IonObjectSerializer()
+        num_objs = 20000
+
+        obj_dicts = [_io_serializer.serialize(IonObject("DataProduct", name="TestObject %s" % i, description=u"Test \u20ac"))
+                     for i in xrange(num_objs)]
+
+        def decode_setattr(obj_dict):
+            ion_obj = obj_registry.new(obj_dict["type_"])
+            for k, v in obj_dict.iteritems():
+                if isinstance(v, unicode):
+                    v = v.encode('utf8')
+                if k != "type_":
+                    setattr(ion_obj, k, v)
+            return ion_obj
+
+        t1 = time.time()
+        objs1 = [decode_setattr(od) for od in obj_dicts]
+        t2 = time.time()
+        log.info("Decode new+setattr: %s objects/sec", int(num_objs / (t2-t1)))
+
+        t1 = time.time()
+        objs2 = [obj_registry.get_decoder(od["type_"])(od) for od in obj_dicts]
+        t2 = time.time()
+        log.info("Decode cached decoder: %s objects/sec", int(num_objs / (t2-t1)))
+
+        self.assertEquals(objs1, objs2)
+
+    def test_validate_perf(self):
+        from pyon.core.registry import model_classes
+        from pyon.core import object as object_mod
+
+        test_objs = []
+        for clzz in model_classes.values():
+            try:
+                test_objs.append(clzz())
+            except Exception:
+                pass
+
+        object_mod._validators.clear()
+        with time_it("compile validators, %s object types" % len(test_objs)):
+            for obj in test_objs:
+                try:
+                    obj._validate()
+                except AttributeError:
+                    pass
+
+        num_rounds = 20
+        num_valid = 0
+        t1 = time.time()
+        for i in xrange(num_rounds):
+            for obj in test_objs:
+                try:
+                    obj._validate()
+                except AttributeError:
+                    pass
+                num_valid += 1
+        t2 = time.time()
+        log.info("Validate object model: %s validations/sec", int(num_valid / (t2-t1)))
+
+    def test_walk_alloc(self):
+        """Counts dicts and lists allocated by the serializer for large resource documents"""
+        from pyon.core.object import walk
+
+        # Resources with nested dicts and lists, but few nested IonObjects
+        test_objs = []
+        for i in xrange(200):
+            res_obj = IonObject("DataProduct", name="TestObject %s" % i)
+            res_obj.addl = create_test_object(3, 10, do_list=True)
+            test_objs.append(res_obj)
+
+        _io_serializer = IonObjectSerializer()
+
+        def collection_ids(obj, ids):
+            if type(obj) in (dict, list):
+                ids.add(id(obj))
+                for v in (obj.itervalues() if type(obj) is dict else obj):
+                    collection_ids(v, ids)
+            elif isinstance(obj, IonObjectBase):
+                for v in obj.__dict__.itervalues():
+                    collection_ids(v, ids)
+            return ids
+
+        orig_ids = collection_ids(test_objs, set())
+
+        with time_it("serialize, walk copy"):
+            res1 = walk(test_objs, _io_serializer._transform())
+        with time_it("serialize, IonObjectSerializer.serialize"):
+            res2 = _io_serializer.serialize(test_objs)
+        self.assertEquals(res1, res2)
+
+        log.info("  Collections allocated, walk: %s", len(collection_ids(res1, set()) - orig_ids))
+        log.info("  Collections allocated, serialize: %s", len(collection_ids(res2, set()) - orig_ids))
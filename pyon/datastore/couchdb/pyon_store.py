@@ -136,6 +136,15 @@ class PyonCouchDataStoreMixin(AbstractCouchDataStore):
         else:
             return self.read_mult(ids), assocs
 
+    def find_associations_mult(self, triples, id_only=True):
+        """
+        Returns the existing associations for a list of (subject id, predicate, object id) 3-tuples
+        """
+        assocs = []
+        for subject_id, predicate, object_id in triples:
+            assocs.extend(self.find_associations(subject_id, predicate, object_id, id_only=id_only))
+        return assocs
+
     def find_objects(self, subject, predicate=None, object_type=None, id_only=False, **kwargs):
         log.debug("find_objects(subject=%s, predicate=%s, object_type=%s, id_only=%s", subject, predicate, object_type, id_only)
 
@@ -10,6 +10,9 @@ a mapping to the datastore technology.
 
 __author__ = 'Michael Meisinger'
 
+import base64
+import simplejson as json
+
 from pyon.core.exception import BadRequest
 from pyon.datastore.datastore_common import DataStore
 
@@ -85,17 +88,26 @@ QUERY_EXP_ID = "qexp_v1.0"
 
 
 class DatastoreQueryBuilder(DatastoreQueryConst):
-    """Helps create structured queries to the datastore"""
+    """
+    Helps create structured queries to the datastore.
+
+    For paging through large result sets, set keyset=True together with a limit: the datastore then
+    returns a page token with the results, which continues after the last row when passed as page_token
+    to the next query. Unlike skip, this does not get slower for pages deep into the result set.
+    """
 
-    def __init__(self, profile=None, datastore=None, where=None, order_by=None, id_only=False, limit=0, skip=0, **kwargs):
+    def __init__(self, profile=None, datastore=None, where=None, order_by=None, id_only=False, limit=0, skip=0,
+                 keyset=False, page_token=None, **kwargs):
         self.query = {}
         self.query["QUERYEXP"] = QUERY_EXP_ID
         qargs = self.query.setdefault("query_args", {})
         qargs["profile"] = profile or DataStore.DS_PROFILE.RESOURCES
         qargs["datastore"] = datastore or DataStore.DS_RESOURCES
-        self.build_query(where=where, order_by=order_by, id_only=id_only, limit=limit, skip=skip)
+        self.build_query(where=where, order_by=order_by, id_only=id_only, limit=limit, skip=skip,
+                         keyset=keyset, page_token=page_token)
 
-    def build_query(self, where=None, order_by=None, id_only=None, limit=None, skip=None, **kwargs):
+    def build_query(self, where=None, order_by=None, id_only=None, limit=None, skip=None,
+                    keyset=None, page_token=None, **kwargs):
         qargs = self.query["query_args"]
         if id_only is not None:
             qargs["id_only"] = id_only
@@ -103,6 +115,11 @@ class DatastoreQueryBuilder(DatastoreQueryConst):
             qargs["limit"] = limit
         if skip is not None:
             qargs["skip"] = skip
+        if keyset is not None:
+            qargs["keyset"] = keyset
+        if page_token is not None:
+            qargs["keyset"] = True
+            qargs["page_token"] = page_token
         qargs.update(kwargs)
         self.query["where"] = where if where is not None else self.query.get("where", "")
         self.query["order_by"] = order_by if order_by is not None else self.query.get("order_by", {})
@@ -260,6 +277,22 @@ class DatastoreQueryBuilder(DatastoreQueryConst):
 
         return order_by_list
 
+    # --- Keyset paging
+
+    @classmethod
+    def create_page_token(cls, sort_values, last_id):
+        """Returns an opaque token for the page after the row with given sort column values and id"""
+        return base64.urlsafe_b64encode(json.dumps([list(sort_values), last_id]))
+
+    @classmethod
+    def parse_page_token(cls, page_token):
+        """Returns a tuple of sort column values and id from a page token"""
+        try:
+            sort_values, last_id = json.loads(base64.urlsafe_b64decode(str(page_token)))
+        except Exception:
+            raise BadRequest("Invalid page token: %s" % page_token)
+        return sort_values, last_id
+
     def _check_col(self, col):
         profile = self.query["query_args"]["profile"]
         if profile == DataStore.DS_PROFILE.RESOURCES:
@@ -283,3 +316,5 @@ class DatastoreQueryBuilder(DatastoreQueryConst):
             raise BadRequest("where expected in query")
         if not "order_by" in query:
             raise BadRequest("order_by expected in query")
+        if query["query_args"].get("keyset", False) and query["query_args"].get("skip", 0) > 0:
+            raise BadRequest("skip cannot be combined with keyset paging")
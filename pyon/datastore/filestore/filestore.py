@@ -1,21 +1,22 @@
 #!/usr/bin/env python
 
-"""File system based datastore with limited functionality (CRUD)."""
+"""File system based datastore with limited functionality (CRUD and simple resource finds)."""
 
 __author__ = 'Michael Meisinger'
 
+import gevent
 import simplejson as json
-import base64
 import os
+import re
 from uuid import uuid4
 
 from pyon.core import bootstrap
 from pyon.core.bootstrap import get_obj_registry, CFG
-from pyon.core.exception import BadRequest, NotFound, Inconsistent
+from pyon.core.exception import BadRequest, NotFound, Inconsistent, Conflict
 from pyon.core.object import IonObjectBase
 from pyon.ion.event import EventPublisher
 from pyon.ion.identifier import create_unique_resource_id
-from pyon.ion.resource import LCS, LCE, PRED, RT, AS, get_restype_lcsm, is_resource, ExtendedResourceContainer, lcstate, lcsplit
+from pyon.ion.resource import LCS, LCE, PRED, RT, AS, get_restype_lcsm, is_resource, ExtendedResourceContainer, lcstate, lcsplit, AvailabilityStates
 from pyon.util.containers import get_ion_ts
 from pyon.util.log import log
 from pyon.core.object import IonObjectBase, IonObjectSerializer, IonObjectDeserializer
@@ -24,26 +25,252 @@ from pyon.util.file_sys import FileSystem, FS
 from interface.objects import Attachment, AttachmentType, ResourceModificationType
 
 
+DEFAULT_CONFIG = {"fsync": "interval",          # always, interval or never
+                  "fsync_interval": 1.0,        # Seconds between background fsyncs for policy interval
+                  "segment_size": 64*1024*1024, # Bytes after which a new segment is started
+                  "compact_ratio": 0.5,         # Auto compact when this fraction of the log is garbage (0: off)
+                  }
+
+SEGMENT_PATTERN = re.compile(r"^seg-(\d{6})\.log$")
+
+# Document attributes with an in-memory secondary index
+INDEX_ATTRS = ("type_", "lcstate", "availability", "name", "visibility")
+
+
 class FileDataStore(object):
-    def __init__(self, container, datastore_name=""):
+    """
+    Datastore in a directory of append-only segment files. Each create, update and delete
+    appends one JSON document line to the active segment and flushes it to the OS, so that it
+    survives a process kill; fsync to disk follows the fsync policy. An in-memory index of id to
+    segment position is rebuilt from the segments on start; superseded revisions are removed
+    by compaction. Secondary in-memory indexes support finding resources by type, lcstate
+    and name.
+    """
+    def __init__(self, container, datastore_name="", config=None):
         self.container = container
         self.datastore_name = datastore_name
 
+        self.config = DEFAULT_CONFIG.copy()
+        self.config.update(config if config is not None else CFG.get_safe("container.filestore", None) or {})
+        if self.config["fsync"] not in ("always", "interval", "never"):
+            raise BadRequest("Unknown filestore fsync policy: %s" % self.config["fsync"])
+
         # Object serialization/deserialization
         self._io_serializer = IonObjectSerializer()
         self._io_deserializer = IonObjectDeserializer(obj_registry=get_obj_registry())
 
+        self._index = {}            # id -> (segment, offset, length, rev, indexed attribute values)
+        self._attr_index = {attr: {} for attr in INDEX_ATTRS}   # attr -> value -> set of ids
+        self._read_files = {}       # segment -> open file for reads
+        self._seg_file = None       # Open file of the active segment
+        self._seg_num = 0
+        self._seg_offset = 0
+        self._dirty = False         # Appended data not yet fsynced
+        self._sync_greenlet = None
+        self._total_bytes = 0
+        self._live_bytes = 0
+
     def start(self):
         if self.container.has_capability(self.container.CCAP.FILE_SYSTEM):
             self.datastore_dir = FileSystem.get_url(FS.FILESTORE, self.datastore_name)
         else:
             self.datastore_dir = "./tmp/%s" % self.datastore_name
+        if not os.path.exists(self.datastore_dir):
+            os.makedirs(self.datastore_dir)
 
-    def stop(self):
-        pass
+        self._load_segments()
+        self._import_object_files()
+        if self.config["fsync"] == "interval":
+            self._sync_greenlet = gevent.spawn(self._sync_loop)
 
-    def _get_filename(self, object_id):
-        return "%s/%s" % (self.datastore_dir, object_id)
+    def stop(self):
+        if self._sync_greenlet:
+            self._sync_greenlet.kill()
+            self._sync_greenlet = None
+        if self._seg_file:
+            self._sync()
+            self._seg_file.close()
+            self._seg_file = None
+        for f in self._read_files.itervalues():
+            f.close()
+        self._read_files.clear()
+
+    # -------------------------------------------------------------------------
+    # Segment log
+
+    def _get_segment_filename(self, seg_num):
+        return os.path.join(self.datastore_dir, "seg-%06d.log" % seg_num)
+
+    def _list_segments(self):
+        seg_nums = []
+        for filename in os.listdir(self.datastore_dir):
+            match = SEGMENT_PATTERN.match(filename)
+            if match:
+                seg_nums.append(int(match.group(1)))
+        return sorted(seg_nums)
+
+    def _load_segments(self):
+        """Rebuilds the in-memory indexes by scanning all segments in order"""
+        self._index.clear()
+        for attr_values in self._attr_index.itervalues():
+            attr_values.clear()
+        self._total_bytes = self._live_bytes = 0
+
+        seg_nums = self._list_segments()
+        for seg_num in seg_nums:
+            self._load_segment(seg_num, is_last=seg_num == seg_nums[-1])
+
+        self._open_segment(seg_nums[-1] if seg_nums else 1)
+        log.debug("FileDataStore %s loaded %s docs from %s segments", self.datastore_name, len(self._index), len(seg_nums))
+
+    def _load_segment(self, seg_num, is_last=False):
+        filename = self._get_segment_filename(seg_num)
+        offset = 0
+        with open(filename, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith("\n"):
+                        raise ValueError("Incomplete record")
+                    doc = json.loads(line)
+                except ValueError:
+                    if not is_last:
+                        raise Inconsistent("FileDataStore segment %s corrupt at offset %s" % (filename, offset))
+                    # A crash during an append leaves a partial last record. Drop it.
+                    log.warn("FileDataStore segment %s truncated at offset %s", filename, offset)
+                    break
+                self._index_record(doc, seg_num, offset, len(line))
+                offset += len(line)
+
+        if is_last and offset != os.path.getsize(filename):
+            with open(filename, "r+b") as f:
+                f.truncate(offset)
+
+    def _open_segment(self, seg_num):
+        if self._seg_file:
+            self._sync()
+            self._seg_file.close()
+        self._seg_num = seg_num
+        filename = self._get_segment_filename(seg_num)
+        self._seg_file = open(filename, "ab")
+        self._seg_offset = os.path.getsize(filename)
+        self._dirty = False
+
+    def _append(self, docs):
+        """Appends given docs as one write, updates the indexes and syncs according to policy"""
+        self._write_records(docs)
+        if self.config["fsync"] == "always":
+            self._sync()
+
+        compact_ratio = self.config["compact_ratio"]
+        if compact_ratio and self._total_bytes > self.config["segment_size"] and \
+                self._total_bytes - self._live_bytes > compact_ratio * self._total_bytes:
+            self.compact_datastore()
+
+    def _write_records(self, docs):
+        if self._seg_offset >= self.config["segment_size"]:
+            self._open_segment(self._seg_num + 1)
+
+        lines = [json.dumps(doc) + "\n" for doc in docs]
+        self._seg_file.write("".join(lines))
+        self._seg_file.flush()
+        self._dirty = True
+        for doc, line in zip(docs, lines):
+            self._index_record(doc, self._seg_num, self._seg_offset, len(line))
+            self._seg_offset += len(line)
+
+    def _sync(self):
+        if self._dirty and self.config["fsync"] != "never":
+            os.fsync(self._seg_file.fileno())
+        self._dirty = False
+
+    def _sync_loop(self):
+        """Fsyncs appended data every fsync_interval seconds for policy interval"""
+        while True:
+            gevent.sleep(self.config["fsync_interval"])
+            if self._dirty:
+                try:
+                    self._sync()
+                except Exception:
+                    log.exception("FileDataStore %s fsync failed", self.datastore_name)
+
+    def _index_record(self, doc, seg_num, offset, length):
+        doc_id = doc["_id"]
+        self._total_bytes += length
+        old_entry = self._index.pop(doc_id, None)
+        if old_entry:
+            self._live_bytes -= old_entry[2]
+            for attr, value in zip(INDEX_ATTRS, old_entry[4]):
+                if value is not None:
+                    self._attr_index[attr][value].discard(doc_id)
+        if doc.get("_deleted", False):
+            return
+
+        attr_values = tuple(doc.get(attr, None) for attr in INDEX_ATTRS)
+        self._index[doc_id] = (seg_num, offset, length, doc["_rev"], attr_values)
+        self._live_bytes += length
+        for attr, value in zip(INDEX_ATTRS, attr_values):
+            if value is not None:
+                self._attr_index[attr].setdefault(value, set()).add(doc_id)
+
+    def _read_record(self, entry):
+        seg_num, offset, length = entry[:3]
+        f = self._read_files.get(seg_num, None)
+        if f is None:
+            f = self._read_files[seg_num] = open(self._get_segment_filename(seg_num), "rb")
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+    def _import_object_files(self):
+        """Moves docs from the former one-file-per-object layout into the log"""
+        filenames = [fn for fn in os.listdir(self.datastore_dir)
+                     if not SEGMENT_PATTERN.match(fn) and os.path.isfile(os.path.join(self.datastore_dir, fn))]
+        docs = []
+        for filename in filenames:
+            try:
+                with open(os.path.join(self.datastore_dir, filename), "r") as f:
+                    doc = json.loads(f.read())
+            except ValueError:
+                continue
+            if type(doc) is dict and doc.get("_id", None) == filename and filename not in self._index:
+                doc["_rev"] = "1"
+                docs.append(doc)
+        if not docs:
+            return
+
+        self._append(docs)
+        self._sync()
+        for doc in docs:
+            os.remove(os.path.join(self.datastore_dir, doc["_id"]))
+        log.info("FileDataStore %s imported %s object files", self.datastore_name, len(docs))
+
+    def compact_datastore(self, datastore_name=None):
+        """
+        Rewrites the current revision of all docs into new segments and removes the old ones.
+        Old segments are removed in order, so an interrupted compaction does not bring back
+        deleted docs.
+        """
+        old_seg_nums = self._list_segments()
+        live_ids = sorted(self._index.keys(), key=lambda doc_id: self._index[doc_id][:2])
+        docs = [self._read_record(self._index[doc_id]) for doc_id in live_ids]
+
+        self._open_segment(self._seg_num + 1)
+        self._index.clear()
+        for attr_values in self._attr_index.itervalues():
+            attr_values.clear()
+        self._total_bytes = self._live_bytes = 0
+        for i in xrange(0, len(docs), 1000):
+            self._write_records(docs[i:i+1000])
+        self._sync()
+
+        for f in self._read_files.itervalues():
+            f.close()
+        self._read_files.clear()
+        for seg_num in old_seg_nums:
+            os.remove(self._get_segment_filename(seg_num))
+        log.debug("FileDataStore %s compacted %s segments, %s docs", self.datastore_name, len(old_seg_nums), len(docs))
+
+    # -------------------------------------------------------------------------
+    # Document operations
 
     def create(self, obj, object_id=None, attachments=None, datastore_name=""):
         """
@@ -54,11 +281,16 @@ class FileDataStore(object):
         if not isinstance(obj, IonObjectBase):
             raise BadRequest("Obj param is not instance of IonObjectBase")
 
-
         return self.create_doc(self._ion_object_to_persistence_dict(obj),
                                object_id=object_id, datastore_name=datastore_name,
                                attachments=attachments)
 
+    def create_mult(self, objects, object_ids=None, allow_ids=None):
+        if any([not isinstance(obj, IonObjectBase) for obj in objects]):
+            raise BadRequest("Obj param is not instance of IonObjectBase")
+
+        return self.create_doc_mult([self._ion_object_to_persistence_dict(obj) for obj in objects], object_ids)
+
     def create_doc(self, doc, object_id=None, attachments=None, datastore_name=""):
         """
         Persists the document using the optionally suggested doc_id, and creates attachments to it.
@@ -66,35 +298,89 @@ class FileDataStore(object):
         """
         if '_id' in doc:
             raise BadRequest("Doc must not have '_id'")
+        if '_rev' in doc:
+            raise BadRequest("Doc must not have '_rev'")
 
-        # Assign an id to doc (recommended in CouchDB documentation)
         doc["_id"] = object_id or uuid4().hex
+        if doc["_id"] in self._index:
+            raise BadRequest("Object with id %s already exists" % doc["_id"])
+        doc["_rev"] = "1"
         log.debug('Creating new object %s/%s' % (datastore_name, doc["_id"]))
-        log.debug('create doc contents: %s', doc)
 
-        filename = self._get_filename(doc["_id"])
-        doc_json = json.dumps(doc)
-        with open(filename, "w") as f:
-            f.write(doc_json)
-
-        return doc["_id"], 1
+        self._append([doc])
+        return doc["_id"], doc["_rev"]
+
+    def create_doc_mult(self, docs, object_ids=None, datastore_name=""):
+        """Creates a list of docs with one append and returns 3-tuples of (Success, id, rev)."""
+        if type(docs) is not list:
+            raise BadRequest("Invalid type for docs:%s" % type(docs))
+        if object_ids and len(object_ids) != len(docs):
+            raise BadRequest("Invalid object_ids")
+        if not docs:
+            return []
+
+        new_ids = set()
+        for i, doc in enumerate(docs):
+            if '_rev' in doc:
+                raise BadRequest("Doc must not have '_rev'")
+            doc_id = doc.get("_id", None) or (object_ids[i] if object_ids else None) or uuid4().hex
+            if doc_id in self._index or doc_id in new_ids:
+                raise BadRequest("Object with id %s already exists" % doc_id)
+            new_ids.add(doc_id)
+        for i, doc in enumerate(docs):
+            doc["_id"] = doc.get("_id", None) or (object_ids[i] if object_ids else None) or uuid4().hex
+            doc["_rev"] = "1"
+
+        self._append(docs)
+        return [(True, doc["_id"], doc["_rev"]) for doc in docs]
 
     def update(self, obj, datastore_name=""):
         if not isinstance(obj, IonObjectBase):
             raise BadRequest("Obj param is not instance of IonObjectBase")
         return self.update_doc(self._ion_object_to_persistence_dict(obj))
 
+    def update_mult(self, objects):
+        if any([not isinstance(obj, IonObjectBase) for obj in objects]):
+            raise BadRequest("Obj param is not instance of IonObjectBase")
+
+        return self.update_doc_mult([self._ion_object_to_persistence_dict(obj) for obj in objects])
+
     def update_doc(self, doc, datastore_name=""):
         if '_id' not in doc:
             raise BadRequest("Doc must have '_id'")
+        entry = self._index.get(doc["_id"], None)
+        if entry is None:
+            raise NotFound('Object with id %s does not exist.' % doc["_id"])
+        if doc.get("_rev", entry[3]) != entry[3]:
+            raise Conflict("Object with id %s revision conflict is=%s, need=%s" % (doc["_id"], entry[3], doc["_rev"]))
 
-        log.debug('update doc contents: %s', doc)
-        filename = self._get_filename(doc["_id"])
-        doc_json = json.dumps(doc)
-        with open(filename, "w") as f:
-            f.write(doc_json)
+        doc["_rev"] = str(int(entry[3]) + 1)
+        self._append([doc])
+        return doc["_id"], doc["_rev"]
 
-        return doc["_id"], 2
+    def update_doc_mult(self, docs, datastore_name=""):
+        """
+        Updates a list of docs with one append. Returns 3-tuples of (True, id, new rev), or
+        (False, id, "conflict") for docs that do not exist or have a different rev.
+        """
+        if type(docs) is not list:
+            raise BadRequest("Invalid type for docs:%s" % type(docs))
+        if not all(["_id" in doc for doc in docs]):
+            raise BadRequest("Docs must have '_id'")
+
+        result, update_docs = [], []
+        for doc in docs:
+            entry = self._index.get(doc["_id"], None)
+            if entry is None or doc.get("_rev", entry[3]) != entry[3]:
+                result.append((False, doc["_id"], "conflict"))
+                continue
+            doc["_rev"] = str(int(entry[3]) + 1)
+            update_docs.append(doc)
+            result.append((True, doc["_id"], doc["_rev"]))
+
+        if update_docs:
+            self._append(update_docs)
+        return result
 
     def read(self, object_id, rev_id="", datastore_name=""):
         if not isinstance(object_id, str):
@@ -103,20 +389,29 @@ class FileDataStore(object):
 
         # Convert doc into Ion object
         obj = self._persistence_dict_to_ion_object(doc)
-        log.debug('Ion object: %s', str(obj))
         return obj
 
+    def read_mult(self, object_ids, datastore_name="", strict=True):
+        if any([not isinstance(object_id, str) for object_id in object_ids]):
+            raise BadRequest("Object ids are not string: %s" % str(object_ids))
+
+        docs = self.read_doc_mult(object_ids, datastore_name, strict=strict)
+        return [self._persistence_dict_to_ion_object(doc) if doc is not None else None for doc in docs]
+
     def read_doc(self, doc_id, rev_id="", datastore_name=""):
-        log.debug('Reading head version of object %s/%s', datastore_name, doc_id)
-        filename = self._get_filename(doc_id)
-        doc = None
-        with open(filename, "r") as f:
-            doc_json = f.read()
-            doc = json.loads(doc_json)
-        if doc is None:
+        entry = self._index.get(doc_id, None)
+        if entry is None:
             raise NotFound('Object with id %s does not exist.' % str(doc_id))
-        log.debug('read doc contents: %s', doc)
-        return doc
+        return self._read_record(entry)
+
+    def read_doc_mult(self, object_ids, datastore_name="", strict=True):
+        entries = [self._index.get(doc_id, None) for doc_id in object_ids]
+        if strict:
+            notfound_list = ['Object with id %s does not exist.' % object_ids[i]
+                             for i, entry in enumerate(entries) if entry is None]
+            if notfound_list:
+                raise NotFound("\n".join(notfound_list))
+        return [self._read_record(entry) if entry is not None else None for entry in entries]
 
     def delete(self, obj, datastore_name="", del_associations=False):
         if not isinstance(obj, IonObjectBase) and not isinstance(obj, str):
@@ -131,12 +426,90 @@ class FileDataStore(object):
     def delete_doc(self, doc, datastore_name="", del_associations=False):
         doc_id = doc if type(doc) is str else doc["_id"]
         log.debug('Deleting object %s/%s', datastore_name, doc_id)
-        filename = self._get_filename(doc_id)
+        self.delete_doc_mult([doc_id])
+
+    def delete_doc_mult(self, object_ids, datastore_name=None):
+        entries = [self._index.get(doc_id, None) for doc_id in object_ids]
+        if None in entries:
+            raise NotFound('Object with id %s does not exist.' % object_ids[entries.index(None)])
+        self._append([dict(_id=doc_id, _rev=str(int(entry[3]) + 1), _deleted=True)
+                      for doc_id, entry in zip(object_ids, entries)])
 
-        try:
-            os.remove(filename)
-        except OSError:
-            raise NotFound('Object with id %s does not exist.' % doc_id)
+    def delete_mult(self, object_ids, datastore_name=None):
+        return self.delete_doc_mult(object_ids, datastore_name)
+
+    # -------------------------------------------------------------------------
+    # Resource finds (secondary indexes)
+
+    def find_res_by_type(self, restype, lcstate=None, id_only=False, filter=None):
+        if type(id_only) is not bool:
+            raise BadRequest('id_only must be type bool, not %s' % type(id_only))
+        if lcstate:
+            raise BadRequest('lcstate not supported anymore in find_res_by_type')
+
+        if restype:
+            res_ids = self._attr_index["type_"].get(restype, set())
+        else:
+            res_ids = (doc_id for (doc_id, entry) in self._index.iteritems() if entry[4][0] is not None)
+        res_ids = [doc_id for doc_id in res_ids if self._index[doc_id][4][1] != LCS.DELETED]
+        return self._prepare_find_return(res_ids, id_only=id_only, filter=filter)
+
+    def find_res_by_lcstate(self, lcstate, restype=None, id_only=False, filter=None):
+        if type(id_only) is not bool:
+            raise BadRequest('id_only must be type bool, not %s' % type(id_only))
+        if '_' in lcstate:
+            log.warn("Search for compound lcstate restricted to maturity: %s", lcstate)
+            lcstate,_ = lcstate.split("_", 1)
+
+        is_maturity = lcstate not in AvailabilityStates
+        res_ids = self._attr_index["lcstate" if is_maturity else "availability"].get(lcstate, set())
+        if restype:
+            res_ids = res_ids & self._attr_index["type_"].get(restype, set())
+        return self._prepare_find_return(res_ids, id_only=id_only, filter=filter,
+                                         lcstate_attr="lcstate" if is_maturity else "availability")
+
+    def find_res_by_name(self, name, restype=None, id_only=False, filter=None):
+        if type(id_only) is not bool:
+            raise BadRequest('id_only must be type bool, not %s' % type(id_only))
+
+        res_ids = self._attr_index["name"].get(name, set())
+        if restype:
+            res_ids = res_ids & self._attr_index["type_"].get(restype, set())
+        res_ids = [doc_id for doc_id in res_ids if self._index[doc_id][4][1] != LCS.DELETED]
+        return self._prepare_find_return(res_ids, id_only=id_only, filter=filter)
+
+    def _filter_access(self, res_ids, filter):
+        """
+        Returns the ids of resources visible to the filter's current actor, as the Postgres store's
+        access filter. Without associations, OWNER and FACILITY visibility grant no additional access.
+        """
+        current_actor_id = filter.get("current_actor_id", None)
+        if current_actor_id in (filter.get("superuser_actor_ids", None) or []):
+            return res_ids
+        if current_actor_id and current_actor_id != "anonymous":
+            hidden = (3, 4)
+        else:
+            hidden = (2, 3, 4)
+        vis_idx = INDEX_ATTRS.index("visibility")
+        return [doc_id for doc_id in res_ids if self._index[doc_id][4][vis_idx] not in hidden]
+
+    def _prepare_find_return(self, res_ids, id_only=True, filter=None, lcstate_attr=None):
+        filter = filter if filter is not None else {}
+        res_ids = sorted(str(doc_id) for doc_id in self._filter_access(res_ids, filter))
+        if filter.get("skip", 0) > 0:
+            res_ids = res_ids[filter["skip"]:]
+        if filter.get("limit", 0) > 0:
+            res_ids = res_ids[:filter["limit"]]
+        res_assocs = []
+        for doc_id in res_ids:
+            attr_values = dict(zip(INDEX_ATTRS, self._index[doc_id][4]))
+            res_assoc = dict(id=doc_id, name=attr_values["name"], type=attr_values["type_"])
+            if lcstate_attr:
+                res_assoc["lcstate"] = attr_values[lcstate_attr]
+            res_assocs.append(res_assoc)
+        if id_only:
+            return res_ids, res_assocs
+        return [self._persistence_dict_to_ion_object(doc) for doc in self.read_doc_mult(res_ids)], res_assocs
 
     def _ion_object_to_persistence_dict(self, ion_object):
         if ion_object is None: return None
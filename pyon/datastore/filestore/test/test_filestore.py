@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+__license__ = 'Apache 2.0'
+
+import gevent
+import os
+import shutil
+import simplejson as json
+import sys
+import tempfile
+import time
+from mock import Mock
+from nose.plugins.attrib import attr
+
+from pyon.util.unit_test import IonUnitTestCase
+
+from pyon.core.exception import BadRequest, NotFound, Conflict
+from pyon.datastore.filestore.filestore import FileDataStore
+
+
+class FileDataStoreTestCase(IonUnitTestCase):
+
+    def setUp(self):
+        # Without file system capability, the store is in ./tmp/<datastore_name>
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp_dir)
+
+    def _start_store(self, datastore_name="test", **config):
+        container = Mock()
+        container.has_capability.return_value = False
+        ds = FileDataStore(container, datastore_name=datastore_name, config=config)
+        ds.start()
+        self.addCleanup(ds.stop)
+        return ds
+
+
+@attr('UNIT', group='datastore')
+class TestFileDataStore(FileDataStoreTestCase):
+
+    def test_crud(self):
+        ds = self._start_store(fsync="always")
+        doc_id, rev = ds.create_doc(dict(type_="InstrumentDevice", name="dev1", lcstate="DEPLOYED"))
+        self.assertEquals(rev, "1")
+        with self.assertRaises(BadRequest):
+            ds.create_doc(dict(name="dev2"), object_id=doc_id)
+        with self.assertRaises(BadRequest):
+            ds.create_doc(dict(_id="dev2", name="dev2"))
+
+        doc = ds.read_doc(doc_id)
+        self.assertEquals(doc["name"], "dev1")
+        doc["name"] = "dev1a"
+        self.assertEquals(ds.update_doc(doc), (doc_id, "2"))
+        doc["_rev"] = "1"
+        with self.assertRaises(Conflict):
+            ds.update_doc(doc)
+
+        res = ds.create_doc_mult([dict(type_="InstrumentDevice", name="dev2"), dict(type_="PlatformDevice", name="dev3")])
+        self.assertTrue(all(r[0] for r in res))
+        docs = ds.read_doc_mult([doc_id, res[0][1]])
+        self.assertEquals([d["name"] for d in docs], ["dev1a", "dev2"])
+        self.assertEquals(ds.read_doc_mult([doc_id, "missing"], strict=False)[1], None)
+
+        docs[1]["name"] = "dev2a"
+        res_upd = ds.update_doc_mult([docs[1], dict(_id=res[1][1], _rev="5")])
+        self.assertEquals(res_upd, [(True, res[0][1], "2"), (False, res[1][1], "conflict")])
+
+        ds.delete_doc(doc_id)
+        with self.assertRaises(NotFound):
+            ds.read_doc(doc_id)
+        with self.assertRaises(NotFound):
+            ds.delete_doc(doc_id)
+
+    def test_find_indexes(self):
+        ds = self._start_store()
+        ds.create_doc_mult([dict(type_="InstrumentDevice", name="dev%s" % (i % 2), lcstate="DEPLOYED",
+                                 availability="AVAILABLE") for i in xrange(4)])
+        doc_id, _ = ds.create_doc(dict(type_="PlatformDevice", name="dev0", lcstate="PLANNED", availability="PRIVATE"))
+
+        self.assertEquals(len(ds.find_res_by_type("InstrumentDevice", id_only=True)[0]), 4)
+        self.assertEquals(len(ds.find_res_by_name("dev0", id_only=True)[0]), 3)
+        self.assertEquals(ds.find_res_by_name("dev0", restype="PlatformDevice", id_only=True)[0], [doc_id])
+        self.assertEquals(len(ds.find_res_by_lcstate("DEPLOYED", id_only=True)[0]), 4)
+        res_ids, res_assocs = ds.find_res_by_lcstate("PRIVATE", id_only=True)
+        self.assertEquals(res_ids, [doc_id])
+        self.assertEquals(res_assocs[0]["lcstate"], "PRIVATE")
+
+        # Index follows updates and deletes
+        doc = ds.read_doc(doc_id)
+        doc["lcstate"] = "DEPLOYED"
+        ds.update_doc(doc)
+        self.assertEquals(len(ds.find_res_by_lcstate("DEPLOYED", id_only=True)[0]), 5)
+        self.assertEquals(ds.find_res_by_lcstate("PLANNED", id_only=True)[0], [])
+        ds.delete_doc(doc_id)
+        self.assertEquals(len(ds.find_res_by_name("dev0", id_only=True)[0]), 2)
+
+    def test_find_filter(self):
+        ds = self._start_store()
+        doc_ids = sorted(r[1] for r in ds.create_doc_mult([dict(type_="InstrumentDevice", name="dev%s" % i, visibility=i % 5)
+                                                           for i in xrange(10)]))
+
+        res_ids, _ = ds.find_res_by_type("InstrumentDevice", id_only=True, filter=dict(skip=2, limit=3))
+        self.assertEquals(res_ids, doc_ids[2:5])
+
+        # Same visibility rules as the Postgres store's access filter
+        def count_visible(**filter):
+            return len(ds.find_res_by_type("InstrumentDevice", id_only=True, filter=filter)[0])
+        self.assertEquals(count_visible(), 4)
+        self.assertEquals(count_visible(current_actor_id="anonymous"), 4)
+        self.assertEquals(count_visible(current_actor_id="actor1"), 6)
+        self.assertEquals(count_visible(current_actor_id="actor1", superuser_actor_ids=["actor1"]), 10)
+        self.assertEquals(len(ds.find_res_by_name("dev3", id_only=True, filter=dict(current_actor_id="actor1"))[0]), 0)
+
+    def test_fsync_interval(self):
+        ds = self._start_store(fsync_interval=0.05)
+        doc_id, _ = ds.create_doc(dict(type_="InstrumentDevice", name="dev1"))
+
+        # Appends reach the OS right away, fsync follows from the background greenlet
+        with open(ds._get_segment_filename(ds._seg_num), "rb") as f:
+            self.assertIn(doc_id, f.read())
+        self.assertTrue(ds._dirty)
+        gevent.sleep(0.2)
+        self.assertFalse(ds._dirty)
+
+    def test_reopen_and_compact(self):
+        ds = self._start_store(segment_size=1000, compact_ratio=0)
+        doc_ids = [r[1] for r in ds.create_doc_mult([dict(type_="InstrumentDevice", name="dev%s" % i) for i in xrange(20)])]
+        for i in xrange(5):
+            ds.update_doc_mult(ds.read_doc_mult(doc_ids))
+        ds.delete_doc(doc_ids[0])
+        self.assertGreater(len(ds._list_segments()), 1)
+        ds.stop()
+
+        # A partial last record, as left by a crash during an append, is dropped
+        seg_filename = ds._get_segment_filename(ds._list_segments()[-1])
+        with open(seg_filename, "ab") as f:
+            f.write('{"_id": "partial", "na')
+
+        ds = self._start_store(segment_size=1000, compact_ratio=0)
+        self.assertEquals(sorted(ds._index.keys()), sorted(doc_ids[1:]))
+        self.assertEquals(ds.read_doc(doc_ids[1])["_rev"], "6")
+
+        ds.compact_datastore()
+        self.assertEquals(ds._total_bytes, ds._live_bytes)
+        self.assertEquals([d["_rev"] for d in ds.read_doc_mult(doc_ids[1:])], ["6"] * 19)
+        ds.stop()
+
+        ds = self._start_store(segment_size=1000, compact_ratio=0)
+        self.assertEquals(len(ds.find_res_by_type("InstrumentDevice", id_only=True)[0]), 19)
+        with self.assertRaises(NotFound):
+            ds.read_doc(doc_ids[0])
+
+    def test_import_object_files(self):
+        os.makedirs(os.path.join(self.tmp_dir, "tmp", "test"))
+        with open(os.path.join(self.tmp_dir, "tmp", "test", "obj1"), "w") as f:
+            f.write(json.dumps(dict(_id="obj1", type_="InstrumentDevice", name="dev1")))
+
+        ds = self._start_store()
+        self.assertEquals(ds.read_doc("obj1")["name"], "dev1")
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "tmp", "test", "obj1")))
+
+
+class ObjectFileStore(object):
+    """The former FileDataStore layout with one JSON file per object, as benchmark baseline"""
+    def __init__(self, datastore_dir):
+        self.datastore_dir = datastore_dir
+
+    def create_doc(self, doc):
+        doc["_id"] = doc.get("_id", None) or os.urandom(16).encode("hex")
+        with open(os.path.join(self.datastore_dir, doc["_id"]), "w") as f:
+            f.write(json.dumps(doc))
+        return doc["_id"], 1
+
+    def update_doc(self, doc):
+        with open(os.path.join(self.datastore_dir, doc["_id"]), "w") as f:
+            f.write(json.dumps(doc))
+        return doc["_id"], 2
+
+    def read_doc(self, doc_id):
+        with open(os.path.join(self.datastore_dir, doc_id), "r") as f:
+            return json.loads(f.read())
+
+
+@attr('PFM', group='datastore')
+class TestFileDataStoreSpeed(FileDataStoreTestCase):
+
+    def test_create_read_update_speed(self):
+        num_docs = 100000
+        obj_dir = os.path.join(self.tmp_dir, "objects")
+        os.makedirs(obj_dir)
+
+        print >>sys.stderr, ""
+        for name, ds in (("object files", ObjectFileStore(obj_dir)),
+                         ("log fsync=never", self._start_store("test_never", fsync="never")),
+                         ("log fsync=interval", self._start_store("test_interval", fsync="interval"))):
+            t1 = time.time()
+            doc_ids = [ds.create_doc(dict(type_="InstrumentDevice", name="dev%s" % i, lcstate="DEPLOYED"))[0]
+                       for i in xrange(num_docs)]
+            t2 = time.time()
+            for doc_id in doc_ids:
+                doc = ds.read_doc(doc_id)
+                doc["lcstate"] = "RETIRED"
+                ds.update_doc(doc)
+            t3 = time.time()
+            print >>sys.stderr, "%s %s docs: create %.4fs, read+update %.4fs" % (name, num_docs, t2-t1, t3-t2)
+            if isinstance(ds, FileDataStore):
+                t1 = time.time()
+                ds.compact_datastore()
+                t2 = time.time()
+                ds.stop()
+                ds.start()
+                t3 = time.time()
+                print >>sys.stderr, "%s compact %.4fs, reopen %.4fs" % (name, t2-t1, t3-t2)
@@ -22,8 +22,9 @@ from ooi.logging import log
 
 from pyon.core.exception import BadRequest, Conflict, NotFound, Inconsistent
 from pyon.datastore.datastore_common import DataStore
-from pyon.datastore.datastore_query import DQ
-from pyon.datastore.postgresql.pg_util import PostgresConnectionPool, StatementBuilder, psycopg2_connect, TracingCursor
+from pyon.datastore.datastore_query import DQ, DatastoreQueryBuilder
+from pyon.datastore.postgresql.pg_util import PostgresConnectionPool, StatementBuilder, psycopg2_connect, TracingCursor, \
+    IteratorFile, copy_escape, statement_stats
 from pyon.util.containers import create_basic_identifier, parse_ion_ts
 from pyon.util.tracer import CallTracer
 
@@ -42,8 +43,8 @@ OBJ_SPECIAL = {"R": ("", ("type_", "lcstate", "availability", "visibility", "nam
                }
 OBJ_TYPE_PRECED = {"R": 1, "A": 2, "D": 3}
 
-# Shared connection pool for container
-pg_connection_pool = None
+# Shared connection pools for container, by pool name ("default" or a datastore profile with its own sizing)
+pg_connection_pools = {}
 
 
 class PostgresDataStore(DataStore):
@@ -73,6 +74,11 @@ class PostgresDataStore(DataStore):
         self.database = self.config.get('database', None) or DEFAULT_DBNAME
         self.default_database = self.config.get('default_database', None) or 'postgres'
         self.pool_maxsize = int(self.config.get('connection_pool_max', 4))
+        self.pool_timeout = self.config.get('connection_pool_timeout', 30)
+        self.pool_max_idle = self.config.get('connection_max_idle', None)
+        self.pool_max_lifetime = self.config.get('connection_max_lifetime', None)
+        self.pool_check_interval = self.config.get('connection_check_interval', None)
+        self.use_prepared = bool(self.config.get('use_prepared_statements', True))
 
         # Database (Postgres database) and datastore (database table) name handling.
         # Scope database with given scope (e.g. sysname).
@@ -83,17 +89,29 @@ class PostgresDataStore(DataStore):
             self.database = "%s_%s" % (self.scope, self.database)
         self.datastore_name = datastore_name
 
+        # Profiles listed in connection_pool_profile_max get a separately sized pool
+        self.pool_name = "default"
+        profile_maxsize = (self.config.get('connection_pool_profile_max', None) or {}).get(self.profile, None)
+        if profile_maxsize:
+            self.pool_name = str(self.profile)
+            self.pool_maxsize = int(profile_maxsize)
+
         self._call_tracer = CallTracer(scope="DB." + (self.datastore_name or "_"))
+        self._column_types = {}   # Table name -> dict of column name to Postgres type name
         self.cursor_args = dict(cursor_factory=TracingCursor, tracer=self._call_tracer)
 
         # Make sure database exists and set connection
         dsn = "host=%s port=%s dbname=%s user=%s password=%s sslmode=disable connect_timeout=5 application_name=%s" % (
             self.host, self.port, self.database, self.username, self.password, "%s:%s" % ("ion", self.datastore_name))
         log.info("Using Postgres connection DSN: %s", dsn)   # TODO: Remove later because of password
-        global pg_connection_pool
-        if not pg_connection_pool:
-            pg_connection_pool = PostgresConnectionPool(dsn, maxsize=self.pool_maxsize)
-        self.pool = pg_connection_pool
+        pool = pg_connection_pools.get(self.pool_name, None)
+        if not pool:
+            pool = PostgresConnectionPool(dsn, maxsize=self.pool_maxsize, checkout_timeout=self.pool_timeout,
+                                          max_idle_time=self.pool_max_idle, max_lifetime=self.pool_max_lifetime,
+                                          check_interval=self.pool_check_interval,
+                                          prepared_statements=self.use_prepared)
+            pg_connection_pools[self.pool_name] = pool
+        self.pool = pool
         try:
             with self.pool.connection() as conn:
                 # Check whether database exists
@@ -143,11 +161,20 @@ class PostgresDataStore(DataStore):
 
     @classmethod
     def close_all(cls):
-        global pg_connection_pool
-        if pg_connection_pool:
-            log.info("Closing %s shared Postgres datastore connections", pg_connection_pool.size)
-            pg_connection_pool.closeall()
-            pg_connection_pool = None
+        for pool_name, pool in pg_connection_pools.items():
+            log.info("Closing %s shared Postgres datastore connections (pool %s)", pool.size, pool_name)
+            pool.closeall()
+        pg_connection_pools.clear()
+
+    @classmethod
+    def get_pool_stats(cls):
+        """Returns a dict of connection pool name to pool stats dict"""
+        return {pool_name: pool.get_stats() for pool_name, pool in pg_connection_pools.iteritems()}
+
+    @classmethod
+    def get_statement_stats(cls, sort_by="total_time", limit=None):
+        """Returns a list of counters per statement template, aggregated over all traced cursors"""
+        return statement_stats.get_stats(sort_by=sort_by, limit=limit)
 
     @classmethod
     def force_disconnect(cls, database_name, default_database="postgres",
@@ -593,6 +620,66 @@ class PostgresDataStore(DataStore):
 
         return result_list
 
+    def bulk_load_docs(self, docs, object_ids=None, datastore_name=None):
+        """
+        Creates a list of objects like create_doc_mult, but streams the rows via COPY instead of
+        building an INSERT statement. Intended for large batches (e.g. events); blocks other greenlets
+        while loading. Returns 3-tuples of (Success, id, rev).
+        """
+        if type(docs) is not list:
+            raise BadRequest("Invalid type for docs:%s" % type(docs))
+        if object_ids and len(object_ids) != len(docs):
+            raise BadRequest("Invalid object_ids")
+        if not docs:
+            return []
+        log.debug('bulk_load_docs(): create %s documents', len(docs))
+
+        qual_ds_name = self._get_datastore_name(datastore_name)
+
+        for i, doc in enumerate(docs):
+            if "_id" not in doc:
+                doc["_id"] = (object_ids[i] if object_ids else None) or self.get_unique_id()
+            doc["_rev"] = "1"
+
+        doc_obj_type = [self._get_obj_type(doc, self.profile) for doc in docs]
+        all_obj_types = set(doc_obj_type)
+
+        with self.pool.copy_cursor(**self.cursor_args) as cur:
+            # Need to make sure to first insert resources then associations for referential integrity
+            for obj_type in sorted(all_obj_types, key=lambda x: OBJ_TYPE_PRECED.get(x, 10)):
+                docs_ot = [doc for (doc, doc_ot) in zip(docs, doc_obj_type) if doc_ot == obj_type]
+
+                extra_cols, table = self._get_extra_cols(docs_ot[0], qual_ds_name, self.profile)
+                xcol = "".join(", %s" % col for col in extra_cols)
+                try:
+                    cur.copy_expert("COPY "+table+" (id, rev, doc" + xcol + ") FROM STDIN",
+                                    IteratorFile(self._copy_rows(docs_ot, extra_cols)))
+                except IntegrityError as ie:
+                    raise BadRequest("Some object already exists: %s" % ie)
+
+        result_list = [(True, doc["_id"], doc["_rev"]) for doc in docs]
+
+        return result_list
+
+    def _copy_rows(self, docs, extra_cols):
+        """Yields COPY text format rows for the given docs"""
+        for doc in docs:
+            row = [doc["_id"], "1", json.dumps(doc)]
+            row.extend(self._get_col_value(col, doc) for col in extra_cols)
+            yield "\t".join([copy_escape(value) for value in row]) + "\n"
+
+    def _get_col_value(self, col, doc):
+        """Returns the value of an extra column for a doc in Postgres text input form"""
+        if col in GEOSPATIAL_COLS:
+            value = self._get_geom_value(col, doc)
+            if value:
+                value = "SRID=4326;" + value
+        elif col in NUMRANGE_COLS:
+            value = self._get_range_value(col, doc)
+        else:
+            value = doc.get(col, None)
+        return value
+
     def create_attachment(self, doc, attachment_name, data, content_type=None, datastore_name=""):
         if not isinstance(attachment_name, str):
             raise BadRequest("attachment name is not string")
@@ -643,21 +730,75 @@ class PostgresDataStore(DataStore):
             raise BadRequest("Docs must have '_rev'")
         if not docs:
             return []
+        if len(set(doc["_id"] for doc in docs)) != len(docs):
+            # A set based update applies only one of several rows for the same id
+            raise BadRequest("Docs must have unique '_id'")
         log.debug('update_doc_mult(): update %s documents', len(docs))
 
         qual_ds_name = self._get_datastore_name(datastore_name)
-        # Could use cur.executemany() here but does not allow for case-by-case reaction to failure
+        # All docs of a table are updated in one statement; rev mismatches are reported per doc
+        result_by_id = {}
         with self.pool.cursor(**self.cursor_args) as cur:
-            result_list = []
+            docs_by_table = {}
             for doc in docs:
                 if "_deleted" in doc:
                     self._delete_doc(cur, qual_ds_name, doc["_id"])
-                    oid, version = doc["_id"], doc["_rev"]
+                    result_by_id[doc["_id"]] = (True, doc["_id"], doc["_rev"])
                 else:
-                    oid, version = self._update_doc(cur, qual_ds_name, doc)
-                result_list.append((True, oid, version))
+                    extra_cols, table = self._get_extra_cols(doc, qual_ds_name, self.profile)
+                    docs_by_table.setdefault((table, extra_cols), []).append(doc)
 
-        return result_list
+            for (table, extra_cols), docs_table in docs_by_table.iteritems():
+                result_by_id.update(self._update_doc_set(cur, table, extra_cols, docs_table))
+
+        return [result_by_id[doc["_id"]] for doc in docs]
+
+    def _update_doc_set(self, cur, table, extra_cols, docs):
+        """
+        Updates the given docs of one table with a single UPDATE ... FROM unnest(arrays) statement.
+        Returns a dict of doc id to (True, id, new rev) or (False, id, "conflict") on rev mismatch.
+        """
+        col_types = self._get_column_types(cur, table)
+        cols = ("id", "rev", "doc") + tuple(extra_cols)
+        col_values = dict(id=[], rev=[], doc=[])
+        col_values.update((col, []) for col in extra_cols)
+        old_revs = {}
+        for doc in docs:
+            old_rev = int(doc["_rev"])
+            old_revs[doc["_id"]] = old_rev
+            doc["_rev"] = str(old_rev+1)
+            col_values["id"].append(doc["_id"])
+            col_values["rev"].append(old_rev)
+            col_values["doc"].append(json.dumps(doc))
+            for col in extra_cols:
+                value = self._get_col_value(col, doc)
+                # Same as single update: only assign values that are set
+                col_values[col].append(value if value or type(value) is bool else None)
+
+        # Arrays are cast explicitly, because an all-NULL array would otherwise be text[]
+        source = ", ".join("unnest(%%(%s)s::%s[]) AS %s" % (col, col_types.get(col, "varchar"), col) for col in cols)
+        assign = "".join(", %s=COALESCE(v.%s, %s.%s)" % (col, col, table, col) for col in extra_cols)
+        statement = "UPDATE " + table + " SET doc=v.doc, rev=v.rev+1" + assign + \
+                    " FROM (SELECT " + source + ") AS v" + \
+                    " WHERE " + table + ".id=v.id AND " + table + ".rev=v.rev RETURNING " + table + ".id"
+        cur.execute(statement, col_values)
+        updated_ids = set(row[0] for row in cur.fetchall())
+
+        result = {}
+        for doc in docs:
+            if doc["_id"] in updated_ids:
+                result[doc["_id"]] = (True, doc["_id"], doc["_rev"])
+            else:
+                doc["_rev"] = str(old_revs[doc["_id"]])
+                result[doc["_id"]] = (False, doc["_id"], "conflict")
+        return result
+
+    def _get_column_types(self, cur, table):
+        """Returns a dict of column name to Postgres type name for given table, cached"""
+        if table not in self._column_types:
+            cur.execute("SELECT column_name, udt_name FROM information_schema.columns WHERE table_name=%s", (table, ))
+            self._column_types[table] = dict(cur.fetchall())
+        return self._column_types[table]
 
     def _update_doc(self, cur, table, doc):
         old_rev = int(doc["_rev"])
@@ -674,8 +815,8 @@ class PostgresDataStore(DataStore):
                 if insert_expr:
                     xval += insert_expr
 
-        cur.execute("UPDATE "+table+" SET doc=%(doc)s, rev=%(revn)s" + xval + " WHERE id=%(id)s AND rev=%(rev)s",
-                    statement_args)
+        self._execute(cur, "UPDATE "+table+" SET doc=%(doc)s, rev=%(revn)s" + xval + " WHERE id=%(id)s AND rev=%(rev)s",
+                      statement_args)
         if not cur.rowcount:
             # Distinguish rev conflict from documents does not exist.
             #try:
@@ -686,6 +827,12 @@ class PostgresDataStore(DataStore):
             raise Conflict("Object with id %s revision conflict" % doc["_id"])
         return doc["_id"], doc["_rev"]
 
+    def _execute(self, cur, statement, args=None):
+        """Executes a statement of fixed shape, as server side prepared statement if enabled for the pool"""
+        if self.pool.prepared:
+            return self.pool.prepared.execute(cur, statement, args)
+        return cur.execute(statement, args)
+
     def _get_extra_cols(self, doc, table, profile):
         obj_type = self._get_obj_type(doc, profile)
         table_ext, extra_cols = OBJ_SPECIAL.get(obj_type, ("", tuple()))
@@ -742,7 +889,7 @@ class PostgresDataStore(DataStore):
             table = qual_ds_name + "_dir"
 
         with self.pool.cursor(**self.cursor_args) as cur:
-            cur.execute("SELECT doc FROM "+table+" WHERE id=%s", (doc_id,))
+            self._execute(cur, "SELECT doc FROM "+table+" WHERE id=%s", (doc_id,))
             doc_list = cur.fetchall()
             if not doc_list:
                 raise NotFound('Object with id %s does not exist.' % doc_id)
@@ -758,7 +905,7 @@ class PostgresDataStore(DataStore):
         qual_ds_name = self._get_datastore_name(datastore_name)
 
         with self.pool.cursor(**self.cursor_args) as cur:
-            cur.execute("SELECT rev FROM "+qual_ds_name+" WHERE id=%s", (doc_id,))
+            self._execute(cur, "SELECT rev FROM "+qual_ds_name+" WHERE id=%s", (doc_id,))
             doc_list = cur.fetchall()
             if not doc_list:
                 raise NotFound('Object with id %s does not exist.' % doc_id)
@@ -786,15 +933,8 @@ class PostgresDataStore(DataStore):
         elif object_type == "DirEntry":
             table = qual_ds_name + "_dir"
 
-        query = "SELECT id, doc FROM "+table+" WHERE id IN ("
-        query_args = dict()
-        for i, oid in enumerate(object_ids):
-            arg_name = "id" + str(i)
-            if i>0:
-                query += ","
-            query += "%(" + arg_name + ")s"
-            query_args[arg_name] = oid
-        query += ")"
+        query = "SELECT id, doc FROM "+table+" WHERE id = ANY(%(ids)s)"
+        query_args = dict(ids=list(object_ids))
 
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query, query_args)
@@ -809,6 +949,28 @@ class PostgresDataStore(DataStore):
                 raise NotFound("\n".join(notfound_list))
         return doc_list
 
+    def read_doc_iter(self, object_ids, datastore_name=None, object_type=None, chunk_size=1000):
+        """
+        Iterates over a number of raw doc instances, HEAD rev, fetched from a server-side cursor
+        chunk_size docs at a time. Docs are returned in database order; ids that do not exist are
+        skipped. Holds a pool connection until the iteration ends or the iterator is closed.
+        """
+        if not object_ids:
+            return
+        qual_ds_name = self._get_datastore_name(datastore_name)
+        table = qual_ds_name
+
+        if object_type == "Association":
+            table = qual_ds_name + "_assoc"
+        elif object_type == "DirEntry":
+            table = qual_ds_name + "_dir"
+
+        query = "SELECT id, doc FROM "+table+" WHERE id = ANY(%(ids)s)"
+        query_args = dict(ids=list(object_ids))
+
+        for row in self.pool.fetchiter(query, query_args, name="read_doc_iter", chunk_size=chunk_size, **self.cursor_args):
+            yield row[1]
+
     def read_attachment(self, doc, attachment_name, datastore_name=""):
         qual_ds_name = self._get_datastore_name(datastore_name)
         table = qual_ds_name + "_att"
@@ -906,17 +1068,43 @@ class PostgresDataStore(DataStore):
         view_args = {}
         if all_args:
             view_args.update(all_args)
-        extra_clause = ""
+        extra_clause, extra_args = "", {}
+        if all_args.get("keyset", False):
+            # Keyset paging by id, see _add_keyset_filter
+            if all_args.get("skip", 0) > 0:
+                raise BadRequest("skip cannot be combined with keyset paging")
+            extra_clause += " ORDER BY id DESC" if all_args.get("descending", False) else " ORDER BY id"
         if "limit" in all_args and all_args['limit'] > 0:
-            extra_clause += " LIMIT %s" % all_args['limit']
+            # Limit and skip are bound as arguments so that the statement text does not vary with them
+            extra_clause += " LIMIT %(view_limit)s"
+            extra_args['view_limit'] = int(all_args['limit'])
         if "skip" in all_args and all_args['skip'] > 0:
-            extra_clause += " OFFSET %s " % all_args['skip']
+            extra_clause += " OFFSET %(view_skip)s "
+            extra_args['view_skip'] = int(all_args['skip'])
 
         view_args['extra_clause'] = extra_clause
+        view_args['extra_args'] = extra_args
         if access_args:
             view_args.update(access_args)
         return view_args
 
+    def _get_extra_clause(self, view_args, query_args):
+        """Returns the ORDER BY/LIMIT/OFFSET clause of the view args and adds its arguments to the query args"""
+        query_args.update(view_args.get("extra_args", None) or {})
+        return view_args.get("extra_clause", "")
+
+    def _add_keyset_filter(self, view_args, tablename, query_clause, query_args):
+        """Returns the query clause restricted to rows after the page token's id for keyset paging by id"""
+        page_token = (view_args or {}).get("page_token", None)
+        if not page_token:
+            return query_clause
+        _, last_id = DatastoreQueryBuilder.parse_page_token(page_token)
+        query_args["page_last_id"] = last_id
+        seek_filter = tablename + (".id<%(page_last_id)s" if view_args.get("descending", False) else ".id>%(page_last_id)s")
+        if query_clause.strip():
+            return query_clause + " AND " + seek_filter
+        return " WHERE " + seek_filter
+
     def find_docs_by_view(self, design_name, view_name, key=None, keys=None, start_key=None, end_key=None,
                           id_only=True, **kwargs):
         log.debug("find_docs_by_view() %s/%s, %s, %s, %s, %s, %s, %s", design_name, view_name, key, keys, start_key, end_key, id_only, kwargs)
@@ -971,7 +1159,7 @@ class PostgresDataStore(DataStore):
         elif start_key or end_key:
             raise NotImplementedError()
 
-        extra_clause = filter.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             #print query + query_clause + extra_clause, query_args
             cur.execute(query + query_clause + extra_clause, query_args)
@@ -1026,7 +1214,7 @@ class PostgresDataStore(DataStore):
         # by parent, path, attribute, key
             raise NotImplementedError()
 
-        extra_clause = filter.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             #print query + query_clause + extra_clause, query_args
             cur.execute(query + query_clause + extra_clause, query_args)
@@ -1059,7 +1247,7 @@ class PostgresDataStore(DataStore):
         else:
             raise NotImplementedError()
 
-        extra_clause = filter.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -1094,7 +1282,7 @@ class PostgresDataStore(DataStore):
         if filter.get('descending', False):
             order_clause += " DESC"
 
-        extra_clause = filter.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             # print query + query_clause + order_clause + extra_clause, query_args
             cur.execute(query + query_clause + order_clause + extra_clause, query_args)
@@ -1173,7 +1361,7 @@ class PostgresDataStore(DataStore):
 
         if query_clause == " WHERE ":
             query_clause = " "
-        extra_clause = filter.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             sql = query + query_clause + order_clause + extra_clause
             #print "QUERY:", sql, query_args
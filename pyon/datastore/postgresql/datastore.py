@@ -9,6 +9,7 @@ from pyon.core.exception import BadRequest, Conflict, NotFound, Inconsistent
 from pyon.core.object import IonObjectBase, IonObjectSerializer, IonObjectDeserializer
 from pyon.datastore.postgresql.base_store import PostgresDataStore
 from pyon.datastore.postgresql.pg_query import PostgresQueryBuilder
+from pyon.datastore.datastore_query import DatastoreQueryBuilder
 from pyon.datastore.datastore import DataStore
 from pyon.util.log import log
 from pyon.ion.resource import AvailabilityStates, OT, RT
@@ -58,6 +59,12 @@ class PostgresPyonDataStore(PostgresDataStore):
         return self.create_doc_mult([self._ion_object_to_persistence_dict(obj) for obj in objects], object_ids)
 
 
+    def bulk_load(self, objects, object_ids=None):
+        if any([not isinstance(obj, IonObjectBase) for obj in objects]):
+            raise BadRequest("Obj param is not instance of IonObjectBase")
+
+        return self.bulk_load_docs([self._ion_object_to_persistence_dict(obj) for obj in objects], object_ids)
+
     def update(self, obj, datastore_name=""):
         if not isinstance(obj, IonObjectBase):
             raise BadRequest("Obj param is not instance of IonObjectBase")
@@ -89,6 +96,13 @@ class PostgresPyonDataStore(PostgresDataStore):
 
         return obj_list
 
+    def read_iter(self, object_ids, datastore_name="", chunk_size=1000):
+        if any([not isinstance(object_id, str) for object_id in object_ids]):
+            raise BadRequest("Object ids are not string: %s" % str(object_ids))
+
+        return (self._persistence_dict_to_ion_object(doc)
+                for doc in self.read_doc_iter(object_ids, datastore_name, chunk_size=chunk_size))
+
     def delete(self, obj, datastore_name="", object_type=None):
         if not isinstance(obj, IonObjectBase) and not isinstance(obj, str):
             raise BadRequest("Obj param is not instance of IonObjectBase or string id")
@@ -112,28 +126,65 @@ class PostgresPyonDataStore(PostgresDataStore):
         """
         Returns a list of associations for a given list of subjects
         """
-        # TODO: Port this implementation to Postgres single query
-        res_list = [[], []]
-        if not subjects:
-            return res_list
-        for sub in subjects:
-            res_ids, res_assocs = self.find_objects(subject=sub, id_only=id_only, predicate=predicate, access_args=access_args)
-            res_list[0].extend(res_ids)
-            res_list[1].extend(res_assocs)
-        return res_list
+        return self._find_mult(subjects, "s", "o", id_only=id_only, predicate=predicate, access_args=access_args)
 
     def find_subjects_mult(self, objects, id_only=False, predicate=None, access_args=None):
         """
         Returns a list of associations for a given list of objects
         """
-        # TODO: Port this implementation to Postgres single query
+        return self._find_mult(objects, "o", "s", id_only=id_only, predicate=predicate, access_args=access_args)
+
+    def _find_mult(self, ids, key_col, res_col, id_only=False, predicate=None, access_args=None):
+        """
+        Finds the associated resources for a list of subject (key_col="s") or object (key_col="o")
+        ids in one query. Returns a 2-list of (resources or ids, associations), grouped by input
+        id in the order of the given list.
+        """
+        if type(id_only) is not bool:
+            raise BadRequest('id_only must be type bool, not %s' % type(id_only))
         res_list = [[], []]
-        if not objects:
+        if not ids:
             return res_list
-        for obj in objects:
-            res_ids, res_assocs = self.find_subjects(obj=obj, id_only=id_only, predicate=predicate, access_args=access_args)
-            res_list[0].extend(res_ids)
-            res_list[1].extend(res_assocs)
+
+        key_ids = []
+        for key in ids:
+            if type(key) is str:
+                key_ids.append(key)
+            elif "_id" not in key:
+                raise BadRequest("Object id not available in %s" % ("subject" if key_col == "s" else "object"))
+            else:
+                key_ids.append(key._id)
+
+        qual_ds_name = self._get_datastore_name()
+        assoc_table_name = qual_ds_name+"_assoc"
+        table_names = dict(ds=qual_ds_name, dsa=assoc_table_name, kc=key_col, rc=res_col)
+
+        if id_only:
+            query = "SELECT %(dsa)s.%(kc)s, %(dsa)s.%(rc)s, %(dsa)s.doc FROM %(dsa)s, %(ds)s WHERE retired<>true AND %(dsa)s.%(rc)s=%(ds)s.id " % table_names
+        else:
+            query = "SELECT %(dsa)s.%(kc)s, %(ds)s.doc, %(dsa)s.doc FROM %(dsa)s, %(ds)s WHERE retired<>true AND %(dsa)s.%(rc)s=%(ds)s.id " % table_names
+        query_args = dict(ids=list(set(key_ids)), p=predicate)
+
+        query_clause = "AND %(dsa)s.%(kc)s = ANY(%%(ids)s)" % table_names
+        if predicate:
+            query_clause += " AND p=%(p)s"
+
+        query_clause = self._add_access_filter(access_args, qual_ds_name, query_clause, query_args)
+        with self.pool.cursor(**self.cursor_args) as cur:
+            self._execute(cur, query + query_clause, query_args)
+            rows = cur.fetchall()
+
+        rows_by_key = {}
+        for row in rows:
+            rows_by_key.setdefault(row[0], []).append(row)
+
+        for key in key_ids:
+            for row in rows_by_key.get(key, ()):
+                if id_only:
+                    res_list[0].append(self._prep_id(row[1]))
+                else:
+                    res_list[0].append(self._persistence_dict_to_ion_object(row[1]))
+                res_list[1].append(self._persistence_dict_to_ion_object(row[2]))
         return res_list
 
     def find_objects(self, subject, predicate=None, object_type=None, id_only=False, access_args=None, **kwargs):
@@ -173,9 +224,9 @@ class PostgresPyonDataStore(PostgresDataStore):
                 query_clause += " AND ot=%(ot)s"
 
         query_clause = self._add_access_filter(access_args, qual_ds_name, query_clause, query_args)
-        extra_clause = view_args.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(view_args, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
-            cur.execute(query + query_clause + extra_clause, query_args)
+            self._execute(cur, query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
 
         obj_assocs = [self._persistence_dict_to_ion_object(row[-1]) for row in rows]
@@ -224,9 +275,9 @@ class PostgresPyonDataStore(PostgresDataStore):
                 query_clause += " AND st=%(st)s"
 
         query_clause = self._add_access_filter(access_args, qual_ds_name, query_clause, query_args)
-        extra_clause = view_args.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(view_args, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
-            cur.execute(query + query_clause + extra_clause, query_args)
+            self._execute(cur, query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
 
         obj_assocs = [self._persistence_dict_to_ion_object(row[-1]) for row in rows]
@@ -311,12 +362,8 @@ class PostgresPyonDataStore(PostgresDataStore):
                 query_args["any"] = anyside
             elif type(anyside_ids[0]) is str:
                 # keys are IDs of resources
-                for i, key in enumerate(anyside_ids):
-                    if i > 0:
-                        query_clause += " OR "
-                    argname = "id%s" % i
-                    query_args[argname] = key
-                    query_clause += "(s=%("+argname+")s OR o=%("+argname+")s)"
+                query_clause += "(s = ANY(%(any_ids)s) OR o = ANY(%(any_ids)s))"
+                query_args["any_ids"] = list(anyside_ids)
             else:
                 # keys are tuples of (id, pred)
                 for i, (key, pred) in enumerate(anyside_ids):
@@ -336,11 +383,15 @@ class PostgresPyonDataStore(PostgresDataStore):
         else:
             raise BadRequest("Illegal arguments")
 
-        extra_clause = view_args.get("extra_clause", "")
+        extra_clause = self._get_extra_clause(view_args, query_args)
         sql = query + query_clause + extra_clause
         #print "find_associations(): SQL=", sql, query_args
         with self.pool.cursor(**self.cursor_args) as cur:
-            cur.execute(sql, query_args)
+            if anyside and not predicate and type(anyside_ids[0]) is not str:
+                # Statement shape depends on the number of anyside (id, predicate) keys
+                cur.execute(sql, query_args)
+            else:
+                self._execute(cur, sql, query_args)
             rows = cur.fetchall()
 
         if id_only:
@@ -351,6 +402,58 @@ class PostgresPyonDataStore(PostgresDataStore):
 
         return assocs
 
+    def find_associations_mult(self, triples, id_only=True):
+        """
+        Returns the existing associations for a list of (subject id, predicate, object id) 3-tuples,
+        found with one query. Returns association ids or objects, in no particular order.
+        """
+        if type(id_only) is not bool:
+            raise BadRequest('id_only must be type bool, not %s' % type(id_only))
+        if not triples:
+            return []
+        triples = set(tuple(triple) for triple in triples)
+
+        table = self._get_datastore_name() + "_assoc"
+        query = "SELECT id, s, p, o, doc FROM " + table + \
+                " WHERE retired<>true AND s = ANY(%(s)s) AND o = ANY(%(o)s) AND p = ANY(%(p)s)"
+        query_args = dict(s=list({t[0] for t in triples}), p=list({t[1] for t in triples}), o=list({t[2] for t in triples}))
+        with self.pool.cursor(**self.cursor_args) as cur:
+            cur.execute(query, query_args)
+            rows = cur.fetchall()
+
+        # The ANY conditions also match combinations of different triples
+        rows = [row for row in rows if (row[1], row[2], row[3]) in triples]
+        if id_only:
+            return [self._prep_id(row[0]) for row in rows]
+        return [self._persistence_dict_to_ion_object(row[4]) for row in rows]
+
+    def find_associations_iter(self, chunk_size=10000):
+        """
+        Iterates over all current (not retired) associations as (id, rev, s, st, p, o, ot, ts) tuples,
+        fetched from a server-side cursor chunk_size rows at a time. Documents are not decoded.
+        """
+        table = self._get_datastore_name() + "_assoc"
+        query = "SELECT id, rev, s, st, p, o, ot, json_string(doc,'ts') FROM " + table + " WHERE retired<>true"
+        for row in self.pool.fetchiter(query, {}, name="find_associations_iter", chunk_size=chunk_size, **self.cursor_args):
+            yield (self._prep_id(row[0]), str(row[1]), self._prep_id(row[2]), row[3], row[4], self._prep_id(row[5]), row[6], row[7])
+
+    def count_associations(self):
+        """Returns the number of current (not retired) associations"""
+        table = self._get_datastore_name() + "_assoc"
+        with self.pool.cursor(**self.cursor_args) as cur:
+            cur.execute("SELECT count(*) FROM " + table + " WHERE retired<>true")
+            return cur.fetchone()[0]
+
+    def read_visibility_mult(self, object_ids):
+        """Returns a dict of resource id to visibility for the resources with given ids that exist"""
+        if not object_ids:
+            return {}
+        query = "SELECT id, visibility FROM " + self._get_datastore_name() + " WHERE id = ANY(%(ids)s)"
+        with self.pool.cursor(**self.cursor_args) as cur:
+            self._execute(cur, query, dict(ids=list(set(object_ids))))
+            rows = cur.fetchall()
+        return {self._prep_id(row[0]): row[1] for row in rows}
+
     def _prepare_find_return(self, rows, res_assocs=None, id_only=True, **kwargs):
         if id_only:
             res_ids = [self._prep_id(row[0]) for row in rows]
@@ -402,28 +505,44 @@ class PostgresPyonDataStore(PostgresDataStore):
     def find_resources_ext(self, restype="", lcstate="", name="",
                            keyword=None, nested_type=None,
                            attr_name=None, attr_value=None, alt_id=None, alt_id_ns=None,
-                           limit=None, skip=None, descending=None, id_only=True, access_args=None):
-        filter_kwargs = self._get_view_args(dict(limit=limit, skip=skip, descending=descending), access_args)
+                           limit=None, skip=None, descending=None, id_only=True, access_args=None,
+                           keyset=False, page_token=None):
+        """
+        Find resources by one of several criteria. With keyset=True (or a page_token), results are
+        ordered by id and a 3-tuple with the page token for the next page (or None) is returned.
+        """
+        keyset = keyset or bool(page_token)
+        filter_kwargs = self._get_view_args(dict(limit=limit, skip=skip, descending=descending,
+                                                 keyset=keyset, page_token=page_token), access_args)
         if name:
             if lcstate:
                 raise BadRequest("find by name does not support lcstate")
-            return self.find_res_by_name(name, restype, id_only, filter=filter_kwargs)
+            res = self.find_res_by_name(name, restype, id_only, filter=filter_kwargs)
         elif keyword:
-            return self.find_res_by_keyword(keyword, restype, id_only, filter=filter_kwargs)
+            res = self.find_res_by_keyword(keyword, restype, id_only, filter=filter_kwargs)
         elif alt_id or alt_id_ns:
-            return self.find_res_by_alternative_id(alt_id, alt_id_ns, id_only, filter=filter_kwargs)
+            res = self.find_res_by_alternative_id(alt_id, alt_id_ns, id_only, filter=filter_kwargs)
         elif nested_type:
-            return self.find_res_by_nested_type(nested_type, restype, id_only, filter=filter_kwargs)
+            res = self.find_res_by_nested_type(nested_type, restype, id_only, filter=filter_kwargs)
         elif restype and attr_name:
-            return self.find_res_by_attribute(restype, attr_name, attr_value, id_only=id_only, filter=filter_kwargs)
+            res = self.find_res_by_attribute(restype, attr_name, attr_value, id_only=id_only, filter=filter_kwargs)
         elif restype and lcstate:
-            return self.find_res_by_lcstate(lcstate, restype, id_only, filter=filter_kwargs)
+            res = self.find_res_by_lcstate(lcstate, restype, id_only, filter=filter_kwargs)
         elif restype:
-            return self.find_res_by_type(restype, lcstate, id_only, filter=filter_kwargs)
+            res = self.find_res_by_type(restype, lcstate, id_only, filter=filter_kwargs)
         elif lcstate:
-            return self.find_res_by_lcstate(lcstate, restype, id_only, filter=filter_kwargs)
-        elif not restype and not lcstate and not name:
-            return self.find_res_by_type(None, None, id_only, filter=filter_kwargs)
+            res = self.find_res_by_lcstate(lcstate, restype, id_only, filter=filter_kwargs)
+        else:
+            res = self.find_res_by_type(None, None, id_only, filter=filter_kwargs)
+        if not keyset:
+            return res
+
+        res_list, res_info = res
+        next_token = None
+        if limit and len(res_list) == limit:
+            last_res = res_list[-1]
+            next_token = DatastoreQueryBuilder.create_page_token([], last_res if id_only else last_res._id)
+        return res_list, res_info, next_token
 
     def find_res_by_type(self, restype, lcstate=None, id_only=False, filter=None):
         log.debug("find_res_by_type(restype=%s, lcstate=%s)", restype, lcstate)
@@ -448,7 +567,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause = ""
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -483,7 +603,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause += " AND type_=%(type_)s"
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -510,7 +631,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause += " AND type_=%(type_)s"
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -540,7 +662,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause += " AND type_=%(type_)s"
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -569,7 +692,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause += " AND type_=%(type_)s"
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -603,7 +727,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause += " AND type_=%(type_)s"
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -637,7 +762,8 @@ class PostgresPyonDataStore(PostgresDataStore):
             query_clause += "AND %(aid)s <@ json_altids_id(doc) AND %(ans)s <@ json_altids_ns(doc)"
 
         query_clause = self._add_access_filter(filter, qual_ds_name, query_clause, query_args)
-        extra_clause = filter.get("extra_clause", "")
+        query_clause = self._add_keyset_filter(filter, qual_ds_name, query_clause, query_args)
+        extra_clause = self._get_extra_clause(filter, query_args)
         with self.pool.cursor(**self.cursor_args) as cur:
             cur.execute(query + query_clause + extra_clause, query_args)
             rows = cur.fetchall()
@@ -691,7 +817,8 @@ class PostgresPyonDataStore(PostgresDataStore):
         """
         Find resources given a datastore query expression dict.
         @param query  a dict representation of a datastore query
-        @retval  list of resource ids or resource objects matching query (dependent on id_only value)
+        @retval  list of resource ids or resource objects matching query (dependent on id_only value).
+                 For keyset paging queries, a tuple of this list and the page token for the next page (or None)
         """
         qual_ds_name = self._get_datastore_name()
 
@@ -706,11 +833,12 @@ class PostgresPyonDataStore(PostgresDataStore):
 
         id_only = query["query_args"].get("id_only", True)
         if id_only:
-            res_ids = [self._prep_id(row[0]) for row in rows]
-            return res_ids
+            res = [self._prep_id(row[0]) for row in rows]
         else:
-            res_docs = [self._persistence_dict_to_ion_object(row[-1]) for row in rows]
-            return res_docs
+            res = [self._persistence_dict_to_ion_object(row[-1]) for row in rows]
+        if pqb.keyset:
+            return res, pqb.get_page_token(rows)
+        return res
 
 
     # -------------------------------------------------------------------------
@@ -4,6 +4,8 @@
 
 __author__ = 'Michael Meisinger'
 
+from collections import OrderedDict
+
 from pyon.core.exception import BadRequest
 from pyon.datastore.datastore_query import DQ, DatastoreQueryBuilder
 
@@ -33,19 +35,113 @@ class PostgresQueryBuilder(object):
               DQ.XOP_ATTILIKE: "ILIKE",
               }
 
+    # Compiled SQL for query shapes, see _get_plan_key
+    use_plan_cache = True
+    plan_cache_size = 1000
+    _plan_cache = OrderedDict()
+    plan_cache_stats = dict(hits=0, misses=0)
+
     def __init__(self, query, basetable):
         DatastoreQueryBuilder.check_query(query)
         self.query = query
         self.basetable = basetable
+        self.keyset = self.query["query_args"].get("keyset", False)
+
+        plan_values = []
+        plan_key = self._get_plan_key(plan_values) if self.use_plan_cache else None
+        plan = self._plan_cache.get(plan_key, None) if plan_key else None
+        if plan:
+            # Same query shape compiled before - only bind the values
+            self.plan_cache_stats["hits"] += 1
+            self.where, self.order_by, cols, keyset_cols = plan
+            self.cols, self.keyset_cols = list(cols), list(keyset_cols)
+            self._valcnt = len(plan_values)
+            self.values = dict(("v" + str(i + 1), value) for i, value in enumerate(plan_values))
+            return
+
         self.cols = ["id"]
-        if not self.query["query_args"].get("id_only", True):
-            self.cols.append("doc")
         self._valcnt = 0
         self.values = {}
 
         self.where = self._build_where(self.query["where"])
         self.order_by = self._build_order_by(self.query["order_by"])
 
+        # Keyset paging: sort columns are selected after id, so that the page token can be built from a row
+        self.keyset_cols = []
+        if self.keyset:
+            self._build_keyset()
+        if not self.query["query_args"].get("id_only", True):
+            self.cols.append("doc")
+
+        if plan_key:
+            self.plan_cache_stats["misses"] += 1
+            if len(self._plan_cache) >= self.plan_cache_size:
+                self._plan_cache.popitem(last=False)
+            self._plan_cache[plan_key] = (self.where, self.order_by, tuple(self.cols), tuple(self.keyset_cols))
+
+    def _get_plan_key(self, values):
+        """
+        Returns a hashable key for the structure of the query (operators, columns, ordering, keyset paging),
+        with all literals that _build_where and _build_keyset pass to _value removed and appended to
+        values in the same order. Returns None if the query cannot be cached.
+        """
+        qargs = self.query["query_args"]
+        try:
+            where_key = self._get_where_key(self.query["where"], values)
+            order_key = tuple(tuple(ob) for ob in self.query["order_by"] or [])
+            hash(where_key)
+        except (TypeError, ValueError):
+            return None
+        token_shape = None
+        page_token = qargs.get("page_token", None) if self.keyset else None
+        if page_token:
+            sort_values, last_id = DatastoreQueryBuilder.parse_page_token(page_token)
+            # The seek filter differs for NULL sort values, which are not bound as values
+            token_shape = tuple(val is None for val in sort_values)
+            values.extend(val for val in sort_values if val is not None)
+            values.append(last_id)
+        # Limit and skip are added by get_query and are not part of the plan
+        return self.basetable, where_key, order_key, bool(self.keyset), token_shape, qargs.get("id_only", True)
+
+    def _get_where_key(self, expr, values):
+        """Mirrors _build_where, returning the structure of the expression and collecting its values"""
+        if not expr:
+            return None
+        op, args = expr
+        if op.startswith(DQ.OP_PREFIX):
+            colname, value = args
+            values.append(value)
+            return op, colname
+        elif op == DQ.XOP_IN:
+            values.extend(args[1:])
+            return op, args[0], len(args) - 1
+        elif op == DQ.XOP_BETWEEN:
+            attname, value1, value2 = args
+            values.extend([value1, value2])
+            return op, attname
+        elif op == DQ.XOP_ATTLIKE or op == DQ.XOP_ATTILIKE:
+            values.extend(args)
+            return op,
+        elif op == DQ.XOP_ALLMATCH:
+            values.append("%" + str(args[0]) + "%")
+            return op,
+        elif op.startswith(DQ.ROP_PREFIX):
+            colname, x1, y1 = args
+            values.append("[%s,%s]" % (x1, y1))
+            return op, colname
+        elif op.startswith(DQ.GOP_PREFIX):
+            if op.endswith('_geom'):
+                # Geometry is part of the SQL text
+                return (op, ) + tuple(args)
+            values.extend(args[1:])
+            return op, args[0]
+        elif op == DQ.EXP_AND or op == DQ.EXP_OR:
+            return op, tuple(self._get_where_key(ex, values) for ex in args)
+        elif op == DQ.EXP_NOT:
+            return op, self._get_where_key(args[0], values)
+        # Unknown op: let _build_where raise
+        raise ValueError("Unknown op: %s" % op)
+
     def _value(self, value):
         """Saves a value for later type conformant insertion into the query"""
         self._valcnt += 1
@@ -108,6 +204,59 @@ class PostgresQueryBuilder(object):
         order_by = ",".join(order_by_list)
         return order_by
 
+    def _build_keyset(self):
+        """Orders by the sort columns plus id and continues after the page token's row, if given"""
+        sort_dirs = set()
+        for col, colsort in self.query["order_by"] or []:
+            if col != "id":
+                self.keyset_cols.append(col)
+            sort_dirs.add(colsort.lower() == "desc")
+        if len(sort_dirs) > 1:
+            raise BadRequest("Keyset paging requires the same sort direction for all columns")
+        descending = sort_dirs.pop() if sort_dirs else False
+        self.cols.extend(self.keyset_cols)
+        self.order_by = ",".join("%s %s" % (col, "DESC" if descending else "ASC") for col in self.keyset_cols + ["id"])
+
+        page_token = self.query["query_args"].get("page_token", None)
+        if page_token:
+            sort_values, last_id = DatastoreQueryBuilder.parse_page_token(page_token)
+            if len(sort_values) != len(self.keyset_cols):
+                raise BadRequest("Page token does not match query sort order")
+            seek_expr = self._build_seek(sort_values, last_id, descending)
+            self.where = "%s AND %s" % (self.where, seek_expr) if self.where else seek_expr
+
+    def _build_seek(self, sort_values, last_id, descending):
+        """
+        Returns the filter for rows after the given sort values and id in keyset order. A row comparison
+        is NULL if a compared column is NULL, so the filter is spelled out per column, with NULLs sorting
+        last ascending and first descending as in Postgres' default ORDER BY.
+        """
+        val_names = [self._value(val) if val is not None else None for val in sort_values]
+        id_name = self._value(last_id)
+        terms, prefix = [], []
+        for col, val_name in zip(self.keyset_cols, val_names):
+            if val_name is None:
+                after = "%s IS NOT NULL" % col if descending else None
+            elif descending:
+                after = "%s<%s" % (col, val_name)
+            else:
+                after = "(%s>%s OR %s IS NULL)" % (col, val_name, col)
+            if after:
+                terms.append(" AND ".join(prefix + [after]))
+            prefix.append("%s IS NULL" % col if val_name is None else "%s=%s" % (col, val_name))
+        terms.append(" AND ".join(prefix + ["id%s%s" % ("<" if descending else ">", id_name)]))
+        if len(terms) == 1:
+            return "(%s)" % terms[0]
+        return "(%s)" % " OR ".join("(%s)" % term for term in terms)
+
+    def get_page_token(self, rows):
+        """Returns the page token for the page after given result rows, or None if this is the last page"""
+        limit = self.query["query_args"].get("limit", 0)
+        if not self.keyset or not rows or limit <= 0 or len(rows) < limit:
+            return None
+        last_row = rows[-1]
+        return DatastoreQueryBuilder.create_page_token(last_row[1:1 + len(self.keyset_cols)], last_row[0])
+
     def get_query(self):
         qargs = self.query["query_args"]
         frags = []
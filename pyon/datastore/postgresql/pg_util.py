@@ -4,17 +4,23 @@
 
 __author__ = 'Michael Meisinger'
 
+from collections import OrderedDict
 import contextlib
+import itertools
 import gevent
-from gevent.queue import Queue
+from gevent.queue import Queue, Empty
 from gevent.socket import wait_read, wait_write
+import re
 import time
 import sys
 import simplejson as json
 
+from pyon.core.exception import Timeout
+from pyon.util.tracer import trace_data
+
 try:
     import psycopg2
-    from psycopg2 import OperationalError, ProgrammingError, DatabaseError, IntegrityError, extensions
+    from psycopg2 import OperationalError, ProgrammingError, DatabaseError, DataError, IntegrityError, extensions
     from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
     from psycopg2.extensions import connection as _connection
     from psycopg2.extensions import cursor as _cursor
@@ -48,30 +54,81 @@ register_default_json(None, globally=True, loads=json.loads)
 class DatabaseConnectionPool(object):
     """Gevent compliant database connection pool"""
 
-    def __init__(self, maxsize=100):
+    def __init__(self, maxsize=100, checkout_timeout=None, max_idle_time=None, max_lifetime=None, check_interval=None,
+                 prepared_statements=False):
+        """
+        @param maxsize  Maximum number of open connections (pooled + checked out)
+        @param checkout_timeout  Seconds to wait for a connection when all are checked out, None for no limit
+        @param max_idle_time  Seconds after which an idle connection is closed, None for no limit
+        @param max_lifetime  Seconds after which a connection is replaced, None for no limit
+        @param check_interval  Seconds between background checks of idle connections, None for no checks
+        @param prepared_statements  If True, keep a PreparedStatementCache for the pool's connections
+        """
         if not isinstance(maxsize, (int, long)):
             raise TypeError('Expected integer, got %r' % (maxsize, ))
         self.maxsize = maxsize  # Maximum connections (pool + checkout out)
         self.pool = Queue()     # Open connection pool
         self.size = 0           # Number of open connections
+        self.checkout_timeout = checkout_timeout
+        self.max_idle_time = max_idle_time
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+
+        self._conn_times = {}   # Connection -> [created time, last returned time]
+        self._check_gl = None
+        self.prepared = PreparedStatementCache() if prepared_statements else None
+        self.stats = dict(checkouts=0, wait_time=0.0, max_wait_time=0.0, timeouts=0,
+                          created=0, closed=0, broken=0, recycled=0)
 
     def get(self):
         pool = self.pool
-        if self.size >= self.maxsize or pool.qsize():
-            return pool.get()
-        else:
-            self.size += 1
-            try:
-                new_item = self.create_connection()
-            except:
-                self.size -= 1
-                raise
-            return new_item
+        t_begin = time.time()
+        if self.check_interval and self._check_gl is None:
+            self._check_gl = gevent.spawn(self._check_loop)
+        while True:
+            if self.size >= self.maxsize or pool.qsize():
+                # Wait in slices, so that a connection discarded meanwhile can be replaced
+                timeout = 1.0
+                if self.checkout_timeout is not None:
+                    remaining = t_begin + self.checkout_timeout - time.time()
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise Timeout("No database connection available after %s sec (pool size %s, all in use)" % (
+                            self.checkout_timeout, self.maxsize))
+                    timeout = min(timeout, remaining)
+                try:
+                    conn = pool.get(timeout=timeout)
+                except Empty:
+                    continue
+                if conn.closed or self._is_expired(conn, time.time()):
+                    self._discard(conn, recycled=not conn.closed)
+                    continue
+            else:
+                self.size += 1
+                try:
+                    conn = self.create_connection()
+                except:
+                    self.size -= 1
+                    raise
+                self.stats["created"] += 1
+                self._conn_times[conn] = [time.time(), None]
+
+            wait_time = time.time() - t_begin
+            self.stats["checkouts"] += 1
+            self.stats["wait_time"] += wait_time
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], wait_time)
+            return conn
 
     def put(self, item):
+        conn_times = self._conn_times.get(item, None)
+        if conn_times:
+            conn_times[1] = time.time()
         self.pool.put(item)
 
     def closeall(self):
+        if self._check_gl is not None:
+            self._check_gl.kill(block=False)
+            self._check_gl = None
         while not self.pool.empty():
             conn = self.pool.get_nowait()
             try:
@@ -79,6 +136,77 @@ class DatabaseConnectionPool(object):
                 self.size -= 1
             except Exception:
                 pass
+            self._conn_times.pop(conn, None)
+            if self.prepared:
+                self.prepared.evict(conn)
+
+    def get_stats(self):
+        """Returns a dict with pool counters and current connection numbers"""
+        stats = self.stats.copy()
+        stats["size"] = self.size
+        stats["maxsize"] = self.maxsize
+        stats["idle"] = self.pool.qsize()
+        stats["in_use"] = self.size - stats["idle"]
+        if self.prepared:
+            stats["prepared"] = self.prepared.get_stats()
+        return stats
+
+    def check_idle(self):
+        """Closes idle connections that exceeded max idle time or lifetime or that fail validation"""
+        now = time.time()
+        for i in xrange(self.pool.qsize()):
+            try:
+                conn = self.pool.get_nowait()
+            except Empty:
+                break
+            conn_times = self._conn_times.get(conn, None)
+            if conn.closed:
+                self._discard(conn)
+            elif self._is_expired(conn, now) or (self.max_idle_time and conn_times and conn_times[1] and
+                                                 now - conn_times[1] > self.max_idle_time):
+                self._discard(conn, recycled=True)
+            elif not self._validate(conn):
+                self._discard(conn)
+            else:
+                self.pool.put(conn)
+
+    def _check_loop(self):
+        while True:
+            gevent.sleep(self.check_interval)
+            try:
+                self.check_idle()
+            except Exception:
+                gevent.get_hub().handle_error(self, *sys.exc_info())
+
+    def _validate(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _is_expired(self, conn, now):
+        conn_times = self._conn_times.get(conn, None)
+        return bool(self.max_lifetime and conn_times and now - conn_times[0] > self.max_lifetime)
+
+    def _discard(self, conn, recycled=False):
+        """Closes and forgets a single connection, e.g. because it is broken or too old"""
+        self.size -= 1
+        self._conn_times.pop(conn, None)
+        if self.prepared:
+            self.prepared.evict(conn)
+        if recycled:
+            self.stats["recycled"] += 1
+        else:
+            self.stats["broken"] += 1
+        self.stats["closed"] += 1
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
 
     @contextlib.contextmanager
     def connection(self, isolation_level=None):
@@ -91,21 +219,23 @@ class DatabaseConnectionPool(object):
                     conn.set_isolation_level(isolation_level)
             yield conn
         except:
-            if conn.closed:
+            # Only replace the broken connection, not the entire pool
+            if conn.closed or self._rollback(conn) is None:
+                self._discard(conn)
                 conn = None
-                self.closeall()
-            else:
-                conn = self._rollback(conn)
             raise
         else:
             if conn.closed:
                 raise OperationalError("Cannot commit because connection was closed: %r" % (conn, ))
             conn.commit()
         finally:
-            if conn is not None and not conn.closed:
-                if isolation_level is not None:
-                    conn.set_isolation_level(isolation_level)
-                self.put(conn)
+            if conn is not None:
+                if conn.closed:
+                    self._discard(conn)
+                else:
+                    if isolation_level is not None:
+                        conn.set_isolation_level(isolation_level)
+                    self.put(conn)
 
     @contextlib.contextmanager
     def cursor(self, *args, **kwargs):
@@ -123,21 +253,47 @@ class DatabaseConnectionPool(object):
                 cur._tracer = tracer
             yield cur
         except:
-            if conn.closed:
+            # Only replace the broken connection, not the entire pool
+            if conn.closed or self._rollback(conn) is None:
+                self._discard(conn)
                 conn = None
-                self.closeall()
-            else:
-                conn = self._rollback(conn)
             raise
         else:
             if conn.closed:
                 raise OperationalError("Cannot commit because connection was closed: %r" % (conn, ))
             conn.commit()
         finally:
+            if conn is not None:
+                if conn.closed:
+                    self._discard(conn)
+                else:
+                    if isolation_level is not None:
+                        conn.set_isolation_level(isolation_level)
+                    self.put(conn)
+
+    @contextlib.contextmanager
+    def copy_cursor(self, *args, **kwargs):
+        """
+        Yields a cursor on a separate, non-pooled connection that can be used for COPY.
+        psycopg2 refuses COPY while a wait callback is registered, so the gevent wait callback is
+        suspended while the connection is open. This blocks the gevent hub: no other greenlet of
+        the process runs (heartbeats, messaging, other datastore calls) until the body completes.
+        Only use it where that is acceptable, such as for explicitly enabled bulk loads.
+        """
+        tracer = kwargs.pop("tracer", None)
+        conn = None
+        extensions.set_wait_callback(None)
+        try:
+            conn = self.create_connection()
+            cur = conn.cursor(*args, **kwargs)
+            if isinstance(cur, TracingCursor):
+                cur._tracer = tracer
+            yield cur
+            conn.commit()
+        finally:
+            extensions.set_wait_callback(gevent_wait_callback)
             if conn is not None and not conn.closed:
-                if isolation_level is not None:
-                    conn.set_isolation_level(isolation_level)
-                self.put(conn)
+                conn.close()
 
     def _rollback(self, conn):
         try:
@@ -163,27 +319,139 @@ class DatabaseConnectionPool(object):
             return cursor.fetchall()
 
     def fetchiter(self, *args, **kwargs):
+        """
+        Yields result rows, fetched chunk_size rows at a time. Pass a cursor name to use a server-side
+        cursor, so that the result set is not transferred to the client all at once.
+        """
+        chunk_size = kwargs.pop("chunk_size", 1000)
         with self.cursor(**kwargs) as cursor:
             cursor.execute(*args)
             while True:
-                items = cursor.fetchmany()
+                items = cursor.fetchmany(chunk_size)
                 if not items:
                     break
                 for item in items:
                     yield item
 
 
+class PreparedStatementCache(object):
+    """
+    Per-connection cache of server side prepared statements. A statement is prepared (PREPARE) on a
+    connection the first time it is executed there and reused (EXECUTE) afterwards, so that Postgres
+    does not parse and plan it again. Statements are keyed by their whitespace normalized text, which
+    includes the table name. Only use for statements of fixed shape, with values passed as arguments.
+    Prepared statements live as long as their connection; the pool evicts them when a connection is closed.
+    """
+    PARAM_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+    STMT_NOT_FOUND = "26000"    # Postgres error code invalid_sql_statement_name
+    _cache_count = itertools.count(1)
+
+    def __init__(self, max_statements=200):
+        self.max_statements = max_statements    # Per connection, least recently prepared are deallocated
+        self._conn_stmts = {}       # Connection -> OrderedDict of statement key to (stmt name, param names)
+        self._unpreparable = set()  # Statement keys that Postgres refused to prepare
+        self._stmt_count = 0
+        # Unique per cache, so that a new cache does not collide with statements a pooled connection still holds
+        self._stmt_prefix = "ion_stmt_%s_" % next(self._cache_count)
+        self.stats = dict(prepared=0, executed=0, deallocated=0, failed=0)
+
+    def execute(self, cur, statement, args=None):
+        key = " ".join(statement.split())
+        if key in self._unpreparable:
+            return cur.execute(statement, args)
+
+        stmts = self._conn_stmts.setdefault(cur.connection, OrderedDict())
+        entry = stmts.get(key, None)
+        if entry is None:
+            entry = self._prepare(cur, key)
+            if entry is None:
+                return cur.execute(statement, args)
+            stmts[key] = entry
+            if len(stmts) > self.max_statements:
+                old_key, (old_name, _) = stmts.popitem(last=False)
+                cur.execute("DEALLOCATE " + old_name)
+                self.stats["deallocated"] += 1
+
+        stmt_name, params = entry
+        if isinstance(args, dict):
+            exec_args = [args[param] for param in params]
+        else:
+            exec_args = list(args or ())
+        exec_stmt = "EXECUTE " + stmt_name
+        if exec_args:
+            exec_stmt += " (" + ", ".join(["%s"] * len(exec_args)) + ")"
+        try:
+            if isinstance(cur, TracingCursor):
+                # Aggregate statement stats by the prepared statement text, not the EXECUTE
+                res = cur.execute(exec_stmt, exec_args or None, template=key)
+            else:
+                res = cur.execute(exec_stmt, exec_args or None)
+        except ProgrammingError as pe:
+            if getattr(pe, "pgcode", None) == self.STMT_NOT_FOUND:
+                # Connection lost the statement (e.g. server side DEALLOCATE ALL) - prepare again next time
+                stmts.pop(key, None)
+            raise
+        self.stats["executed"] += 1
+        return res
+
+    def _prepare(self, cur, key):
+        params = []
+
+        def replace_param(match):
+            if match.group(0) == "%%":
+                return "%"
+            name = match.group(1)   # None for positional parameters
+            if name is None or name not in params:
+                params.append(name)
+                return "$%s" % len(params)
+            return "$%s" % (params.index(name) + 1)
+        sql = self.PARAM_RE.sub(replace_param, key)
+
+        self._stmt_count += 1
+        stmt_name = "%s%s" % (self._stmt_prefix, self._stmt_count)
+        prepare_stmt = "PREPARE %s AS %s" % (stmt_name, sql)
+        # Within a transaction, a failed PREPARE must not abort the caller's transaction
+        use_savepoint = cur.connection.isolation_level != ISOLATION_LEVEL_AUTOCOMMIT
+        try:
+            if use_savepoint:
+                cur.execute("SAVEPOINT ion_prepare; %s; RELEASE SAVEPOINT ion_prepare" % prepare_stmt)
+            else:
+                cur.execute(prepare_stmt)
+        except (ProgrammingError, DataError):
+            # E.g. Postgres cannot determine a parameter type
+            if use_savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT ion_prepare")
+            self._unpreparable.add(key)
+            self.stats["failed"] += 1
+            return None
+        self.stats["prepared"] += 1
+        return stmt_name, params
+
+    def evict(self, conn):
+        """Forgets all statements of given connection, e.g. because it was closed"""
+        self._conn_stmts.pop(conn, None)
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats["connections"] = len(self._conn_stmts)
+        stats["statements"] = sum(len(stmts) for stmts in self._conn_stmts.itervalues())
+        return stats
+
+
 class PostgresConnectionPool(DatabaseConnectionPool):
 
     def __init__(self, *args, **kwargs):
         self.connect = kwargs.pop('connect', psycopg2.connect)
         self.tracer = kwargs.pop('tracer', None)
         maxsize = kwargs.pop('maxsize', None)
+        pool_kwargs = dict((key, kwargs.pop(key)) for key in
+                           ('checkout_timeout', 'max_idle_time', 'max_lifetime', 'check_interval',
+                                        'prepared_statements') if key in kwargs)
         self.args = args
         self.kwargs = kwargs
         if self.tracer:
             self.kwargs.setdefault("connection_factory", TracingConnection)
-        DatabaseConnectionPool.__init__(self, maxsize)
+        DatabaseConnectionPool.__init__(self, maxsize, **pool_kwargs)
 
     def create_connection(self):
         conn = self.connect(*self.args, **self.kwargs)
@@ -221,8 +489,81 @@ class TracingConnection(_connection):
         return super(TracingConnection, self).cursor(*args, **kwargs)
 
 
+class StatementStats(object):
+    """
+    Aggregated counters (count, total/max time, rows) per statement template, i.e. statement text with
+    parameter placeholders. Whitespace, numeric literals, numbered placeholder names, placeholder lists
+    and repeated value rows are normalized, so that e.g. different LIMITs, IN list lengths or multi-row
+    INSERT sizes count as one template. Memory is bounded by max_templates; statements beyond that
+    count towards the OTHER_KEY entry.
+    """
+    OTHER_KEY = "<other>"
+    NORM_RES = [(re.compile(r"\s+"), " "),
+                (re.compile(r"%\((\w*?)\d+\)s"), r"%(\1N)s"),
+                (re.compile(r"\b\d+\b"), "?"),
+                (re.compile(r"\(\s*%(?:\(\w+\))?s(?:\s*,\s*%(?:\(\w+\))?s)*\s*\)"), "(...)"),
+                (re.compile(r"(\((?:[^()]|%\(\w+\)s)*\))(?:\s*,\s*\1)+"), r"\1")]
+
+    def __init__(self, max_templates=500):
+        self.max_templates = max_templates
+        self._stats = {}        # Template -> stats entry list [count, total time, max time, rows]
+        self._templates = {}    # Statement text -> template, bounded like the stats
+
+    def add(self, statement, query_time, rows=0):
+        """Counts one execution of given statement and returns its stats entry"""
+        template = self._templates.get(statement, None)
+        if template is None:
+            if len(self._templates) >= 2 * self.max_templates:
+                self._templates.clear()
+            template = statement.strip()
+            for norm_re, repl in self.NORM_RES:
+                template = norm_re.sub(repl, template)
+            self._templates[statement] = template
+        entry = self._stats.get(template, None)
+        if entry is None:
+            if len(self._stats) >= self.max_templates:
+                template = self.OTHER_KEY
+            entry = self._stats.setdefault(template, [0, 0.0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += query_time
+        entry[2] = max(entry[2], query_time)
+        if rows > 0:
+            entry[3] += rows
+        return entry
+
+    def get_stats(self, sort_by="total_time", limit=None):
+        """Returns a list of dicts with counters per template, sorted descending by given counter"""
+        stats = [dict(statement=template, count=entry[0], total_time=entry[1], max_time=entry[2], rows=entry[3],
+                      avg_time=entry[1] / entry[0] if entry[0] else 0.0)
+                 for template, entry in self._stats.items()]
+        stats.sort(key=lambda st: st[sort_by], reverse=True)
+        return stats[:limit] if limit else stats
+
+    def dump(self, sort_by="total_time", limit=50, truncate=200):
+        """Returns the top statement templates as a text table"""
+        lines = ["%8s %10s %10s %10s %10s  %s" % ("count", "total[s]", "avg[ms]", "max[ms]", "rows", "statement")]
+        for st in self.get_stats(sort_by=sort_by, limit=limit):
+            lines.append("%8s %10.3f %10.3f %10.3f %10s  %s" % (st["count"], st["total_time"], st["avg_time"] * 1000,
+                                                                st["max_time"] * 1000, st["rows"], st["statement"][:truncate]))
+        return "\n".join(lines)
+
+    def clear(self):
+        self._stats.clear()
+        self._templates.clear()
+
+# Statement stats for all traced cursors in the container
+statement_stats = StatementStats()
+
+
 class TracingCursor(_cursor):
-    """A cursor that logs queries using its connection logging facilities."""
+    """
+    A cursor that logs queries using its connection logging facilities.
+    Tracer config (container.tracer) options for statements:
+    - db_stats: aggregate counters per statement template in statement_stats (default True)
+    - db_sample_rate: log 1 in N statements to the trace log (default 1, 0 for none)
+    - db_slow_threshold: always log statements taking at least this many seconds (default None)
+    """
+    _sample_seq = 0
 
     def __init__(self, *args, **kwargs):
         self._tracer = kwargs.pop("_tracer", None)
@@ -230,8 +571,10 @@ class TracingCursor(_cursor):
         _cursor.__init__(self, *args, **kwargs)
         self._tracer = self._tracer or getattr(self.connection, "_tracer", None)
         self._trace_stmt = self._trace_stmt or getattr(self.connection, "_trace_stmt", None)
+        self._current_entry = None
+        self._current_stats = None
 
-    def execute(self, query, vars=None):
+    def execute(self, query, vars=None, template=None):
         query_time = 0
         try:
             t_begin = time.time()
@@ -240,7 +583,7 @@ class TracingCursor(_cursor):
             return res
         finally:
             if self._tracer:
-                self._log_call(self._tracer, trace_stmt=self._trace_stmt, query_time=query_time)
+                self._trace_call(template or query, query_time)
 
     def callproc(self, procname, vars=None):
         query_time = 0
@@ -251,7 +594,18 @@ class TracingCursor(_cursor):
             return res
         finally:
             if self._tracer:
-                self._log_call(self._tracer, trace_stmt=self._trace_stmt, query_time=query_time)
+                self._trace_call("CALL " + procname, query_time)
+
+    def copy_expert(self, sql, file, size=8192):
+        query_time = 0
+        try:
+            t_begin = time.time()
+            res = super(TracingCursor, self).copy_expert(sql, file, size)
+            query_time = time.time() - t_begin
+            return res
+        finally:
+            if self._tracer:
+                self._trace_call(sql, query_time)
 
     def fetchall(self):
         query_time = 0
@@ -261,10 +615,31 @@ class TracingCursor(_cursor):
             query_time = time.time() - t_begin
             return res
         finally:
-            log_entry = getattr(self, "_current_entry", None)
+            if self._current_stats:
+                self._current_stats[1] += query_time
+            log_entry = self._current_entry
             if log_entry and log_entry.get("statement", "") == self.query and "statement_time" in log_entry:
                 log_entry["statement_time"] += query_time
 
+    def _trace_call(self, template, query_time):
+        """Aggregates statement stats and logs sampled or slow statements to the tracer"""
+        tracer_cfg = trace_data["config"]
+        self._current_stats = None
+        self._current_entry = None
+        if tracer_cfg.get("db_stats", True):
+            self._current_stats = statement_stats.add(self._trace_stmt or template, query_time, self.rowcount)
+        if not tracer_cfg.get("enabled", False):
+            return
+        slow_threshold = tracer_cfg.get("db_slow_threshold", None)
+        if slow_threshold is not None and query_time >= slow_threshold:
+            self._log_call(self._tracer, trace_stmt=self._trace_stmt, query_time=query_time)
+            return
+        sample_rate = tracer_cfg.get("db_sample_rate", 1)
+        if sample_rate:
+            TracingCursor._sample_seq += 1
+            if TracingCursor._sample_seq % sample_rate == 0:
+                self._log_call(self._tracer, trace_stmt=self._trace_stmt, query_time=query_time)
+
     def _log_call(self, tracer, trace_stmt=None, query_time=None):
         statement = trace_stmt or self.query
         status = self.rowcount
@@ -279,6 +654,38 @@ class TracingCursor(_cursor):
         return log_entry
 
 
+class IteratorFile(object):
+    """File-like object reading from an iterator of strings, to stream data into COPY FROM STDIN"""
+    def __init__(self, str_iter):
+        self._iter = iter(str_iter)
+        self._buf = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += self._iter.next()
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buf = self._buf, ""
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+def copy_escape(value):
+    """Returns the COPY text format representation of a column value"""
+    if value is None:
+        return "\\N"
+    if type(value) is bool:
+        return "t" if value else "f"
+    if type(value) is unicode:
+        value = value.encode("utf8")
+    elif type(value) is not str:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
 class StatementBuilder(object):
     def __init__(self):
         self.statement = None
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+__license__ = 'Apache 2.0'
+
+import resource
+import sys
+import time
+from nose.plugins.attrib import attr
+from unittest import SkipTest
+
+from pyon.util.int_test import IonIntegrationTestCase
+
+from pyon.core.bootstrap import IonObject, CFG, get_sys_name
+from pyon.core.exception import NotFound
+from pyon.datastore.datastore import DataStore
+from pyon.datastore.datastore_query import DatastoreQueryBuilder
+from pyon.datastore.postgresql.datastore import PostgresPyonDataStore
+from pyon.datastore.postgresql.pg_query import PostgresQueryBuilder
+from pyon.datastore.postgresql.pg_util import PreparedStatementCache
+from pyon.ion.identifier import create_unique_resource_id, create_unique_association_id
+from pyon.ion.resource import RT, PRED
+from pyon.util.containers import get_ion_ts
+
+from interface.objects import ResourceLifecycleEvent
+
+
+@attr('PFM', group='datastore')
+class TestPostgresDataStoreSpeed(IonIntegrationTestCase):
+
+    def setUp(self):
+        if CFG.get_safe("container.datastore.default_server", "couchdb") != "postgresql":
+            raise SkipTest("Postgres only")
+
+        self.data_store = PostgresPyonDataStore(datastore_name='ion_test_speed', profile=DataStore.DS_PROFILE.RESOURCES, scope=get_sys_name())
+        try:
+            self.data_store.delete_datastore()
+        except NotFound:
+            pass
+        self.data_store.create_datastore()
+        self.addCleanup(self.data_store.delete_datastore)
+
+    def _create_resources(self, restype, num_res):
+        res_objs = [IonObject(restype, name="%s%s" % (restype, i)) for i in xrange(num_res)]
+        res_ids = [create_unique_resource_id() for i in xrange(num_res)]
+        self.data_store.create_mult(res_objs, res_ids)
+        return res_ids
+
+    def _create_associations(self, subject_ids, st, predicate, object_ids, ot, assocs_per_subject):
+        assoc_objs = []
+        for i, sid in enumerate(subject_ids):
+            for j in xrange(assocs_per_subject):
+                oid = object_ids[(i * assocs_per_subject + j) % len(object_ids)]
+                assoc_objs.append(IonObject("Association", s=sid, st=st, p=predicate, o=oid, ot=ot, ts=get_ion_ts()))
+        self.data_store.create_mult(assoc_objs, [create_unique_association_id() for a in assoc_objs])
+        return assoc_objs
+
+    def test_find_mult_speed(self):
+        # 1000 subjects with 10 associations each = 10k associations
+        subject_ids = self._create_resources(RT.InstrumentDevice, 1000)
+        object_ids = self._create_resources(RT.DataProduct, 2000)
+        self._create_associations(subject_ids, RT.InstrumentDevice, PRED.hasOutputProduct, object_ids, RT.DataProduct, 10)
+
+        print >>sys.stderr, ""
+        for num_ids in (10, 100, 500):
+            for id_only in (True, False):
+                query_ids = subject_ids[:num_ids]
+
+                t1 = time.time()
+                res_loop = [[], []]
+                for sid in query_ids:
+                    res_ids, res_assocs = self.data_store.find_objects(sid, id_only=id_only)
+                    res_loop[0].extend(res_ids)
+                    res_loop[1].extend(res_assocs)
+                t2 = time.time()
+                res_mult = self.data_store.find_objects_mult(query_ids, id_only=id_only)
+                t3 = time.time()
+
+                self.assertEquals(len(res_loop[0]), len(res_mult[0]))
+                self.assertEquals(len(res_mult[0]), num_ids * 10)
+                print >>sys.stderr, "find_objects %s subjects (id_only=%s): loop %.4fs, mult %.4fs" % (num_ids, id_only, t2-t1, t3-t2)
+
+                object_query_ids = object_ids[:num_ids]
+                t1 = time.time()
+                for oid in object_query_ids:
+                    self.data_store.find_subjects(obj=oid, id_only=id_only)
+                t2 = time.time()
+                self.data_store.find_subjects_mult(object_query_ids, id_only=id_only)
+                t3 = time.time()
+                print >>sys.stderr, "find_subjects %s objects (id_only=%s): loop %.4fs, mult %.4fs" % (num_ids, id_only, t2-t1, t3-t2)
+
+    def test_read_doc_mult_speed(self):
+        num_docs = 100000
+        res_ids = []
+        for i in xrange(num_docs / 10000):
+            res_ids.extend(self._create_resources(RT.InstrumentDevice, 10000))
+
+        print >>sys.stderr, ""
+        # Iterator first, so that the peak RSS increase of the materializing read shows separately
+        rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t1 = time.time()
+        num_read = 0
+        for doc in self.data_store.read_doc_iter(res_ids, chunk_size=1000):
+            num_read += 1
+        t2 = time.time()
+        rss2 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertEquals(num_read, num_docs)
+        print >>sys.stderr, "read_doc_iter %s docs: %.4fs, peak RSS +%s KB" % (num_docs, t2-t1, rss2-rss1)
+
+        t1 = time.time()
+        docs = self.data_store.read_doc_mult(res_ids)
+        t2 = time.time()
+        rss3 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertEquals(len(docs), num_docs)
+        print >>sys.stderr, "read_doc_mult %s docs: %.4fs, peak RSS +%s KB" % (num_docs, t2-t1, rss3-rss2)
+
+    def test_bulk_load_speed(self):
+        num_events = 100000
+        batch_size = 10000
+        event_store = PostgresPyonDataStore(datastore_name='ion_test_speed_events', profile=DataStore.DS_PROFILE.EVENTS, scope=get_sys_name())
+        try:
+            event_store.delete_datastore()
+        except NotFound:
+            pass
+        event_store.create_datastore()
+        self.addCleanup(event_store.delete_datastore)
+
+        def make_docs(prefix):
+            return [event_store._ion_object_to_persistence_dict(
+                ResourceLifecycleEvent(origin="%s%s" % (prefix, i % 1000), origin_type="InstrumentDevice",
+                                       sub_type="DEPLOYED", ts_created=get_ion_ts()))
+                    for i in xrange(batch_size)]
+
+        print >>sys.stderr, ""
+        for name, load_func in (("create_doc_mult", event_store.create_doc_mult),
+                                ("bulk_load_docs", event_store.bulk_load_docs)):
+            total_time = 0
+            for i in xrange(num_events / batch_size):
+                docs = make_docs(name)
+                t1 = time.time()
+                load_func(docs)
+                total_time += time.time() - t1
+            print >>sys.stderr, "%s %s events (batch %s): %.4fs, %s events/s" % (
+                name, num_events, batch_size, total_time, int(num_events / total_time))
+
+    def test_update_doc_mult_speed(self):
+        num_res = 5000
+        res_ids = self._create_resources(RT.InstrumentDevice, num_res)
+
+        print >>sys.stderr, ""
+        for name, lcstate in (("update_doc loop", "PLANNED"), ("update_doc_mult", "DEVELOPED")):
+            docs = self.data_store.read_doc_mult(res_ids)
+            for doc in docs:
+                doc["lcstate"] = lcstate
+                doc["ts_updated"] = get_ion_ts()
+
+            t1 = time.time()
+            if name == "update_doc_mult":
+                res = self.data_store.update_doc_mult(docs)
+                self.assertTrue(all(r[0] for r in res))
+            else:
+                for doc in docs:
+                    self.data_store.update_doc(doc)
+            t2 = time.time()
+            print >>sys.stderr, "%s %s lifecycle updates: %.4fs" % (name, num_res, t2-t1)
+
+        self.assertEquals(len(self.data_store.find_res_by_lcstate("DEVELOPED", RT.InstrumentDevice, id_only=True)[0]), num_res)
+
+    def test_prepared_statements_speed(self):
+        num_calls = 50000
+        subject_ids = self._create_resources(RT.InstrumentDevice, 1000)
+        object_ids = self._create_resources(RT.DataProduct, 1000)
+        self._create_associations(subject_ids, RT.InstrumentDevice, PRED.hasOutputProduct, object_ids, RT.DataProduct, 2)
+
+        pool = self.data_store.pool
+        self.addCleanup(setattr, pool, "prepared", pool.prepared)
+
+        print >>sys.stderr, ""
+        for use_prepared in (False, True):
+            # A new cache prepares each statement again on every connection
+            pool.prepared = PreparedStatementCache() if use_prepared else None
+
+            t1 = time.time()
+            for i in xrange(num_calls):
+                self.data_store.read_doc(subject_ids[i % len(subject_ids)])
+            t2 = time.time()
+            for i in xrange(num_calls):
+                self.data_store.find_associations(subject=subject_ids[i % len(subject_ids)], predicate=PRED.hasOutputProduct)
+            t3 = time.time()
+            print >>sys.stderr, "prepared=%s: %s read_doc %.4fs, %s find_associations %.4fs" % (
+                use_prepared, num_calls, t2-t1, num_calls, t3-t2)
+
+    def test_keyset_paging_speed(self):
+        num_events = 1000000
+        batch_size = 10000
+        page_size = 1000
+        event_store = PostgresPyonDataStore(datastore_name='ion_test_speed_events', profile=DataStore.DS_PROFILE.EVENTS, scope=get_sys_name())
+        try:
+            event_store.delete_datastore()
+        except NotFound:
+            pass
+        event_store.create_datastore()
+        self.addCleanup(event_store.delete_datastore)
+
+        for i in xrange(num_events / batch_size):
+            event_store.bulk_load_docs([event_store._ion_object_to_persistence_dict(
+                ResourceLifecycleEvent(origin="dev%s" % (j % 100), origin_type="InstrumentDevice",
+                                       sub_type="DEPLOYED", ts_created=str(1400000000000 + i * batch_size + j)))
+                for j in xrange(batch_size)])
+
+        print >>sys.stderr, ""
+        # Offset paging, sampled at increasing depth
+        for skip in (0, 100000, 500000, 900000):
+            qb = DatastoreQueryBuilder(profile=DataStore.DS_PROFILE.EVENTS, datastore=DataStore.DS_EVENTS,
+                                       order_by=[("ts_created", "asc")], id_only=True, limit=page_size, skip=skip)
+            t1 = time.time()
+            res = event_store.find_by_query(qb.get_query())
+            t2 = time.time()
+            self.assertEquals(len(res), page_size)
+            print >>sys.stderr, "offset page at %s: %.4fs" % (skip, t2-t1)
+
+        # Keyset paging through all events
+        qb = DatastoreQueryBuilder(profile=DataStore.DS_PROFILE.EVENTS, datastore=DataStore.DS_EVENTS,
+                                   order_by=[("ts_created", "asc")], id_only=True, limit=page_size, keyset=True)
+        num_found, num_pages, max_page_time = 0, 0, 0
+        t1 = time.time()
+        while True:
+            tp = time.time()
+            res, page_token = event_store.find_by_query(qb.get_query())
+            max_page_time = max(max_page_time, time.time() - tp)
+            num_found += len(res)
+            num_pages += 1
+            if not page_token:
+                break
+            qb.build_query(page_token=page_token)
+        t2 = time.time()
+        self.assertEquals(num_found, num_events)
+        print >>sys.stderr, "keyset paging %s events in %s pages: %.4fs, max page %.4fs" % (
+            num_found, num_pages, t2-t1, max_page_time)
+
+    def test_query_plan_cache_speed(self):
+        num_queries = 10000
+        res_ids = self._create_resources(RT.InstrumentDevice, 1000)
+
+        def resource_query(i):
+            qb = DatastoreQueryBuilder(id_only=True, limit=10)
+            qb.build_query(where=qb.and_(qb.eq(qb.ATT_TYPE, RT.InstrumentDevice),
+                                         qb.or_(qb.like(qb.RA_NAME, "%s%s%%" % (RT.InstrumentDevice, i % 100)),
+                                                qb.eq(qb.RA_LCSTATE, "DEPLOYED")),
+                                         qb.in_(qb.RA_AVAILABILITY, "AVAILABLE", "PRIVATE")),
+                           order_by=qb.order_by("name"))
+            return qb.get_query()
+
+        def event_query(i):
+            qb = DatastoreQueryBuilder(profile=DataStore.DS_PROFILE.EVENTS, datastore=DataStore.DS_EVENTS,
+                                       id_only=True, limit=100)
+            qb.build_query(where=qb.and_(qb.eq(qb.EA_ORIGIN, res_ids[i % len(res_ids)]),
+                                         qb.gte(qb.RA_TS_CREATED, str(1400000000000 + i))),
+                           order_by=qb.order_by("ts_created", "desc"))
+            return qb.get_query()
+
+        print >>sys.stderr, ""
+        for name, query_func, basetable in (("resource", resource_query, "ion_resources"),
+                                            ("event", event_query, "ion_events")):
+            queries = [query_func(i) for i in xrange(num_queries)]
+            for use_cache in (False, True):
+                PostgresQueryBuilder.use_plan_cache = use_cache
+                PostgresQueryBuilder._plan_cache.clear()
+                try:
+                    t1 = time.time()
+                    for query in queries:
+                        PostgresQueryBuilder(query, basetable).get_query()
+                    t2 = time.time()
+                finally:
+                    PostgresQueryBuilder.use_plan_cache = True
+                print >>sys.stderr, "%s %s %s queries compile: %.4fs" % (
+                    "cached" if use_cache else "uncached", num_queries, name, t2-t1)
+
+        # End to end for the resource queries
+        for use_cache in (False, True):
+            PostgresQueryBuilder.use_plan_cache = use_cache
+            try:
+                t1 = time.time()
+                for i in xrange(1000):
+                    self.data_store.find_by_query(resource_query(i))
+                t2 = time.time()
+            finally:
+                PostgresQueryBuilder.use_plan_cache = True
+            print >>sys.stderr, "%s 1000 resource find_by_query: %.4fs" % ("cached" if use_cache else "uncached", t2-t1)
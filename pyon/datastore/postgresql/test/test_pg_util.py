@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+__license__ = 'Apache 2.0'
+
+from nose.plugins.attrib import attr
+from mock import Mock
+
+from pyon.util.unit_test import IonUnitTestCase
+from pyon.core.exception import Timeout
+
+from pyon.datastore.postgresql.pg_util import DatabaseConnectionPool, IteratorFile, PreparedStatementCache, \
+    StatementStats, copy_escape, ProgrammingError
+
+
+class MockConnectionPool(DatabaseConnectionPool):
+
+    def create_connection(self):
+        conn = Mock()
+        conn.closed = False
+        return conn
+
+
+@attr('UNIT', group='datastore')
+class PostgresUtilUnitTest(IonUnitTestCase):
+
+    def test_fetchiter(self):
+        pool = MockConnectionPool(maxsize=2)
+        rows = [(i, "doc%s" % i) for i in xrange(5)]
+        chunks = [rows[0:2], rows[2:4], rows[4:5], []]
+
+        conn = pool.get()
+        pool.put(conn)
+        cur = conn.cursor.return_value
+        cur.fetchmany.side_effect = chunks
+
+        res_iter = pool.fetchiter("SELECT id, doc FROM test", {}, name="test_iter", chunk_size=2)
+        self.assertEquals(list(res_iter), rows)
+
+        conn.cursor.assert_called_once_with(name="test_iter")
+        cur.execute.assert_called_once_with("SELECT id, doc FROM test", {})
+        self.assertEquals([c[0] for c in cur.fetchmany.call_args_list], [(2,)] * 4)
+        conn.commit.assert_called_once_with()
+        self.assertEquals(pool.pool.qsize(), 1)
+
+    def test_fetchiter_closed_early(self):
+        pool = MockConnectionPool(maxsize=2)
+        conn = pool.get()
+        pool.put(conn)
+        conn.cursor.return_value.fetchmany.return_value = [(1, "doc1"), (2, "doc2")]
+
+        res_iter = pool.fetchiter("SELECT id, doc FROM test", {}, name="test_iter")
+        self.assertEquals(res_iter.next(), (1, "doc1"))
+        res_iter.close()
+
+        # Connection is rolled back and returned to the pool
+        conn.rollback.assert_called_once_with()
+        self.assertFalse(conn.commit.called)
+        self.assertEquals(pool.pool.qsize(), 1)
+
+    def test_checkout_timeout(self):
+        pool = MockConnectionPool(maxsize=1, checkout_timeout=0.05)
+        conn = pool.get()
+        self.assertRaises(Timeout, pool.get)
+
+        pool.put(conn)
+        self.assertIs(pool.get(), conn)
+
+        stats = pool.get_stats()
+        self.assertEquals(stats["checkouts"], 2)
+        self.assertEquals(stats["timeouts"], 1)
+        self.assertEquals(stats["created"], 1)
+        self.assertEquals(stats["in_use"], 1)
+
+    def test_broken_connection(self):
+        pool = MockConnectionPool(maxsize=2)
+        conn1, conn2 = pool.get(), pool.get()
+        pool.put(conn1)
+
+        def use_broken_cursor():
+            with pool.cursor() as cur:
+                conn1.closed = True
+                raise Exception("Connection lost")
+        self.assertRaises(Exception, use_broken_cursor)
+
+        # Only the broken connection is gone
+        self.assertEquals(pool.size, 1)
+        self.assertEquals(pool.pool.qsize(), 0)
+        stats = pool.get_stats()
+        self.assertEquals(stats["broken"], 1)
+        self.assertEquals(stats["in_use"], 1)
+
+        # A broken connection returned to the pool is replaced on checkout
+        conn2.closed = True
+        pool.put(conn2)
+        conn3 = pool.get()
+        self.assertIsNot(conn3, conn2)
+        self.assertEquals(pool.size, 1)
+        self.assertEquals(pool.get_stats()["broken"], 2)
+
+    def test_recycle_connections(self):
+        pool = MockConnectionPool(maxsize=2, max_lifetime=60, max_idle_time=10)
+        conn1, conn2 = pool.get(), pool.get()
+        pool.put(conn1)
+        pool.put(conn2)
+
+        # Too old connections are replaced on checkout
+        pool._conn_times[conn1][0] -= 100
+        conn3 = pool.get()
+        self.assertIs(conn3, conn2)
+        self.assertTrue(conn1.close.called)
+        self.assertEquals(pool.get_stats()["recycled"], 1)
+        pool.put(conn3)
+
+        # Idle connections are closed by the check
+        pool._conn_times[conn2][1] -= 20
+        pool.check_idle()
+        self.assertTrue(conn2.close.called)
+        self.assertEquals(pool.size, 0)
+        self.assertEquals(pool.get_stats()["recycled"], 2)
+
+    def test_prepared_statements(self):
+        cache = PreparedStatementCache(max_statements=1)
+        cur = Mock()
+        cur.connection.isolation_level = 1
+        stmt1, stmt2 = cache._stmt_prefix + "1", cache._stmt_prefix + "2"
+        # Statement names are unique per cache
+        self.assertNotEquals(PreparedStatementCache()._stmt_prefix, cache._stmt_prefix)
+
+        stmt = "SELECT doc FROM ion_test WHERE id=%(id)s AND  rev=%(rev)s AND s<>%(id)s"
+        cache.execute(cur, stmt, dict(id="id1", rev=2))
+        self.assertEquals(cur.execute.call_args_list[0][0], (
+            "SAVEPOINT ion_prepare; PREPARE " + stmt1 + " AS SELECT doc FROM ion_test WHERE id=$1 AND rev=$2 AND s<>$1; "
+            "RELEASE SAVEPOINT ion_prepare", ))
+        self.assertEquals(cur.execute.call_args_list[1][0], ("EXECUTE " + stmt1 + " (%s, %s)", ["id1", 2]))
+
+        # Same statement is executed without preparing again
+        cur.reset_mock()
+        cache.execute(cur, stmt, dict(id="id2", rev=3))
+        cur.execute.assert_called_once_with("EXECUTE " + stmt1 + " (%s, %s)", ["id2", 3])
+
+        # Another statement replaces the least recently prepared one
+        cur.reset_mock()
+        cache.execute(cur, "SELECT rev FROM ion_test WHERE id=%s", ("id1", ))
+        self.assertEquals([c[0][0] for c in cur.execute.call_args_list], [
+            "SAVEPOINT ion_prepare; PREPARE " + stmt2 + " AS SELECT rev FROM ion_test WHERE id=$1; RELEASE SAVEPOINT ion_prepare",
+            "DEALLOCATE " + stmt1,
+            "EXECUTE " + stmt2 + " (%s)"])
+
+        stats = cache.get_stats()
+        self.assertEquals((stats["prepared"], stats["executed"], stats["deallocated"]), (2, 3, 1))
+        self.assertEquals((stats["connections"], stats["statements"]), (1, 1))
+
+        cache.evict(cur.connection)
+        self.assertEquals(cache.get_stats()["connections"], 0)
+
+    def test_prepared_statements_failed(self):
+        cache = PreparedStatementCache()
+        cur = Mock()
+        cur.connection.isolation_level = 1
+        cur.execute.side_effect = [ProgrammingError("could not determine data type of parameter $1"), None, None, None]
+
+        stmt = "SELECT %(val)s"
+        cache.execute(cur, stmt, dict(val=1))
+        self.assertEquals([c[0] for c in cur.execute.call_args_list[1:]], [
+            ("ROLLBACK TO SAVEPOINT ion_prepare", ),
+            (stmt, dict(val=1))])
+
+        # Not attempted again
+        cur.reset_mock()
+        cache.execute(cur, stmt, dict(val=2))
+        cur.execute.assert_called_once_with(stmt, dict(val=2))
+        self.assertEquals(cache.get_stats()["failed"], 1)
+
+    def test_pool_evicts_prepared(self):
+        pool = MockConnectionPool(maxsize=2, prepared_statements=True)
+        conn = pool.get()
+        cur = Mock()
+        cur.connection = conn
+        pool.prepared.execute(cur, "SELECT doc FROM ion_test WHERE id=%s", ("id1", ))
+        self.assertEquals(pool.get_stats()["prepared"]["statements"], 1)
+
+        conn.closed = True
+        pool.put(conn)
+        pool.get()
+        self.assertEquals(pool.get_stats()["prepared"]["statements"], 0)
+
+    def test_statement_stats(self):
+        stats = StatementStats(max_templates=2)
+        stats.add("SELECT id FROM ion_test WHERE type_ IN (%(v1)s,%(v2)s) LIMIT 10", 0.5, 2)
+        stats.add("SELECT  id FROM ion_test WHERE type_ IN (%(v1)s) LIMIT 20", 1.5, 1)
+        entry = stats.add("INSERT INTO ion_test (id, doc) VALUES (%(id0)s, %(doc0)s),(%(id1)s, %(doc1)s)", 0.1, -1)
+        self.assertEquals(entry, [1, 0.1, 0.1, 0])
+        stats.add("INSERT INTO ion_test (id, doc) VALUES (%(id0)s, %(doc0)s)", 0.2, 1)
+        stats.add("DELETE FROM ion_test", 0.25, 5)
+
+        res = stats.get_stats()
+        self.assertEquals([st["statement"] for st in res], [
+            "SELECT id FROM ion_test WHERE type_ IN (...) LIMIT ?",
+            "INSERT INTO ion_test (id, doc) VALUES (...)",
+            StatementStats.OTHER_KEY])
+        self.assertEquals((res[0]["count"], res[0]["total_time"], res[0]["max_time"], res[0]["rows"]), (2, 2.0, 1.5, 3))
+        self.assertEquals(res[0]["avg_time"], 1.0)
+        self.assertEquals((res[1]["count"], res[1]["rows"]), (2, 1))
+        self.assertEquals((res[2]["count"], res[2]["rows"]), (1, 5))
+        self.assertEquals(stats.get_stats(sort_by="count", limit=1)[0]["count"], 2)
+
+        dump = stats.dump(limit=2)
+        self.assertEquals(len(dump.split("\n")), 3)
+        self.assertIn("LIMIT ?", dump)
+
+        stats.clear()
+        self.assertEquals(stats.get_stats(), [])
+
+    def test_copy_escape(self):
+        self.assertEquals(copy_escape(None), "\\N")
+        self.assertEquals(copy_escape(True), "t")
+        self.assertEquals(copy_escape(False), "f")
+        self.assertEquals(copy_escape(12), "12")
+        self.assertEquals(copy_escape(u"\u20ac"), "\xe2\x82\xac")
+        self.assertEquals(copy_escape("a\tb\nc\rd\\e"), "a\\tb\\nc\\rd\\\\e")
+
+    def test_iterator_file(self):
+        f = IteratorFile(["abc\n", "de\n", "fghij\n"])
+        self.assertEquals(f.read(5), "abc\nd")
+        self.assertEquals(f.read(100), "e\nfghij\n")
+        self.assertEquals(f.read(100), "")
+
+        f = IteratorFile(iter(["ab", "cd"]))
+        self.assertEquals(f.read(), "abcd")
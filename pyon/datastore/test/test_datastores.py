@@ -5,7 +5,7 @@ __license__ = 'Apache 2.0'
 
 from nose.plugins.attrib import attr
 from unittest import SkipTest
-from mock import Mock, patch, ANY
+from mock import Mock, MagicMock, patch, ANY
 
 from pyon.util.int_test import IonIntegrationTestCase
 from pyon.util.unit_test import IonUnitTestCase
@@ -21,6 +21,7 @@ from pyon.util.tracer import CallTracer
 
 from pyon.datastore.postgresql.datastore import PostgresPyonDataStore
 from pyon.datastore.datastore_query import DatastoreQueryBuilder
+from pyon.datastore.postgresql.pg_query import PostgresQueryBuilder
 
 import interface.objects
 
@@ -50,6 +51,286 @@ class TestDataStoreUnitTest(IonUnitTestCase):
         qb.build_query(where=qb.within_geom(qb.RA_GEOM_LOC,wkt,buf))
         self.assertEquals(qb.get_query()['where'], ['gop:within_geom', ('geom_loc', 'POINT(-72.0 40.0)', 0.1)])
 
+    def test_pg_query_keyset(self):
+        qb = DatastoreQueryBuilder(profile=DataStore.DS_PROFILE.EVENTS, id_only=True, limit=2, keyset=True)
+        qb.build_query(where=qb.eq(qb.EA_ORIGIN, "dev1"), order_by=qb.order_by("ts_created", "desc"))
+        pqb = PostgresQueryBuilder(qb.get_query(), "ion_events")
+        self.assertEquals(pqb.get_query(), "SELECT id,ts_created FROM ion_events WHERE origin=%(v1)s "
+                                           "ORDER BY ts_created DESC,id DESC LIMIT 2")
+
+        self.assertEquals(pqb.get_page_token([("e4", "1004"), ("e3", "1003")]),
+                          DatastoreQueryBuilder.create_page_token(["1003"], "e3"))
+        self.assertIsNone(pqb.get_page_token([("e2", "1002")]))
+
+        # Next page continues after the token's row
+        page_token = pqb.get_page_token([("e4", "1004"), ("e3", "1003")])
+        qb.build_query(page_token=page_token)
+        pqb = PostgresQueryBuilder(qb.get_query(), "ion_events")
+        self.assertEquals(pqb.get_query(), "SELECT id,ts_created FROM ion_events WHERE origin=%(v1)s AND "
+                                           "((ts_created<%(v2)s) OR (ts_created=%(v2)s AND id<%(v3)s)) "
+                                           "ORDER BY ts_created DESC,id DESC LIMIT 2")
+        self.assertEquals(pqb.get_values(), dict(v1="dev1", v2="1003", v3="e3"))
+
+        # NULL sort values sort first descending: after a NULL row come the remaining NULLs, then all others
+        qb.build_query(page_token=pqb.get_page_token([("e2", None), ("e1", None)]))
+        pqb = PostgresQueryBuilder(qb.get_query(), "ion_events")
+        self.assertEquals(pqb.get_query(), "SELECT id,ts_created FROM ion_events WHERE origin=%(v1)s AND "
+                                           "((ts_created IS NOT NULL) OR (ts_created IS NULL AND id<%(v2)s)) "
+                                           "ORDER BY ts_created DESC,id DESC LIMIT 2")
+        self.assertEquals(pqb.get_values(), dict(v1="dev1", v2="e1"))
+
+        # NULL sort values sort last ascending: rows with NULLs follow any value
+        qb = DatastoreQueryBuilder(profile=DataStore.DS_PROFILE.EVENTS, id_only=True, limit=2, keyset=True,
+                                   page_token=DatastoreQueryBuilder.create_page_token(["1003"], "e3"))
+        qb.build_query(where=qb.eq(qb.EA_ORIGIN, "dev1"), order_by=qb.order_by("ts_created", "asc"))
+        pqb = PostgresQueryBuilder(qb.get_query(), "ion_events")
+        self.assertIn("WHERE origin=%(v1)s AND (((ts_created>%(v2)s OR ts_created IS NULL)) OR "
+                      "(ts_created=%(v2)s AND id>%(v3)s)) ORDER", pqb.get_query())
+        qb.build_query(page_token=DatastoreQueryBuilder.create_page_token([None], "e5"))
+        pqb = PostgresQueryBuilder(qb.get_query(), "ion_events")
+        self.assertIn("WHERE origin=%(v1)s AND (ts_created IS NULL AND id>%(v2)s) ORDER", pqb.get_query())
+
+        # Without sort order pages by id
+        qb = DatastoreQueryBuilder(id_only=False, limit=2, page_token=DatastoreQueryBuilder.create_page_token([], "r2"))
+        pqb = PostgresQueryBuilder(qb.get_query(), "ion_resources")
+        self.assertEquals(pqb.get_query(), "SELECT id,doc FROM ion_resources WHERE (id>%(v1)s) ORDER BY id ASC LIMIT 2")
+
+        with self.assertRaises(BadRequest):
+            qb.build_query(page_token="not a token")
+            PostgresQueryBuilder(qb.get_query(), "ion_resources")
+        with self.assertRaises(BadRequest):
+            qb.build_query(skip=10)
+            qb.get_query()
+
+    def test_pg_query_plan_cache(self):
+        def build(origin, ts_from, sub_types):
+            qb = DatastoreQueryBuilder(profile=DataStore.DS_PROFILE.EVENTS, limit=10)
+            qb.build_query(where=qb.and_(qb.eq(qb.EA_ORIGIN, origin), qb.gte(qb.RA_TS_CREATED, ts_from),
+                                         qb.in_(qb.EA_SUB_TYPE, *sub_types), qb.not_(qb.all_match("x"))),
+                           order_by=qb.order_by("ts_created", "desc"))
+            return PostgresQueryBuilder(qb.get_query(), "ion_events")
+
+        PostgresQueryBuilder._plan_cache.clear()
+        hits = PostgresQueryBuilder.plan_cache_stats["hits"]
+        pqb1 = build("dev1", "100", ["A", "B"])
+        pqb2 = build("dev2", "200", ["C", "D"])
+        self.assertEquals(PostgresQueryBuilder.plan_cache_stats["hits"], hits + 1)
+        self.assertEquals(pqb2.get_query(), pqb1.get_query())
+        self.assertEquals(pqb2.get_values(), dict(v1="dev2", v2="200", v3="C", v4="D", v5="%x%"))
+
+        # Values bound from the cache are the same as when compiling
+        PostgresQueryBuilder.use_plan_cache = False
+        try:
+            pqb3 = build("dev2", "200", ["C", "D"])
+        finally:
+            PostgresQueryBuilder.use_plan_cache = True
+        self.assertEquals(pqb3.get_query(), pqb2.get_query())
+        self.assertEquals(pqb3.get_values(), pqb2.get_values())
+
+        # Different shape
+        pqb4 = build("dev3", "300", ["E"])
+        self.assertEquals(PostgresQueryBuilder.plan_cache_stats["hits"], hits + 1)
+        self.assertIn("sub_type IN (%(v3)s)", pqb4.get_query())
+
+    def _mock_pg_datastore(self, rows):
+        ds = PostgresPyonDataStore.__new__(PostgresPyonDataStore)
+        ds.cursor_args = {}
+        ds._column_types = {}
+        ds._get_datastore_name = Mock(return_value="ion_test")
+        ds._persistence_dict_to_ion_object = lambda doc: doc
+        ds.pool = MagicMock()
+        ds.pool.prepared = None
+        cur = ds.pool.cursor.return_value.__enter__.return_value
+        cur.fetchall.return_value = rows
+        return ds, cur
+
+    def test_pg_find_mult(self):
+        rows = [("s2", "o3", "a3"), ("s1", "o1", "a1"), ("s2", "o4", "a4"), ("s1", "o2", "a2")]
+        ds, cur = self._mock_pg_datastore(rows)
+
+        obj_ids, assocs = ds.find_objects_mult(["s1", "s2", "s3"], id_only=True, predicate="hasModel")
+        self.assertEquals(obj_ids, ["o1", "o2", "o3", "o4"])
+        self.assertEquals(assocs, ["a1", "a2", "a3", "a4"])
+
+        self.assertEquals(cur.execute.call_count, 1)
+        sql, args = cur.execute.call_args[0]
+        self.assertIn("ion_test_assoc.s = ANY(%(ids)s)", sql)
+        self.assertIn("ion_test_assoc.o=ion_test.id", sql)
+        self.assertIn("p=%(p)s", sql)
+        self.assertEquals(set(args["ids"]), {"s1", "s2", "s3"})
+
+        ds, cur = self._mock_pg_datastore([("o1", "s1doc", "a1")])
+        sub_objs, assocs = ds.find_subjects_mult(["o1"], id_only=False)
+        self.assertEquals(sub_objs, ["s1doc"])
+        sql, args = cur.execute.call_args[0]
+        self.assertIn("ion_test_assoc.o = ANY(%(ids)s)", sql)
+        self.assertNotIn("p=%(p)s", sql)
+
+        ds, cur = self._mock_pg_datastore([])
+        self.assertEquals(ds.find_objects_mult([]), [[], []])
+        self.assertFalse(cur.execute.called)
+
+        # Goes through prepared statements when enabled
+        ds, cur = self._mock_pg_datastore([])
+        ds.pool.prepared = Mock()
+        ds.find_objects_mult(["s1"], id_only=True)
+        self.assertEquals(ds.pool.prepared.execute.call_count, 1)
+        self.assertFalse(cur.execute.called)
+
+    def test_pg_find_associations_mult(self):
+        rows = [("a1", "s1", "hasModel", "o1", "a1doc"), ("a2", "s1", "hasModel", "o2", "a2doc"),
+                ("a3", "s2", "hasModel", "o1", "a3doc")]
+        ds, cur = self._mock_pg_datastore(rows)
+
+        # (s1, o2) and (s2, o1) match the ANY conditions but were not asked for
+        assoc_ids = ds.find_associations_mult([("s1", "hasModel", "o1"), ("s2", "hasModel", "o2")])
+        self.assertEquals(assoc_ids, ["a1"])
+        self.assertEquals(cur.execute.call_count, 1)
+        sql, args = cur.execute.call_args[0]
+        self.assertIn("s = ANY(%(s)s) AND o = ANY(%(o)s) AND p = ANY(%(p)s)", sql)
+        self.assertEquals(set(args["s"]), {"s1", "s2"})
+
+        self.assertEquals(ds.find_associations_mult([("s2", "hasModel", "o1")], id_only=False), ["a3doc"])
+
+        ds, cur = self._mock_pg_datastore([])
+        self.assertEquals(ds.find_associations_mult([]), [])
+        self.assertFalse(cur.execute.called)
+
+    def test_pg_find_associations_anyside(self):
+        ds, cur = self._mock_pg_datastore([("a1",), ("a2",)])
+        ds.pool.prepared = Mock()
+
+        # Any number of resource ids results in the same statement
+        self.assertEquals(ds.find_associations(anyside=["r1", "r2", "r3"], id_only=True), ["a1", "a2"])
+        sql, args = ds.pool.prepared.execute.call_args[0][1:]
+        self.assertIn("(s = ANY(%(any_ids)s) OR o = ANY(%(any_ids)s))", sql)
+        self.assertEquals(args["any_ids"], ["r1", "r2", "r3"])
+
+    def test_pg_limit_skip_args(self):
+        ds, cur = self._mock_pg_datastore([])
+        ds.pool.prepared = Mock()
+
+        # Limit and skip are statement arguments, so different values share one prepared statement
+        ds.find_objects("s1", id_only=True, limit=10, skip=20)
+        sql1, args = ds.pool.prepared.execute.call_args[0][1:]
+        self.assertTrue(sql1.endswith(" LIMIT %(view_limit)s OFFSET %(view_skip)s "))
+        self.assertEquals((args["view_limit"], args["view_skip"]), (10, 20))
+
+        ds.find_objects("s1", id_only=True, limit=50, skip=100)
+        sql2, args = ds.pool.prepared.execute.call_args[0][1:]
+        self.assertEquals(sql1, sql2)
+        self.assertEquals((args["view_limit"], args["view_skip"]), (50, 100))
+
+    def test_pg_find_associations_iter(self):
+        ds, _ = self._mock_pg_datastore([])
+        ds.pool.fetchiter.return_value = iter([("a-1", 2, "s-1", "Org", "hasResource", "o-1", "InstrumentDevice", "123")])
+
+        assoc_tuples = list(ds.find_associations_iter(chunk_size=10))
+        self.assertEquals(assoc_tuples, [("a1", "2", "s1", "Org", "hasResource", "o1", "InstrumentDevice", "123")])
+        sql, args = ds.pool.fetchiter.call_args[0]
+        self.assertEquals(sql, "SELECT id, rev, s, st, p, o, ot, json_string(doc,'ts') FROM ion_test_assoc WHERE retired<>true")
+        self.assertEquals(ds.pool.fetchiter.call_args[1], dict(name="find_associations_iter", chunk_size=10))
+
+    def test_pg_read_visibility_mult(self):
+        ds, cur = self._mock_pg_datastore([("r-1", 1), ("r-2", None)])
+        self.assertEquals(ds.read_visibility_mult(["r-1", "r-2", "r3", "r-1"]), {"r1": 1, "r2": None})
+        sql, args = cur.execute.call_args[0]
+        self.assertEquals(sql, "SELECT id, visibility FROM ion_test WHERE id = ANY(%(ids)s)")
+        self.assertEquals(sorted(args["ids"]), ["r-1", "r-2", "r3"])
+
+        ds, cur = self._mock_pg_datastore([])
+        self.assertEquals(ds.read_visibility_mult([]), {})
+        self.assertFalse(cur.execute.called)
+
+    def test_pg_read_doc_mult(self):
+        ds, cur = self._mock_pg_datastore([("id2", {"_id": "id2"}), ("id1", {"_id": "id1"})])
+
+        docs = ds.read_doc_mult(("id1", "id2", "id3"), strict=False)
+        self.assertEquals(docs, [{"_id": "id1"}, {"_id": "id2"}, None])
+
+        sql, args = cur.execute.call_args[0]
+        self.assertEquals(sql, "SELECT id, doc FROM ion_test WHERE id = ANY(%(ids)s)")
+        self.assertEquals(args, dict(ids=["id1", "id2", "id3"]))
+
+        with self.assertRaises(NotFound):
+            ds.read_doc_mult(["id1", "id3"])
+
+    def test_pg_read_doc_iter(self):
+        ds, cur = self._mock_pg_datastore([])
+        ds.pool.fetchiter.return_value = iter([("id2", {"_id": "id2"}), ("id1", {"_id": "id1"})])
+
+        docs = list(ds.read_doc_iter(["id1", "id2"], object_type="Association", chunk_size=10))
+        self.assertEquals(docs, [{"_id": "id2"}, {"_id": "id1"}])
+        ds.pool.fetchiter.assert_called_once_with("SELECT id, doc FROM ion_test_assoc WHERE id = ANY(%(ids)s)",
+                                                  dict(ids=["id1", "id2"]), name="read_doc_iter", chunk_size=10)
+
+        self.assertEquals(list(ds.read_doc_iter([])), [])
+
+    def test_pg_bulk_load_docs(self):
+        ds, _ = self._mock_pg_datastore([])
+        ds.profile = DataStore.DS_PROFILE.EVENTS
+        cur = ds.pool.copy_cursor.return_value.__enter__.return_value
+        copied = []
+        cur.copy_expert.side_effect = lambda sql, f: copied.append((sql, f.read()))
+
+        docs = [dict(_id="ev1", type_="ResourceEvent", origin="res1", origin_type="Resource", sub_type=None,
+                     ts_created="1", description="Line1\nLine2\ttab"),
+                dict(type_="ResourceEvent", origin="res2", origin_type="Resource", sub_type="upd", ts_created="2")]
+        res = ds.bulk_load_docs(docs, object_ids=[None, "ev2"])
+
+        self.assertEquals(res, [(True, "ev1", "1"), (True, "ev2", "1")])
+        self.assertEquals(len(copied), 1)
+        sql, data = copied[0]
+        self.assertEquals(sql, "COPY ion_test (id, rev, doc, origin, origin_type, sub_type, ts_created, type_) FROM STDIN")
+        rows = data.split("\n")
+        self.assertEquals(len(rows), 3)
+        self.assertEquals(rows[2], "")
+        row1 = rows[0].split("\t")
+        self.assertEquals(row1[0:2], ["ev1", "1"])
+        self.assertEquals(row1[3:], ["res1", "Resource", "\\N", "1", "ResourceEvent"])
+        self.assertIn("Line1\\\\nLine2\\\\ttab", row1[2])
+        self.assertEquals(rows[1].split("\t")[3:], ["res2", "Resource", "upd", "2", "ResourceEvent"])
+
+        with self.assertRaises(BadRequest):
+            ds.bulk_load_docs(docs, object_ids=["ev1"])
+
+    def test_pg_update_doc_mult(self):
+        ds, cur = self._mock_pg_datastore([])
+        ds.profile = DataStore.DS_PROFILE.RESOURCES
+        cur.fetchall.side_effect = [[("id", "varchar"), ("rev", "int4"), ("doc", "json"), ("visibility", "int4")],
+                                    [("r1", ), ("r3", )]]
+
+        docs = [dict(_id="r1", _rev="1", type_="Resource", name="R1", lcstate="DRAFT"),
+                dict(_id="r2", _rev="3", type_="Resource", name="R2", lcstate="DRAFT"),
+                dict(_id="r3", _rev="2", type_="Resource", name="R3", lcstate="DEPLOYED", visibility=1)]
+        res = ds.update_doc_mult(docs)
+
+        self.assertEquals(res, [(True, "r1", "2"), (False, "r2", "conflict"), (True, "r3", "3")])
+        self.assertEquals([doc["_rev"] for doc in docs], ["2", "3", "3"])
+
+        # One catalog lookup and one update statement
+        self.assertEquals(cur.execute.call_count, 2)
+        sql, args = cur.execute.call_args[0]
+        self.assertTrue(sql.startswith("UPDATE ion_test SET doc=v.doc, rev=v.rev+1, type_=COALESCE(v.type_, ion_test.type_)"))
+        self.assertIn("unnest(%(doc)s::json[]) AS doc", sql)
+        self.assertIn("unnest(%(visibility)s::int4[]) AS visibility", sql)
+        self.assertIn("WHERE ion_test.id=v.id AND ion_test.rev=v.rev RETURNING ion_test.id", sql)
+        self.assertEquals(args["id"], ["r1", "r2", "r3"])
+        self.assertEquals(args["rev"], [1, 3, 2])
+        self.assertEquals(args["lcstate"], ["DRAFT", "DRAFT", "DEPLOYED"])
+        self.assertEquals(args["visibility"], [None, None, 1])
+
+        # Column types are cached
+        cur.fetchall.side_effect = [[("r1", )]]
+        res = ds.update_doc_mult(docs[:1])
+        self.assertEquals(res, [(True, "r1", "3")])
+        self.assertEquals(cur.execute.call_count, 3)
+
+        # Duplicate ids are rejected before any update
+        with self.assertRaises(BadRequest):
+            ds.update_doc_mult([docs[0], dict(docs[0])])
+        self.assertEquals(cur.execute.call_count, 3)
+
 
 @attr('INT', group='datastore')
 class TestDataStores(IonIntegrationTestCase):
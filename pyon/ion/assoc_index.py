@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""In-memory index of resource associations"""
+
+__license__ = 'Apache 2.0'
+
+import random
+
+from pyon.core.bootstrap import IonObject
+
+
+class AssociationIndex(object):
+    """
+    Container-local index of all current (not retired) associations by subject and by object and
+    predicate, answering find_objects, find_subjects and anyside association lookups (such as the
+    multi-hop lookups of extended resources) without datastore queries.
+    Associations are kept as (id, rev, s, st, p, o, ot, ts) tuples. Association objects created
+    from the index have only these attributes set.
+    """
+    def __init__(self):
+        self._assocs = {}       # Association id -> (id, rev, s, st, p, o, ot, ts)
+        self._by_subject = {}   # Subject id -> dict of predicate -> set of association ids
+        self._by_object = {}    # Object id -> dict of predicate -> set of association ids
+        self.loaded = False
+        self.stats = dict(loads=0, lookups=0, refreshes=0, mismatches=0)
+
+    def count(self):
+        return len(self._assocs)
+
+    def load(self, assoc_tuples):
+        """Replaces the index content with given association tuples, e.g. as read from the datastore"""
+        self.clear()
+        for assoc_tuple in assoc_tuples:
+            self._add(assoc_tuple)
+        self.loaded = True
+        self.stats["loads"] += 1
+
+    def clear(self):
+        self._assocs.clear()
+        self._by_subject.clear()
+        self._by_object.clear()
+        self.loaded = False
+
+    def add(self, assoc):
+        """Adds an Association object, which must have _id and _rev set"""
+        self._add((assoc._id, assoc._rev, assoc.s, assoc.st, assoc.p, assoc.o, assoc.ot, assoc.ts))
+
+    def _add(self, assoc_tuple):
+        assoc_id, _, s, _, p, o, _, _ = assoc_tuple
+        if assoc_id in self._assocs:
+            self.remove(assoc_id)
+        self._assocs[assoc_id] = assoc_tuple
+        self._by_subject.setdefault(s, {}).setdefault(p, set()).add(assoc_id)
+        self._by_object.setdefault(o, {}).setdefault(p, set()).add(assoc_id)
+
+    def get(self, assoc_id):
+        """Returns the association tuple for given id or None"""
+        return self._assocs.get(assoc_id, None)
+
+    def remove(self, assoc_id):
+        """Removes an association by id. Returns False if not in the index"""
+        assoc_tuple = self._assocs.pop(assoc_id, None)
+        if assoc_tuple is None:
+            return False
+        _, _, s, _, p, o, _, _ = assoc_tuple
+        self._discard(self._by_subject, s, p, assoc_id)
+        self._discard(self._by_object, o, p, assoc_id)
+        return True
+
+    def _discard(self, by_res, res_id, predicate, assoc_id):
+        by_pred = by_res[res_id]
+        assoc_ids = by_pred[predicate]
+        assoc_ids.discard(assoc_id)
+        if not assoc_ids:
+            del by_pred[predicate]
+            if not by_pred:
+                del by_res[res_id]
+
+    def remove_resource(self, res_id):
+        """Removes all associations with given resource as subject or object"""
+        for assoc_id in self.get_association_ids(res_id):
+            self.remove(assoc_id)
+
+    def refresh_resource(self, res_id, assocs):
+        """Replaces all associations of given resource with given Association objects from the datastore"""
+        self.remove_resource(res_id)
+        for assoc in assocs:
+            self.add(assoc)
+        self.stats["refreshes"] += 1
+
+    def get_association_ids(self, res_id):
+        """Returns the set of ids of associations with given resource as subject or object"""
+        assoc_ids = set()
+        for by_res in (self._by_subject, self._by_object):
+            for pred_assoc_ids in by_res.get(res_id, {}).itervalues():
+                assoc_ids.update(pred_assoc_ids)
+        return assoc_ids
+
+    def sample_resource_ids(self, sample_size):
+        """Returns up to sample_size random ids of resources that have associations"""
+        res_ids = list(set(self._by_subject).union(self._by_object))
+        return random.sample(res_ids, min(sample_size, len(res_ids)))
+
+    def _find(self, by_res, res_id, predicate=None):
+        by_pred = by_res.get(res_id, None)
+        if not by_pred:
+            return []
+        if predicate:
+            return [self._assocs[assoc_id] for assoc_id in by_pred.get(predicate, ())]
+        return [self._assocs[assoc_id] for pred_assoc_ids in by_pred.itervalues() for assoc_id in pred_assoc_ids]
+
+    def find_objects(self, subject_id, predicate=None, object_type=None):
+        """Returns association tuples with given subject and optional predicate and object type"""
+        self.stats["lookups"] += 1
+        assoc_tuples = self._find(self._by_subject, subject_id, predicate)
+        if object_type:
+            assoc_tuples = [assoc_tuple for assoc_tuple in assoc_tuples if assoc_tuple[6] == object_type]
+        return assoc_tuples
+
+    def find_subjects(self, object_id, predicate=None, subject_type=None):
+        """Returns association tuples with given object and optional predicate and subject type"""
+        self.stats["lookups"] += 1
+        assoc_tuples = self._find(self._by_object, object_id, predicate)
+        if subject_type:
+            assoc_tuples = [assoc_tuple for assoc_tuple in assoc_tuples if assoc_tuple[3] == subject_type]
+        return assoc_tuples
+
+    def find_associations(self, anyside):
+        """
+        Returns association tuples with any of the given resources as subject or object, as the datastore
+        find_associations(anyside=...). anyside is a resource id, a list of resource ids or a list of
+        (resource id, predicate) tuples.
+        """
+        self.stats["lookups"] += 1
+        keys = [anyside] if type(anyside) is str else anyside
+        found = {}
+        for key in keys:
+            res_id, predicate = (key, None) if type(key) is str else key
+            for by_res in (self._by_subject, self._by_object):
+                for assoc_tuple in self._find(by_res, res_id, predicate):
+                    found[assoc_tuple[0]] = assoc_tuple
+        return found.values()
+
+    @staticmethod
+    def to_object(assoc_tuple):
+        assoc_id, rev, s, st, p, o, ot, ts = assoc_tuple
+        assoc = IonObject("Association", s=s, st=st, p=p, o=o, ot=ot, ts=ts or "")
+        assoc._id = assoc_id
+        assoc._rev = rev
+        return assoc
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats["size"] = len(self._assocs)
+        stats["resources"] = len(set(self._by_subject).union(self._by_object))
+        return stats
@@ -5,7 +5,7 @@
 __author__ = 'Michael Meisinger, David Stuebe, Dave Foster <dfoster@asascience.com>'
 __license__ = 'Apache 2.0'
 
-from pyon.net.endpoint import Publisher, Subscriber, EndpointUnit, process_interceptors, RPCRequestEndpointUnit, BaseEndpoint, RPCClient, RPCResponseEndpointUnit, RPCServer, PublisherEndpointUnit, SubscriberEndpointUnit
+from pyon.net.endpoint import Publisher, Subscriber, EndpointUnit, process_interceptors, RPCRequestEndpointUnit, BaseEndpoint, RPCClient, RPCResponseMultiplexer, RPCResponseEndpointUnit, RPCServer, PublisherEndpointUnit, SubscriberEndpointUnit
 from pyon.ion.event import BaseEventSubscriberMixin
 from pyon.util.log import log
 from pyon.core.exception import Timeout as IonTimeout
@@ -179,6 +179,22 @@ class ProcessRPCClient(RPCClient):
         newkwargs['process'] = self._process
         return RPCClient.create_endpoint(self, to_name, existing_channel, **newkwargs)
 
+    def _get_channel_affinity(self):
+        return getattr(self._process, 'id', None)
+
+    def _get_multiplexer(self):
+        """
+        Shares one multiplexer, and so one reply queue, among all RPC clients of the process.
+
+        The process manager closes it when the process quits.
+        """
+        multiplexer = getattr(self._process, '_rpc_multiplexer', None)
+        if multiplexer is None:
+            multiplexer = RPCResponseMultiplexer(self.node, affinity=self._get_channel_affinity())
+            self._process._rpc_multiplexer = multiplexer
+
+        return multiplexer
+
 
 class ProcessRPCResponseEndpointUnit(ProcessEndpointUnitMixin, RPCResponseEndpointUnit):
     def __init__(self, process=None, routing_call=None, **kwargs):
@@ -261,7 +277,7 @@ class ProcessRPCResponseEndpointUnit(ProcessEndpointUnitMixin, RPCResponseEndpoi
         """
         Gets the process' saturation, as an integer percentage (process time / total time).
         """
-        total, _, proc, interval, interval_run = self._process._process.time_stats  # we want the ION proc's stats
+        total, _, proc, interval, interval_run = self._process._process.time_stats[:5]  # we want the ION proc's stats
         #return str(int(proc / float(total) * 100))  # Total
         return str(int(interval_run / float(interval) * 100))  # Percentage in current (partial) and prior interval
 
@@ -294,6 +310,9 @@ class ProcessRPCServer(RPCServer):
         newkwargs['routing_call'] = self._routing_call
         return RPCServer.create_endpoint(self, **newkwargs)
 
+    def _get_channel_affinity(self):
+        return getattr(self._process, 'id', None)
+
     def __str__(self):
         return "ProcessRPCServer at %s:\n\trecv_name: %s\n\tprocess: %s" % (hex(id(self)), str(self._recv_name), str(self._process))
 
@@ -328,6 +347,9 @@ class ProcessPublisher(Publisher):
         newkwargs['process'] = self._process
         return Publisher.create_endpoint(self, *args, **newkwargs)
 
+    def _get_channel_affinity(self):
+        return getattr(self._process, 'id', None)
+
 
 class PublisherError(StandardError):
     """
@@ -412,6 +434,9 @@ class ProcessSubscriber(Subscriber):
         newkwargs['routing_call'] = self._routing_call
         return Subscriber.create_endpoint(self, **newkwargs)
 
+    def _get_channel_affinity(self):
+        return getattr(self._process, 'id', None)
+
     def __str__(self):
         return "ProcessSubscriber at %s:\n\trecv_name: %s\n\tprocess: %s\n\tcb: %s" % (hex(id(self)), str(self._recv_name), str(self._process), str(self._callback))
 
@@ -298,6 +298,10 @@ class EventRepository(object):
         datastore_manager = datastore_manager or self.container.datastore_manager
         self.event_store = datastore_manager.get_datastore("events", DataStore.DS_PROFILE.EVENTS)
 
+        # Batches of at least this many events are loaded in bulk, if the datastore supports it (0 to disable).
+        # Note: the Postgres bulk load blocks all greenlets of the container while it runs, so it is opt-in
+        self.bulk_load_threshold = bootstrap.CFG.get_safe("container.event_repository.bulk_load_threshold", 0)
+
     def start(self):
         pass
 
@@ -325,6 +329,9 @@ class EventRepository(object):
             raise BadRequest("events must all be type Event")
 
         if events:
+            if self.bulk_load_threshold and len(events) >= self.bulk_load_threshold and \
+                    hasattr(self.event_store, "bulk_load"):
+                return self.event_store.bulk_load(events)
             return self.event_store.create_mult(events, allow_ids=True)
         else:
             return None
@@ -349,8 +349,9 @@ class ExchangeManager(object):
 
             log.debug("Created RR XS object, id: %s", xso_id)
         else:
-            self._ensure_default_declared()
-            xs.declare()
+            with self._priviledged_transport.pipelined():
+                self._ensure_default_declared()
+                xs.declare()
 
         self.xs_by_name[name] = xs
 
@@ -398,8 +399,9 @@ class ExchangeManager(object):
 
             xpo_id = self._ems_client.create_exchange_point(xpo, self._get_xs_obj(xs._exchange)._id, headers=self._build_security_headers())        # @TODO: _exchange is wrong
         else:
-            self._ensure_default_declared()
-            xp.declare()
+            with self._priviledged_transport.pipelined():
+                self._ensure_default_declared()
+                xp.declare()
 
         return xp
 
@@ -460,8 +462,9 @@ class ExchangeManager(object):
 
             self._ems_client.declare_exchange_name(xno, self._get_xs_obj(xs._exchange)._id, headers=self._build_security_headers())     # @TODO: exchange is wrong
         else:
-            self._ensure_default_declared()
-            xn.declare()
+            with self._priviledged_transport.pipelined():
+                self._ensure_default_declared()
+                xn.declare()
 
         return xn
 
@@ -7,13 +7,14 @@ from pyon.util.log import log
 from pyon.core.thread import PyonThreadManager, PyonThread, ThreadManager, PyonThreadTraceback, PyonHeartbeatError
 from pyon.ion.service import BaseService
 from gevent.event import Event, waitall, AsyncResult
-from gevent.queue import Queue
 from gevent import greenlet, Timeout
 from pyon.util.async import spawn
 from pyon.core.exception import IonException, ContainerError
 from pyon.core.exception import Timeout as IonTimeout
 from pyon.util.containers import get_ion_ts, get_ion_ts_millis
 from pyon.core.bootstrap import CFG
+import heapq
+import itertools
 import threading
 import traceback
 
@@ -35,6 +36,158 @@ class IonProcessError(StandardError):
     pass
 
 
+class ControlQueue(object):
+    """
+    Scheduling queue for the calls synchronized through an IonProcessThread's control flow.
+
+    Calls are served by the optional "priority" context header (higher first), then by their
+    "reply-by" deadline (earliest first), then in arrival order. Calls without a reply-by are
+    ordered as if due default_deadline ms after arrival, so they are not starved by RPCs.
+    Calls whose reply-by has passed are dropped on every get, regardless of their position,
+    and handed to expired_callback. Pending calls are indexed by their AsyncResult.
+
+    Entries are removed lazily from the heaps; a StopIteration put ends iteration once the
+    remaining calls have been served.
+    """
+
+    def __init__(self, expired_callback=None, default_deadline=10000):
+        self._expired_callback  = expired_callback
+        self._default_deadline  = default_deadline
+        self._heap              = []        # (-priority, order deadline, seq, entry)
+        self._deadlines         = []        # (reply-by, seq, entry), only calls with a reply-by
+        self._entries           = {}        # AsyncResult -> entry, entry = [calltuple, enqueue time]
+        self._seq               = itertools.count()
+        self._ready             = Event()
+        self._stopped           = False
+
+        self.stats = dict(max_depth=0, served=0, wait_time=0, max_wait_time=0, expired=0, cancelled=0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ar):
+        return ar in self._entries
+
+    def __iter__(self):
+        while True:
+            calltuple = self.get()
+            if calltuple is StopIteration:
+                return
+            yield calltuple
+
+    def put(self, calltuple):
+        """
+        Schedules a call tuple (calling greenlet, ar, call, callargs, callkwargs, context).
+        Putting StopIteration stops the queue.
+        """
+        if calltuple is StopIteration:
+            self._stopped = True
+            self._ready.set()
+            return
+
+        ar, context = calltuple[1], calltuple[5]
+        now = get_ion_ts_millis()
+        priority = self._get_header_int(context, 'priority', 0)
+        reply_by = self._get_header_int(context, 'reply-by', None)
+
+        seq = self._seq.next()
+        entry = [calltuple, now]
+        self._entries[ar] = entry
+
+        order_deadline = reply_by if reply_by is not None else now + self._default_deadline
+        heapq.heappush(self._heap, (-priority, order_deadline, seq, entry))
+        if reply_by is not None:
+            heapq.heappush(self._deadlines, (reply_by, seq, entry))
+
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self._entries))
+        self._ready.set()
+
+    def get(self):
+        """
+        Blocks until a call is available and returns the next call tuple by schedule order,
+        or StopIteration if the queue has been stopped and is empty.
+        """
+        while True:
+            now = get_ion_ts_millis()
+            self._drop_expired(now)
+
+            while self._heap:
+                _, _, _, entry = heapq.heappop(self._heap)
+                if entry[0] is None:
+                    continue        # cancelled, expired or already served
+
+                calltuple, enqueue_time = entry
+                entry[0] = None
+                del self._entries[calltuple[1]]
+
+                wait_time = now - enqueue_time
+                self.stats['served'] += 1
+                self.stats['wait_time'] += wait_time
+                self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+                self._compact()
+                return calltuple
+
+            if self._stopped:
+                return StopIteration
+
+            self._ready.clear()
+            self._ready.wait()
+
+    def cancel(self, ar):
+        """
+        Removes the pending call keyed by the given AsyncResult.
+
+        @return True if the call was pending.
+        """
+        entry = self._entries.pop(ar, None)
+        if entry is None:
+            return False
+
+        entry[0] = None
+        self.stats['cancelled'] += 1
+        self._compact()
+        return True
+
+    @property
+    def avg_wait_time(self):
+        if not self.stats['served']:
+            return 0
+        return self.stats['wait_time'] / self.stats['served']
+
+    def _drop_expired(self, now):
+        while self._deadlines and self._deadlines[0][0] <= now:
+            reply_by, _, entry = heapq.heappop(self._deadlines)
+            if entry[0] is None:
+                continue
+
+            calltuple = entry[0]
+            entry[0] = None
+            del self._entries[calltuple[1]]
+            self.stats['expired'] += 1
+
+            if self._expired_callback is not None:
+                self._expired_callback(calltuple, now)
+
+    def _compact(self):
+        """Rebuilds the heaps when they are mostly made of removed entries."""
+        live = len(self._entries)
+        if len(self._heap) > 2 * live + 64:
+            self._heap = [x for x in self._heap if x[3][0] is not None]
+            heapq.heapify(self._heap)
+        if len(self._deadlines) > 2 * live + 64:
+            self._deadlines = [x for x in self._deadlines if x[2][0] is not None]
+            heapq.heapify(self._deadlines)
+
+    @staticmethod
+    def _get_header_int(context, header, default):
+        if context is None or header not in context:
+            return default
+        try:
+            return int(context[header])
+        except (TypeError, ValueError):
+            return default
+
+
 class IonProcessThread(PyonThread):
     """
     Form the base of an ION process.
@@ -67,7 +220,8 @@ class IonProcessThread(PyonThread):
         self.thread_manager     = ThreadManager(failure_notify_callback=self._child_failed) # bubbles up to main thread manager
         self._dead_children     = []        # save any dead children for forensics
         self._ctrl_thread       = None
-        self._ctrl_queue        = Queue()
+        self._ctrl_queue        = ControlQueue(expired_callback=self._expire_call,
+                                               default_deadline=CFG.get_safe('cc.timeout.ctrl_queue_default_deadline', 10) * 1000)
         self._ready_control     = Event()
         self._errors            = []
         self._ctrl_current      = None      # set to the AR generated by _routing_call when in the context of a call
@@ -141,8 +295,10 @@ class IonProcessThread(PyonThread):
     @property
     def time_stats(self):
         """
-        Returns a 5-tuple of (total time, idle time, processing time, time since prior interval start,
-        busy since prior interval start), all in ms (int).
+        Returns a 9-tuple of (total time, idle time, processing time, time since prior interval start,
+        busy since prior interval start, control queue depth, max control queue depth, average call
+        wait time, max call wait time). Times are in ms (int); wait time is the time a call spent in
+        the control queue before it was started.
         """
         now = get_ion_ts_millis()
         running_time = now - self._start_time
@@ -158,7 +314,9 @@ class IonProcessThread(PyonThread):
         else:
             proc_time_since_prior = 0
 
-        return (running_time, idle_time, self._proc_time, now_since_prior, proc_time_since_prior)
+        return (running_time, idle_time, self._proc_time, now_since_prior, proc_time_since_prior,
+                len(self._ctrl_queue), self._ctrl_queue.stats['max_depth'], self._ctrl_queue.avg_wait_time,
+                self._ctrl_queue.stats['max_wait_time'])
 
     def _child_failed(self, child):
         """
@@ -282,11 +440,7 @@ class IonProcessThread(PyonThread):
         """
         Returns true if the call (keyed by the AsyncResult returned by _routing_call) is still pending.
         """
-        for _, qar, _, _, _, _ in self._ctrl_queue.queue:
-            if qar == ar:
-                return True
-
-        return False
+        return ar in self._ctrl_queue
 
     def _cancel_pending_call(self, ar):
         """
@@ -294,7 +448,7 @@ class IonProcessThread(PyonThread):
 
         @return True if the call was truly pending.
         """
-        if self.has_pending_call(ar):
+        if self._ctrl_queue.cancel(ar):
             ar.set(False)
             return True
 
@@ -325,7 +479,7 @@ class IonProcessThread(PyonThread):
         automatically for you by the Container's Process Manager.
 
         This method blocks until there are calls to be made in the synchronized queue, and
-        then calls from within this greenlet.  Any exception raised is caught and re-raised
+        then calls from within this greenlet, in the order given by the ControlQueue.  Any exception raised is caught and re-raised
         in the greenlet that originally scheduled the call.  If successful, the AsyncResult
         created at scheduling time is set with the result of the call.
         """
@@ -345,18 +499,7 @@ class IonProcessThread(PyonThread):
             start_proc_time = get_ion_ts_millis()
             self._record_proc_time(start_proc_time)
 
-            # check context for expiration
-            if context is not None and 'reply-by' in context:
-                if start_proc_time >= int(context['reply-by']):
-                    log.info("control_flow: attempting to process message already exceeding reply-by, ignore")
-
-                    # raise a timeout in the calling thread to allow endpoints to continue processing
-                    e = IonTimeout("Reply-by time has already occurred (reply-by: %s, op start time: %s)" % (context['reply-by'], start_proc_time))
-                    calling_gl.kill(exception=e, block=False)
-
-                    continue
-
-            # also check ar if it is set, if it is, that means it is cancelled
+            # expired calls were already dropped by the queue, check ar if it is set, if it is, that means it is cancelled
             if ar.ready():
                 log.info("control_flow: attempting to process message that has been cancelled, ignore")
                 continue
@@ -399,6 +542,17 @@ class IonProcessThread(PyonThread):
 
             ar.set(res)
 
+    def _expire_call(self, calltuple, now):
+        """
+        Called by the control queue for a pending call whose reply-by has passed.
+        """
+        calling_gl, ar, call, callargs, callkwargs, context = calltuple
+        log.info("control_flow: dropping message already exceeding reply-by")
+
+        # raise a timeout in the calling thread to allow endpoints to continue processing
+        e = IonTimeout("Reply-by time has already occurred (reply-by: %s, op start time: %s)" % (context['reply-by'], now))
+        calling_gl.kill(exception=e, block=False)
+
     def _record_proc_time(self, cur_time):
         """Keep the _proc_time of the prior and prior-prior intervals for stats computation"""
         cur_interval = cur_time / STAT_INTERVAL_LENGTH
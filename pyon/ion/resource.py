@@ -12,6 +12,7 @@ import time
 from pyon.core.registry import getextends, issubtype, is_ion_object, isenum
 from pyon.core.bootstrap import IonObject
 from pyon.core.exception import BadRequest, NotFound, Inconsistent, Unauthorized
+from pyon.ion.assoc_index import AssociationIndex
 from pyon.util.config import Config
 from pyon.util.containers import DotDict, named_any, get_ion_ts
 from pyon.util.execute import get_method_arguments, get_remote_info, execute_method
@@ -392,17 +393,69 @@ class ExtendedResourceContainer(object):
                                                 ext_associations=None, ext_exclude=None, **kwargs):
         """
         Returns a list of extended resource containers for given list of resource_ids.
+        All resources are read at once, then their associations are found at once, then the second
+        level associations and the associated resources for all containers are read at once.
+        Overridden set_container_field_values and set_computed_attributes are called per container.
         """
+        overall_start_time = time.time()
+        self.ctx = None  # Clear the context in case this instance gets reused
+
         if not isinstance(resource_id_list, types.ListType):
             raise Inconsistent("The parameter resource_id_list is not a list of resource_ids")
+        if not all(isinstance(resource_id, types.StringType) for resource_id in resource_id_list):
+            raise Inconsistent("The parameter resource_id_list is not a list of resource_ids")
+
+        self._check_container_types(extended_resource_type, computed_resource_type)
+
+        if not resource_id_list:
+            return []
 
-        ret = list()
-        for res_id in resource_id_list:
-            ext_res = self.create_extended_resource_container(extended_resource_type, res_id, computed_resource_type,
-                ext_associations, ext_exclude )
-            ret.append(ext_res)
+        resource_objs = self._rr.read_mult(resource_id_list)
+
+        res_containers = [self._create_container(extended_resource_type, resource_obj) for resource_obj in resource_objs]
+
+        # Initialize context object field and load associations of all resources
+        self._prepare_context(list(set(resource_id_list)))
+
+        batch_fields = self._is_default_hook("set_container_field_values")
+        batch_computed = self._is_default_hook("set_computed_attributes")
+        obj_needs = []
+        for res_container in res_containers:
+            # Fill lcstate related resource container fields
+            self.set_container_lcstate_info(res_container)
+
+            # Fill resource container info; currently only type_version
+            self.set_res_container_info(res_container)
+
+            # Determine needs for resource container fields and computed attributes
+            if batch_fields:
+                obj_needs.append(self._get_field_needs(res_container, res_container.resource, ext_exclude, **kwargs))
+            else:
+                self.set_container_field_values(res_container, ext_exclude, **kwargs)
+            if not batch_computed:
+                self.set_computed_attributes(res_container, computed_resource_type, ext_exclude, **kwargs)
+            elif computed_resource_type:
+                res_container.computed = IonObject(computed_resource_type)
+                obj_needs.append(self._get_field_needs(res_container.computed, res_container.resource, ext_exclude, **kwargs))
 
-        return ret
+        # Fill resource container fields and computed attributes for all containers
+        obj_needs = [needs for needs in obj_needs if needs]
+        if obj_needs:
+            self._set_field_needs(obj_needs)
+
+        ts_created = get_ion_ts()
+        for res_container in res_containers:
+            # Fill additional associations
+            self.set_extended_associations(res_container, ext_associations, ext_exclude)
+
+            res_container.ts_created = ts_created
+
+        overall_stop_time = time.time()
+
+        log.debug("Time to process %s extended resource containers %s %f secs", len(res_containers),
+                  extended_resource_type, overall_stop_time - overall_start_time)
+
+        return res_containers
 
     def create_extended_resource_container(self, extended_resource_type, resource_id, computed_resource_type=None,
                                            ext_associations=None, ext_exclude=None, **kwargs):
@@ -415,33 +468,14 @@ class ExtendedResourceContainer(object):
         if not isinstance(resource_id, types.StringType):
             raise Inconsistent("The parameter resource_id is not a single resource id string")
 
-        if not self.service_provider or not self._rr:
-            raise Inconsistent("This class is not initialized properly")
-
-        if extended_resource_type not in getextends(OT.ResourceContainer):
-            raise BadRequest('The requested resource %s is not extended from %s' % (extended_resource_type, OT.ResourceContainer))
-
-        if computed_resource_type and computed_resource_type not in getextends(OT.BaseComputedAttributes):
-            raise BadRequest('The requested resource %s is not extended from %s' % (computed_resource_type, OT.BaseComputedAttributes))
+        self._check_container_types(extended_resource_type, computed_resource_type)
 
         resource_object = self._rr.read(resource_id)
 
         if not resource_object:
             raise NotFound("The Resource %s does not exist" % resource_id)
 
-        res_container = IonObject(extended_resource_type)
-
-        # Check to make sure the extended resource decorator raise OriginResourceType matches the type of the resource type
-        originResourceType = res_container.get_class_decorator_value('OriginResourceType')
-        if originResourceType is None:
-            log.error('The requested extended resource %s does not contain an OriginResourceType decorator.' , extended_resource_type)
-
-        elif originResourceType != resource_object.type_ and not issubtype(resource_object.type_, originResourceType):
-            raise Inconsistent('The OriginResourceType decorator of the requested resource %s(%s) does not match the type of the specified resource id(%s).' % (
-                extended_resource_type, originResourceType, resource_object.type_))
-
-        res_container._id = resource_object._id
-        res_container.resource = resource_object
+        res_container = self._create_container(extended_resource_type, resource_object)
 
         # Initialize context object field and load resource associations
         self._prepare_context(resource_object._id)
@@ -471,6 +505,39 @@ class ExtendedResourceContainer(object):
 
         return res_container
 
+    def _is_default_hook(self, method_name):
+        """Returns True if given container hook method is not overridden, so that its work can be batched"""
+        return getattr(getattr(self, method_name), "im_func", None) is getattr(ExtendedResourceContainer, method_name).im_func
+
+    def _check_container_types(self, extended_resource_type, computed_resource_type):
+        if not self.service_provider or not self._rr:
+            raise Inconsistent("This class is not initialized properly")
+
+        if extended_resource_type not in getextends(OT.ResourceContainer):
+            raise BadRequest('The requested resource %s is not extended from %s' % (extended_resource_type, OT.ResourceContainer))
+
+        if computed_resource_type and computed_resource_type not in getextends(OT.BaseComputedAttributes):
+            raise BadRequest('The requested resource %s is not extended from %s' % (computed_resource_type, OT.BaseComputedAttributes))
+
+    def _create_container(self, extended_resource_type, resource_object):
+        """
+        Returns a new extended resource container for given resource object.
+        """
+        res_container = IonObject(extended_resource_type)
+
+        # Check to make sure the extended resource decorator raise OriginResourceType matches the type of the resource type
+        originResourceType = res_container.get_class_decorator_value('OriginResourceType')
+        if originResourceType is None:
+            log.error('The requested extended resource %s does not contain an OriginResourceType decorator.' , extended_resource_type)
+
+        elif originResourceType != resource_object.type_ and not issubtype(resource_object.type_, originResourceType):
+            raise Inconsistent('The OriginResourceType decorator of the requested resource %s(%s) does not match the type of the specified resource id(%s).' % (
+                extended_resource_type, originResourceType, resource_object.type_))
+
+        res_container._id = resource_object._id
+        res_container.resource = resource_object
+        return res_container
+
     def set_res_container_info(self, res_container):
         """
         Set info in resource container, such as type_version.
@@ -515,7 +582,16 @@ class ExtendedResourceContainer(object):
         Iterate through all fields of the given object and set values according
         to the field type and decorator definition in the object type schema.
         """
+        obj_needs = self._get_field_needs(obj, resource, ext_exclude, **kwargs)
+        if obj_needs:
+            self._set_field_needs([obj_needs])
 
+    def _get_field_needs(self, obj, resource, ext_exclude, **kwargs):
+        """
+        Sets the fields of given object that do not need resource objects. Returns a tuple of
+        (obj, resource, field needs, resource needs, compound association needs, final target types)
+        for the other fields, or None if there are none.
+        """
         # Step 1: Determine needs to fill fields with resource objects.
         field_needs = []         # Fields that need to be set in a subsequent step
         resource_needs = set()   # Resources to read by id based on needs
@@ -603,67 +679,81 @@ class ExtendedResourceContainer(object):
 
         # field_needs contains a list of what's needed to load in next step (different cases)
         if not field_needs:
-            return
+            return None
+        return obj, resource, field_needs, resource_needs, assoc_needs, final_target_types
 
+    def _set_field_needs(self, obj_needs):
+        """
+        Sets the fields for a list of needs as returned by _get_field_needs. The second level associations
+        and the resource objects for all needs are read at once.
+        """
         # Step 2: Read second level of compound associations as needed
         # @TODO Can only do 2 level compounds for now. Make recursive someday
+        assoc_needs = set()
+        for _, _, _, _, obj_assoc_needs, _ in obj_needs:
+            assoc_needs.update(obj_assoc_needs)
         if assoc_needs:
-            assocs = self._rr.find_associations(anyside=list(assoc_needs), id_only=False)
+            assocs = self._find_context_associations(list(assoc_needs))
             self._add_associations(assocs)
 
             # Determine resource ids to read for compound associations
-            for field, need_type, needs in field_needs:
-                if need_type == 'A':
-                    assoc_list, predicates = needs
-                    for target_id, assoc in assoc_list:
-                        res_type = assoc.ot if target_id == assoc.o else assoc.st
-                        assoc_list1 = self._find_associated_resources(target_id, predicates[1], None, res_type)
-                        for target_id1, assoc1 in assoc_list1:
-                            resource_needs.add(target_id1)
+            for _, _, field_needs, resource_needs, _, _ in obj_needs:
+                for field, need_type, needs in field_needs:
+                    if need_type == 'A':
+                        assoc_list, predicates = needs
+                        for target_id, assoc in assoc_list:
+                            res_type = assoc.ot if target_id == assoc.o else assoc.st
+                            assoc_list1 = self._find_associated_resources(target_id, predicates[1], None, res_type)
+                            for target_id1, assoc1 in assoc_list1:
+                                resource_needs.add(target_id1)
 
         # Step 3: Read resource objects based on needs
+        resource_needs = set()
+        for _, _, _, obj_resource_needs, _, _ in obj_needs:
+            resource_needs.update(obj_resource_needs)
         res_list = self._rr.read_mult(list(resource_needs))
         res_objs = dict(zip(resource_needs, res_list))
 
         # Step 4: Set fields to loaded resource objects based on type
-        for field, need_type, needs in field_needs:
-            if need_type == 'L':    # case list
-                obj_list = [res_objs[target_id] for target_id, assoc in needs]
-                setattr(obj, field, obj_list)
-            elif need_type == 'O':  # case nested object
-                target_id, assoc = needs
-                setattr(obj, field, res_objs[target_id])
-            elif need_type == 'A':  # case compound
-                assoc_list, predicates = needs
-                obj_list = []
-                for target_id, assoc in assoc_list:
-                    res_type = assoc.ot if target_id == assoc.o else assoc.st
-                    assoc_list1 = self._find_associated_resources(target_id, predicates[1], None, res_type)
-                    obj_list.append([res_objs[target_id1] for target_id1, assoc1 in assoc_list1])
-
-                # Filter the list to remove objects that might match the current resource type
-                result_obj_list = []
-                for ol_nested in obj_list:
-                    if ol_nested:
-                        #Only get the object types which don't match the current resource type and may match a final type
-                        if final_target_types.has_key(field):
-                            result_obj_list.extend([target_obj for target_obj in ol_nested if (target_obj.type_ != resource.type_ and final_target_types[field] in target_obj._get_extends())])
-                        else:
-                            result_obj_list.extend([target_obj for target_obj in ol_nested if (target_obj.type_ != resource.type_) ])
+        for obj, resource, field_needs, _, _, final_target_types in obj_needs:
+            for field, need_type, needs in field_needs:
+                if need_type == 'L':    # case list
+                    obj_list = [res_objs[target_id] for target_id, assoc in needs]
+                    setattr(obj, field, obj_list)
+                elif need_type == 'O':  # case nested object
+                    target_id, assoc = needs
+                    setattr(obj, field, res_objs[target_id])
+                elif need_type == 'A':  # case compound
+                    assoc_list, predicates = needs
+                    obj_list = []
+                    for target_id, assoc in assoc_list:
+                        res_type = assoc.ot if target_id == assoc.o else assoc.st
+                        assoc_list1 = self._find_associated_resources(target_id, predicates[1], None, res_type)
+                        obj_list.append([res_objs[target_id1] for target_id1, assoc1 in assoc_list1])
+
+                    # Filter the list to remove objects that might match the current resource type
+                    result_obj_list = []
+                    for ol_nested in obj_list:
+                        if ol_nested:
+                            #Only get the object types which don't match the current resource type and may match a final type
+                            if final_target_types.has_key(field):
+                                result_obj_list.extend([target_obj for target_obj in ol_nested if (target_obj.type_ != resource.type_ and final_target_types[field] in target_obj._get_extends())])
+                            else:
+                                result_obj_list.extend([target_obj for target_obj in ol_nested if (target_obj.type_ != resource.type_) ])
 
-                if obj._schema[field]['type'] == 'list':
-                    if result_obj_list:
-                        setattr(obj, field, result_obj_list)
-                elif obj._schema[field]['type'] == 'int':
-                    setattr(obj, field, len(result_obj_list))
-                else:
-                    if result_obj_list:
-                        if len(result_obj_list) != 1:
-                            # WARNING: Swallow random further objects here!
-                            log.warn("Extended object field %s uses only 1 of %d compound associated resources", field, len(result_obj_list))
-                        setattr(obj, field, result_obj_list[0])
+                    if obj._schema[field]['type'] == 'list':
+                        if result_obj_list:
+                            setattr(obj, field, result_obj_list)
+                    elif obj._schema[field]['type'] == 'int':
+                        setattr(obj, field, len(result_obj_list))
                     else:
-                        setattr(obj, field, None)
+                        if result_obj_list:
+                            if len(result_obj_list) != 1:
+                                # WARNING: Swallow random further objects here!
+                                log.warn("Extended object field %s uses only 1 of %d compound associated resources", field, len(result_obj_list))
+                            setattr(obj, field, result_obj_list[0])
+                        else:
+                            setattr(obj, field, None)
 
     def set_extended_associations(self, res_container, ext_associations, ext_exclude):
         """
@@ -683,13 +773,23 @@ class ExtendedResourceContainer(object):
 
     def _prepare_context(self, resource_id):
         """
-        Initializes the context object and loads associations for resource id.
+        Initializes the context object and loads associations for resource id or list of resource ids.
         """
         self.ctx = dict(by_subject={}, by_object={})
-        assocs = self._rr.find_associations(anyside=resource_id, id_only=False)
+        assocs = self._find_context_associations(resource_id)
         self._add_associations(assocs)
         log.debug("Found %s associations for resource %s", len(assocs), resource_id)
 
+    def _find_context_associations(self, anyside):
+        """
+        Returns Association objects for given resource id or list of ids or (id, predicate) tuples,
+        from the container's association index if the resource registry has one loaded.
+        """
+        assoc_index = getattr(self._rr, "assoc_index", None)
+        if isinstance(assoc_index, AssociationIndex) and assoc_index.loaded:
+            return [AssociationIndex.to_object(assoc_tuple) for assoc_tuple in assoc_index.find_associations(anyside)]
+        return self._rr.find_associations(anyside=anyside, id_only=False)
+
     def _add_associations(self, assocs):
         """
         Adds a list of Association objects to the context memory structure, indexed by
@@ -4,13 +4,20 @@
 
 __author__ = 'Michael Meisinger'
 
+import gevent
+import simplejson as json
+import sys
+import time
+from collections import OrderedDict
+
 from pyon.core import bootstrap
 from pyon.core.bootstrap import IonObject, CFG
 from pyon.core.exception import BadRequest, NotFound, Inconsistent
 from pyon.core.object import IonObjectBase
 from pyon.core.registry import getextends
 from pyon.datastore.datastore import DataStore
-from pyon.ion.event import EventPublisher
+from pyon.ion.assoc_index import AssociationIndex
+from pyon.ion.event import EventPublisher, EventSubscriber
 from pyon.ion.identifier import create_unique_resource_id, create_unique_association_id
 from pyon.ion.resource import LCS, LCE, PRED, RT, AS, OT, get_restype_lcsm, is_resource, ExtendedResourceContainer, \
     lcstate, lcsplit, Predicates, create_access_args
@@ -21,6 +28,95 @@ from pyon.util.log import log
 from interface.objects import Attachment, AttachmentType, ResourceModificationType
 
 
+DEFAULT_CACHE_CONFIG = {"enabled": False,
+                        "max_size": 1000,       # Max cached resources per type
+                        "ttl": 60.0,            # Seconds a cached resource is valid
+                        "types": {RT.Org: {}, RT.ActorIdentity: {}, RT.UserRole: {}, RT.Service: {}},
+                        }
+
+DEFAULT_ASSOC_INDEX_CONFIG = {"enabled": False,
+                              "check_interval": 0,          # Seconds between consistency checks, 0 for no checks
+                              "check_sample_size": 100,     # Resources compared with the datastore per check
+                              }
+
+
+class ResourceCache(object):
+    """
+    Bounded in-container cache of resource documents for configured resource types, with per-type
+    LRU size limit and TTL. Entries are removed by invalidate() for resource modification events.
+    Docs are kept JSON encoded, so that every get returns an independent copy.
+    """
+    def __init__(self, config=None):
+        config = config if config is not None else {}
+        max_size = config.get("max_size", DEFAULT_CACHE_CONFIG["max_size"])
+        ttl = config.get("ttl", DEFAULT_CACHE_CONFIG["ttl"])
+        types = config.get("types", None) or DEFAULT_CACHE_CONFIG["types"]
+        self._type_limits = {}      # Resource type -> (max size, ttl)
+        self._entries = {}          # Resource type -> OrderedDict of id to (JSON doc, rev, expiry time)
+        for restype, type_cfg in types.iteritems():
+            type_cfg = type_cfg or {}
+            self._type_limits[restype] = (type_cfg.get("max_size", max_size), type_cfg.get("ttl", ttl))
+            self._entries[restype] = OrderedDict()
+        self._id_types = {}         # Resource id -> type for cached ids
+        # Counts invalidations. A doc read before an invalidation must not be put afterwards.
+        self.generation = 0
+        self.stats = dict(hits=0, misses=0, puts=0, invalidations=0, evictions=0)
+
+    def is_cached_type(self, restype):
+        return restype in self._type_limits
+
+    def get(self, res_id, rev_id=None):
+        """Returns the cached doc for given resource id or None. If rev_id is given, the doc must have this rev"""
+        restype = self._id_types.get(res_id, None)
+        if restype is not None:
+            entries = self._entries[restype]
+            doc_json, rev, expires = entries.pop(res_id)
+            if expires >= time.time() and (not rev_id or rev_id == rev):
+                entries[res_id] = (doc_json, rev, expires)
+                self.stats["hits"] += 1
+                return json.loads(doc_json)
+            del self._id_types[res_id]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, doc, generation):
+        """Caches given doc if of a cached type and no invalidation happened since given generation"""
+        restype = doc.get("type_", None)
+        if restype not in self._type_limits or generation != self.generation:
+            return
+        max_size, ttl = self._type_limits[restype]
+        entries = self._entries[restype]
+        res_id = doc["_id"]
+        entries.pop(res_id, None)
+        entries[res_id] = (json.dumps(doc), doc.get("_rev", None), time.time() + ttl)
+        self._id_types[res_id] = restype
+        self.stats["puts"] += 1
+        while len(entries) > max_size:
+            old_id, _ = entries.popitem(last=False)
+            del self._id_types[old_id]
+            self.stats["evictions"] += 1
+
+    def invalidate(self, res_id):
+        self.generation += 1
+        self.stats["invalidations"] += 1
+        restype = self._id_types.pop(res_id, None)
+        if restype is not None:
+            del self._entries[restype][res_id]
+
+    def clear(self):
+        self.generation += 1
+        self._id_types.clear()
+        for entries in self._entries.itervalues():
+            entries.clear()
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = float(stats["hits"]) / lookups if lookups else 0.0
+        stats["size"] = {restype: len(entries) for restype, entries in self._entries.iteritems()}
+        return stats
+
+
 class ResourceRegistry(object):
     """
     Class that uses a datastore to provide a resource registry.
@@ -43,10 +139,42 @@ class ResourceRegistry(object):
 
         self.superuser_actors = None
 
+        # Optional cache for reads of frequently used resource types
+        cache_cfg = DEFAULT_CACHE_CONFIG.copy()
+        cache_cfg.update(CFG.get_safe("container.resource_registry.cache", None) or {})
+        self.res_cache = ResourceCache(cache_cfg) if cache_cfg["enabled"] else None
+        self._cache_subscribers = []
+
+        # Optional in-memory index of all associations for find_objects/find_subjects and extended resources
+        self.assoc_index_cfg = DEFAULT_ASSOC_INDEX_CONFIG.copy()
+        self.assoc_index_cfg.update(CFG.get_safe("container.resource_registry.assoc_index", None) or {})
+        self.assoc_index = AssociationIndex() if self.assoc_index_cfg["enabled"] else None
+        self._assoc_check_gl = None
+        # Marks association events of this container, which has already updated its own index
+        self._assoc_event_source = "assoc_index:%s" % getattr(self.container, "id", "")
+
     def start(self):
-        pass
+        if self.assoc_index and not hasattr(self.rr_store, "find_associations_iter"):
+            log.warn("Association index not supported by datastore %s - disabled", type(self.rr_store).__name__)
+            self.assoc_index = None
+        if (self.res_cache or self.assoc_index) and self.container.has_capability(self.container.CCAP.EXCHANGE_MANAGER):
+            # Invalidate cache and refresh association index for changes made in any container
+            for event_type in ("ResourceModifiedEvent", "ResourceLifecycleEvent"):
+                sub = EventSubscriber(event_type=event_type, callback=self._receive_resource_event, auto_delete=True)
+                sub.start()
+                self._cache_subscribers.append(sub)
+        if self.assoc_index:
+            self.load_assoc_index()
+            if self.assoc_index_cfg["check_interval"]:
+                self._assoc_check_gl = gevent.spawn(self._assoc_check_loop)
 
     def stop(self):
+        if self._assoc_check_gl:
+            self._assoc_check_gl.kill()
+            self._assoc_check_gl = None
+        for sub in self._cache_subscribers:
+            sub.stop()
+        self._cache_subscribers = []
         self.close()
 
     def close(self):
@@ -55,6 +183,133 @@ class ResourceRegistry(object):
         """
         self.rr_store.close()
 
+    def _receive_resource_event(self, event, headers):
+        if event.sub_type == "ASSOCIATION" and event.description == self._assoc_event_source:
+            return
+        if self.res_cache:
+            self.res_cache.invalidate(event.origin)
+        if self.assoc_index and (event.sub_type in ("ASSOCIATION", "DELETE") or
+                                 (event.type_ == "ResourceLifecycleEvent" and event.lcstate == LCS.DELETED)):
+            self._refresh_assoc_index(event.origin)
+
+    def _invalidate_cached(self, resource_id):
+        if self.res_cache:
+            self.res_cache.invalidate(resource_id)
+
+    # -------------------------------------------------------------------------
+    # Association index
+
+    def load_assoc_index(self):
+        """(Re)loads the association index from the datastore. Queries use the datastore while loading"""
+        t1 = time.time()
+        self.assoc_index.load(self.rr_store.find_associations_iter())
+        log.info("Loaded association index with %s associations in %.2f sec", self.assoc_index.count(), time.time() - t1)
+
+    def _refresh_assoc_index(self, resource_id):
+        assocs = self.rr_store.find_associations(anyside=resource_id, id_only=False)
+        self.assoc_index.refresh_resource(resource_id, assocs)
+
+    def check_assoc_index(self, sample_size=None):
+        """
+        Compares the association index with the datastore. Reloads the index if the number of associations
+        differs, otherwise refreshes the associations of sampled resources that differ.
+        Returns the number of mismatches found.
+        """
+        if self.rr_store.count_associations() != self.assoc_index.count():
+            log.warn("Association index has %s associations, datastore differs - reloading", self.assoc_index.count())
+            self.assoc_index.stats["mismatches"] += 1
+            self.load_assoc_index()
+            return 1
+
+        res_ids = self.assoc_index.sample_resource_ids(sample_size or self.assoc_index_cfg["check_sample_size"])
+        if not res_ids:
+            return 0
+        store_assoc_ids = {}
+        for assoc in self.rr_store.find_associations(anyside=res_ids, id_only=False):
+            store_assoc_ids.setdefault(assoc.s, set()).add(assoc._id)
+            store_assoc_ids.setdefault(assoc.o, set()).add(assoc._id)
+        stale_ids = [res_id for res_id in res_ids
+                     if self.assoc_index.get_association_ids(res_id) != store_assoc_ids.get(res_id, set())]
+        if stale_ids:
+            log.warn("Association index differs from datastore for resources %s - refreshing", stale_ids)
+            self.assoc_index.stats["mismatches"] += len(stale_ids)
+            for res_id in stale_ids:
+                self._refresh_assoc_index(res_id)
+        return len(stale_ids)
+
+    def _assoc_check_loop(self):
+        while True:
+            gevent.sleep(self.assoc_index_cfg["check_interval"])
+            try:
+                self.check_assoc_index()
+            except Exception:
+                gevent.get_hub().handle_error(self, *sys.exc_info())
+
+    def _use_assoc_index(self, res_list, id_only, limit=None, skip=None, descending=None, access_args=None):
+        """Returns True if a find for given resources (ids or objects with id) can be answered by the index"""
+        if not self.assoc_index or not self.assoc_index.loaded or not res_list or type(id_only) is not bool or \
+                limit or skip or descending or self._get_hidden_visibilities(access_args) is None:
+            return False
+        res_list = res_list if type(res_list) is list else [res_list]
+        return all(type(res) is str or "_id" in res for res in res_list)
+
+    def _get_hidden_visibilities(self, access_args):
+        """
+        Returns the resource visibilities that the datastore access filter hides for given access args,
+        or None if the filter depends on the actor's ownerships and memberships (registered actors).
+        """
+        access_args = access_args or {}
+        current_actor_id = access_args.get("current_actor_id", None)
+        if current_actor_id in (access_args.get("superuser_actor_ids", None) or []):
+            return ()
+        if current_actor_id and current_actor_id != "anonymous":
+            return None
+        return (2, 3, 4)
+
+    def _get_indexed_result(self, assoc_tuples, res_pos, id_only, access_args=None):
+        """
+        Returns find_objects/find_subjects results from association index tuples. res_pos selects s or o.
+        As in the datastore, associated resources must exist and be visible under the access args.
+        """
+        hidden = self._get_hidden_visibilities(access_args)
+
+        def is_visible(visibility):
+            # As SQL "visibility NOT IN (...)", which is not true for NULL
+            return not hidden or (visibility is not None and visibility not in hidden)
+
+        res_ids = [assoc_tuple[res_pos] for assoc_tuple in assoc_tuples]
+        if id_only:
+            visibilities = self.rr_store.read_visibility_mult(res_ids)
+            found = [(res_id, assoc_tuple) for res_id, assoc_tuple in zip(res_ids, assoc_tuples)
+                     if res_id in visibilities and is_visible(visibilities[res_id])]
+        else:
+            res_objs = self.read_mult(res_ids, strict=False)
+            found = [(res_obj, assoc_tuple) for res_obj, assoc_tuple in zip(res_objs, assoc_tuples)
+                     if res_obj is not None and is_visible(getattr(res_obj, "visibility", None))]
+        return [res for res, _ in found], [AssociationIndex.to_object(assoc_tuple) for _, assoc_tuple in found]
+
+    def _publish_association_events(self, subjects):
+        """Publishes an event per subject id (dict to subject type) of created or deleted associations,
+        so that association indexes in other containers are refreshed. This container skips its own events"""
+        if not self.container.has_capability(self.container.CCAP.EVENT_PUBLISHER):
+            return
+        for subject_id, subject_type in subjects.iteritems():
+            self.event_pub.publish_event(event_type="ResourceModifiedEvent",
+                                         origin=subject_id, origin_type=subject_type,
+                                         sub_type="ASSOCIATION", description=self._assoc_event_source,
+                                         mod_type=ResourceModificationType.UPDATE)
+
+    def _remove_indexed_associations(self, assoc_ids):
+        if not self.assoc_index:
+            return
+        subjects = {}
+        for assoc_id in assoc_ids:
+            assoc_tuple = self.assoc_index.get(assoc_id)
+            if assoc_tuple:
+                self.assoc_index.remove(assoc_id)
+                subjects[assoc_tuple[2]] = assoc_tuple[3]
+        self._publish_association_events(subjects)
+
     # -------------------------------------------------------------------------
     # Resource object manipulation
 
@@ -136,22 +391,53 @@ class ResourceRegistry(object):
 
         return rid_list
 
-    def read(self, object_id='', rev_id=''):
+    def read(self, object_id='', rev_id='', use_cache=True):
+        """
+        Returns the resource object for given id. With the resource cache enabled, a cached object is
+        only returned if it has the given rev_id (if any). use_cache=False always reads the current
+        revision from the datastore.
+        """
         if not object_id:
             raise BadRequest("The object_id parameter is an empty string")
-
-        return self.rr_store.read(object_id, rev_id)
-
-    def read_mult(self, object_ids=None, strict=True):
+        if not self.res_cache or not use_cache:
+            return self.rr_store.read(object_id, rev_id)
+        if not isinstance(object_id, str):
+            raise BadRequest("Object id param is not string")
+
+        doc = self.res_cache.get(object_id, rev_id)
+        if doc is None:
+            generation = self.res_cache.generation
+            doc = self.rr_store.read_doc(object_id, rev_id)
+            if not rev_id:
+                self.res_cache.put(doc, generation)
+        return self.rr_store._persistence_dict_to_ion_object(doc)
+
+    def read_mult(self, object_ids=None, strict=True, use_cache=True):
         """
         @param object_ids  a list of resource ids (can be empty)
         @param strict  a bool - if True (default), raise a NotFound in case one of the resources was not found
+        @param use_cache  a bool - if False, bypass the resource cache
         Returns resource objects for given list of resource ids in the same order. If a resource object was not
         found, contains None (unless strict==True) in which case NotFound will be raised.
         """
         if object_ids is None:
             raise BadRequest("The object_ids parameter is empty")
-        return self.rr_store.read_mult(object_ids, strict=strict)
+        if not self.res_cache or not use_cache:
+            return self.rr_store.read_mult(object_ids, strict=strict)
+        if any([not isinstance(object_id, str) for object_id in object_ids]):
+            raise BadRequest("Object ids are not string: %s" % str(object_ids))
+
+        docs = [self.res_cache.get(object_id) for object_id in object_ids]
+        missing_ids = [object_id for object_id, doc in zip(object_ids, docs) if doc is None]
+        if missing_ids:
+            generation = self.res_cache.generation
+            missing_docs = iter(self.rr_store.read_doc_mult(missing_ids, strict=strict))
+            for i, doc in enumerate(docs):
+                if doc is None:
+                    docs[i] = next(missing_docs)
+                    if docs[i] is not None:
+                        self.res_cache.put(docs[i], generation)
+        return [self.rr_store._persistence_dict_to_ion_object(doc) if doc is not None else None for doc in docs]
 
     def update(self, object):
         if object is None:
@@ -159,7 +445,7 @@ class ResourceRegistry(object):
         if not hasattr(object, "_id") or not hasattr(object, "_rev"):
             raise BadRequest("Object does not have required '_id' or '_rev' attribute")
             # Do an check whether LCS has been modified
-        res_obj = self.read(object._id)
+        res_obj = self.read(object._id, use_cache=False)
 
         object.ts_updated = get_ion_ts()
         if res_obj.lcstate != object.lcstate or res_obj.availability != object.availability:
@@ -169,15 +455,19 @@ class ResourceRegistry(object):
             object.lcstate = res_obj.lcstate
             object.availability = res_obj.availability
 
+        res = self.rr_store.update(object)
+        self._invalidate_cached(object._id)
+
+        # Published after the update, so that caches do not reread the previous revision
         self.event_pub.publish_event(event_type="ResourceModifiedEvent",
                                      origin=object._id, origin_type=object.type_,
                                      sub_type="UPDATE",
                                      mod_type=ResourceModificationType.UPDATE)
 
-        return self.rr_store.update(object)
+        return res
 
     def delete(self, object_id='', del_associations=False):
-        res_obj = self.read(object_id)
+        res_obj = self.read(object_id, use_cache=False)
         if not res_obj:
             raise NotFound("Resource %s does not exist" % object_id)
 
@@ -187,12 +477,15 @@ class ResourceRegistry(object):
         if del_associations:
             assoc_ids = self.find_associations(anyside=object_id, id_only=True)
             self.rr_store.delete_doc_mult(assoc_ids, object_type="Association")
+            if self.assoc_index:
+                self.assoc_index.remove_resource(object_id)
             #log.debug("Deleted %s associations for resource %s", len(assoc_ids), object_id)
 
         elif self._is_in_association(object_id):
             log.warn("Deleting object %s that still has associations" % object_id)
 
         res = self.rr_store.delete(object_id)
+        self._invalidate_cached(object_id)
 
         if self.container.has_capability(self.container.CCAP.EVENT_PUBLISHER):
             self.event_pub.publish_event(event_type="ResourceModifiedEvent",
@@ -216,7 +509,7 @@ class ResourceRegistry(object):
         This is the official "delete" for resource objects: they are set to DELETED lcstate.
         All associations are set to deleted as well.
         """
-        res_obj = self.read(resource_id)
+        res_obj = self.read(resource_id, use_cache=False)
         old_state = res_obj.lcstate
         if old_state == LCS.DELETED:
             raise BadRequest("Resource id=%s already DELETED" % (resource_id))
@@ -225,6 +518,7 @@ class ResourceRegistry(object):
         res_obj.ts_updated = get_ion_ts()
 
         updres = self.rr_store.update(res_obj)
+        self._invalidate_cached(resource_id)
         log.debug("retire(res_id=%s). Change %s_%s to %s_%s", resource_id,
                   old_state, res_obj.availability, res_obj.lcstate, res_obj.availability)
 
@@ -234,6 +528,8 @@ class ResourceRegistry(object):
         if assocs:
             self.rr_store.update_mult(assocs)
             log.debug("lcs_delete(res_id=%s). Retired %s associations", resource_id, len(assocs))
+        if self.assoc_index:
+            self.assoc_index.remove_resource(resource_id)
 
         if self.container.has_capability(self.container.CCAP.EVENT_PUBLISHER):
             self.event_pub.publish_event(event_type="ResourceLifecycleEvent",
@@ -247,7 +543,7 @@ class ResourceRegistry(object):
         if transition_event == LCE.DELETE:
             return self.lcs_delete(resource_id)
 
-        res_obj = self.read(resource_id)
+        res_obj = self.read(resource_id, use_cache=False)
         old_lcstate = res_obj.lcstate
         old_availability = res_obj.availability
 
@@ -275,6 +571,7 @@ class ResourceRegistry(object):
 
         res_obj.ts_updated = get_ion_ts()
         self.rr_store.update(res_obj)
+        self._invalidate_cached(resource_id)
         log.debug("execute_lifecycle_transition(res_id=%s, event=%s). Change %s_%s to %s_%s", resource_id, transition_event,
                   old_lcstate, old_availability, res_obj.lcstate, res_obj.availability)
 
@@ -297,7 +594,7 @@ class ResourceRegistry(object):
         if target_lcstate.startswith(LCS.RETIRED):
             self.execute_lifecycle_transition(resource_id, LCE.RETIRE)
 
-        res_obj = self.read(resource_id)
+        res_obj = self.read(resource_id, use_cache=False)
         old_lcstate = res_obj.lcstate
         old_availability = res_obj.availability
 
@@ -332,6 +629,7 @@ class ResourceRegistry(object):
         res_obj.ts_updated = get_ion_ts()
 
         updres = self.rr_store.update(res_obj)
+        self._invalidate_cached(resource_id)
         log.debug("set_lifecycle_state(res_id=%s, target=%s). Change %s_%s to %s_%s", resource_id, target_lcstate,
                   old_lcstate, old_availability, res_obj.lcstate, res_obj.availability)
 
@@ -444,67 +742,14 @@ class ResourceRegistry(object):
         if not (subject and predicate and object):
             raise BadRequest("Association must have all elements set")
 
-        if type(subject) is str:
-            subject_id = subject
-            subject = self.read(subject_id)
-            subject_type = subject.type_
-        else:
-            if "_id" not in subject:
-                raise BadRequest("Subject id not available")
-            subject_id = subject._id
-            subject_type = subject.type_
-
-        if type(object) is str:
-            object_id = object
-            object = self.read(object_id)
-            object_type = object.type_
-        else:
-            if "_id" not in object:
-                raise BadRequest("Object id not available")
-            object_id = object._id
-            object_type = object.type_
-
-        # Check that subject and object type are permitted by association definition
-        try:
-            pt = Predicates.get(predicate)
-        except AttributeError:
-            raise BadRequest("Predicate unknown %s" % predicate)
-        if not subject_type in pt['domain']:
-            found_st = False
-            for domt in pt['domain']:
-                if subject_type in getextends(domt):
-                    found_st = True
-                    break
-            if not found_st:
-                raise BadRequest("Illegal subject type %s for predicate %s" % (subject_type, predicate))
-        if not object_type in pt['range']:
-            found_ot = False
-            for rant in pt['range']:
-                if object_type in getextends(rant):
-                    found_ot = True
-                    break
-            if not found_ot:
-                raise BadRequest("Illegal object type %s for predicate %s" % (object_type, predicate))
-
-        # Finally, ensure this isn't a duplicate
-        assoc_list = self.find_associations(subject_id, predicate, object_id, id_only=False)
-        if len(assoc_list) != 0:
-            assoc = assoc_list[0]
-            #print "**** Found associations:"
-            #import pprint
-            #pprint.pprint(assoc_list)
-            raise BadRequest("Association between %s and %s with predicate %s already exists" % (subject_id, object_id, predicate))
-
-        assoc = IonObject("Association",
-                          s=subject_id, st=subject_type,
-                          p=predicate,
-                          o=object_id, ot=object_type,
-                          ts=get_ion_ts())
-        return self.rr_store.create(assoc, create_unique_association_id())
+        success, assoc_id, rev = self.create_association_mult([(subject, predicate, object)])[0]
+        return assoc_id, rev
 
     def create_association_mult(self, assoc_list=None):
         """
         Create multiple associations between two IonObjects with a given predicate.
+        Subjects and objects given as ids are read with one read_mult, existing associations are
+        found with one query and all associations are created with one create_mult.
         @param assoc_list  A list of 3-tuples of (subject, predicate, object). Subject/object can be str or object
         """
         if not assoc_list:
@@ -512,16 +757,19 @@ class ResourceRegistry(object):
 
         lookup_rid = set()
         for s, p, o in assoc_list:
+            if not (s and p and o):
+                raise BadRequest("Association must have all elements set")
             if type(s) is str:
                 lookup_rid.add(s)
             if type(o) is str:
                 lookup_rid.add(o)
         lookup_rid = list(lookup_rid)
-        lookup_obj = self.read_mult(lookup_rid) if lookup_rid else []
+        lookup_obj = self.read_mult(lookup_rid, strict=False) if lookup_rid else []
         res_by_id = dict(zip(lookup_rid, lookup_obj))
 
         create_ts = get_ion_ts()
         new_assoc_list = []
+        assoc_keys = set()
         for s, p, o in assoc_list:
             new_s = s
             new_o = o
@@ -537,7 +785,7 @@ class ResourceRegistry(object):
                 if not new_o:
                     raise NotFound("Object %s not found" % o)
             else:
-                if "_id" not in object:
+                if "_id" not in o:
                     raise BadRequest("Object id not available")
 
             # Check that subject and object type are permitted by association definition
@@ -561,7 +809,10 @@ class ResourceRegistry(object):
                 if not found_ot:
                     raise BadRequest("Illegal object type %s for predicate %s" % (new_o.type_, p))
 
-            # Skip duplicate check
+            assoc_key = (new_s._id, p, new_o._id)
+            if assoc_key in assoc_keys:
+                raise BadRequest("Association between %s and %s with predicate %s given twice" % (new_s._id, new_o._id, p))
+            assoc_keys.add(assoc_key)
 
             assoc = IonObject("Association",
                               s=new_s._id, st=new_s.type_,
@@ -570,8 +821,20 @@ class ResourceRegistry(object):
                               ts=create_ts)
             new_assoc_list.append(assoc)
 
+        # Finally, ensure none of these is a duplicate
+        found_assocs = self.rr_store.find_associations_mult(list(assoc_keys), id_only=False)
+        if found_assocs:
+            assoc = found_assocs[0]
+            raise BadRequest("Association between %s and %s with predicate %s already exists" % (assoc.s, assoc.o, assoc.p))
+
         new_assoc_ids = [create_unique_association_id() for i in xrange(len(new_assoc_list))]
-        return self.rr_store.create_mult(new_assoc_list, new_assoc_ids)
+        res = self.rr_store.create_mult(new_assoc_list, new_assoc_ids)
+        if self.assoc_index:
+            for assoc, (_, assoc_id, rev) in zip(new_assoc_list, res):
+                assoc._id, assoc._rev = assoc_id, rev
+                self.assoc_index.add(assoc)
+            self._publish_association_events({assoc.s: assoc.st for assoc in new_assoc_list})
+        return res
 
     def delete_association(self, association=''):
         """
@@ -584,9 +847,12 @@ class ResourceRegistry(object):
             success = True
             for aid in assoc_id_list:
                 success = success and self.rr_store.delete(aid, object_type="Association")
+            self._remove_indexed_associations(assoc_id_list)
             return success
         else:
-            return self.rr_store.delete(association, object_type="Association")
+            res = self.rr_store.delete(association, object_type="Association")
+            self._remove_indexed_associations([association if type(association) is str else association._id])
+            return res
 
     def _is_in_association(self, obj_id):
         if not obj_id:
@@ -639,11 +905,19 @@ class ResourceRegistry(object):
 
     def find_objects(self, subject="", predicate="", object_type="", id_only=False,
                      limit=None, skip=None, descending=None, access_args=None):
+        if self._use_assoc_index(subject, id_only, limit, skip, descending, access_args) and (predicate or not object_type):
+            subject_id = subject if type(subject) is str else subject._id
+            return self._get_indexed_result(self.assoc_index.find_objects(subject_id, predicate, object_type), 5, id_only,
+                                            access_args)
         return self.rr_store.find_objects(subject, predicate, object_type, id_only=id_only,
                                           limit=limit, skip=skip, descending=descending, access_args=access_args)
 
     def find_subjects(self, subject_type="", predicate="", object="", id_only=False,
                       limit=None, skip=None, descending=None, access_args=None):
+        if self._use_assoc_index(object, id_only, limit, skip, descending, access_args) and (predicate or not subject_type):
+            object_id = object if type(object) is str else object._id
+            return self._get_indexed_result(self.assoc_index.find_subjects(object_id, predicate, subject_type), 2, id_only,
+                                            access_args)
         return self.rr_store.find_subjects(subject_type, predicate, object, id_only=id_only,
                                            limit=limit, skip=skip, descending=descending, access_args=access_args)
 
@@ -653,9 +927,17 @@ class ResourceRegistry(object):
                                                limit=limit, skip=skip, descending=descending, access_args=access_args)
 
     def find_objects_mult(self, subjects=[], id_only=False, predicate="", access_args=None):
+        if self._use_assoc_index(subjects, id_only, access_args=access_args):
+            assoc_tuples = [assoc_tuple for subject in subjects
+                            for assoc_tuple in self.assoc_index.find_objects(subject if type(subject) is str else subject._id, predicate)]
+            return list(self._get_indexed_result(assoc_tuples, 5, id_only, access_args))
         return self.rr_store.find_objects_mult(subjects=subjects, id_only=id_only, predicate=predicate, access_args=access_args)
 
     def find_subjects_mult(self, objects=[], id_only=False, predicate="", access_args=None):
+        if self._use_assoc_index(objects, id_only, access_args=access_args):
+            assoc_tuples = [assoc_tuple for obj in objects
+                            for assoc_tuple in self.assoc_index.find_subjects(obj if type(obj) is str else obj._id, predicate)]
+            return list(self._get_indexed_result(assoc_tuples, 2, id_only, access_args))
         return self.rr_store.find_subjects_mult(objects=objects, id_only=id_only, predicate=predicate, access_args=access_args)
 
     def get_association(self, subject="", predicate="", object="", assoc_type=None, id_only=False):
@@ -669,17 +951,30 @@ class ResourceRegistry(object):
         return assoc[0]
 
     def find_resources(self, restype="", lcstate="", name="", id_only=False, access_args=None):
-        return self.rr_store.find_resources(restype, lcstate, name, id_only=id_only, access_args=access_args)
+        if id_only or not self.res_cache or not self.res_cache.is_cached_type(restype):
+            return self.rr_store.find_resources(restype, lcstate, name, id_only=id_only, access_args=access_args)
+
+        # Find ids, then read objects through the cache. Skips resources deleted in between.
+        res_ids, res_assocs = self.rr_store.find_resources(restype, lcstate, name, id_only=True, access_args=access_args)
+        res_objs = self.read_mult(res_ids, strict=False)
+        found = [(res_obj, res_assoc) for res_obj, res_assoc in zip(res_objs, res_assocs) if res_obj is not None]
+        return [res_obj for res_obj, _ in found], [res_assoc for _, res_assoc in found]
 
     def find_resources_ext(self, restype="", lcstate="", name="",
                            keyword=None, nested_type=None,
                            attr_name=None, attr_value=None, alt_id="", alt_id_ns="",
-                           limit=None, skip=None, descending=None, id_only=False, access_args=None):
+                           limit=None, skip=None, descending=None, id_only=False, access_args=None,
+                           keyset=False, page_token=None):
+        """
+        Find resources by one of several criteria. For keyset paging (keyset=True or a page_token from a
+        previous call), returns a 3-tuple with the page token for the next page or None after the last page.
+        """
+        paging_args = dict(keyset=keyset, page_token=page_token) if keyset or page_token else {}
         return self.rr_store.find_resources_ext(restype=restype, lcstate=lcstate, name=name,
             keyword=keyword, nested_type=nested_type,
             attr_name=attr_name, attr_value=attr_value, alt_id=alt_id, alt_id_ns=alt_id_ns,
             limit=limit, skip=skip, descending=descending,
-            id_only=id_only, access_args=access_args)
+            id_only=id_only, access_args=access_args, **paging_args)
 
 
     def get_superuser_actors(self, reset=False):
@@ -822,11 +1117,12 @@ class ResourceRegistryServiceWrapper(object):
                                                      access_args=access_args)
 
     def find_resources_ext(self, restype='', lcstate='', name='', keyword='', nested_type='', attr_name='', attr_value='',
-                           alt_id='', alt_id_ns='', limit=0, skip=0, descending=False, id_only=False):
+                           alt_id='', alt_id_ns='', limit=0, skip=0, descending=False, id_only=False,
+                           keyset=False, page_token=None):
         access_args = create_access_args(current_actor_id=get_ion_actor_id(self._process),
                                          superuser_actor_ids=self._rr.get_superuser_actors())
         return self._rr.find_resources_ext(restype=restype, lcstate=lcstate, name=name,
             keyword=keyword, nested_type=nested_type, attr_name=attr_name, attr_value=attr_value,
             alt_id=alt_id, alt_id_ns=alt_id_ns,
             limit=limit, skip=skip, descending=descending,
-            id_only=id_only, access_args=access_args)
+            id_only=id_only, access_args=access_args, keyset=keyset, page_token=page_token)
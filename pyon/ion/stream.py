@@ -82,6 +82,19 @@ class StreamPublisher(Publisher):
         log.trace('Publishing (%s,%s)', xp.exchange, stream_route.routing_key)
         super(StreamPublisher,self).publish(msg, to_name=xp_route, headers={'exchange_point':stream_route.exchange_point, 'stream':stream_id or self.stream_id})
 
+    def publish_many(self, msgs, stream_id='', stream_route=None):
+        '''
+        Encapsulates and publishes a list of messages in one batch on the specified stream/route
+        or the stream/route specified at instantiation
+        '''
+        xp_route = self.xp_route
+        if stream_route:
+            xp = self.container.ex_manager.create_xp(stream_route.exchange_point)
+            xp_route = xp.create_route(stream_route.routing_key)
+        else:
+            stream_route = self.stream_route
+        super(StreamPublisher,self).publish_many(msgs, to_name=xp_route, headers={'exchange_point':stream_route.exchange_point, 'stream':stream_id or self.stream_id})
+
 
 class StreamSubscriber(Subscriber):
     '''
@@ -97,19 +110,21 @@ class StreamSubscriber(Subscriber):
       def receive(msg, route, stream_id):
           pass
     '''
-    def __init__(self, process, exchange_name, callback=None):
+    def __init__(self, process, exchange_name, callback=None, prefetch_count=None, ack_batch_size=None):
         '''
         Creates a new StreamSubscriber which will listen on the specified queue (exchange_name).
-        @param process       The Ion Process to attach to.
-        @param exchange_name The subscribing queue name.
-        @param callback      The callback to execute upon receipt of a packet.
+        @param process        The Ion Process to attach to.
+        @param exchange_name  The subscribing queue name.
+        @param callback       The callback to execute upon receipt of a packet.
+        @param prefetch_count Max number of unacked packets delivered ahead of processing.
+        @param ack_batch_size Number of packet acks to coalesce into one broker ack.
         '''
         validate_is_instance(process, BaseService, 'No valid process was provided.')
         self.container = process.container
         self.xn = self.container.ex_manager.create_xn_queue(exchange_name)
         self.started = False
         self.callback = callback or process.call_process
-        super(StreamSubscriber, self).__init__(from_name=self.xn, callback=self.preprocess)
+        super(StreamSubscriber, self).__init__(from_name=self.xn, callback=self.preprocess, prefetch_count=prefetch_count, ack_batch_size=ack_batch_size)
 
     def preprocess(self, msg, headers):
         '''
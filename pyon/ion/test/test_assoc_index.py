@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+__license__ = 'Apache 2.0'
+
+from nose.plugins.attrib import attr
+
+from pyon.ion.assoc_index import AssociationIndex
+from pyon.util.containers import DotDict
+from pyon.util.unit_test import IonUnitTestCase
+
+
+@attr('UNIT', group='resource')
+class TestAssociationIndex(IonUnitTestCase):
+
+    def test_index(self):
+        assoc_index = AssociationIndex()
+        self.assertFalse(assoc_index.loaded)
+        assoc_index.load([("a1", "1", "org1", "Org", "hasResource", "dev1", "InstrumentDevice", "1"),
+                          ("a2", "1", "org1", "Org", "hasResource", "dp1", "DataProduct", "2"),
+                          ("a3", "1", "dev1", "InstrumentDevice", "hasOutputProduct", "dp1", "DataProduct", "3"),
+                          ("a4", "1", "org1", "Org", "hasMembership", "actor1", "ActorIdentity", "4")])
+        self.assertTrue(assoc_index.loaded)
+        self.assertEquals(assoc_index.count(), 4)
+
+        def ids(assoc_tuples):
+            return sorted(assoc_tuple[0] for assoc_tuple in assoc_tuples)
+
+        self.assertEquals(ids(assoc_index.find_objects("org1")), ["a1", "a2", "a4"])
+        self.assertEquals(ids(assoc_index.find_objects("org1", "hasResource")), ["a1", "a2"])
+        self.assertEquals(ids(assoc_index.find_objects("org1", "hasResource", "DataProduct")), ["a2"])
+        self.assertEquals(ids(assoc_index.find_subjects("dp1")), ["a2", "a3"])
+        self.assertEquals(ids(assoc_index.find_subjects("dp1", "hasResource", "Org")), ["a2"])
+        self.assertEquals(assoc_index.find_objects("dp1"), [])
+
+        # anyside with ids, and with (id, predicate) for multi-hop lookups
+        self.assertEquals(ids(assoc_index.find_associations("dev1")), ["a1", "a3"])
+        self.assertEquals(ids(assoc_index.find_associations(["dev1", "dp1"])), ["a1", "a2", "a3"])
+        self.assertEquals(ids(assoc_index.find_associations([("dev1", "hasOutputProduct"), ("org1", "hasMembership")])),
+                          ["a3", "a4"])
+
+        self.assertTrue(assoc_index.remove("a3"))
+        self.assertFalse(assoc_index.remove("a3"))
+        self.assertEquals(assoc_index.find_objects("dev1"), [])
+        self.assertEquals(assoc_index.get_association_ids("dp1"), {"a2"})
+
+        # Refresh replaces all associations of a resource with those from the datastore
+        assoc_index.refresh_resource("org1", [DotDict(_id="a5", _rev="1", s="org1", st="Org", p="hasResource",
+                                                      o="dev2", ot="InstrumentDevice", ts="5")])
+        self.assertEquals(ids(assoc_index.find_objects("org1")), ["a5"])
+        self.assertEquals(assoc_index.find_subjects("dp1"), [])
+        self.assertEquals(assoc_index.get("a5")[5], "dev2")
+
+        assoc_index.remove_resource("dev2")
+        self.assertEquals(assoc_index.count(), 0)
+        self.assertEquals(assoc_index.sample_resource_ids(10), [])
+        self.assertEquals(assoc_index.get_stats()["resources"], 0)
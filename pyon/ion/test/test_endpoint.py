@@ -163,6 +163,19 @@ class TestProcessRPCClient(PyonTestCase):
 
         mockce.assert_called_once_with(prpc, sentinel.to_name, None, process=sentinel.process)
 
+    def test__get_multiplexer_shared_by_process(self):
+        proc = Mock()
+        proc._rpc_multiplexer = None
+
+        prpc1 = ProcessRPCClient(process=proc, node=sentinel.node, multiplex=True)
+        prpc2 = ProcessRPCClient(process=proc, node=sentinel.node, multiplex=True)
+
+        mux = prpc1._get_multiplexer()
+        self.assertIsInstance(mux, endpoint.RPCResponseMultiplexer)
+        self.assertEquals(mux._affinity, proc.id)
+        self.assertEquals(proc._rpc_multiplexer, mux)
+        self.assertEquals(prpc2._get_multiplexer(), mux)
+
 
 @attr('UNIT')
 class TestProcessRPCResponseEndpointUnit(PyonTestCase):
@@ -481,3 +481,23 @@ class TestEventRepository(IonUnitTestCase):
         events_r = event_repo.find_events(event_type='DeviceStatusEvent')
         self.assertEquals(len(events_r), 4)
 
+
+    def test_put_events_bulk_load(self):
+        dsm = Mock()
+        event_store = dsm.get_datastore.return_value
+        event_repo = EventRepository(dsm)
+        self.assertEquals(event_repo.bulk_load_threshold, 0)
+        event_repo.bulk_load_threshold = 3
+
+        events = [Event(origin="resource%s" % i) for i in xrange(3)]
+        event_repo.put_events(events[:2])
+        event_store.create_mult.assert_called_once_with(events[:2], allow_ids=True)
+        self.assertFalse(event_store.bulk_load.called)
+
+        event_repo.put_events(events)
+        event_store.bulk_load.assert_called_once_with(events)
+
+        # Disabled
+        event_repo.bulk_load_threshold = 0
+        event_repo.put_events(events)
+        self.assertEquals(event_store.create_mult.call_count, 2)
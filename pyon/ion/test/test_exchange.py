@@ -252,7 +252,7 @@ class TestExchangeManagerInt(IonIntegrationTestCase):
 class TestExchangeObjects(PyonTestCase):
     def setUp(self):
         self.ex_manager = ExchangeManager(Mock())
-        self.pt = Mock(spec=BaseTransport)
+        self.pt = MagicMock(spec=BaseTransport)
         self.ex_manager.get_transport = Mock(return_value=self.pt)
 
         # set up some nodes
@@ -431,6 +431,20 @@ class TestExchangeObjects(PyonTestCase):
         self.assertIsInstance(xn, ExchangeName)
         self.assertIsInstance(xn, ExchangeNameQueue)
 
+    def test_create_xn_pipelined(self):
+        def check_not_declared(*args):
+            self.assertEquals(self.pt.declare_queue_impl.call_count, 0)
+
+        def check_declared(*args):
+            self.assertEquals(self.pt.declare_queue_impl.call_count, 1)
+
+        self.pt.pipelined.return_value.__enter__.side_effect = check_not_declared
+        self.pt.pipelined.return_value.__exit__.side_effect = check_declared
+
+        self.ex_manager.create_xn_process('procname')
+
+        self.assertEquals(self.pt.pipelined.return_value.__exit__.call_count, 1)
+
     def test_create_xn_with_different_xs(self):
         xs = self.ex_manager.create_xs(sentinel.xs)
         xs_exstr = '%s.ion.xs.%s' % (get_sys_name(), str(sentinel.xs))     # what we expect the exchange property to return
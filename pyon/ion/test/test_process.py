@@ -3,7 +3,7 @@
 __author__ = 'Dave Foster <dfoster@asascience.com>'
 __license__ = 'Apache 2.0'
 
-from pyon.ion.process import IonProcessThread
+from pyon.ion.process import IonProcessThread, ControlQueue
 from pyon.ion.endpoint import ProcessRPCServer
 from gevent.event import AsyncResult, Event
 from gevent.coros import Semaphore
@@ -351,6 +351,23 @@ class ProcessTest(PyonTestCase):
         ar2 = p._routing_call(futurear2.set, MagicMock(), sentinel.val2)
         ar2.get(timeout=2)
 
+    def test_time_stats(self):
+        svc = self._make_service()
+        p = IonProcessThread(name=sentinel.name, listeners=[], service=svc)
+        p._start_time = 0
+
+        p._routing_call(sentinel.call, MagicMock())
+        p._routing_call(sentinel.call, MagicMock())
+
+        stats = p.time_stats
+        self.assertEquals(len(stats), 9)
+        self.assertEquals(stats[5], 2)
+        self.assertEquals(stats[6], 2)
+
+        p._ctrl_queue.get()
+        self.assertEquals(p.time_stats[5], 1)
+        self.assertEquals(p.time_stats[6], 2)
+
     def test_heartbeat_no_listeners(self):
         svc = self._make_service()
         p = IonProcessThread(name=sentinel.name, listeners=[], service=svc)
@@ -533,6 +550,95 @@ class ProcessTest(PyonTestCase):
 
         self.assertEquals((True, True, False), hb)
 
+@attr('UNIT', group='coi')
+class ControlQueueTest(PyonTestCase):
+
+    def _put(self, cq, context=None):
+        ar = AsyncResult()
+        calltuple = (Mock(), ar, sentinel.call, (), {}, context)
+        cq.put(calltuple)
+        return calltuple
+
+    def test_fifo_without_headers(self):
+        cq = ControlQueue()
+        calls = [self._put(cq) for x in xrange(5)]
+
+        self.assertEquals([cq.get() for x in xrange(5)], calls)
+        self.assertEquals(len(cq), 0)
+
+    def test_priority_and_deadline_order(self):
+        cq = ControlQueue()
+        now = int(time.time() * 1000)
+
+        late = self._put(cq, {'reply-by': now + 60000})
+        plain = self._put(cq, {})
+        soon = self._put(cq, {'reply-by': now + 5000})
+        urgent = self._put(cq, {'reply-by': now + 60000, 'priority': 5})
+        background = self._put(cq, {'priority': -1})
+
+        self.assertEquals([cq.get() for x in xrange(5)], [urgent, soon, plain, late, background])
+
+    def test_expired_dropped_early(self):
+        expcb = Mock()
+        cq = ControlQueue(expired_callback=expcb)
+
+        first = self._put(cq)
+        expired = self._put(cq, {'reply-by': 0, 'priority': -10})
+
+        self.assertIn(expired[1], cq)
+        self.assertEquals(cq.get(), first)
+
+        # dropped even though it would have been served last
+        expcb.assert_called_once_with(expired, ANY)
+        self.assertNotIn(expired[1], cq)
+        self.assertEquals(len(cq), 0)
+        self.assertEquals(cq.stats['expired'], 1)
+
+    def test_cancel(self):
+        cq = ControlQueue()
+        first = self._put(cq)
+        second = self._put(cq)
+
+        self.assertTrue(cq.cancel(first[1]))
+        self.assertFalse(cq.cancel(first[1]))
+        self.assertNotIn(first[1], cq)
+        self.assertEquals(cq.stats['cancelled'], 1)
+
+        self.assertEquals(cq.get(), second)
+        self.assertFalse(cq.cancel(second[1]))
+
+    def test_stop(self):
+        cq = ControlQueue()
+        call = self._put(cq)
+        cq.put(StopIteration)
+
+        self.assertEquals(list(cq), [call])
+        self.assertEquals(cq.get(), StopIteration)
+
+    def test_compact(self):
+        cq = ControlQueue()
+        now = int(time.time() * 1000)
+        for x in xrange(500):
+            cq.cancel(self._put(cq, {'reply-by': now + 60000})[1])
+
+        self.assertEquals(len(cq), 0)
+        self.assertLess(len(cq._heap), 100)
+        self.assertLess(len(cq._deadlines), 100)
+
+    def test_wait_stats(self):
+        cq = ControlQueue()
+        self.assertEquals(cq.avg_wait_time, 0)
+
+        self._put(cq)
+        self._put(cq)
+        self.assertEquals(cq.stats['max_depth'], 2)
+
+        cq.get()
+        cq.get()
+        self.assertEquals(cq.stats['served'], 2)
+        self.assertGreaterEqual(cq.avg_wait_time, 0)
+
+
 class FakeService(BaseService):
     """
     Class to use for testing below.
@@ -106,6 +106,8 @@ class TestResources(IonUnitTestCase):
         instrument_device2._id = '456'
         instrument_device2.name = "MyInstrument2"
         instrument_device2.type_ = RT.InstrumentDevice
+        instrument_device2.lcstate = LCS.DRAFT
+        instrument_device2.availability = AS.PRIVATE
 
 
         actor_identity = Mock()
@@ -180,7 +182,10 @@ class TestResources(IonUnitTestCase):
         mock_clients.resource_registry.find_objects.return_value = ([actor_identity], [Instrument_device_to_actor_identity_association])
         mock_clients.resource_registry.find_subjects.return_value = (None,None)
         mock_clients.resource_registry.find_associations.return_value = [actor_identity_to_info_association, Instrument_device_to_actor_identity_association]
-        mock_clients.resource_registry.read_mult.return_value = [user_info]
+        # Origin resources by id, any other resource is the user info
+        res_by_id = {'123': instrument_device, '456': instrument_device2}
+        mock_clients.resource_registry.read_mult.side_effect = lambda res_ids, *args, **kwargs: \
+            [res_by_id.get(res_id, user_info) for res_id in res_ids]
 
         extended_res = extended_resource_handler.create_extended_resource_container(OT.TestExtendedResource, '123')
         self.assertEquals(extended_res.resource, instrument_device)
@@ -226,6 +231,13 @@ class TestResources(IonUnitTestCase):
         self.assertEquals(len(extended_res_list[0].owners),2)
         self.assertEquals(extended_res_list[0].resource_object.type_, RT.SystemResource)
         self.assertEquals(extended_res.remote_resource_object.type_, RT.InstrumentDevice)
+        self.assertEquals(extended_res_list[1].resource, instrument_device2)
+
+        # Overridden container hooks are called for each container of the list
+        extended_resource_handler.set_container_field_values = Mock()
+        extended_res_list = extended_resource_handler.create_extended_resource_container_list(OT.TestExtendedResource, ['123','456'])
+        self.assertEqual(extended_resource_handler.set_container_field_values.call_count, 2)
+        self.assertEqual(len(extended_res_list[0].owners), 0)
 
         #Test create_prepare_update_resource
         prepare_create = extended_resource_handler.create_prepare_resource_support(prepare_resource_type=OT.TestPrepareUpdateResource)
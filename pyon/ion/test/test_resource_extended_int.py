@@ -3,6 +3,9 @@
 __author__ = 'Michael Meisinger'
 
 import pprint
+import sys
+import time
+from mock import patch
 from nose.plugins.attrib import attr
 
 from pyon.ion.resource import ExtendedResourceContainer
@@ -211,3 +214,70 @@ class TestExtendedResourceIntegration(IonIntegrationTestCase):
         self.assertEquals(set(r._id for r in ext_site.child_sites1), set([is1_id, ps2_id]))
         self.assertEquals(len(ext_site.child_instrument_sites), 1)
         self.assertEquals(ext_site.child_instrument_sites[0]._id, is1_id)
+
+        # The batched list fills the same fields as one resource at a time
+        ext_sites = extended_resource_handler.create_extended_resource_container_list(
+            extended_resource_type=OT.TestExtendedResourceSite,
+            resource_id_list=[ps1_id, ps2_id],
+            computed_resource_type=OT.BaseComputedAttributes)
+
+        self.assertEquals([ext_site._id for ext_site in ext_sites], [ps1_id, ps2_id])
+        self.assertEquals(ext_sites[0].parent_site, None)
+        self.assertEquals(set(r._id for r in ext_sites[0].child_sites), set([is1_id, ps2_id]))
+        self.assertEquals(len(ext_sites[0].child_instrument_sites), 1)
+        self.assertEquals(ext_sites[1].parent_site._id, ps1_id)
+        self.assertEquals(ext_sites[1].child_sites, [])
+        self.assertEquals(extended_resource_handler.create_extended_resource_container_list(
+            OT.TestExtendedResourceSite, []), [])
+
+
+@attr('PFM', group='resources')
+class TestExtendedResourceSpeed(IonIntegrationTestCase):
+
+    def setUp(self):
+        self._start_container()
+        self.RR = self.container.resource_registry
+
+    def _count_queries(self):
+        """Counts calls to resource registry datastore read and find operations"""
+        rr_store = self.RR.rr_store
+        mocks = []
+        for name in ("read", "read_mult", "find_associations", "find_objects", "find_subjects",
+                     "find_objects_mult", "find_subjects_mult"):
+            patcher = patch.object(rr_store, name, wraps=getattr(rr_store, name))
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        return lambda: sum(m.call_count for m in mocks)
+
+    def test_extended_resource_list_speed(self):
+        num_sites = 1000
+        obs_id, _ = self.RR.create(IonObject(RT.Observatory, name="Observatory 1"))
+        site_ids = [rid for rid, _ in self.RR.create_mult([IonObject(RT.PlatformSite, name="PlatformSite %s" % i)
+                                                           for i in xrange(num_sites)])]
+        inst_site_ids = [rid for rid, _ in self.RR.create_mult([IonObject(RT.InstrumentSite, name="InstrumentSite %s" % i)
+                                                                for i in xrange(2 * num_sites)])]
+        assoc_list = [(obs_id, PRED.hasSite, site_id) for site_id in site_ids]
+        assoc_list.extend((site_ids[i / 2], PRED.hasSite, inst_site_id) for i, inst_site_id in enumerate(inst_site_ids))
+        assoc_ids = [aid for _, aid, _ in self.RR.create_association_mult(assoc_list)]
+        self.addCleanup(self.RR.rr_store.delete_doc_mult, assoc_ids, object_type="Association")
+        self.addCleanup(self.RR.rr_store.delete_mult, [obs_id] + site_ids + inst_site_ids)
+
+        query_count = self._count_queries()
+        extended_resource_handler = ExtendedResourceContainer(self)
+        print >>sys.stderr, ""
+        for num_res in (10, 100, 1000):
+            res_ids = site_ids[:num_res]
+            queries1 = query_count()
+            t1 = time.time()
+            ext_sites = [extended_resource_handler.create_extended_resource_container(
+                OT.TestExtendedResourceSite, res_id, OT.BaseComputedAttributes) for res_id in res_ids]
+            t2 = time.time()
+            queries2 = query_count()
+            ext_sites_list = extended_resource_handler.create_extended_resource_container_list(
+                OT.TestExtendedResourceSite, res_ids, OT.BaseComputedAttributes)
+            t3 = time.time()
+            queries3 = query_count()
+            self.assertEquals([len(s.child_instrument_sites) for s in ext_sites_list], [len(s.child_instrument_sites) for s in ext_sites])
+            print >>sys.stderr, "%s extended resources: one by one %s queries %.4fs, list %s queries %.4fs" % (
+                num_res, queries2 - queries1, t2 - t1, queries3 - queries2, t3 - t2)
+
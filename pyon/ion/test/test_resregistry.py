@@ -2,12 +2,22 @@
 
 __author__ = 'Michael Meisinger'
 
+import random
+import sys
+import time
 import uuid
 
+from mock import Mock
+
 from pyon.core.bootstrap import IonObject
 from pyon.core.exception import NotFound, Inconsistent, BadRequest
-from pyon.ion.resource import PRED, RT, LCS, AS, LCE, lcstate, create_access_args
+from pyon.ion.assoc_index import AssociationIndex
+from pyon.ion.identifier import create_unique_association_id
+from pyon.ion.resource import PRED, RT, LCS, AS, LCE, lcstate, create_access_args, ExtendedResourceContainer
+from pyon.ion.resregistry import ResourceCache
+from pyon.util.containers import get_ion_ts
 from pyon.util.int_test import IonIntegrationTestCase
+from pyon.util.unit_test import IonUnitTestCase
 from nose.plugins.attrib import attr
 
 from interface.objects import Attachment, AttachmentType, ResourceVisibilityEnum
@@ -95,6 +105,15 @@ class TestResourceRegistry(IonIntegrationTestCase):
         ])
         self.assertEquals(len(res_assocs), 2)
         print res_assocs
+
+        # Duplicates of existing associations or within the list
+        with self.assertRaises(BadRequest) as ex:
+            self.rr.create_association(rid1, PRED.hasResource, rid3)
+        with self.assertRaises(BadRequest) as ex:
+            self.rr.create_association_mult([(rid4, PRED.hasResource, rid5), (rid1, PRED.hasResource, rid5)])
+        with self.assertRaises(BadRequest) as ex:
+            self.rr.create_association_mult([(rid4, PRED.hasResource, rid5), (rid4, PRED.hasResource, rid5)])
+        self.assertEquals(self.rr.find_associations(rid4, PRED.hasResource, rid5, id_only=True), [])
         assocs = [a[1] for a in res_assocs]
         for a in assocs:
              self.rr.delete_association(a)
@@ -552,3 +571,250 @@ class TestResourceRegistry(IonIntegrationTestCase):
         #breakpoint()
 
         self.rr.rr_store.delete_mult(res_by_name.values())
+
+    def test_resource_cache(self):
+        self.rr.res_cache = ResourceCache(dict(types={RT.Org: {}, RT.ActorIdentity: dict(max_size=2)}))
+        self.addCleanup(setattr, self.rr, "res_cache", None)
+        res_cache = self.rr.res_cache
+
+        org_id, _ = self.rr.create(IonObject(RT.Org, name="Org1"))
+        dev_id, _ = self.rr.create(IonObject(RT.InstrumentDevice, name="ID1"))
+
+        org_obj = self.rr.read(org_id)
+        self.assertEquals(res_cache.get_stats()["size"][RT.Org], 1)
+        org_obj1 = self.rr.read(org_id)
+        self.assertEquals(res_cache.stats["hits"], 1)
+        # Cached objects are copies
+        org_obj1.name = "changed"
+        self.assertEquals(self.rr.read(org_id).name, "Org1")
+        self.rr.read(dev_id)
+        self.assertNotIn(RT.InstrumentDevice, res_cache.get_stats()["size"])
+
+        # Update invalidates, rev_id requires the cached rev
+        org_obj.description = "updated"
+        self.rr.update(org_obj)
+        org_obj2 = self.rr.read(org_id)
+        self.assertEquals(org_obj2.description, "updated")
+        self.assertEquals(self.rr.read(org_id, rev_id=org_obj2._rev)._rev, org_obj2._rev)
+
+        self.rr.execute_lifecycle_transition(org_id, LCE.RETIRE)
+        self.assertEquals(self.rr.read(org_id).lcstate, LCS.RETIRED)
+
+        res_objs = self.rr.read_mult([org_id, dev_id])
+        self.assertEquals([o._id for o in res_objs], [org_id, dev_id])
+        org_objs, _ = self.rr.find_resources(restype=RT.Org, name="Org1", id_only=False)
+        self.assertEquals([o._id for o in org_objs], [org_id])
+
+        self.rr.delete(org_id)
+        with self.assertRaises(NotFound):
+            self.rr.read(org_id)
+        self.rr.delete(dev_id)
+
+    def test_assoc_index(self):
+        self.rr.assoc_index = AssociationIndex()
+        self.addCleanup(setattr, self.rr, "assoc_index", None)
+        self.rr.load_assoc_index()
+        assoc_index = self.rr.assoc_index
+
+        org_id, _ = self.rr.create(IonObject(RT.Org, name="Org1"))
+        dev_id, _ = self.rr.create(IonObject(RT.InstrumentDevice, name="ID1"))
+        dp_id, _ = self.rr.create(IonObject(RT.DataProduct, name="DP1"))
+        self.addCleanup(self.rr.rr_store.delete_mult, [org_id, dev_id, dp_id])
+
+        aid1, _ = self.rr.create_association(org_id, PRED.hasResource, dev_id)
+        aid2, _ = self.rr.create_association(dev_id, PRED.hasOutputProduct, dp_id)
+        self.assertEquals(assoc_index.get_association_ids(dev_id), {aid1, aid2})
+
+        # Finds are answered from the index, with the same results as from the datastore
+        lookups = assoc_index.stats["lookups"]
+        obj_ids, assocs = self.rr.find_objects(org_id, PRED.hasResource, RT.InstrumentDevice, id_only=True)
+        self.assertEquals(obj_ids, [dev_id])
+        self.assertEquals(assocs[0]._id, aid1)
+        self.assertEquals(self.rr.rr_store.find_objects(org_id, PRED.hasResource, RT.InstrumentDevice, id_only=True)[0], obj_ids)
+        sub_objs, _ = self.rr.find_subjects(RT.InstrumentDevice, PRED.hasOutputProduct, dp_id, id_only=False)
+        self.assertEquals([o._id for o in sub_objs], [dev_id])
+        self.assertEquals(self.rr.find_objects_mult([org_id, dev_id], id_only=True)[0], [dev_id, dp_id])
+        self.assertGreater(assoc_index.stats["lookups"], lookups)
+
+        # Same access filter and existence check as the datastore
+        owner_dp_id, _ = self.rr.create(IonObject(RT.DataProduct, name="DP2", visibility=ResourceVisibilityEnum.OWNER))
+        gone_dp_id, _ = self.rr.create(IonObject(RT.DataProduct, name="DP3"))
+        self.addCleanup(self.rr.rr_store.delete_mult, [owner_dp_id])
+        aid4, _ = self.rr.create_association(dev_id, PRED.hasOutputProduct, owner_dp_id)
+        aid5, _ = self.rr.create_association(dev_id, PRED.hasOutputProduct, gone_dp_id)
+        self.rr.rr_store.delete(gone_dp_id)
+        for id_only in (True, False):
+            obj_res = self.rr.find_objects(dev_id, PRED.hasOutputProduct, id_only=id_only)
+            store_res = self.rr.rr_store.find_objects(dev_id, PRED.hasOutputProduct, id_only=id_only)
+            self.assertEquals([a._id for a in obj_res[1]], [aid2])
+            self.assertEquals([a._id for a in store_res[1]], [aid2])
+        su_args = dict(current_actor_id="su1", superuser_actor_ids=["su1"])
+        self.assertEquals(sorted(self.rr.find_objects(dev_id, PRED.hasOutputProduct, id_only=True, access_args=su_args)[0]),
+                          sorted([dp_id, owner_dp_id]))
+        self.assertEquals(self.rr.find_objects_mult([dev_id], id_only=True, predicate=PRED.hasOutputProduct)[0], [dp_id])
+        self.rr.delete_association(aid4)
+        self.rr.delete_association(aid5)
+
+        ext_res_handler = ExtendedResourceContainer(Mock(), self.rr)
+        self.assertEquals({a._id for a in ext_res_handler._find_context_associations(dev_id)}, {aid1, aid2})
+        self.assertEquals([a._id for a in ext_res_handler._find_context_associations([(dev_id, PRED.hasOutputProduct)])], [aid2])
+
+        # Changes made directly in the datastore are found by the consistency check
+        self.rr.rr_store.delete(aid2, object_type="Association")
+        self.assertEquals(self.rr.check_assoc_index(), 1)
+        self.assertEquals(assoc_index.get_association_ids(dp_id), set())
+        self.assertEquals(self.rr.check_assoc_index(sample_size=1000), 0)
+
+        self.rr.delete_association(aid1)
+        self.assertEquals(self.rr.find_objects(org_id, id_only=True)[0], [])
+
+        aid3, _ = self.rr.create_association(org_id, PRED.hasResource, dev_id)
+        self.addCleanup(self.rr.rr_store.delete_doc_mult, [aid3], object_type="Association")
+        self.rr.lcs_delete(dev_id)
+        self.assertEquals(assoc_index.get_association_ids(org_id), set())
+        self.assertEquals(self.rr.find_objects(org_id, id_only=True), self.rr.rr_store.find_objects(org_id, id_only=True))
+
+
+@attr('UNIT', group='resource')
+class TestResourceCache(IonUnitTestCase):
+
+    def test_cache(self):
+        res_cache = ResourceCache(dict(max_size=2, ttl=60, types={RT.Org: {}, RT.UserRole: dict(ttl=0.01)}))
+
+        generation = res_cache.generation
+        res_cache.put(dict(_id="o1", _rev="1", type_=RT.Org, name="Org1"), generation)
+        res_cache.put(dict(_id="d1", _rev="1", type_=RT.InstrumentDevice), generation)
+        self.assertEquals(res_cache.get("o1")["name"], "Org1")
+        self.assertIsNone(res_cache.get("d1"))
+        self.assertEquals(res_cache.get("o1", "1")["_rev"], "1")
+        self.assertIsNone(res_cache.get("o1", "2"))
+
+        # LRU limit per type
+        for i in xrange(3):
+            res_cache.put(dict(_id="o%s" % i, _rev="1", type_=RT.Org), generation)
+        self.assertIsNone(res_cache.get("o0"))
+        self.assertIsNotNone(res_cache.get("o2"))
+        self.assertEquals(res_cache.stats["evictions"], 1)
+
+        # TTL per type
+        res_cache.put(dict(_id="r1", _rev="1", type_=RT.UserRole), generation)
+        time.sleep(0.02)
+        self.assertIsNone(res_cache.get("r1"))
+
+        # A doc read before an invalidation is not put
+        res_cache.invalidate("o2")
+        self.assertIsNone(res_cache.get("o2"))
+        res_cache.put(dict(_id="o2", _rev="1", type_=RT.Org), generation)
+        self.assertIsNone(res_cache.get("o2"))
+        res_cache.put(dict(_id="o2", _rev="2", type_=RT.Org), res_cache.generation)
+        self.assertEquals(res_cache.get("o2")["_rev"], "2")
+
+        stats = res_cache.get_stats()
+        self.assertEquals(stats["size"], {RT.Org: 2, RT.UserRole: 0})
+        self.assertEquals(stats["hit_ratio"], float(stats["hits"]) / (stats["hits"] + stats["misses"]))
+
+
+@attr('PFM', group='resource')
+class TestResourceRegistrySpeed(IonIntegrationTestCase):
+
+    def setUp(self):
+        self._start_container()
+        self.rr = self.container.resource_registry
+        self.addCleanup(setattr, self.rr, "res_cache", self.rr.res_cache)
+        self.addCleanup(setattr, self.rr, "assoc_index", self.rr.assoc_index)
+
+    def test_create_association_speed(self):
+        num_assocs = 10000
+        batch_size = 1000
+        print >>sys.stderr, ""
+        for name in ("create_association", "create_association_mult"):
+            subject_ids = [rid for rid, _ in self.rr.create_mult([IonObject(RT.InstrumentDevice, name="ID%s" % i)
+                                                                  for i in xrange(num_assocs / 10)])]
+            object_ids = [rid for rid, _ in self.rr.create_mult([IonObject(RT.DataProduct, name="DP%s" % i)
+                                                                 for i in xrange(num_assocs / 10)])]
+            self.addCleanup(self.rr.rr_store.delete_mult, subject_ids + object_ids)
+            assoc_list = [(subject_ids[i / 10], PRED.hasOutputProduct, object_ids[(i / 10 + i) % len(object_ids)])
+                          for i in xrange(num_assocs)]
+
+            t1 = time.time()
+            if name == "create_association":
+                assoc_ids = [self.rr.create_association(s, p, o)[0] for s, p, o in assoc_list]
+            else:
+                assoc_ids = []
+                for i in xrange(0, num_assocs, batch_size):
+                    assoc_ids.extend(aid for _, aid, _ in self.rr.create_association_mult(assoc_list[i:i+batch_size]))
+            t2 = time.time()
+            self.assertEquals(len(assoc_ids), num_assocs)
+            self.addCleanup(self.rr.rr_store.delete_doc_mult, assoc_ids, object_type="Association")
+            print >>sys.stderr, "%s %s associations: %.4fs" % (name, num_assocs, t2-t1)
+
+    def test_read_cache_speed(self):
+        num_reads = 20000
+        res_ids = []
+        for restype, num_res in ((RT.Org, 20), (RT.ActorIdentity, 1000), (RT.UserRole, 100), (RT.InstrumentDevice, 1000)):
+            res_ids.extend(rid for rid, _ in self.rr.create_mult([IonObject(restype, name="%s%s" % (restype, i))
+                                                                  for i in xrange(num_res)]))
+        self.addCleanup(self.rr.rr_store.delete_mult, res_ids)
+
+        # Read-heavy replay: 80% of reads go to 10% of the resources, 1% updates
+        rnd = random.Random(1)
+        hot_ids = res_ids[:len(res_ids) / 10]
+        workload = [("update" if rnd.random() < 0.01 else "read", rnd.choice(hot_ids if rnd.random() < 0.8 else res_ids))
+                    for i in xrange(num_reads)]
+
+        print >>sys.stderr, ""
+        for use_cache in (False, True):
+            self.rr.res_cache = ResourceCache() if use_cache else None
+            t1 = time.time()
+            for op, res_id in workload:
+                res_obj = self.rr.read(res_id)
+                if op == "update":
+                    self.rr.update(res_obj)
+            t2 = time.time()
+            stats = self.rr.res_cache.get_stats() if use_cache else dict(hit_ratio=0.0)
+            print >>sys.stderr, "cache=%s: %s reads %.4fs, %.3f ms/read, hit ratio %.3f" % (
+                use_cache, num_reads, t2-t1, 1000 * (t2-t1) / num_reads, stats["hit_ratio"])
+
+    def test_extended_resource_speed(self):
+        num_render = 500
+        batch_size = 10000
+        res_ids = {}
+        for restype, num_res in ((RT.InformationResource, 5000), (RT.ActorIdentity, 20000), (RT.UserInfo, 25000)):
+            res_ids[restype] = []
+            for i in xrange(0, num_res, batch_size):
+                res_ids[restype].extend(rid for rid, _ in self.rr.create_mult(
+                    [IonObject(restype, name="%s%s" % (restype, j)) for j in xrange(i, min(i + batch_size, num_res))]))
+            self.addCleanup(self.rr.rr_store.delete_mult, res_ids[restype])
+        info_ids, actor_ids, user_info_ids = res_ids[RT.InformationResource], res_ids[RT.ActorIdentity], res_ids[RT.UserInfo]
+
+        # 100k owner associations (20 per resource) and 100k info associations (5 per actor)
+        ts = get_ion_ts()
+        assoc_objs = [IonObject("Association", s=info_ids[i / 20], st=RT.InformationResource, p=PRED.hasOwner,
+                                o=actor_ids[(i * 7) % len(actor_ids)], ot=RT.ActorIdentity, ts=ts) for i in xrange(100000)]
+        assoc_objs.extend(IonObject("Association", s=actor_ids[i / 5], st=RT.ActorIdentity, p=PRED.hasInfo,
+                                    o=user_info_ids[(i * 3) % len(user_info_ids)], ot=RT.UserInfo, ts=ts) for i in xrange(100000))
+        assoc_ids = []
+        for i in xrange(0, len(assoc_objs), batch_size):
+            batch = assoc_objs[i:i + batch_size]
+            assoc_ids.extend(aid for _, aid, _ in self.rr.rr_store.create_mult(batch, [create_unique_association_id() for a in batch]))
+        self.addCleanup(self.rr.rr_store.delete_doc_mult, assoc_ids, object_type="Association")
+
+        render_ids = random.Random(1).sample(info_ids, num_render)
+        print >>sys.stderr, ""
+        for use_index in (False, True):
+            self.rr.assoc_index = AssociationIndex() if use_index else None
+            if use_index:
+                t1 = time.time()
+                self.rr.load_assoc_index()
+                print >>sys.stderr, "index load %s associations: %.4fs" % (self.rr.assoc_index.count(), time.time()-t1)
+            t1 = time.time()
+            for res_id in render_ids:
+                ext_res = self.rr.get_resource_extension(res_id, "ExtendedInformationResource")
+                self.assertEquals(len(ext_res.owners), 20)
+            t2 = time.time()
+            print >>sys.stderr, "index=%s: %s extended resources %.4fs, %.3f ms/resource" % (
+                use_index, num_render, t2-t1, 1000 * (t2-t1) / num_render)
+            if use_index:
+                t1 = time.time()
+                self.assertEquals(self.rr.check_assoc_index(), 0)
+                print >>sys.stderr, "index consistency check: %.4fs" % (time.time()-t1)
@@ -188,6 +188,21 @@ class BaseChannel(object):
             finally:
                 self._lock_trace = None
 
+    @contextmanager
+    def _pipelined(self):
+        """
+        Batches the declare/bind operations made inside the block on this Channel's transport.
+
+        The transport sends them together and waits on all confirmations at the end of the block.
+        If no transport is attached yet, the operations run as usual.
+        """
+        if not self._transport:
+            yield
+            return
+
+        with self._transport.pipelined():
+            yield
+
     def _declare_exchange(self, exchange):
         """
         Performs an AMQP exchange declare.
@@ -383,6 +398,40 @@ class SendChannel(BaseChannel):
                                          mandatory=False,
                                          durable_msg=durable_msg)
 
+    def send_many(self, msgs):
+        """
+        Sends several messages to the connected name in one transport call.
+
+        @param  msgs    A list of 2-tuples of (data, headers).
+        """
+        self._send_many(self._send_name, msgs)
+
+    def _send_many(self, name, msgs):
+        exchange    = name.exchange
+        routing_key = name.binding
+
+        blame = None
+        if os.environ.get('QUEUE_BLAME', None) is not None:
+            blame = os.environ['QUEUE_BLAME'].split(',')
+
+        messages = []
+        for data, headers in msgs:
+            headers = headers or {}
+            if blame is not None:
+                headers['QUEUE_BLAME'] = blame
+            messages.append((routing_key, data, headers))
+
+        durable_msg = False
+        if hasattr(self._send_name, 'queue_durable'):
+            durable_msg = self._send_name.queue_durable
+
+        with self._ensure_transport():
+            self._transport.publish_many_impl(exchange=exchange,
+                                              messages=messages,
+                                              immediate=False,
+                                              mandatory=False,
+                                              durable_msg=durable_msg)
+
 class RecvChannel(BaseChannel):
     """
     A channel that can only receive.
@@ -498,6 +547,8 @@ class RecvChannel(BaseChannel):
         - _declare_queue
         - _bind
 
+        These are sent to the broker as one pipelined batch (see BaseTransport.pipelined).
+
         Name must be a NameTrio. If queue is None, the broker will generate a name e.g. "amq-RANDOMSTUFF".
         Binding may be left none and will use the queue name by default.
 
@@ -521,11 +572,13 @@ class RecvChannel(BaseChannel):
         if name != self._recv_name:
             self._recv_name = name
 
-        self._declare_exchange(exchange)
-        queue   = self._declare_queue(queue)
-        binding = binding or self._recv_binding or self._recv_name.binding or queue      # last option should only happen in the case of anon-queue
+        # exchange/queue declares and the bind go to the broker as one pipelined batch
+        with self._pipelined():
+            self._declare_exchange(exchange)
+            queue   = self._declare_queue(queue)
+            binding = binding or self._recv_binding or self._recv_name.binding or queue      # last option should only happen in the case of anon-queue
 
-        self._bind(binding)
+            self._bind(binding)
 
         self._setup_listener_called = True
 
@@ -743,6 +796,15 @@ class RecvChannel(BaseChannel):
         with self._ensure_transport():
             self._transport.reject_impl(delivery_tag, requeue=requeue)
 
+    def qos(self, prefetch_count=0):
+        """
+        Limits the number of unacked messages the broker delivers to this channel.
+
+        Should be called before start_consume. A prefetch_count of 0 means no limit.
+        """
+        with self._ensure_transport():
+            self._transport.qos_impl(prefetch_count=prefetch_count)
+
     def get_stats(self):
         """
         Returns a tuple of number of messages, number of consumers for this queue.
@@ -766,6 +828,15 @@ class RecvChannel(BaseChannel):
 
 class PublisherChannel(SendChannel):
 
+    def reset(self):
+        """
+        Clears the send name and exchange settings, so a pooled channel can be handed to another Publisher.
+        """
+        self._send_name = None
+        self._exchange = None
+        self._exchange_auto_delete = None
+        self._exchange_durable = None
+
     def send(self, data, headers=None):
         """
         Send override that ensures the exchange is declared, always.
@@ -776,6 +847,14 @@ class PublisherChannel(SendChannel):
         self._declare_exchange(self._send_name.exchange)
         SendChannel.send(self, data, headers=headers)
 
+    def send_many(self, msgs):
+        """
+        Send many override that ensures the exchange is declared, once for all messages.
+        """
+        assert self._send_name and self._send_name.exchange
+        self._declare_exchange(self._send_name.exchange)
+        SendChannel.send_many(self, msgs)
+
 class BidirClientChannel(SendChannel, RecvChannel):
     """
     This should be pooled for the receiving side?
@@ -857,17 +936,26 @@ class ListenChannel(RecvChannel):
         def ack(self, delivery_tag):
             """
             Acks a message - broker discards.
+
+            If the parent channel batches acks, the ack is deferred to the parent.
             """
-            RecvChannel.ack(self, delivery_tag)
+            if self._parent_channel is not None and self._parent_channel._ack_batch_size > 1:
+                self._parent_channel.ack_batched(delivery_tag)
+            else:
+                RecvChannel.ack(self, delivery_tag)
             self._checkin(delivery_tag)
 
         def reject(self, delivery_tag, requeue=False):
             """
             Rejects a message - specify requeue=True to requeue for delivery later.
             """
+            if self._parent_channel is not None:
+                self._parent_channel.flush_acks()
             RecvChannel.reject(self, delivery_tag, requeue=requeue)
             self._checkin(delivery_tag)
 
+    _ack_batch_size = 1     # number of acks to coalesce into one multiple ack, see ack_batched
+
     def __init__(self, name=None, binding=None, **kwargs):
         RecvChannel.__init__(self, name=name, binding=binding, **kwargs)
 
@@ -877,6 +965,10 @@ class ListenChannel(RecvChannel):
         self._fsm.add_transition(self.I_CLOSE,          self.S_ACCEPTED,    None, self.S_CLOSING)
         self._fsm.add_transition(self.I_EXIT_ACCEPT,    self.S_CLOSING,     self._on_close_while_accepted,  self.S_CLOSED)
 
+        # batched ack state
+        self._pending_acks = 0
+        self._last_ack_tag = None
+
     def _create_accepted_channel(self, transport, msg):
         """
         Creates an AcceptedListenChannel.
@@ -960,6 +1052,41 @@ class ListenChannel(RecvChannel):
         """
         self._fsm.process(self.I_EXIT_ACCEPT)
 
+    def ack_batched(self, delivery_tag):
+        """
+        Acks a message delivered to this channel, coalescing consecutive acks into one multiple ack.
+
+        Pending acks are sent when _ack_batch_size of them have accumulated, or when no delivered
+        messages are waiting in the recv queue, so a consumer limited by its prefetch count never
+        stalls waiting for its own acks. Only valid while messages are acked in delivery order.
+        """
+        self._pending_acks += 1
+        self._last_ack_tag = delivery_tag
+
+        if self._pending_acks >= self._ack_batch_size or self._recv_queue.qsize() == 0 or not self._consuming:
+            self.flush_acks()
+
+    def flush_acks(self):
+        """
+        Sends any pending batched acks to the broker.
+        """
+        if not self._pending_acks:
+            return
+
+        delivery_tag = self._last_ack_tag
+        self._pending_acks = 0
+        self._last_ack_tag = None
+
+        with self._ensure_transport():
+            self._transport.ack_impl(delivery_tag, multiple=True)
+
+    def stop_consume(self):
+        """
+        Stop consume override, sends pending batched acks first.
+        """
+        self.flush_acks()
+        RecvChannel.stop_consume(self)
+
 
 class SubscriberChannel(ListenChannel):
     def close_impl(self):
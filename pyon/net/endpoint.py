@@ -17,12 +17,13 @@ import threading
 from pyon.core import bootstrap, exception
 from pyon.core.bootstrap import CFG, IonObject
 from pyon.core.exception import ExceptionFactory, IonException, BadRequest
-from pyon.net.channel import ChannelClosedError, PublisherChannel, ListenChannel, SubscriberChannel, ServerChannel, BidirClientChannel
+from pyon.net.channel import ChannelClosedError, ChannelError, PublisherChannel, ListenChannel, SubscriberChannel, ServerChannel, BidirClientChannel, SendChannel, RecvChannel
 from pyon.core.interceptor.interceptor import Invocation, process_interceptors
 from pyon.util.containers import get_ion_ts, get_ion_ts_millis
 from pyon.util.log import log
 from pyon.net.transport import NameTrio, BaseTransport
 from pyon.util.sflow import SFlowManager
+from pyon.util.async import spawn
 
 # create special logging category for RPC message tracking
 import logging
@@ -317,8 +318,20 @@ class BaseEndpoint(object):
 
         Can pass additional kwargs in to be passed through to the channel provider.
         """
+        affinity = self._get_channel_affinity()
+        if affinity is not None:
+            return self.node.channel(self.channel_type, transport=transport, affinity=affinity)
+
         return self.node.channel(self.channel_type, transport=transport)
 
+    def _get_channel_affinity(self):
+        """
+        Returns a key the node uses to keep related channels on the same broker connection, or None.
+
+        Override in derived classes, such as the process endpoints.
+        """
+        return None
+
     def close(self):
         """
         To be defined by derived classes. Cleanup any resources here, such as channels being open.
@@ -654,7 +667,29 @@ class ListeningBaseEndpoint(BaseEndpoint):
 #
 
 class PublisherEndpointUnit(EndpointUnit):
-    pass
+
+    def send_many(self, msgs, headers=None):
+        """
+        Sends several messages with a single call into the channel.
+
+        Each message is built and put through the outgoing interceptor stack on its own.
+
+        @param  msgs        A list of messages to send.
+        @param  headers     Optional headers to send with every message.
+        @returns            A list of 2-tuples of the message bodies and headers sent.
+        """
+        out = []
+        for msg in msgs:
+            _msg, _header = self._build_msg(msg, headers)
+            if headers: _header.update(headers)
+
+            new_msg, new_headers = self.intercept_out(_msg, _header)
+            trigger_msg_out_callback(new_msg, new_headers, self)
+            out.append((new_msg, new_headers))
+
+        self.channel.send_many(out)
+
+        return out
 
 class Publisher(SendingBaseEndpoint):
     """
@@ -669,12 +704,36 @@ class Publisher(SendingBaseEndpoint):
         SendingBaseEndpoint.__init__(self, **kwargs)
 
     def publish(self, msg, to_name=None, headers=None):
+        ep = self._get_pub_ep(to_name)
+
+        ep.send(msg, headers)
+        if ep != self._pub_ep:
+            ep.close()
+
+    def publish_many(self, msgs, to_name=None, headers=None):
+        """
+        Publishes a list of messages, handing them to the transport in one batch.
+
+        Amortizes the per-message channel and broker round trip cost of publish.
+        """
+        if not msgs:
+            return
+
+        ep = self._get_pub_ep(to_name)
+
+        ep.send_many(msgs, headers)
+        if ep != self._pub_ep:
+            ep.close()
+
+    def _get_pub_ep(self, to_name=None):
+        """
+        Returns the cached publishing endpoint unit, or a new one if to_name is given.
+        """
         if to_name is not None:
             if not isinstance(to_name, NameTrio):
                 to_name = NameTrio(bootstrap.get_sys_name(), to_name)   # ensure NT before
 
         # only use the cached pub_ep if to_name is None
-        ep = None
         if to_name is None:
 
             # we may have to create the cached ep
@@ -687,21 +746,20 @@ class Publisher(SendingBaseEndpoint):
                 self._pub_ep = self.create_endpoint(self._send_name)
                 self._pub_ep.channel.connect(self._send_name)
 
-            ep = self._pub_ep
-        else:
-            ep = self.create_endpoint(to_name)
-            ep.channel.connect(to_name)
+            return self._pub_ep
 
-        ep.send(msg, headers)
-        if ep != self._pub_ep:
-            ep.close()
+        ep = self.create_endpoint(to_name)
+        ep.channel.connect(to_name)
+        return ep
 
     def close(self):
         """
         Closes the opened publishing channel, if we've opened it previously.
+        A later publish opens a new channel.
         """
         if self._pub_ep:
-            self._pub_ep.close()
+            pub_ep, self._pub_ep = self._pub_ep, None
+            pub_ep.close()
 
 
 class SubscriberEndpointUnit(EndpointUnit):
@@ -748,13 +806,28 @@ class Subscriber(ListeningBaseEndpoint):
     endpoint_unit_type = SubscriberEndpointUnit
     channel_type = SubscriberChannel
 
-    def __init__(self, callback=None, **kwargs):
+    def __init__(self, callback=None, prefetch_count=None, ack_batch_size=None, **kwargs):
         """
-        @param  callback should be a callable with two args: msg, headers
+        @param  callback        should be a callable with two args: msg, headers
+        @param  prefetch_count  Max number of unacked messages the broker delivers ahead, None for no limit.
+        @param  ack_batch_size  Number of acks to coalesce into a single broker ack, None or 1 acks each message.
         """
         self._callback = callback
+        self._prefetch_count = prefetch_count
+        self._ack_batch_size = ack_batch_size
         ListeningBaseEndpoint.__init__(self, **kwargs)
 
+    def initialize(self, binding=None):
+        """
+        Initialize override, applies the prefetch and ack batching settings to the new channel.
+        """
+        ListeningBaseEndpoint.initialize(self, binding=binding)
+
+        if self._prefetch_count is not None:
+            self._chan.qos(prefetch_count=self._prefetch_count)
+        if self._ack_batch_size is not None:
+            self._chan._ack_batch_size = self._ack_batch_size
+
     def create_endpoint(self, **kwargs):
         return ListeningBaseEndpoint.create_endpoint(self, callback=self._callback, **kwargs)
 
@@ -777,6 +850,10 @@ class BidirectionalListeningEndpointUnit(EndpointUnit):
 
 
 class RequestEndpointUnit(BidirectionalEndpointUnit):
+    def __init__(self, multiplexer=None, **kwargs):
+        BidirectionalEndpointUnit.__init__(self, **kwargs)
+        self._multiplexer = multiplexer
+
     def _get_response(self, conv_id, timeout):
         """
         Gets a response message to the conv_id within the given timeout.
@@ -818,6 +895,10 @@ class RequestEndpointUnit(BidirectionalEndpointUnit):
 
         # we have a timeout, update reply-by header
         headers['reply-by'] = str(int(headers['ts']) + int(timeout * 1000))
+
+        if self._multiplexer is not None:
+            return self._send_multiplexed(msg, headers, timeout)
+
         self.channel.setup_listener(NameTrio(self.channel._send_name.exchange)) # anon queue
         # call base send, and get back the headers it ended up building and sending
         # we extract the conv-id so we can tell the listener what is valid.
@@ -829,6 +910,28 @@ class RequestEndpointUnit(BidirectionalEndpointUnit):
             raise exception.Timeout('Request timed out (%d sec) waiting for response from %s, conv %s' % (timeout, str(self.channel._send_name), sent_headers['conv-id']))
         return result_data, result_headers
 
+    def _send_multiplexed(self, msg, headers, timeout):
+        """
+        Sends a request with the multiplexer's shared reply queue as reply-to, and waits for the
+        response the multiplexer hands over for this request's conv-id.
+        """
+        conv_id = headers['conv-id']
+        ar = self._multiplexer.register(conv_id)
+        try:
+            headers['reply-to'] = self._multiplexer.reply_to
+            BidirectionalEndpointUnit._send(self, msg, headers=headers)
+
+            rmsg, rheaders, rdtag = ar.get(timeout=timeout)
+        except Timeout:
+            raise exception.Timeout('Request timed out (%d sec) waiting for response from %s, conv %s' % (timeout, str(self.channel._send_name), conv_id))
+        finally:
+            self._multiplexer.unregister(conv_id)
+
+        # Provide a hook for any message received
+        trigger_msg_in_callback(rmsg, rheaders, rdtag, self)
+
+        return self.intercept_in(rmsg, rheaders)
+
     def _build_header(self, raw_msg, raw_headers):
         """
         Sets headers common to Request-Response patterns, non-ion-specific.
@@ -967,6 +1070,145 @@ class RPCRequestEndpointUnit(RequestEndpointUnit):
         return headers
 
 
+class RPCResponseMultiplexer(object):
+    """
+    Carries the responses to many concurrent RPC requests on a single long-lived reply queue.
+
+    Requests send on channels sharing this multiplexer's transport, register their conv-id before
+    sending, and name the shared queue as reply-to. One consuming greenlet hands each response to the
+    AsyncResult registered for its conv-id. Responses nobody waits on anymore (such as those to timed
+    out requests) are discarded.
+
+    If the reply channel dies, waiting requests fail and the next request opens a new one.
+    """
+    def __init__(self, node, exchange=None, affinity=None):
+        self._node      = node
+        self._exchange  = exchange or bootstrap.get_sys_name()
+        self._affinity  = affinity
+        self._chan      = None
+        self._recv_gl   = None
+        self._pending   = {}                # conv-id -> AsyncResult
+        self._lock      = coros.RLock()
+        self.stats      = {'requests': 0, 'responses': 0, 'discarded': 0, 'channels': 0, 'max_pending': 0}
+
+    @property
+    def reply_to(self):
+        """
+        The reply-to header value naming the shared reply queue.
+        """
+        self._ensure_started()
+        return "%s,%s" % (self._chan._recv_name.exchange, self._chan._recv_name.queue)
+
+    def _ensure_started(self):
+        """
+        Opens the reply channel and starts consuming on it, if not already running.
+        """
+        with self._lock:
+            if self._chan is not None and self._chan._transport is not None:
+                return
+
+            # a previous reply channel died under us, its consumer may be stuck waiting on it
+            if self._recv_gl is not None:
+                self._recv_gl.kill(block=False)
+
+            if self._affinity is not None:
+                ch = self._node.channel(RecvChannel, affinity=self._affinity)
+            else:
+                ch = self._node.channel(RecvChannel)
+
+            ch.queue_auto_delete = True
+            ch.setup_listener(NameTrio(self._exchange))     # anon queue
+            ch.start_consume()
+
+            self._chan = ch
+            self.stats['channels'] += 1
+            self._recv_gl = spawn(self._recv_loop, ch)
+            self._recv_gl._glname = "RPCResponseMultiplexer"
+
+    def _recv_loop(self, ch):
+        """
+        Consumes responses from the reply channel and dispatches them by conv-id.
+        """
+        while True:
+            try:
+                msg, headers, delivery_tag = ch.recv()
+                ch.ack(delivery_tag)
+            except (ChannelClosedError, ChannelError):
+                break
+
+            ar = self._pending.pop(headers.get('conv-id', None), None)
+            if ar is None:
+                self.stats['discarded'] += 1
+                log.warn("Discarding unknown message, likely from a previous timed out request (conv-id: %s, seq: %s, perf: %s)", headers.get('conv-id', "no conv id"), headers.get('conv-seq', 'no conv seq'), headers.get('performative', 'None'))
+                continue
+
+            self.stats['responses'] += 1
+            ar.set((msg, headers, delivery_tag))
+
+        # reply channel is gone: responses can no longer reach anyone waiting
+        with self._lock:
+            if self._chan is ch:
+                self._chan = None
+            pending, self._pending = self._pending, {}
+
+        for ar in pending.itervalues():
+            ar.set_exception(EndpointError("RPC reply channel closed while waiting for a response"))
+
+    def register(self, conv_id):
+        """
+        Registers a request's conv-id before it is sent.
+
+        @returns    An AsyncResult set to a 3-tuple of (message, headers, delivery tag) on response.
+        """
+        self._ensure_started()
+
+        if conv_id in self._pending:
+            raise EndpointError("A request with conv-id %s is already waiting on this multiplexer" % conv_id)
+
+        ar = event.AsyncResult()
+        self._pending[conv_id] = ar
+
+        self.stats['requests'] += 1
+        self.stats['max_pending'] = max(self.stats['max_pending'], len(self._pending))
+
+        return ar
+
+    def unregister(self, conv_id):
+        """
+        Stops waiting for a response to conv_id. A late response will be discarded.
+        """
+        self._pending.pop(conv_id, None)
+
+    def create_channel(self):
+        """
+        Returns a SendChannel for one request, sharing the reply channel's transport.
+
+        Closing the returned channel leaves the shared transport open.
+        """
+        self._ensure_started()
+
+        ch = SendChannel(close_callback=lambda ch: None)
+        ch.attach_transport(self._chan._transport)
+        ch._lock = self._chan._lock         # serialize sends with the reply channel's acks
+
+        return ch
+
+    def close(self):
+        """
+        Closes the reply channel. Any requests still waiting fail.
+        """
+        with self._lock:
+            ch, self._chan = self._chan, None
+
+        if ch is not None:
+            ch.close()
+
+        if self._recv_gl is not None:
+            self._recv_gl.join(timeout=5)
+            self._recv_gl.kill()
+            self._recv_gl = None
+
+
 class RPCClient(RequestResponseClient):
     """
     Base RPCClient class.
@@ -978,13 +1220,23 @@ class RPCClient(RequestResponseClient):
     at compile time.
     """
     endpoint_unit_type = RPCRequestEndpointUnit
+    _multiplexer = None
 
-    def __init__(self, iface=None, **kwargs):
+    def __init__(self, iface=None, multiplex=None, **kwargs):
+        """
+        @param  multiplex   If True, all requests from this client share one reply queue (see RPCResponseMultiplexer)
+                            instead of each taking a pooled channel and reply queue. Defaults to
+                            CFG endpoint.rpc.multiplex.
+        """
         if isinstance(iface, interface.interface.InterfaceClass):
             self._define_interface(iface)
 #        elif isinstance(iface, IonServiceDefinition):
 #            self._define_svcdef(iface)
 
+        if multiplex is None:
+            multiplex = CFG.get_safe('endpoint.rpc.multiplex', False)
+        self._multiplex = multiplex
+
         RequestResponseClient.__init__(self, **kwargs)
 
 #    def _define_svcdef(self, svc_def):
@@ -1051,6 +1303,36 @@ class RPCClient(RequestResponseClient):
 
         return RequestResponseClient.request(self, msg, headers=headers, timeout=timeout)
 
+    def create_endpoint(self, to_name=None, existing_channel=None, **kwargs):
+        """
+        In multiplexed mode, creates endpoint units that send on the multiplexer's transport and
+        receive their response through it.
+        """
+        if self._multiplex and existing_channel is None:
+            self._ensure_node()
+            multiplexer = self._get_multiplexer()
+
+            kwargs['multiplexer'] = multiplexer
+            existing_channel = multiplexer.create_channel()
+
+        return RequestResponseClient.create_endpoint(self, to_name=to_name, existing_channel=existing_channel, **kwargs)
+
+    def _get_multiplexer(self):
+        """
+        Returns the RPCResponseMultiplexer used in multiplexed mode, creating it on first use.
+
+        At this base level, there is one per client. Override to share one more widely.
+        """
+        if self._multiplexer is None:
+            self._multiplexer = RPCResponseMultiplexer(self.node, affinity=self._get_channel_affinity())
+
+        return self._multiplexer
+
+    def close(self):
+        if self._multiplexer is not None:
+            self._multiplexer.close()
+            self._multiplexer = None
+
 
 class RPCResponseEndpointUnit(ResponseEndpointUnit):
     def __init__(self, routing_obj=None, **kwargs):
@@ -20,6 +20,7 @@ from pyon.util.pool import IDPool
 from pyon.net.transport import LocalTransport, LocalRouter, AMQPTransport, ComposableTransport
 
 from collections import defaultdict
+from functools import partial
 import traceback
 
 class BaseNode(object):
@@ -76,14 +77,15 @@ class BaseNode(object):
         """
         log.debug("In Node.channel")
 
-    def _new_channel(self, ch_type, ch_number=None, transport=None):
+    def _new_channel(self, ch_type, ch_number=None, transport=None, client=None):
         """
         Creates a pyon Channel based on the passed in type, and activates it for use.
 
         @param  transport   If specified, will wrap the underlying transport created here.
+        @param  client      The broker connection to open the channel on, if the node has several.
         """
         chan = ch_type()
-        new_transport = self._new_transport(ch_number=ch_number)
+        new_transport = self._new_transport(ch_number=ch_number, client=client)
 
         # create overlay transport
         if transport is not None:
@@ -92,7 +94,7 @@ class BaseNode(object):
         chan.on_channel_open(new_transport)
         return chan
 
-    def _new_transport(self, ch_number=None):
+    def _new_transport(self, ch_number=None, client=None):
         """
         Creates a new transport to be used by a Channel.
 
@@ -146,8 +148,58 @@ class NodeB(BaseNode):
         self._pool_map = {}     # maps active pika channel numbers to our numbers (from self._pool)
         self._dead_pool = []    # channels removed from pool for failing health test, for later forensics
 
+        self._clients = []                      # additional broker connections, see make_node's pool_size
+        self._pool_slots = {}                   # maps slot number (1 to pool size - 1) to open additional connection
+        self._pool_size = 1                     # number of broker connections configured, see make_node
+        self._pub_pool = defaultdict(list)      # maps broker connection to idle pooled PublisherChannels
+        self._pub_pool_map = {}                 # maps id of checked out pooled PublisherChannels to their broker connection
+        self._pub_pool_size = CFG.get_safe('container.messaging.publisher_pool_size', 10)   # max idle per connection
+
         BaseNode.__init__(self)
 
+    def on_pool_connection_open(self, client, slot=None):
+        """
+        AMQP Connection Open event handler for additional pooled connections.
+
+        Channels are only placed on the connection once it has opened. The slot is the
+        connection's fixed position in the pool, by default the next free one.
+        """
+        log.debug("NodeB.on_pool_connection_open: %s (slot %s)", client, slot)
+        if slot is None:
+            slot = 1
+            while slot in self._pool_slots:
+                slot += 1
+        self._pool_size = max(self._pool_size, slot + 1)
+        client.add_on_close_callback(lambda *a: self.on_pool_connection_close(client))
+        self._clients.append(client)
+        self._pool_slots[slot] = client
+
+    def on_pool_connection_close(self, client):
+        """
+        AMQP Connection Close event handler for additional pooled connections.
+        """
+        log.debug("NodeB.on_pool_connection_close: %s", client)
+        if client in self._clients:
+            self._clients.remove(client)
+        for slot, slot_client in self._pool_slots.items():
+            if slot_client is client:
+                del self._pool_slots[slot]
+        self._pub_pool.pop(client, None)
+
+    def _get_client(self, affinity=None):
+        """
+        Returns the broker connection to open a channel on.
+
+        Channels with the same affinity key (typically an ION process id) always share a
+        connection, spreading processes over the configured pool. The key maps to a fixed pool
+        slot, so connections opening or closing do not move other keys. Without a key, or if the
+        slot's connection is not open, the primary connection is used.
+        """
+        if affinity is None or not self._pool_slots:
+            return self.client
+
+        return self._pool_slots.get(hash(affinity) % self._pool_size, self.client)
+
     def stop_node(self):
         """
         Closes the connection to the broker, cleans up resources held by this node.
@@ -159,6 +211,9 @@ class NodeB(BaseNode):
             self._destroy_pool()
             self.client.close()
 
+            for client in list(self._clients):
+                client.close()
+
         BaseNode.stop_node(self)
 
     def _destroy_pool(self):
@@ -169,11 +224,14 @@ class NodeB(BaseNode):
             if chan._recv_name:
                 chan._destroy_queue()
 
-    def _new_transport(self, ch_number=None):
+    def _new_transport(self, ch_number=None, client=None):
         """
         Creates a new AMQPTransport with an underlying Pika channel.
+
+        @param  client  The broker connection to open the channel on, the primary connection if None.
         """
-        amq_chan = blocking_cb(self.client.channel, 'on_open_callback', channel_number=ch_number)
+        client = client or self.client
+        amq_chan = blocking_cb(client.channel, 'on_open_callback', channel_number=ch_number)
         if amq_chan is None:
             log.error("AMQCHAN IS NONE THIS SHOULD NEVER HAPPEN, chan number requested: %s", ch_number)
             from pyon.container.cc import Container
@@ -184,7 +242,7 @@ class NodeB(BaseNode):
         transport = AMQPTransport(amq_chan)
 
         # return the pending in collection (lets this number be assigned again later)
-        self.client._pending.remove(transport.channel_number)
+        client._pending.remove(transport.channel_number)
 
         # by default, everything should have a prefetch count of 1 (configurable)
         # this can be overridden by the channel get_n related methods
@@ -209,66 +267,136 @@ class NodeB(BaseNode):
 
         return True
 
-    def channel(self, ch_type, transport=None):
+    def channel(self, ch_type, transport=None, affinity=None):
         """
         Creates a Channel object with an underlying transport callback and returns it.
 
+        BidirClientChannels and plain PublisherChannels are pooled. Other channels are opened on the
+        broker connection chosen by affinity. The node lock only guards pool bookkeeping and is never
+        held while a channel is being opened.
+
         @type ch_type   BaseChannel
+        @param affinity Optional key (such as a process id) to keep related channels on one broker connection.
         """
         #log.debug("NodeB.channel")
-        with self._lock:
-            # having _queue_auto_delete on is a pre-req to being able to pool.
-            if ch_type == channel.BidirClientChannel and not ch_type._queue_auto_delete:
-
-                # only attempt this 5 times - somewhat arbitrary but we can't have an infinite loop here
-                attempts = 5
-                while attempts > 0:
-                    attempts -= 1
-
-                    chid = self._pool.get_id()
-                    if chid in self._bidir_pool:
-                        log.debug("BidirClientChannel requested, pulling from pool (%d)", chid)
-                        assert not chid in self._pool_map.values()
-
-                        # we need to check the health of this bidir channel
-                        ch = self._bidir_pool[chid]
-                        if not self._check_pooled_channel_health(ch):
-                            log.warning("Channel (%d) failed health check, removing from pool", ch.get_channel_id())
-
-                            # return chid to the id pool
-                            self._pool.release_id(chid)
-
-                            # remove this channel from the pool, put into dead pool
-                            self._dead_pool.append(ch)
-                            del self._bidir_pool[chid]
-
-                            # now close the channel (must remove our close callback which returns it to the pool)
-                            assert ch._close_callback == self.on_channel_request_close
-                            ch._close_callback = None
-                            ch.close()
-
-                            # resume the loop to attempt to get one again
-                            continue
-
-                        self._pool_map[ch.get_channel_id()] = chid
-                    else:
-                        log.debug("BidirClientChannel requested, no pool items available, creating new (%d)", chid)
-                        ch = self._new_channel(ch_type, transport=transport)
-                        ch.set_close_callback(self.on_channel_request_close)
-                        self._bidir_pool[chid] = ch
-                        self._pool_map[ch.get_channel_id()] = chid
-
-                    # channel here is valid, exit out of attempts loop
-                    break
-                else:    # while loop didn't get a valid channel in X attempts
-                    raise StandardError("Could not get a valid channel")
-
-            else:
+        # having _queue_auto_delete on is a pre-req to being able to pool.
+        if ch_type == channel.BidirClientChannel and not ch_type._queue_auto_delete:
+            ch = self._get_pooled_bidir_channel(ch_type, transport=transport)
+
+        elif ch_type == channel.PublisherChannel and transport is None:
+            ch = self._get_pooled_publisher_channel(ch_type, self._get_client(affinity))
+
+        else:
+            ch = self._new_channel(ch_type, transport=transport, client=self._get_client(affinity))
+
+        assert ch
+        return ch
+
+    def _get_pooled_bidir_channel(self, ch_type, transport=None):
+        """
+        Returns a healthy pooled BidirClientChannel, or opens a new one and adds it to the pool.
+        """
+        # only attempt this 5 times - somewhat arbitrary but we can't have an infinite loop here
+        attempts = 5
+        while attempts > 0:
+            attempts -= 1
+
+            with self._lock:
+                chid = self._pool.get_id()
+                if chid in self._bidir_pool:
+                    log.debug("BidirClientChannel requested, pulling from pool (%d)", chid)
+                    assert not chid in self._pool_map.values()
+
+                    # we need to check the health of this bidir channel
+                    ch = self._bidir_pool[chid]
+                    if not self._check_pooled_channel_health(ch):
+                        log.warning("Channel (%d) failed health check, removing from pool", ch.get_channel_id())
+
+                        # return chid to the id pool
+                        self._pool.release_id(chid)
+
+                        # remove this channel from the pool, put into dead pool
+                        self._dead_pool.append(ch)
+                        del self._bidir_pool[chid]
+
+                        # now close the channel (must remove our close callback which returns it to the pool)
+                        assert ch._close_callback == self.on_channel_request_close
+                        ch._close_callback = None
+                        ch.close()
+
+                        # resume the loop to attempt to get one again
+                        continue
+
+                    self._pool_map[ch.get_channel_id()] = chid
+                    return ch
+
+            # chid is reserved for us, so the channel can be opened without holding the node lock
+            log.debug("BidirClientChannel requested, no pool items available, creating new (%d)", chid)
+            try:
                 ch = self._new_channel(ch_type, transport=transport)
-            assert ch
+            except Exception:
+                with self._lock:
+                    self._pool.release_id(chid)
+                raise
+
+            ch.set_close_callback(self.on_channel_request_close)
+            with self._lock:
+                self._bidir_pool[chid] = ch
+                self._pool_map[ch.get_channel_id()] = chid
+
+            return ch
+
+        # while loop didn't get a valid channel in X attempts
+        raise StandardError("Could not get a valid channel")
+
+    def _get_pooled_publisher_channel(self, ch_type, client):
+        """
+        Returns an idle pooled PublisherChannel on the given connection, or opens a new one.
+
+        The channel's close callback returns it to the pool, see on_publisher_channel_close.
+        """
+        with self._lock:
+            idle = self._pub_pool[client]
+            while idle:
+                ch = idle.pop()
+                if ch._transport is not None and ch._transport.active:
+                    self._pub_pool_map[id(ch)] = client
+                    return ch
+
+                log.debug("Discarding closed pooled publisher channel")
+
+        ch = self._new_channel(ch_type, client=client)
+        ch.set_close_callback(self.on_publisher_channel_close)
+
+        with self._lock:
+            self._pub_pool_map[id(ch)] = client
 
         return ch
 
+    def on_publisher_channel_close(self, ch):
+        """
+        Close callback for pooled PublisherChannels.
+
+        Returns the channel to its connection's pool, unless the pool is full or the channel's
+        transport has gone away, in which case the channel is really closed.
+        """
+        with self._lock:
+            if id(ch) not in self._pub_pool_map:
+                # Already returned to the pool or closed
+                log.debug("Ignoring close of publisher channel not checked out from the pool")
+                return
+            client = self._pub_pool_map.pop(id(ch))
+
+            keep = ch._transport is not None and ch._transport.active and client in self._pub_pool \
+                and len(self._pub_pool[client]) < self._pub_pool_size
+            if keep:
+                ch.reset()
+                self._pub_pool[client].append(ch)
+
+        if not keep:
+            ch.set_close_callback(None)
+            ch.close()
+
     def on_channel_request_close(self, ch):
         """
         Close callback for pooled Channels.
@@ -317,6 +445,27 @@ def ioloop(connection, name=None):
         # Loop until the connection is closed
         connection.ioloop.start()
 
+def ioloop_pool(connections, name=None):
+    """
+    Runs the ioloops of several connections in their own greenlets.
+
+    Returns as soon as any of them exits, killing the rest, so the pool can be supervised and
+    killed like a single ioloop.
+    """
+    done = event.Event()
+
+    gls = []
+    for i, connection in enumerate(connections):
+        gl = gevent.spawn(ioloop, connection, name="%s-%d" % (name, i) if name else None)
+        gl._glname = "pyon.net AMQP ioloop proc %d" % i
+        gl.link(lambda _: done.set())
+        gls.append(gl)
+
+    try:
+        done.wait()
+    finally:
+        gevent.killall(gls)
+
 class PyonSelectConnection(SelectConnection):
     """
     Custom-derived Pika SelectConnection to allow us to get around re-using failed channels.
@@ -372,19 +521,29 @@ class PyonSelectConnection(SelectConnection):
         log.debug("Marking %d as a bad channel", ch_number)
         self._bad_channel_numbers.add(ch_number)
 
-def make_node(connection_params=None, name=None, timeout=None):
+def make_node(connection_params=None, name=None, timeout=None, pool_size=None):
     """
     Blocking construction and connection of node.
 
     @param connection_params  AMQP connection parameters. By default, uses CFG.server.amqp (most common use).
+    @param pool_size          Number of broker connections the node opens. By default, uses
+                              CFG.container.messaging.connection_pool_size or 1. Channels are spread
+                              over the additional connections by affinity, see NodeB.channel.
     """
     log.debug("In make_node")
     node = NodeB()
     connection_params = connection_params or CFG.server.amqp
+    pool_size = pool_size or CFG.get_safe('container.messaging.connection_pool_size', 1)
     credentials = PlainCredentials(connection_params["username"], connection_params["password"])
     conn_parameters = ConnectionParameters(host=connection_params["host"], virtual_host=connection_params["vhost"], port=connection_params["port"], credentials=credentials)
     connection = PyonSelectConnection(conn_parameters , node.on_connection_open)
-    ioloop_process = gevent.spawn(ioloop, connection, name=name)
+    if pool_size > 1:
+        node._pool_size = pool_size
+        connections = [connection] + [PyonSelectConnection(conn_parameters, partial(node.on_pool_connection_open, slot=slot))
+                                      for slot in xrange(1, pool_size)]
+        ioloop_process = gevent.spawn(ioloop_pool, connections, name=name)
+    else:
+        ioloop_process = gevent.spawn(ioloop, connection, name=name)
     ioloop_process._glname = "pyon.net AMQP ioloop proc"
     #ioloop_process = gevent.spawn(connection.ioloop.start)
     node.ready.wait(timeout=timeout)
@@ -416,11 +575,11 @@ class LocalNode(BaseNode):
                 self._local_router.stop()
         self.running = False
 
-    def _new_transport(self, ch_number=None):
+    def _new_transport(self, ch_number=None, client=None):
         trans = LocalTransport(self._local_router, ch_number)
         return trans
 
-    def channel(self, ch_type, transport=None):
+    def channel(self, ch_type, transport=None, affinity=None):
         ch = self._new_channel(ch_type, ch_number=self._channel_id_pool.get_id(), transport=transport)
         # @TODO keep track of all channels to close them later from the top
 
@@ -258,6 +258,18 @@ class TestRecvChannel(PyonTestCase):
         mdq.assert_called_with(None)
         mb.assert_called_with(sentinel.binding2)
 
+    def test_setup_listener_pipelined(self):
+        ch = self._create_channel()
+        ch._transport = MagicMock()
+        ch._transport.pipelined.return_value.__exit__.side_effect = lambda *a: ch._declare_exchange.assert_called_once_with(sentinel.xp)
+
+        ch.setup_listener(NameTrio(sentinel.xp, sentinel.queue, sentinel.binding))
+
+        ch._transport.pipelined.assert_called_once_with()
+        self.assertEquals(ch._transport.pipelined.return_value.__enter__.call_count, 1)
+        self.assertEquals(ch._transport.pipelined.return_value.__exit__.call_count, 1)
+        ch._bind.assert_called_once_with(sentinel.binding)
+
     def test_setup_listener_existing_recv_name(self):
         ch = self._create_channel()
 
@@ -603,6 +615,18 @@ class TestPublisherChannel(PyonTestCase):
         depmock.assert_called_once_with(sentinel.xp)
         mocksendchannel.send.assert_called_once_with(pubchan, sentinel.data, headers=None)
 
+    def test_send_many(self, mocksendchannel):
+        depmock = Mock()
+        pubchan = PublisherChannel()
+        pubchan._declare_exchange = depmock
+
+        pubchan._send_name = NameTrio(sentinel.xp, sentinel.routing_key)
+
+        pubchan.send_many(sentinel.msgs)
+
+        depmock.assert_called_once_with(sentinel.xp)
+        mocksendchannel.send_many.assert_called_once_with(pubchan, sentinel.msgs)
+
 @attr('UNIT')
 @patch('pyon.net.channel.SendChannel')
 class TestBidirClientChannel(PyonTestCase):
@@ -744,6 +768,59 @@ class TestListenChannel(PyonTestCase):
 
         self.assertEquals(self.ch._fsm.current_state, self.ch.S_ACTIVE)
 
+    def test_ack_batched(self):
+        transport = Mock()
+        self.ch.on_channel_open(transport)
+        self.ch._ack_batch_size = 3
+        self.ch._consuming = True
+        self.ch._recv_queue.put(sentinel.waiting)
+
+        self.ch.ack_batched(sentinel.dtag1)
+        self.ch.ack_batched(sentinel.dtag2)
+        self.assertEquals(transport.ack_impl.call_count, 0)
+
+        self.ch.ack_batched(sentinel.dtag3)
+        transport.ack_impl.assert_called_once_with(sentinel.dtag3, multiple=True)
+
+    def test_ack_batched_flushes_on_empty_queue(self):
+        transport = Mock()
+        self.ch.on_channel_open(transport)
+        self.ch._ack_batch_size = 10
+        self.ch._consuming = True
+
+        self.ch.ack_batched(sentinel.dtag)
+        transport.ack_impl.assert_called_once_with(sentinel.dtag, multiple=True)
+
+    def test_stop_consume_flushes_acks(self):
+        transport = Mock()
+        self.ch.on_channel_open(transport)
+        self.ch._ack_batch_size = 10
+        self.ch._consuming = True
+        self.ch._recv_queue.put(sentinel.waiting)
+        self.ch._on_stop_consume = Mock()
+
+        self.ch.ack_batched(sentinel.dtag)
+        self.assertEquals(transport.ack_impl.call_count, 0)
+
+        self.ch.stop_consume()
+        transport.ack_impl.assert_called_once_with(sentinel.dtag, multiple=True)
+
+    def test_AcceptedListenChannel_ack_batched(self):
+        transport = Mock()
+        self.ch.on_channel_open(transport)
+        self.ch._ack_batch_size = 10
+        self.ch.ack_batched = Mock()
+
+        ach = self.ch._create_accepted_channel(transport, [])
+        ach._delivery_tags.add(sentinel.dtag)
+        self.ch._fsm.current_state = self.ch.S_ACCEPTED
+
+        ach.ack(sentinel.dtag)
+
+        self.ch.ack_batched.assert_called_once_with(sentinel.dtag)
+        self.assertEquals(transport.ack_impl.call_count, 0)
+        self.assertEquals(self.ch._fsm.current_state, self.ch.S_ACTIVE)
+
     def test_AcceptedListenChannel_close_does_not_close_underlying_amqp_channel(self):
         transport = Mock()
         newch = self.ch._create_accepted_channel(transport, sentinel.msg)
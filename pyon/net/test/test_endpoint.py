@@ -18,7 +18,7 @@ from pyon.core.bootstrap import get_sys_name, CFG
 from pyon.container.cc import Container
 from pyon.core.interceptor.interceptor import Invocation
 from pyon.net.channel import BaseChannel, SendChannel, BidirClientChannel, SubscriberChannel, ChannelClosedError, ServerChannel, RecvChannel, ListenChannel
-from pyon.net.endpoint import EndpointUnit, BaseEndpoint, RPCServer, Subscriber, Publisher, RequestResponseClient, RequestEndpointUnit, RPCRequestEndpointUnit, RPCClient, RPCResponseEndpointUnit, EndpointError, SendingBaseEndpoint, ListeningBaseEndpoint
+from pyon.net.endpoint import EndpointUnit, BaseEndpoint, RPCServer, Subscriber, Publisher, RequestResponseClient, RequestEndpointUnit, RPCRequestEndpointUnit, RPCClient, RPCResponseEndpointUnit, EndpointError, SendingBaseEndpoint, ListeningBaseEndpoint, RPCResponseMultiplexer
 from pyon.net.messaging import NodeB
 from pyon.ion.service import BaseService
 from pyon.net.transport import NameTrio, BaseTransport
@@ -425,12 +425,38 @@ class TestPublisher(PyonTestCase):
         self._pub.publish(sentinel.msg, to_name=sentinel.to_name)
         self.assertEquals(self._ch.send.call_count, 2)
 
+    def test_publish_many(self):
+        self._pub.publish_many(["pub1", "pub2", "pub3"], headers={'stream':sentinel.stream})
+
+        self._node.channel.assert_called_once_with(self._pub.channel_type, transport=None)
+        self.assertEquals(self._ch.send.call_count, 0)
+        self.assertEquals(self._ch.send_many.call_count, 1)
+
+        msgs = self._ch.send_many.call_args[0][0]
+        self.assertEquals([m for m, h in msgs], ["pub1", "pub2", "pub3"])
+        self.assertTrue(all(h['stream'] == sentinel.stream for m, h in msgs))
+
+    def test_publish_many_empty(self):
+        self._pub.publish_many([])
+        self.assertEquals(self._node.channel.call_count, 0)
+
     def test_close(self):
         self._pub.publish(sentinel.msg)
-        self._pub._pub_ep.close = Mock()
+        pub_ep = self._pub._pub_ep
+        pub_ep.close = Mock()
+
+        self._pub.close()
+        pub_ep.close.assert_called_once_with()
+        self.assertIsNone(self._pub._pub_ep)
 
+        # closing again does nothing
         self._pub.close()
-        self._pub._pub_ep.close.assert_called_once_with()
+        pub_ep.close.assert_called_once_with()
+
+        # publish after close opens a new channel
+        self._pub.publish(sentinel.msg)
+        self.assertEquals(self._node.channel.call_count, 2)
+        self.assertIsNot(self._pub._pub_ep, pub_ep)
 
 
 class RecvMockMixin(object):
@@ -497,6 +523,27 @@ class TestSubscriber(PyonTestCase, RecvMockMixin):
         # make sure we got our message
         cbmock.assert_called_once_with('subbed', {'conv-id': sentinel.conv_id, 'status_code':200, 'error_message':'', 'op': None})
 
+    def test_initialize_prefetch_and_ack_batch(self):
+        sub = Subscriber(node=self._node, from_name="testsub", callback=Mock(), prefetch_count=50, ack_batch_size=10)
+
+        listen_channel_mock = Mock(spec=SubscriberChannel)
+        sub.node.channel.return_value = listen_channel_mock
+
+        sub.initialize()
+
+        listen_channel_mock.qos.assert_called_once_with(prefetch_count=50)
+        self.assertEquals(listen_channel_mock._ack_batch_size, 10)
+
+    def test_initialize_defaults(self):
+        sub = Subscriber(node=self._node, from_name="testsub", callback=Mock())
+
+        listen_channel_mock = Mock(spec=SubscriberChannel)
+        sub.node.channel.return_value = listen_channel_mock
+
+        sub.initialize()
+
+        self.assertEquals(listen_channel_mock.qos.call_count, 0)
+
 @attr('UNIT')
 @patch('pyon.net.endpoint.BidirectionalEndpointUnit._send', Mock(return_value=(sentinel.body, {'conv-id':sentinel.conv_id})))
 class TestRequestResponse(PyonTestCase, RecvMockMixin):
@@ -606,6 +653,180 @@ class TestRPCClient(PyonTestCase, RecvMockMixin):
         rpcc = RPCClient(to_name="simply", iface=ISimpleInterface)
         self.assertRaises(AssertionError, rpcc.simple, "zap", "zip")
 
+    def _setup_mock_multiplexer(self, rpcc, value="bidirmsg", status_code=200):
+        mux = Mock(spec=RPCResponseMultiplexer)
+        mux.reply_to = "xp,replyq"
+        mux.create_channel.return_value = MagicMock(spec=SendChannel())
+
+        ar = event.AsyncResult()
+        if value is not None:
+            ar.set((value, {'status_code':status_code, 'error_message':'no problem', 'conv-id':sentinel.conv_id}, sentinel.delivery_tag))
+        mux.register.return_value = ar
+
+        rpcc._get_multiplexer = Mock(return_value=mux)
+        return mux
+
+    @patch('pyon.net.endpoint.IonObject')
+    @patch('pyon.net.endpoint.RPCRequestEndpointUnit._build_conv_id', Mock(return_value=sentinel.conv_id))
+    def test_rpc_client_multiplexed(self, iomock):
+        node = Mock(spec=NodeB)
+
+        rpcc = RPCClient(node=node, to_name="simply", iface=ISimpleInterface, multiplex=True)
+        rpcc.node.interceptors = {}
+        mux = self._setup_mock_multiplexer(rpcc)
+
+        ret = rpcc.simple(one="zap", two="zip")
+        self.assertEquals(ret, "bidirmsg")
+
+        # no channel taken from the node, sent on the multiplexer's channel with its reply queue
+        self.assertEquals(node.channel.call_count, 0)
+        ch = mux.create_channel.return_value
+        ch.connect.assert_called_once_with(rpcc._send_name)
+        self.assertEquals(ch.send.call_count, 1)
+        self.assertEquals(ch.send.call_args[0][1]['reply-to'], "xp,replyq")
+        self.assertEquals(ch.send.call_args[0][1]['conv-id'], sentinel.conv_id)
+
+        mux.register.assert_called_once_with(sentinel.conv_id)
+        mux.unregister.assert_called_once_with(sentinel.conv_id)
+        self.assertEquals(ch.setup_listener.call_count, 0)
+        self.assertEquals(ch.close.call_count, 1)
+
+    @patch('pyon.net.endpoint.IonObject')
+    @patch('pyon.net.endpoint.RPCRequestEndpointUnit._build_conv_id', Mock(return_value=sentinel.conv_id))
+    def test_rpc_client_multiplexed_timeout(self, iomock):
+        rpcc = RPCClient(node=Mock(spec=NodeB), to_name="simply", iface=ISimpleInterface, multiplex=True)
+        rpcc.node.interceptors = {}
+        mux = self._setup_mock_multiplexer(rpcc, value=None)
+
+        self.assertRaises(exception.Timeout, rpcc.request, {}, op='simple', timeout=0.1)
+        mux.unregister.assert_called_once_with(sentinel.conv_id)
+
+    def test_rpc_client_multiplex_from_cfg(self):
+        with patch.dict(CFG, {'endpoint':{'rpc':{'multiplex':True}}}):
+            rpcc = RPCClient(to_name="simply")
+            self.assertTrue(rpcc._multiplex)
+
+        rpcc = RPCClient(to_name="simply")
+        self.assertFalse(rpcc._multiplex)
+
+    def test_get_multiplexer(self):
+        rpcc = RPCClient(node=sentinel.node, to_name="simply", multiplex=True)
+        mux = rpcc._get_multiplexer()
+
+        self.assertIsInstance(mux, RPCResponseMultiplexer)
+        self.assertEquals(mux._node, sentinel.node)
+        self.assertEquals(rpcc._get_multiplexer(), mux)
+
+        # close takes it down
+        mux.close = Mock()
+        rpcc.close()
+        mux.close.assert_called_once_with()
+        self.assertIsNone(rpcc._multiplexer)
+
+@attr('UNIT')
+class TestRPCResponseMultiplexer(PyonTestCase):
+
+    def setUp(self):
+        self.node = Mock(spec=NodeB)
+        self.ch = MagicMock(spec=RecvChannel())
+        self.ch._recv_name = NameTrio(sentinel.xp, sentinel.queue)
+        self.ch._lock = sentinel.lock
+        self.node.channel.return_value = self.ch
+        self.mux = RPCResponseMultiplexer(self.node, exchange=sentinel.xp)
+
+        spawn_patch = patch('pyon.net.endpoint.spawn')
+        self.spawn = spawn_patch.start()
+        self.addCleanup(spawn_patch.stop)
+
+    def test_register_starts_once(self):
+        ar1 = self.mux.register(sentinel.conv_id1)
+        ar2 = self.mux.register(sentinel.conv_id2)
+
+        self.node.channel.assert_called_once_with(RecvChannel)
+        self.assertTrue(self.ch.queue_auto_delete)
+        self.assertEquals(self.ch.setup_listener.call_count, 1)
+        self.assertEquals(self.ch.setup_listener.call_args[0][0].exchange, sentinel.xp)
+        self.assertIsNone(self.ch.setup_listener.call_args[0][0].queue)
+        self.ch.start_consume.assert_called_once_with()
+        self.spawn.assert_called_once_with(self.mux._recv_loop, self.ch)
+
+        self.assertNotEquals(ar1, ar2)
+        self.assertEquals(self.mux.stats['requests'], 2)
+        self.assertEquals(self.mux.stats['max_pending'], 2)
+        self.assertEquals(self.mux.stats['channels'], 1)
+
+    def test_register_with_affinity(self):
+        mux = RPCResponseMultiplexer(self.node, affinity=sentinel.affinity)
+        mux.register(sentinel.conv_id)
+
+        self.node.channel.assert_called_once_with(RecvChannel, affinity=sentinel.affinity)
+
+    def test_register_duplicate_conv_id(self):
+        self.mux.register(sentinel.conv_id)
+        self.assertRaises(EndpointError, self.mux.register, sentinel.conv_id)
+
+    def test_unregister(self):
+        self.mux.register(sentinel.conv_id)
+        self.mux.unregister(sentinel.conv_id)
+        self.mux.unregister(sentinel.conv_id)       # second is a no-op
+
+        self.assertEquals(self.mux._pending, {})
+
+    def test_restarts_dead_channel(self):
+        self.mux.register(sentinel.conv_id1)
+        self.ch._transport = None                   # closed underneath us
+        self.mux.register(sentinel.conv_id2)
+
+        self.assertEquals(self.node.channel.call_count, 2)
+        self.spawn.return_value.kill.assert_called_once_with(block=False)
+        self.assertEquals(self.mux.stats['channels'], 2)
+
+    def test_reply_to(self):
+        self.assertEquals(self.mux.reply_to, "%s,%s" % (sentinel.xp, sentinel.queue))
+
+    def test_recv_loop_dispatches(self):
+        ar_a = self.mux.register('a')
+        ar_b = self.mux.register('b')
+
+        vals = [('late', {'conv-id':'zz'}, sentinel.dtag2), ('resp', {'conv-id':'a'}, sentinel.dtag1)]
+        def _ret(*args, **kwargs):
+            if len(vals):
+                return vals.pop()
+            raise ChannelClosedError()
+
+        self.ch.recv.side_effect = _ret
+        self.mux._recv_loop(self.ch)
+
+        self.assertEquals(ar_a.get(timeout=0), ('resp', {'conv-id':'a'}, sentinel.dtag1))
+        self.assertEquals(self.ch.ack.call_args_list, [call(sentinel.dtag1), call(sentinel.dtag2)])
+        self.assertEquals(self.mux.stats['responses'], 1)
+        self.assertEquals(self.mux.stats['discarded'], 1)
+
+        # channel closed: remaining waiter fails, next request gets a new channel
+        self.assertRaises(EndpointError, ar_b.get, timeout=0)
+        self.assertIsNone(self.mux._chan)
+        self.assertEquals(self.mux._pending, {})
+
+    def test_create_channel(self):
+        ch = self.mux.create_channel()
+
+        self.assertIsInstance(ch, SendChannel)
+        self.assertEquals(ch._transport, self.ch._transport)
+        self.assertEquals(ch._lock, sentinel.lock)
+
+        # closing does not close the shared transport
+        ch.close()
+        self.assertEquals(self.ch._transport.close.call_count, 0)
+        self.assertEquals(self.ch.close.call_count, 0)
+
+    def test_close(self):
+        self.mux.register(sentinel.conv_id)
+        self.mux.close()
+
+        self.ch.close.assert_called_once_with()
+        self.spawn.return_value.join.assert_called_once_with(timeout=5)
+        self.assertIsNone(self.mux._chan)
+
 @attr('UNIT')
 class TestRPCResponseEndpoint(PyonTestCase, RecvMockMixin):
 
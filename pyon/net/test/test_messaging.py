@@ -3,8 +3,8 @@
 __author__ = 'Dave Foster <dfoster@asascience.com>'
 __license__ = 'Apache 2.0'
 
-from pyon.net.messaging import NodeB, ioloop, make_node, PyonSelectConnection
-from pyon.net.channel import BaseChannel, BidirClientChannel, RecvChannel
+from pyon.net.messaging import NodeB, ioloop, ioloop_pool, make_node, PyonSelectConnection
+from pyon.net.channel import BaseChannel, BidirClientChannel, RecvChannel, PublisherChannel
 from pyon.util.unit_test import PyonTestCase
 from mock import Mock, sentinel, patch
 from nose.plugins.attrib import attr
@@ -91,9 +91,98 @@ class TestNodeB(PyonTestCase):
 
         ch = self._node.channel(BaseChannel)
 
-        ncmock.assert_called_once_with(BaseChannel, transport=None)
+        ncmock.assert_called_once_with(BaseChannel, transport=None, client=self._node.client)
         self.assertEquals(ch, sentinel.new_chan)
 
+    @patch('pyon.net.messaging.NodeB._new_channel', return_value=sentinel.new_chan)
+    def test_channel_affinity(self, ncmock):
+        self._node.client = sentinel.client
+        self._node.on_pool_connection_open(Mock())
+        self._node.on_pool_connection_open(Mock())
+
+        clients = [self._node._get_client(affinity="proc%d" % x) for x in xrange(30)]
+
+        # spread over all connections, stable per key
+        self.assertEquals(set(clients), set([sentinel.client] + self._node._clients))
+        self.assertEquals(clients, [self._node._get_client(affinity="proc%d" % x) for x in xrange(30)])
+
+        # no key means primary connection
+        self.assertEquals(self._node._get_client(), sentinel.client)
+
+        self._node.channel(BaseChannel, affinity="proc1")
+        ncmock.assert_called_once_with(BaseChannel, transport=None, client=self._node._get_client(affinity="proc1"))
+
+        # a connection closing only moves its own keys, to the primary connection
+        closed_client = self._node._clients[0]
+        self._node.on_pool_connection_close(closed_client)
+        for x, client in enumerate(clients):
+            expected = sentinel.client if client is closed_client else client
+            self.assertEquals(self._node._get_client(affinity="proc%d" % x), expected)
+
+    def test_pool_connection_close(self):
+        client = Mock()
+        self._node.on_pool_connection_open(client)
+        self.assertEquals(self._node._clients, [client])
+
+        self._node.on_pool_connection_close(client)
+        self.assertEquals(self._node._clients, [])
+
+    def test_channel_publisher_pool(self):
+        self._node.client = sentinel.client
+
+        ncm = Mock()
+        ncm.return_value = PublisherChannel()
+        ncm.return_value.attach_transport(Mock())
+
+        with patch('pyon.net.messaging.NodeB._new_channel', ncm):
+            ch = self._node.channel(PublisherChannel)
+            ch._send_name = sentinel.send_name
+
+            # close returns it to the pool, reset
+            ch.close()
+            self.assertEquals(self._node._pub_pool[sentinel.client], [ch])
+            self.assertIsNone(ch._send_name)
+
+            # closing again does not return it twice
+            ch.close()
+            self.assertEquals(self._node._pub_pool[sentinel.client], [ch])
+
+            # reacquire gets the same one, without opening a new channel
+            ch2 = self._node.channel(PublisherChannel)
+            self.assertEquals(ch, ch2)
+            self.assertEquals(ncm.call_count, 1)
+            self.assertEquals(self._node._pub_pool[sentinel.client], [])
+
+    def test_channel_publisher_pool_full(self):
+        self._node.client = sentinel.client
+        self._node._pub_pool_size = 0
+
+        ncm = Mock()
+        ncm.return_value = PublisherChannel()
+        ncm.return_value.attach_transport(Mock())
+
+        with patch('pyon.net.messaging.NodeB._new_channel', ncm):
+            ch = self._node.channel(PublisherChannel)
+            ch.close()
+
+        # really closed
+        self.assertEquals(self._node._pub_pool[sentinel.client], [])
+        self.assertEquals(ch._fsm.current_state, ch.S_CLOSED)
+        self.assertEquals(self._node._pub_pool_map, {})
+
+    def test_channel_publisher_pool_discards_dead(self):
+        self._node.client = sentinel.client
+
+        deadch = Mock(spec=PublisherChannel)
+        deadch._transport = None
+        self._node._pub_pool[sentinel.client].append(deadch)
+
+        with patch('pyon.net.messaging.NodeB._new_channel', return_value=Mock(spec=PublisherChannel)) as ncm:
+            ch = self._node.channel(PublisherChannel)
+
+        ncm.assert_called_once_with(PublisherChannel, client=sentinel.client)
+        self.assertEquals(self._node._pub_pool[sentinel.client], [])
+
     def test_channel_pool(self):
         ncm = Mock()
         ncm.return_value = Mock(spec=BidirClientChannel)
@@ -208,6 +297,17 @@ class TestNodeB(PyonTestCase):
         self._node._destroy_pool.assert_called_once_with()
         self.assertFalse(self._node.running)
 
+    def test_stop_node_closes_pool_connections(self):
+        self._node.client = Mock()
+        self._node._destroy_pool = Mock()
+        self._node.running = True
+        pool_client = Mock()
+        self._node._clients.append(pool_client)
+
+        self._node.stop_node()
+
+        pool_client.close.assert_called_once_with()
+
     def test_stop_node_not_running(self):
         self._node.client = Mock()
         self._node._destroy_pool = Mock()
@@ -281,6 +381,42 @@ class TestMessaging(PyonTestCase):
         self.assertEquals(ilp, sentinel.ioloop_process)
         gevmock.assert_called_once_with(ioloop, sentinel.connection, name=sentinel.name)
 
+    @patch('pyon.net.messaging.gevent.spawn', return_value=sentinel.ioloop_process)
+    def test_make_node_pool(self, gevmock):
+        connection_params = { 'username': sentinel.username,
+                              'password': sentinel.password,
+                              'host': str(sentinel.host),
+                              'vhost': sentinel.vhost,
+                              'port': 2111 }
+
+        cm = Mock()
+        def select_connection(params, cb):
+            cb(cm)
+            return sentinel.connection
+
+        with patch('pyon.net.messaging.PyonSelectConnection', new=select_connection):
+            node, ilp = make_node(connection_params, name=sentinel.name, pool_size=3)
+
+        self.assertEquals(ilp, sentinel.ioloop_process)
+        gevmock.assert_called_once_with(ioloop_pool, [sentinel.connection] * 3, name=sentinel.name)
+        self.assertEquals(node.client, cm)
+        self.assertEquals(node._clients, [cm, cm])
+        self.assertEquals(node._pool_slots, {1: cm, 2: cm})
+        self.assertEquals(node._pool_size, 3)
+
+    def test_ioloop_pool(self):
+        cmock1 = Mock()
+        cmock2 = Mock()
+        ev = event.Event()
+        cmock2.ioloop.start.side_effect = ev.wait
+
+        gl = spawn(ioloop_pool, [cmock1, cmock2])
+        gl.join(timeout=5)
+
+        # first ioloop ending ends the pool and kills the other
+        self.assertTrue(gl.ready())
+        self.assertEquals(cmock1.ioloop.start.call_count, 1)
+
 @attr('UNIT')
 class TestPyonSelectConnection(PyonTestCase):
 
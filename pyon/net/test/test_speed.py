@@ -5,8 +5,13 @@ __author__ = 'Dave Foster <dfoster@asascience.com>'
 __license__ = 'Apache 2.0'
 
 from pyon.util.int_test import IonIntegrationTestCase
-from interface.services.examples.hello.ihello_service import HelloServiceClient
+from pyon.util.unit_test import PyonTestCase
+from pyon.net.transport import LocalRouter
+from pyon.core.bootstrap import get_sys_name
+from interface.services.examples.hello.ihello_service import HelloServiceClient, HelloServiceProcessClient
 from nose.plugins.attrib import attr
+from mock import patch
+import gevent
 import time
 import sys
 from pyon.util.async import spawn
@@ -48,6 +53,53 @@ class TestMessagingSpeed(IonIntegrationTestCase):
 
         print >>sys.stderr, "Requests per second (RPC):", mps, "(", self.counter, "messages in", diff, "seconds)"
 
+    def _rpc_concurrent(self, multiplex, count=1000):
+        """
+        Makes count concurrent RPC calls from one process, returns (seconds, channels opened, latencies, failures).
+        """
+        pid = self.container.spawn_process('rpc_bench_%s' % ('mux' if multiplex else 'pooled'), 'pyon.ion.process', 'SimpleProcess')
+        proc = self.container.proc_manager.procs[pid]
+        hsc = HelloServiceProcessClient(process=proc, multiplex=multiplex)
+
+        node = self.container.node
+        opened = []
+        orig_new_channel = node._new_channel
+        def counting_new_channel(ch_type, *args, **kwargs):
+            opened.append(ch_type)
+            return orig_new_channel(ch_type, *args, **kwargs)
+
+        latencies = []
+        def call():
+            t = time.time()
+            hsc.hello('data')
+            latencies.append(time.time() - t)
+
+        with patch.object(node, '_new_channel', counting_new_channel):
+            start_time = time.time()
+            gls = [spawn(call) for x in xrange(count)]
+            gevent.joinall(gls)
+            diff = time.time() - start_time
+
+        self.container.terminate_process(pid)
+
+        return diff, len(opened), sorted(latencies), len([g for g in gls if g.exception is not None])
+
+    def test_rpc_concurrent_speed(self):
+        count = 1000
+        print >>sys.stderr, ""
+
+        for multiplex in (False, True):
+            diff, opened, latencies, failed = self._rpc_concurrent(multiplex, count)
+
+            mode = "multiplexed" if multiplex else "pooled"
+            print >>sys.stderr, "Concurrent RPC (%s):" % mode, float(count) / diff, "requests per second (", count, "requests in", diff, "seconds,", failed, "failed)"
+            print >>sys.stderr, "  channels opened:", opened
+            if latencies:
+                print >>sys.stderr, "  latency avg/p50/p99/max (ms): %.1f / %.1f / %.1f / %.1f" % (sum(latencies) * 1000 / len(latencies),
+                                                                                                   latencies[len(latencies) / 2] * 1000,
+                                                                                                   latencies[int(len(latencies) * 0.99)] * 1000,
+                                                                                                   latencies[-1] * 1000)
+
     def test_pub_speed(self):
         pub = Publisher(node=self.container.node, to_name="i_no_exist")
 
@@ -75,4 +127,46 @@ class TestMessagingSpeed(IonIntegrationTestCase):
         diff = end_time - start_time
         mps = float(self.counter) / diff
 
-        print >>sys.stderr, "Published messages per second:", mps, "(", self.counter, "messages in", diff, "seconds)"
\ No newline at end of file
+        print >>sys.stderr, "Published messages per second:", mps, "(", self.counter, "messages in", diff, "seconds)"
+
+
+@attr('PFM')
+class TestLocalRouterSpeed(PyonTestCase):
+
+    def setUp(self):
+        self.lr = LocalRouter(get_sys_name())
+        self.lr.start()
+        self.addCleanup(self.lr.stop)
+
+    def test_route_speed(self):
+        num_bindings = 1000
+        num_events = 100000
+
+        self.lr.declare_exchange('events')
+
+        # event-like bindings: exact origins, per-type wildcards and a few catch-alls
+        for i in xrange(num_bindings):
+            queue = self.lr.declare_queue('q%s' % i)
+            if i % 100 == 0:
+                binding = '#'
+            elif i % 10 == 0:
+                binding = 'ResourceEvent.type%s.#' % (i % 50)
+            else:
+                binding = '*.*.origin%s' % i
+            self.lr.bind('events', queue, binding)
+
+        print >>sys.stderr, ""
+
+        start_time = time.time()
+
+        for i in xrange(num_events):
+            self.lr.publish('events', 'ResourceEvent.type%s.origin%s' % (i % 50, i % num_bindings), 'body', {})
+
+        # wait until the router has drained its incoming queue
+        while not self.lr._queue_incoming.empty():
+            time.sleep(0.01)
+
+        diff = time.time() - start_time
+        routed = sum(q.qsize() for q in self.lr._queues.itervalues())
+
+        print >>sys.stderr, "Routed events per second (LocalRouter):", float(num_events) / diff, "(", num_events, "events to", routed, "queue deliveries over", num_bindings, "bindings in", diff, "seconds)"
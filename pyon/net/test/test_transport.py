@@ -12,6 +12,7 @@ from pika import BasicProperties
 from nose.plugins.attrib import attr
 from mock import Mock, MagicMock, sentinel, patch, call, ANY
 from gevent.event import Event
+from gevent import spawn
 import time
 
 @attr('UNIT')
@@ -41,6 +42,11 @@ class TestTransport(PyonTestCase):
             ac = bt.active
         self.assertRaises(NotImplementedError, bt.add_on_close_callback, sentinel.callback)
 
+    def test_pipelined_default_is_noop(self):
+        bt = BaseTransport()
+        with bt.pipelined() as tp:
+            self.assertEquals(tp, bt)
+
 @attr('UNIT')
 class TestComposableTransport(PyonTestCase):
     def test_init(self):
@@ -64,7 +70,9 @@ class TestComposableTransport(PyonTestCase):
                                         'stop_consume_impl'    : right.stop_consume_impl,
                                         'get_stats_impl'       : right.get_stats_impl,
                                         'qos_impl'             : right.qos_impl,
-                                        'publish_impl'         : right.publish_impl, })
+                                        'publish_impl'         : right.publish_impl,
+                                        'publish_many_impl'    : right.publish_many_impl,
+                                        'pipelined'            : left.pipelined, })
 
     def test_overlay(self):
         left = Mock()
@@ -111,6 +119,8 @@ class TestComposableTransport(PyonTestCase):
         ct.purge_impl(sentinel.queue)
         ct.qos_impl()
         ct.publish_impl(sentinel.exchange, sentinel.rkey, sentinel.body, sentinel.props)
+        ct.publish_many_impl(sentinel.exchange, sentinel.messages)
+        ct.pipelined()
 
         left.declare_exchange_impl.assert_called_once_with(sentinel.exchange)
         left.delete_exchange_impl.assert_called_once_with(sentinel.exchange)
@@ -120,14 +130,16 @@ class TestComposableTransport(PyonTestCase):
         left.unbind_impl.assert_called_once_with(sentinel.exchange, sentinel.queue, sentinel.binding)
         left.purge_impl.assert_called_once_with(sentinel.queue)
         left.setup_listener.assert_called_once_with(sentinel.binding, sentinel.callback)
+        left.pipelined.assert_called_once_with()
 
-        right.ack_impl.assert_called_once_with(sentinel.dtag)
+        right.ack_impl.assert_called_once_with(sentinel.dtag, multiple=False)
         right.reject_impl.assert_called_once_with(sentinel.dtag, requeue=False)
         right.start_consume_impl.assert_called_once_with(sentinel.callback, sentinel.queue, no_ack=False, exclusive=False)
         right.stop_consume_impl.assert_called_once_with(sentinel.ctag)
         right.get_stats_impl.assert_called_once_with(sentinel.queue)
         right.qos_impl.assert_called_once_with(prefetch_size=0, prefetch_count=0, global_=False)
         right.publish_impl.assert_called_once_with(sentinel.exchange, sentinel.rkey, sentinel.body, sentinel.props, immediate=False, mandatory=False, durable_msg=False)
+        right.publish_many_impl.assert_called_once_with(sentinel.exchange, sentinel.messages, immediate=False, mandatory=False, durable_msg=False)
 
         # assert non-calls on other side
         self.assertEquals(right.declare_exchange_impl.call_count, 0)
@@ -138,6 +150,7 @@ class TestComposableTransport(PyonTestCase):
         self.assertEquals(right.unbind_impl.call_count, 0)
         self.assertEquals(right.purge_impl.call_count, 0)
         self.assertEquals(right.setup_listener.call_count, 0)
+        self.assertEquals(right.pipelined.call_count, 0)
 
         self.assertEquals(left.ack_impl.call_count, 0)
         self.assertEquals(left.reject_impl.call_count, 0)
@@ -433,7 +446,12 @@ class TestAMQPTransportCommonMethods(PyonTestCase):
     def test_ack_impl(self):
         self.tp.ack_impl(sentinel.dtag)
 
-        self.tp._client.basic_ack.assert_called_once_with(sentinel.dtag)
+        self.tp._client.basic_ack.assert_called_once_with(sentinel.dtag, multiple=False)
+
+    def test_ack_impl_multiple(self):
+        self.tp.ack_impl(sentinel.dtag, multiple=True)
+
+        self.tp._client.basic_ack.assert_called_once_with(sentinel.dtag, multiple=True)
 
     def test_reject_impl(self):
         self.tp.reject_impl(sentinel.dtag)
@@ -527,6 +545,150 @@ class TestAMQPTransportCommonMethods(PyonTestCase):
                                                               immediate=False,
                                                               mandatory=False)
 
+    @patch('pyon.net.transport.BasicProperties')
+    def test_publish_many_impl(self, bpmock):
+        self.tp.publish_many_impl(sentinel.exchange, [(sentinel.rkey1, sentinel.body1, sentinel.props1),
+                                                      (sentinel.rkey2, sentinel.body2, sentinel.props2)])
+
+        self.assertEquals(self.tp._client.basic_publish.call_count, 2)
+        self.tp._client.basic_publish.assert_called_with(exchange=sentinel.exchange,
+                                                         routing_key=sentinel.rkey2,
+                                                         body=sentinel.body2,
+                                                         properties=bpmock(headers=sentinel.props2,
+                                                                           delivery_mode=None),
+                                                         immediate=False,
+                                                         mandatory=False)
+
+@attr('UNIT')
+class TestAMQPTransportPipelined(PyonTestCase):
+
+    def setUp(self):
+        self.tp = AMQPTransport(MagicMock())
+        self.tp._sync_call = Mock()
+
+    def test_pipelined_sends_batch_with_one_fence(self):
+        with self.tp.pipelined():
+            self.tp.declare_exchange_impl('xp')
+            qname = self.tp.declare_queue_impl('xp.q')
+            self.tp.bind_impl('xp', 'xp.q', 'b')
+
+            # nothing sent until the block exits
+            self.assertEquals(self.tp._client.transport.send_method.call_count, 0)
+            self.assertEquals(self.tp._sync_call.call_count, 0)
+
+        # named queue returned without a round trip
+        self.assertEquals(qname, 'xp.q')
+
+        # all but the last sent with nowait
+        self.assertEquals(self.tp._client.transport.send_method.call_count, 2)
+        sent = [c[0][0] for c in self.tp._client.transport.send_method.call_args_list]
+        self.assertEquals([m.NAME for m in sent], ['Exchange.Declare', 'Queue.Declare'])
+        self.assertTrue(all(m.nowait for m in sent))
+        self.assertEquals(sent[0].exchange, 'xp')
+        self.assertEquals(sent[1].queue, 'xp.q')
+
+        # last one is the fence, waited on synchronously
+        self.tp._sync_call.assert_called_once_with(self.tp._client.transport.rpc, 'callback', ANY, acceptable_replies=[ANY])
+        fence = self.tp._sync_call.call_args[0][2]
+        self.assertEquals(fence.NAME, 'Queue.Bind')
+        self.assertFalse(fence.nowait)
+        self.assertEquals(fence.routing_key, 'b')
+        self.assertEquals(self.tp._sync_call.call_args[1]['acceptable_replies'][0].NAME, 'Queue.BindOk')
+
+        self.assertIsNone(self.tp._pipeline)
+
+    def test_pipelined_empty(self):
+        with self.tp.pipelined():
+            pass
+
+        self.assertEquals(self.tp._client.transport.send_method.call_count, 0)
+        self.assertEquals(self.tp._sync_call.call_count, 0)
+
+    def test_pipelined_anon_queue_is_synchronous(self):
+        with self.tp.pipelined():
+            qname = self.tp.declare_queue_impl('')
+
+        self.tp._sync_call.assert_called_once_with(self.tp._client.queue_declare,
+                                                   'callback',
+                                                   queue='',
+                                                   auto_delete=True,
+                                                   durable=False,
+                                                   arguments={})
+        self.assertEquals(qname, self.tp._sync_call.return_value.method.queue)
+
+    def test_pipelined_nested_joins_outer(self):
+        with self.tp.pipelined():
+            self.tp.declare_exchange_impl('xp')
+            with self.tp.pipelined():
+                self.tp.bind_impl('xp', 'xp.q', 'b')
+
+            self.assertEquals(self.tp._sync_call.call_count, 0)
+
+        self.assertEquals(self.tp._client.transport.send_method.call_count, 1)
+        self.assertEquals(self.tp._sync_call.call_count, 1)
+
+    def test_pipelined_is_greenlet_local(self):
+        with self.tp.pipelined():
+            self.tp.declare_exchange_impl('xp')
+
+            # another greenlet on the same transport is not batched
+            gl = spawn(self.tp.bind_impl, 'xp', 'other.q', 'b')
+            gl.join()
+            self.assertEquals(self.tp._sync_call.call_count, 1)
+            self.assertEquals(self.tp._sync_call.call_args[1]['queue'], 'other.q')
+
+        self.assertEquals(self.tp._sync_call.call_count, 2)
+        self.assertEquals(self.tp._sync_call.call_args[0][2].NAME, 'Exchange.Declare')
+        self.assertEquals(self.tp._pipelines, {})
+
+    def test_pipelined_error_in_block_discards(self):
+        def raiser():
+            with self.tp.pipelined():
+                self.tp.declare_exchange_impl('xp')
+                raise StandardError("boom")
+
+        self.assertRaises(StandardError, raiser)
+        self.assertEquals(self.tp._client.transport.send_method.call_count, 0)
+        self.assertEquals(self.tp._sync_call.call_count, 0)
+        self.assertIsNone(self.tp._pipeline)
+
+    def test_sync_call_flushes_pipeline_first(self):
+        tp = AMQPTransport(MagicMock())
+        calls = []
+
+        def async_func(*args, **kwargs):
+            calls.append(args[0].NAME if args else 'unbind')
+            kwargs['callback']()
+
+        tp._client.transport.rpc.side_effect = async_func
+        tp._client.queue_unbind.side_effect = async_func
+
+        with tp.pipelined():
+            tp.declare_exchange_impl('xp')
+            tp.bind_impl('xp', 'xp.q', 'b')
+            tp.unbind_impl('xp', 'xp.q', 'a')
+
+        # exchange declare went nowait, bind was the fence, then the unbind
+        self.assertEquals(tp._client.transport.send_method.call_count, 1)
+        self.assertEquals(calls, ['Queue.Bind', 'unbind'])
+
+    def test_pipelined_fence_error(self):
+        tp = AMQPTransport(MagicMock())
+
+        def async_func(*args, **kwargs):
+            # broker closes the channel due to a failed nowait declare
+            tp._client.add_on_close_callback.call_args[0][0](sentinel.ch, 406, 'PRECONDITION_FAILED')
+
+        tp._client.transport.rpc.side_effect = async_func
+
+        def pipelined():
+            with tp.pipelined():
+                tp.declare_exchange_impl('xp')
+                tp.bind_impl('xp', 'xp.q', 'b')
+
+        self.assertRaises(TransportError, pipelined)
+        tp._client.transport.connection.mark_bad_channel.assert_called_once_with(tp._client.channel_number)
+
 @attr('UNIT')
 class TestNameTrio(PyonTestCase):
     def test_init(self):
@@ -600,6 +762,23 @@ class TestTopicTrie(PyonTestCase):
         self.assertEquals({sentinel.wild},
                           set(self.tt.get_all_matches('a.b.b.b.b.b.b')))
 
+    def test_multiple_hash_wildcards(self):
+        self.tt.add_topic_tree('#.c',       sentinel.leading)
+        self.tt.add_topic_tree('a.#.#.c',   sentinel.double)
+        self.tt.add_topic_tree('#.b.#',     sentinel.around)
+        self.tt.add_topic_tree('a.#.*',     sentinel.star)
+
+        self.assertEquals({sentinel.leading},
+                          set(self.tt.get_all_matches('c')))
+
+        self.assertEquals({sentinel.leading, sentinel.double, sentinel.around, sentinel.star},
+                          set(self.tt.get_all_matches('a.b.c')))
+
+        self.assertEquals({sentinel.leading, sentinel.double, sentinel.star},
+                          set(self.tt.get_all_matches('a.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.c')))
+
+        self.assertEquals(set(), set(self.tt.get_all_matches('x.y')))
+
 @attr('UNIT')
 class TestLocalRouter(PyonTestCase):
 
@@ -749,6 +928,42 @@ class TestLocalRouter(PyonTestCase):
         self.assertEquals(self.lr._queues['ein'].qsize(), 2)
 
 
+    def test_route_cache(self):
+        self.lr.declare_exchange('known')
+        self.lr.declare_queue('q1')
+        self.lr.bind('known', 'q1', 'a.*')
+
+        self.lr.publish('known', 'a.b', 'body', 'props')
+        self.ev.wait(timeout=10)
+        self.ev.clear()
+
+        self.assertEquals(self.lr._route_cache, {('known', 'a.b'): ('q1',)})
+
+        # binding changes invalidate the cache
+        self.lr.declare_queue('q2')
+        self.lr.bind('known', 'q2', '#')
+        self.assertEquals(self.lr._route_cache, {})
+
+        self.lr.publish('known', 'a.b', 'body', 'props')
+        self.ev.wait(timeout=10)
+
+        self.assertEquals(set(self.lr._route_cache[('known', 'a.b')]), {'q1', 'q2'})
+        self.assertEquals(self.lr._queues['q1'].qsize(), 2)
+        self.assertEquals(self.lr._queues['q2'].qsize(), 1)
+
+        self.lr.delete_queue('q2')
+        self.assertEquals(self.lr._route_cache, {})
+
+    def test_publish_many(self):
+        self.lr.declare_exchange('known')
+        self.lr.declare_queue('q1')
+        self.lr.bind('known', 'q1', 'a.*')
+
+        self.lr.publish_many('known', [('a.b', 'body1', {}), ('a.c', 'body2', {}), ('b.c', 'body3', {})])
+        self.ev.wait(timeout=10)
+
+        self.assertEquals(self.lr._queues['q1'].qsize(), 2)
+
     def test__connect_addr(self):
         self.assertEquals(self.lr._connect_addr, "inproc://%s" % get_sys_name())
 
@@ -893,6 +1108,15 @@ class TestLocalRouter(PyonTestCase):
         self.lr.ack(sentinel.dtag)
         self.assertEquals(len(self.lr._unacked), 0)
 
+    def test_ack_multiple(self):
+        self.lr._unacked['zctag-1-0'] = ('zctag-1', None, None)
+        self.lr._unacked['zctag-1-1'] = ('zctag-1', None, None)
+        self.lr._unacked['zctag-1-2'] = ('zctag-1', None, None)
+        self.lr._unacked['zctag-2-0'] = ('zctag-2', None, None)
+
+        self.lr.ack('zctag-1-1', multiple=True)
+        self.assertEquals(sorted(self.lr._unacked.keys()), ['zctag-1-2', 'zctag-2-0'])
+
     def test_reject(self):
         self.lr._unacked[sentinel.dtag] = (None, None, None)
 
@@ -952,6 +1176,7 @@ class TestLocalTransport(PyonTestCase):
         self.lt.bind_impl(sentinel.exchange, sentinel.queue, sentinel.binding)
         self.lt.unbind_impl(sentinel.exchange, sentinel.queue, sentinel.binding)
         self.lt.publish_impl(sentinel.exchange, sentinel.routing_key, sentinel.body, sentinel.properties)
+        self.lt.publish_many_impl(sentinel.exchange, sentinel.messages)
         self.lt.start_consume_impl(sentinel.callback, sentinel.queue)
         self.lt.stop_consume_impl(sentinel.consumer_tag)
         self.lt.ack_impl(sentinel.delivery_tag)
@@ -968,7 +1193,7 @@ class TestLocalTransport(PyonTestCase):
         self.broker.publish.assert_called_once_with(sentinel.exchange, sentinel.routing_key, sentinel.body, sentinel.properties, immediate=False, mandatory=False)
         self.broker.start_consume.assert_called_once_with(sentinel.callback, sentinel.queue, no_ack=False, exclusive=False)
         self.broker.stop_consume.assert_called_once_with(sentinel.consumer_tag)
-        self.broker.ack.assert_called_once_with(sentinel.delivery_tag)
+        self.broker.ack.assert_called_once_with(sentinel.delivery_tag, multiple=False)
         self.broker.reject.assert_called_once_with(sentinel.delivery_tag, requeue=False)
         self.broker.get_stats(sentinel.queue)
         self.broker.purge(sentinel.queue)
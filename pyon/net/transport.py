@@ -14,12 +14,12 @@ from pyon.util.log import log
 from pyon.util.containers import DotDict
 from gevent.event import AsyncResult, Event
 from gevent.queue import Queue
-from gevent import coros, sleep
+from gevent import coros, sleep, getcurrent
 from gevent.timeout import Timeout
 from gevent.pool import Pool
 from contextlib import contextmanager
 import os
-from pika import BasicProperties
+from pika import BasicProperties, spec
 from pyon.util.async import spawn
 from pyon.util.pool import IDPool
 from uuid import uuid4
@@ -49,7 +49,7 @@ class BaseTransport(object):
     def unbind_impl(self, exchange, queue, binding):
         raise NotImplementedError()
 
-    def ack_impl(self, delivery_tag):
+    def ack_impl(self, delivery_tag, multiple=False):
         raise NotImplementedError()
 
     def reject_impl(self, delivery_tag, requeue=False):
@@ -76,6 +76,28 @@ class BaseTransport(object):
     def publish_impl(self, exchange, routing_key, body, properties, immediate=False, mandatory=False, durable_msg=False):
         raise NotImplementedError()
 
+    def publish_many_impl(self, exchange, messages, immediate=False, mandatory=False, durable_msg=False):
+        """
+        Publishes several messages on an exchange.
+
+        By default calls publish_impl for each message. Derived transports may override this to
+        hand all messages to the broker at once.
+
+        @param  messages    A list of 3-tuples of (routing_key, body, properties).
+        """
+        for routing_key, body, properties in messages:
+            self.publish_impl(exchange, routing_key, body, properties, immediate=immediate, mandatory=mandatory, durable_msg=durable_msg)
+
+    @contextmanager
+    def pipelined(self):
+        """
+        Context manager to batch declare/bind operations made inside the block.
+
+        By default every operation is performed immediately, as usual. Derived transports may override
+        this to send the whole batch to the broker and wait on all confirmations together.
+        """
+        yield self
+
     def close(self):
         raise NotImplementedError()
 
@@ -104,6 +126,7 @@ class ComposableTransport(BaseTransport):
         - qos_impl
         - get_stats_impl
         - publish_impl      (solely for publish rates, not needed for identity in protocol)
+        - publish_many_impl
     """
     common_methods = ['ack_impl',
                       'reject_impl',
@@ -111,7 +134,8 @@ class ComposableTransport(BaseTransport):
                       'stop_consume_impl',
                       'qos_impl',
                       'get_stats_impl',
-                      'publish_impl']
+                      'publish_impl',
+                      'publish_many_impl']
 
     def __init__(self, left, right, *methods):
         self._transports = [left]
@@ -132,7 +156,9 @@ class ComposableTransport(BaseTransport):
                           'get_stats_impl'       : left.get_stats_impl,
                           'purge_impl'           : left.purge_impl,
                           'qos_impl'             : left.qos_impl,
-                          'publish_impl'         : left.publish_impl, }
+                          'publish_impl'         : left.publish_impl,
+                          'publish_many_impl'    : left.publish_many_impl,
+                          'pipelined'            : left.pipelined, }
 
         if right is not None:
             self.overlay(right, *methods)
@@ -170,9 +196,9 @@ class ComposableTransport(BaseTransport):
         m = self._methods['unbind_impl']
         return m(exchange, queue, binding)
 
-    def ack_impl(self, delivery_tag):
+    def ack_impl(self, delivery_tag, multiple=False):
         m = self._methods['ack_impl']
-        return m(delivery_tag)
+        return m(delivery_tag, multiple=multiple)
 
     def reject_impl(self, delivery_tag, requeue=False):
         m = self._methods['reject_impl']
@@ -206,6 +232,14 @@ class ComposableTransport(BaseTransport):
         m = self._methods['publish_impl']
         return m(exchange, routing_key, body, properties, immediate=immediate, mandatory=mandatory, durable_msg=durable_msg)
 
+    def publish_many_impl(self, exchange, messages, immediate=False, mandatory=False, durable_msg=False):
+        m = self._methods['publish_many_impl']
+        return m(exchange, messages, immediate=immediate, mandatory=mandatory, durable_msg=durable_msg)
+
+    def pipelined(self):
+        m = self._methods['pipelined']
+        return m()
+
     def close(self):
         for t in self._transports:
             t.close()
@@ -230,6 +264,8 @@ class AMQPTransport(BaseTransport):
     A transport adapter around a Pika channel.
     """
 
+    sync_timeout = 10       # seconds to wait on a synchronous broker reply (or a whole pipelined batch)
+
     def __init__(self, amq_chan):
         """
         Creates an AMQPTransport, bound to an underlying Pika channel.
@@ -240,6 +276,22 @@ class AMQPTransport(BaseTransport):
 
         self._close_callbacks = []
         self.lock = False
+        self._pipelines = {}    # maps greenlet to its list of buffered (method, reply) while in pipelined mode
+
+    @property
+    def _pipeline(self):
+        """
+        The calling greenlet's buffered operations, or None if it is not in pipelined mode.
+        Other greenlets using this transport at the same time are not affected by the pipeline.
+        """
+        return self._pipelines.get(getcurrent(), None)
+
+    @_pipeline.setter
+    def _pipeline(self, value):
+        if value is None:
+            self._pipelines.pop(getcurrent(), None)
+        else:
+            self._pipelines[getcurrent()] = value
 
     def _on_underlying_close(self, code, text):
         if not (code == 0 or code == 200):
@@ -298,7 +350,12 @@ class AMQPTransport(BaseTransport):
     def _sync_call(self, func, cb_arg, *args, **kwargs):
         """
         Functionally similar to the generic blocking_cb but with error support that's Channel specific.
+
+        If in pipelined mode, any buffered operations are sent first, so ordering is preserved.
         """
+        if self._pipeline:
+            self._flush_pipeline()
+
         ar = AsyncResult()
 
         def cb(*args, **kwargs):
@@ -311,7 +368,7 @@ class AMQPTransport(BaseTransport):
         kwargs[cb_arg] = cb
         with self._push_close_cb(eb):
             func(*args, **kwargs)
-            ret_vals = ar.get(timeout=10)
+            ret_vals = ar.get(timeout=self.sync_timeout)
 
         if isinstance(ret_vals, TransportError):
 
@@ -330,6 +387,59 @@ class AMQPTransport(BaseTransport):
             return ret_vals[0]
         return tuple(ret_vals)
 
+    @contextmanager
+    def pipelined(self):
+        """
+        Batches exchange declares, named queue declares and binds made inside the block.
+
+        Instead of one blocking round trip per operation, the batch is sent when the block exits: all
+        but the last operation go out with nowait set, and the last one is sent normally. The broker
+        handles a channel's methods in order, so that single reply confirms the whole batch, and any
+        failure closes the channel, which surfaces here as a TransportError.
+
+        Operations that need a reply (anonymous queue declares, deletes, unbinds) flush the batch
+        and then run synchronously. Nested blocks join the outermost batch. The batch belongs to the
+        calling greenlet, operations of other greenlets on this transport run as usual.
+        """
+        if self._pipeline is not None:
+            yield self
+            return
+
+        self._pipeline = []
+        try:
+            yield self
+            self._flush_pipeline()
+        finally:
+            self._pipeline = None
+
+    def _pipeline_or_call(self, method, reply, func, **kwargs):
+        """
+        Buffers the pika method if in pipelined mode, otherwise calls func synchronously.
+        """
+        if self._pipeline is not None:
+            self._pipeline.append((method, reply))
+            return None
+
+        return self._sync_call(func, 'callback', **kwargs)
+
+    def _flush_pipeline(self):
+        """
+        Sends all buffered operations, waiting on one confirmation for the batch.
+
+        Pika 0.9.5 treats every declare/bind as synchronous regardless of nowait, so the nowait
+        methods are written directly to the channel instead of through its rpc mechanism.
+        """
+        pending, self._pipeline = self._pipeline, []
+        if not pending:
+            return
+
+        for method, _ in pending[:-1]:
+            method.nowait = True
+            self._client.transport.send_method(method)
+
+        method, reply = pending[-1]
+        self._sync_call(self._client.transport.rpc, 'callback', method, acceptable_replies=[reply])
+
     def declare_exchange_impl(self, exchange, exchange_type='topic', durable=False, auto_delete=True):
         #log.debug("AMQPTransport.declare_exchange_impl(%s): %s, T %s, D %s, AD %s", self._client.channel_number, exchange, exchange_type, durable, auto_delete)
         arguments = {}
@@ -338,12 +448,14 @@ class AMQPTransport(BaseTransport):
             testid = os.environ['QUEUE_BLAME']
             arguments.update({'created-by': testid})
 
-        self._sync_call(self._client.exchange_declare, 'callback',
-                                             exchange=exchange,
-                                             type=exchange_type,
-                                             durable=durable,
-                                             auto_delete=auto_delete,
-                                             arguments=arguments)
+        kwargs = dict(exchange=exchange,
+                      type=exchange_type,
+                      durable=durable,
+                      auto_delete=auto_delete,
+                      arguments=arguments)
+
+        self._pipeline_or_call(spec.Exchange.Declare(**kwargs), spec.Exchange.DeclareOk,
+                               self._client.exchange_declare, **kwargs)
 
     def delete_exchange_impl(self, exchange, **kwargs):
         log.debug("AMQPTransport.delete_exchange_impl(%s): %s", self._client.channel_number, exchange)
@@ -357,6 +469,14 @@ class AMQPTransport(BaseTransport):
             testid = os.environ['QUEUE_BLAME']
             arguments.update({'created-by': testid})
 
+        if self._pipeline is not None and queue:
+            # named queue: no need to wait on the broker for the name
+            self._pipeline.append((spec.Queue.Declare(queue=queue,
+                                                      auto_delete=auto_delete,
+                                                      durable=durable,
+                                                      arguments=arguments), spec.Queue.DeclareOk))
+            return queue
+
         frame = self._sync_call(self._client.queue_declare, 'callback',
                                 queue=queue or '',
                                 auto_delete=auto_delete,
@@ -371,10 +491,12 @@ class AMQPTransport(BaseTransport):
 
     def bind_impl(self, exchange, queue, binding):
         #log.debug("AMQPTransport.bind_impl(%s): EX %s, Q %s, B %s", self._client.channel_number, exchange, queue, binding)
-        self._sync_call(self._client.queue_bind, 'callback',
-                                        queue=queue,
-                                        exchange=exchange,
-                                        routing_key=binding)
+        kwargs = dict(queue=queue,
+                      exchange=exchange,
+                      routing_key=binding)
+
+        self._pipeline_or_call(spec.Queue.Bind(**kwargs), spec.Queue.BindOk,
+                               self._client.queue_bind, **kwargs)
 
     def unbind_impl(self, exchange, queue, binding):
         #log.debug("AMQPTransport.unbind_impl(%s): EX %s, Q %s, B %s", self._client.channel_number, exchange, queue, binding)
@@ -382,12 +504,12 @@ class AMQPTransport(BaseTransport):
                                                      exchange=exchange,
                                                      routing_key=binding)
 
-    def ack_impl(self, delivery_tag):
+    def ack_impl(self, delivery_tag, multiple=False):
         """
-        Acks a message.
+        Acks a message, or with multiple all messages up to and including the delivery tag.
         """
         #log.debug("AMQPTransport.ack(%s): %s", self._client.channel_number, delivery_tag)
-        self._client.basic_ack(delivery_tag)
+        self._client.basic_ack(delivery_tag, multiple=multiple)
 
     def reject_impl(self, delivery_tag, requeue=False):
         """
@@ -486,6 +608,26 @@ class AMQPTransport(BaseTransport):
                                    immediate=immediate,     # todo
                                    mandatory=mandatory)     # todo
 
+    def publish_many_impl(self, exchange, messages, immediate=False, mandatory=False, durable_msg=False):
+        """
+        Publishes several messages on an exchange.
+
+        Pika's basic_publish only appends frames to the connection's outbound buffer and does not yield,
+        so all messages are written to the socket together on the next ioloop pass.
+        """
+        delivery_mode = 2 if durable_msg else None
+
+        for routing_key, body, properties in messages:
+            props = BasicProperties(headers=properties,
+                                    delivery_mode=delivery_mode)
+
+            self._client.basic_publish(exchange=exchange,
+                                       routing_key=routing_key,
+                                       body=body,
+                                       properties=props,
+                                       immediate=immediate,
+                                       mandatory=mandatory)
+
 
 class NameTrio(object):
     """
@@ -571,37 +713,42 @@ class TopicTrie(object):
             """
             Given a list of topic tokens, returns all patterns stored in child nodes/self that match the topic tokens.
 
-            This is a depth-first search pruned by token, with special handling for both wildcard types.
+            Advances the set of live nodes one token at a time, so each node is visited at most once per token.
+            A '#' node goes live along with its parent (matching zero tokens) and stays live while consuming
+            any further tokens.
             """
-            results = []
+            live = {id(self): self}
 
-            if len(topics) == 0:
-                # terminal point, return any pattern we have here
-                return self.patterns
+            for token in topics:
+                # '#' children may match zero tokens, so are live alongside their parents
+                pending = live.values()
+                while pending:
+                    wild = pending.pop().children.get('#')
+                    if wild is not None and id(wild) not in live:
+                        live[id(wild)] = wild
+                        pending.append(wild)
 
-            cur_token = topics[0]
-            rem_tokens = topics[1:]     # will always be a list, even if empty or 1-len
-            #log.debug('get_all_matches(%s): cur_token %s, rem_tokens %s', self.token, cur_token, rem_tokens)
+                following = {}
+                for node in live.itervalues():
+                    if node.token == '#':
+                        following[id(node)] = node
 
-            # child node direct matching
-            if cur_token in self.children:
-                results.extend(self.children[cur_token].get_all_matches(rem_tokens))
+                    child = node.children.get(token)
+                    if child is not None:
+                        following[id(child)] = child
 
-            # now '*' wildcard
-            if '*' in self.children:
-                results.extend(self.children['*'].get_all_matches(rem_tokens))
+                    child = node.children.get('*')
+                    if child is not None:
+                        following[id(child)] = child
 
-            # '#' means any number of tokens - naive method of descent, we'll feed it nothing to start. Then chop the full
-            # topics all the way down, put the results in a set to remove duplicates, and also any patterns on self.
-            if '#' in self.children:
-                # keep popping off and descend, make a set out of results
-                all_wild_childs = set()
-                for i in xrange(len(topics)):
-                    res = self.children['#'].get_all_matches(topics[i:])
-                    map(all_wild_childs.add, res)
+                if not following:
+                    return []
 
-                results.extend(all_wild_childs)
-                results.extend(self.children['#'].patterns)     # any patterns defined in # are legal too
+                live = following
+
+            results = []
+            for node in live.itervalues():
+                results.extend(node.patterns)
 
             return results
 
@@ -667,6 +814,10 @@ class LocalRouter(object):
         """
         pass
 
+    route_cache_size    = 10000     # max number of cached routes before the cache is reset
+    route_batch_size    = 100       # max number of messages routed before yielding to consumers
+    publish_batch_size  = 100       # number of publishes after which a publisher yields to the router
+
     def __init__(self, sysname):
         self._sysname = sysname
         self.ready = Event()
@@ -675,7 +826,8 @@ class LocalRouter(object):
         self._exchanges = {}                            # names -> { subscriber, topictrie(queue name) }
         self._queues = {}                               # names -> gevent queue
         self._bindings_by_queue = defaultdict(list)     # queue name -> [(ex, binding)]
-        self._lock_declarables = coros.RLock()          # exchanges, queues, bindings, routing method
+        self._lock_declarables = coros.RLock()          # exchanges, queues, bindings
+        self._route_cache = {}                          # (ex, routing key) -> tuple of queue names
 
         # consumers
         self._consumers = defaultdict(list)             # queue name -> [ctag, channel._on_deliver]
@@ -690,6 +842,7 @@ class LocalRouter(object):
         self._gl_msgs = None
         self._gl_pool = Pool()
         self.gl_ioloop = None
+        self._publish_count = 0
 
         self.errors = []
 
@@ -716,23 +869,37 @@ class LocalRouter(object):
     def _run_gl_msgs(self):
         self.ready.set()
         while True:
-            ex, rkey, body, props = self._queue_incoming.get()
-            try:
-                with self._lock_declarables:
+            msgs = [self._queue_incoming.get()]
+
+            # take whatever else is waiting, route the batch, then yield once to let consumers run
+            while len(msgs) < self.route_batch_size and not self._queue_incoming.empty():
+                msgs.append(self._queue_incoming.get_nowait())
+
+            for ex, rkey, body, props in msgs:
+                try:
                     self._route(ex, rkey, body, props)
-            except Exception as e:
-                self.errors.append(e)
-                log.exception("Routing message")
+                except Exception as e:
+                    self.errors.append(e)
+                    log.exception("Routing message")
+
+            sleep(0)
 
     def _route(self, exchange, routing_key, body, props):
         """
         Delivers incoming messages into queues based on known routes.
 
-        This entire method runs in a lock (likely pretty slow).
+        Matched queues are cached per (exchange, routing key). No lock is taken: this method never
+        yields, and every change to exchanges, queues or bindings invalidates the cache.
         """
-        assert exchange in self._exchanges, "Unknown exchange %s" % exchange
+        queues = self._route_cache.get((exchange, routing_key), None)
+        if queues is None:
+            assert exchange in self._exchanges, "Unknown exchange %s" % exchange
+
+            queues = tuple(self._exchanges[exchange].get_all_matches(routing_key))
+            if len(self._route_cache) >= self.route_cache_size:
+                self._route_cache.clear()
+            self._route_cache[(exchange, routing_key)] = queues
 
-        queues = self._exchanges[exchange].get_all_matches(routing_key)
         log.debug("route: ex %s, rkey %s,  matched %s routes", exchange, routing_key, len(queues))
 
         # deliver to each queue
@@ -762,7 +929,30 @@ class LocalRouter(object):
 
     def publish(self, exchange, routing_key, body, properties, immediate=False, mandatory=False):
         self._queue_incoming.put((exchange, routing_key, body, properties))
-        sleep(0.0001)      # really wish switch would work instead of a sleep, seems wrong
+
+        # yield to the router once per batch rather than once per message
+        self._publish_count += 1
+        if self._publish_count >= self.publish_batch_size:
+            self._publish_count = 0
+            sleep(0)
+
+    def publish_many(self, exchange, messages, immediate=False, mandatory=False):
+        """
+        Queues several messages for routing and yields to the router once.
+
+        @param  messages    A list of 3-tuples of (routing_key, body, properties).
+        """
+        for routing_key, body, properties in messages:
+            self._queue_incoming.put((exchange, routing_key, body, properties))
+
+        self._publish_count = 0
+        sleep(0)
+
+    def _invalidate_routes(self):
+        """
+        Drops all cached routes. Must be called after any change to exchanges, queues or bindings.
+        """
+        self._route_cache.clear()
 
     def declare_exchange(self, exchange, **kwargs):
         with self._lock_declarables:
@@ -773,6 +963,7 @@ class LocalRouter(object):
         with self._lock_declarables:
             if exchange in self._exchanges:
                 del self._exchanges[exchange]
+                self._invalidate_routes()
 
     def declare_queue(self, queue, **kwargs):
 
@@ -801,6 +992,7 @@ class LocalRouter(object):
                         self._exchanges[ex].remove_topic_tree(binding, queue)
 
                 self._bindings_by_queue.pop(queue)
+                self._invalidate_routes()
 
     def bind(self, exchange, queue, binding):
         log.info("Bind: ex %s, q %s, b %s", exchange, queue, binding)
@@ -812,6 +1004,7 @@ class LocalRouter(object):
 
             tt.add_topic_tree(binding, queue)
             self._bindings_by_queue[queue].append((exchange, binding))
+            self._invalidate_routes()
 
     def unbind(self, exchange, queue, binding):
         with self._lock_declarables:
@@ -825,6 +1018,8 @@ class LocalRouter(object):
                     self._bindings_by_queue[queue].pop(i)
                     break
 
+            self._invalidate_routes()
+
     def start_consume(self, callback, queue, no_ack=False, exclusive=False):
         assert queue in self._queues
 
@@ -911,12 +1106,19 @@ class LocalRouter(object):
         """
         return "%s-%s" % (ctag, cnt)
 
-    def ack(self, delivery_tag):
+    def ack(self, delivery_tag, multiple=False):
         assert delivery_tag in self._unacked
 
         with self._lock_unacked:
             del self._unacked[delivery_tag]
 
+            if multiple:
+                # ack all earlier deliveries to the same consumer
+                ctag, cnt = delivery_tag.rsplit("-", 1)
+                cnt = int(cnt)
+                for dtag in [dt for dt, val in self._unacked.iteritems() if val[0] == ctag and int(dt.rsplit("-", 1)[1]) < cnt]:
+                    del self._unacked[dtag]
+
     def reject(self, delivery_tag, requeue=False):
         assert delivery_tag in self._unacked
 
@@ -987,14 +1189,17 @@ class LocalTransport(BaseTransport):
     def publish_impl(self, exchange, routing_key, body, properties, immediate=False, mandatory=False, durable_msg=False):
         self._broker.publish(exchange, routing_key, body, properties, immediate=immediate, mandatory=mandatory)
 
+    def publish_many_impl(self, exchange, messages, immediate=False, mandatory=False, durable_msg=False):
+        self._broker.publish_many(exchange, messages, immediate=immediate, mandatory=mandatory)
+
     def start_consume_impl(self, callback, queue, no_ack=False, exclusive=False):
         return self._broker.start_consume(callback, queue, no_ack=no_ack, exclusive=exclusive)
 
     def stop_consume_impl(self, consumer_tag):
         self._broker.stop_consume(consumer_tag)
 
-    def ack_impl(self, delivery_tag):
-        self._broker.ack(delivery_tag)
+    def ack_impl(self, delivery_tag, multiple=False):
+        self._broker.ack(delivery_tag, multiple=multiple)
 
     def reject_impl(self, delivery_tag, requeue=False):
         self._broker.reject(delivery_tag, requeue=requeue)
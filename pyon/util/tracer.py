@@ -23,6 +23,9 @@ DEFAULT_CONFIG = {"enabled": True,
                   "log_color": False,
                   "log_stack": False,
                   "log_truncate": 2000,
+                  "db_stats": True,           # Aggregate Postgres statement counters per template
+                  "db_sample_rate": 1,        # Trace 1 in N Postgres statements (0 for none)
+                  "db_slow_threshold": None,  # Always trace Postgres statements slower than this (sec)
                   }
 
 # Global trace log data